@@ -12,9 +12,17 @@ __version__ = "1.0.0"
 __author__ = "LiteDesk Contributors"
 __license__ = "MIT"
 
-from .screen_capture import ScreenCapture
-from .input_control import InputController
-from .network import NetworkServer, NetworkClient
+import importlib
+
+# Public names and the modules defining them. A module, with its heavy
+# dependencies (mss, pynput, PIL), is imported the first time one of its
+# names is used, so importing the package itself costs next to nothing.
+_LAZY_ATTRS = {
+    'ScreenCapture': 'screen_capture',
+    'InputController': 'input_control',
+    'NetworkServer': 'network',
+    'NetworkClient': 'network',
+}
 
 __all__ = [
     'ScreenCapture',
@@ -22,3 +30,16 @@ __all__ = [
     'NetworkServer',
     'NetworkClient',
 ]
+
+
+def __getattr__(name):
+    module_name = _LAZY_ATTRS.get(name)
+    if module_name is None:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(importlib.import_module(f'.{module_name}', __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
@@ -0,0 +1,365 @@
+#!/usr/bin/env python3
+"""
+LiteDesk - Microbenchmarks
+
+Times the hot paths of the protocol and the codecs in isolation: socket
+reads (_recv_exact), header packing, JSON command encoding and decoding,
+JPEG encoding and decoding at several qualities and resolutions, and the
+client's update_frame conversion to a Qt pixmap. Results can be saved as a
+baseline and later runs checked against it, so a change that slows one of
+them down fails instead of going unnoticed.
+
+Socket reads go through an in-memory socket handing out at most
+RECV_CHUNK bytes per recv(), like the kernel does, so they time the
+reassembly in Python rather than the loopback device. Baselines are only
+comparable on the machine that recorded them: save one before a change,
+check after it.
+
+Usage:
+    python bench_micro.py                    # run every benchmark
+    python bench_micro.py 'jpeg_*'           # run some of them
+    python bench_micro.py --save             # record the baseline
+    python bench_micro.py --check            # exit 1 on a regression
+"""
+import argparse
+import fnmatch
+import importlib.util
+import json
+import os
+import statistics
+import struct
+import sys
+import timeit
+from collections import namedtuple
+
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# Where --save writes and --check reads the baseline
+BASELINE_PATH = os.path.join(HERE, 'bench_baseline.json')
+
+# Slowdown (as a fraction of the baseline) --check tolerates
+DEFAULT_TOLERANCE = 0.25
+
+# Wider margins for benchmarks that vary more from run to run
+TOLERANCES = {
+    'update_frame_*': 0.5,
+}
+
+# Timed repeats per benchmark; the fastest counts
+REPEATS = 5
+
+# Largest recv() result of the in-memory socket
+RECV_CHUNK = 64 * 1024
+
+# Qualities and screen sizes the JPEG benchmarks cover
+JPEG_QUALITIES = (30, 50, 80)
+RESOLUTIONS = ((1280, 720), (1920, 1080))
+
+SAMPLE_COMMAND = {'x': 1234, 'y': 567}
+
+# The QApplication of the update_frame benchmarks (created once, kept alive)
+_qt_app = None
+
+
+class Benchmark(namedtuple('Benchmark', 'name setup requires')):
+    """
+    One benchmark
+    
+    setup() prepares the inputs and returns (func, nbytes): func is the
+    call that is timed, nbytes the bytes it processes (None if that says
+    nothing useful). requires names modules it cannot run without.
+    """
+    __slots__ = ()
+
+
+class ReplaySocket:
+    """In-memory socket whose recv() returns the same stream over and over"""
+    
+    def __init__(self, data, chunk=RECV_CHUNK):
+        self.data = data
+        self.chunk = chunk
+        self.offset = 0
+    
+    def recv(self, size):
+        if self.offset == len(self.data):
+            self.offset = 0
+        end = min(self.offset + size, self.offset + self.chunk, len(self.data))
+        data = self.data[self.offset:end]
+        self.offset = end
+        return data
+    
+    def sendall(self, data):
+        pass
+
+
+def synthetic_screen(size):
+    """Desktop-like image: a gradient background, a sidebar and text"""
+    from PIL import Image, ImageDraw
+    
+    width, height = size
+    img = Image.linear_gradient('L').resize(size).convert('RGB')
+    draw = ImageDraw.Draw(img)
+    draw.rectangle((0, 0, 200, height), fill=(60, 60, 90))
+    draw.rectangle((0, height - 30, width, height), fill=(0, 90, 160))
+    for row in range(height // 16):
+        draw.text((220, 4 + row * 16), f"{row:4d}  value={row * row % 997} " * 4,
+                  fill=(20, 20, 20))
+    return img
+
+
+def recv_exact_benchmark(size):
+    """_recv_exact of one message of size bytes"""
+    def setup():
+        from network import NetworkClient
+        client = NetworkClient()
+        client.socket = ReplaySocket(bytes(size))
+        return (lambda: client._recv_exact(size)), size
+    return Benchmark(f'recv_exact_{size}', setup, ())
+
+
+def header_pack_setup():
+    return (lambda: struct.pack('!III', 1920, 1080, 123456)), 12
+
+
+def header_unpack_setup():
+    header = struct.pack('!III', 1920, 1080, 123456)
+    return (lambda: struct.unpack('!III', header)), 12
+
+
+def tiles_header_setup():
+    from network import TILES_HEADER
+    return (lambda: TILES_HEADER.pack(1920, 1080, 64, 16, 1, 120)), TILES_HEADER.size
+
+
+def command_encode_setup():
+    """NetworkClient.send_command down to a socket that drops the bytes"""
+    from network import NetworkClient
+    client = NetworkClient()
+    client.socket = ReplaySocket(b'')
+    client.connected = True
+    size = len(json.dumps({'type': 'mouse_move', 'data': SAMPLE_COMMAND})) + 4
+    return (lambda: client.send_command('mouse_move', SAMPLE_COMMAND)), size
+
+
+def command_decode_setup():
+    """NetworkServer._read_command of a length-prefixed command"""
+    from network import NetworkServer
+    cmd = json.dumps({'type': 'mouse_move', 'data': SAMPLE_COMMAND}).encode('utf-8')
+    server = NetworkServer(host='127.0.0.1', port=0)
+    server.client_socket = ReplaySocket(struct.pack('!I', len(cmd)) + cmd)
+    return server._read_command, len(cmd) + 4
+
+
+def jpeg_encode_benchmark(size, quality):
+    """ScreenCapture.encode of a full frame"""
+    def setup():
+        from types import SimpleNamespace
+        from screen_capture import ScreenCapture
+        img = synthetic_screen(size)
+        # encode() only reads these two attributes; no monitor is opened
+        capture = SimpleNamespace(quality=quality, color_mode='color')
+        return (lambda: ScreenCapture.encode(capture, img)), size[0] * size[1] * 3
+    return Benchmark(f'jpeg_encode_{size[0]}x{size[1]}_q{quality}', setup, ('mss', 'PIL'))
+
+
+def jpeg_decode_benchmark(size, quality):
+    """decode_jpeg of a full frame, pixels included"""
+    def setup():
+        from io import BytesIO
+        from network import decode_jpeg
+        buffer = BytesIO()
+        synthetic_screen(size).save(buffer, format='JPEG', quality=quality, subsampling=2)
+        data = buffer.getvalue()
+        # Image.open() is lazy: load() does the decoding
+        return (lambda: decode_jpeg(data).load()), size[0] * size[1] * 3
+    return Benchmark(f'jpeg_decode_{size[0]}x{size[1]}_q{quality}', setup, ('PIL',))
+
+
+def update_frame_benchmark(size):
+    """RemoteDesktopWidget.update_frame: PIL image to scaled Qt pixmap"""
+    def setup():
+        global _qt_app
+        os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+        from PyQt5.QtWidgets import QApplication
+        from client import RemoteDesktopWidget
+        _qt_app = QApplication.instance() or QApplication([])
+        widget = RemoteDesktopWidget()
+        widget.resize(1280, 720)
+        img = synthetic_screen(size)
+        return (lambda: widget.update_frame(img)), size[0] * size[1] * 3
+    return Benchmark(f'update_frame_{size[0]}x{size[1]}', setup, ('PyQt5', 'PIL'))
+
+
+def all_benchmarks():
+    """Every benchmark, in report order"""
+    benchmarks = [recv_exact_benchmark(size) for size in (4, 64 * 1024, 1024 * 1024)]
+    benchmarks += [
+        Benchmark('header_pack', header_pack_setup, ()),
+        Benchmark('header_unpack', header_unpack_setup, ()),
+        Benchmark('tiles_header_pack', tiles_header_setup, ()),
+        Benchmark('command_encode', command_encode_setup, ()),
+        Benchmark('command_decode', command_decode_setup, ()),
+    ]
+    for size in RESOLUTIONS:
+        benchmarks += [jpeg_encode_benchmark(size, quality) for quality in JPEG_QUALITIES]
+        benchmarks += [jpeg_decode_benchmark(size, quality) for quality in JPEG_QUALITIES]
+    benchmarks += [update_frame_benchmark(size) for size in RESOLUTIONS]
+    return benchmarks
+
+
+def select(benchmarks, patterns):
+    """Benchmarks whose names match any of some shell-style patterns"""
+    if not patterns:
+        return benchmarks
+    return [bench for bench in benchmarks
+            if any(fnmatch.fnmatch(bench.name, pattern) for pattern in patterns)]
+
+
+def missing_modules(bench):
+    """Modules a benchmark requires that are not installed"""
+    return [name for name in bench.requires if importlib.util.find_spec(name) is None]
+
+
+def measure(bench, repeats=REPEATS, number=None):
+    """
+    Time one benchmark
+    
+    Args:
+        bench: Benchmark to run
+        repeats: Timed repeats; the fastest counts
+        number: Calls per repeat (default: enough for about 0.2 s)
+    
+    Returns:
+        dict: 'us' (microseconds per call, fastest repeat), 'median_us',
+        'number' and, when the benchmark processes bytes, 'mb_s'
+    """
+    func, nbytes = bench.setup()
+    timer = timeit.Timer(func)
+    if number is None:
+        number = timer.autorange()[0]
+    timings = [seconds / number for seconds in timer.repeat(repeats, number)]
+    best = min(timings)
+    result = {
+        'us': round(best * 1e6, 3),
+        'median_us': round(statistics.median(timings) * 1e6, 3),
+        'number': number,
+    }
+    if nbytes:
+        result['mb_s'] = round(nbytes / best / 1e6, 1) if best else None
+    return result
+
+
+def tolerance_for(name, default=DEFAULT_TOLERANCE):
+    """Slowdown tolerated for a benchmark"""
+    for pattern, tolerance in TOLERANCES.items():
+        if fnmatch.fnmatch(name, pattern):
+            return tolerance
+    return default
+
+
+def check(results, baseline, tolerance=DEFAULT_TOLERANCE):
+    """
+    Compare results with a baseline
+    
+    Args:
+        results: Benchmark name -> measure() result
+        baseline: Benchmark name -> measure() result of the baseline run
+        tolerance: Slowdown tolerated, as a fraction of the baseline, for
+            benchmarks without their own entry in TOLERANCES
+    
+    Returns:
+        list: Regressions found (empty when every benchmark is within
+        tolerance; benchmarks missing from the baseline are not checked)
+    """
+    problems = []
+    for name, result in results.items():
+        before = baseline.get(name)
+        if not before:
+            continue
+        allowed = tolerance_for(name, tolerance)
+        if result['us'] > before['us'] * (1 + allowed):
+            problems.append(f"{name}: {result['us']:.3f} us, baseline {before['us']:.3f} us "
+                            f"({(result['us'] / before['us'] - 1) * 100:+.0f}%, "
+                            f"tolerance {allowed * 100:.0f}%)")
+    return problems
+
+
+def report(name, result, baseline=None):
+    """Print one benchmark's result, against the baseline when there is one"""
+    line = f"{name:<32} {result['us']:>12.3f} us  (median {result['median_us']:.3f})"
+    if 'mb_s' in result:
+        line += f"  {result['mb_s']:>9.1f} MB/s"
+    before = (baseline or {}).get(name)
+    if before:
+        line += f"  {(result['us'] / before['us'] - 1) * 100:+6.1f}% vs baseline"
+    print(line)
+
+
+def load_baseline(path):
+    """Read a saved baseline (benchmark name -> result)"""
+    with open(path) as f:
+        return json.load(f)['results']
+
+
+def save_baseline(path, results):
+    """Write results as the baseline, merged into an existing one"""
+    merged = {}
+    if os.path.exists(path):
+        merged = load_baseline(path)
+    merged.update(results)
+    with open(path, 'w') as f:
+        json.dump({'python': sys.version.split()[0], 'results': merged}, f, indent=2,
+                  sort_keys=True)
+
+
+def main():
+    """Main entry point"""
+    parser = argparse.ArgumentParser(description='LiteDesk microbenchmarks')
+    parser.add_argument('patterns', nargs='*',
+                        help="Benchmarks to run, shell-style patterns (default: all)")
+    parser.add_argument('--repeats', type=int, default=REPEATS, help='Timed repeats per benchmark')
+    parser.add_argument('--baseline', default=BASELINE_PATH, help='Baseline file')
+    parser.add_argument('--save', action='store_true', help='Save the results as the baseline')
+    parser.add_argument('--check', action='store_true',
+                        help='Exit 1 if a benchmark is slower than the baseline allows')
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE,
+                        help='Slowdown tolerated by --check, as a fraction (default 0.25)')
+    parser.add_argument('--list', action='store_true', help='List the benchmarks and exit')
+    args = parser.parse_args()
+    
+    benchmarks = select(all_benchmarks(), args.patterns)
+    if args.list:
+        for bench in benchmarks:
+            print(bench.name)
+        return
+    
+    baseline = None
+    if os.path.exists(args.baseline):
+        baseline = load_baseline(args.baseline)
+    elif args.check:
+        parser.error(f"no baseline at {args.baseline}; record one with --save first")
+    
+    results = {}
+    for bench in benchmarks:
+        missing = missing_modules(bench)
+        if missing:
+            print(f"{bench.name:<32} skipped, needs {', '.join(missing)}")
+            continue
+        results[bench.name] = measure(bench, args.repeats)
+        report(bench.name, results[bench.name], baseline)
+    
+    if args.save:
+        save_baseline(args.baseline, results)
+        print(f"Baseline saved to {args.baseline}")
+    
+    if args.check:
+        problems = check(results, baseline, args.tolerance)
+        if problems:
+            print('\n'.join(problems))
+            sys.exit(1)
+        print("No regressions")
+
+
+if __name__ == '__main__':
+    main()
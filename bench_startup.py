@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+"""
+LiteDesk - Startup Benchmark
+
+Measures how long the entry points take to import, using
+`python -X importtime` in a fresh interpreter for each run, and lists the
+imports that cost the most. Heavy dependencies (PIL, mss, pynput, PyAV,
+the relay client, the profilers) should only load when first used; this shows
+when one creeps back onto the startup path.
+
+Usage:
+    python bench_startup.py                  # report every entry point
+    python bench_startup.py network client   # report some of them
+    python bench_startup.py --check          # exit 1 if over BUDGETS_MS
+"""
+import argparse
+import os
+import subprocess
+import sys
+
+
+# Import budgets (milliseconds, best of the runs) enforced by --check and
+# the test suite. They leave headroom for slow machines; a heavy import
+# landing on the startup path blows through them.
+BUDGETS_MS = {
+    'network': 60,
+    'daemon': 80,
+    'client': 250,
+    'server': 250,
+}
+
+# Modules that must not be loaded just by importing an entry point
+DEFERRED = {
+    'network': ('PIL.Image', 'relay_client', 'cProfile', 'tracemalloc', 'av'),
+    'daemon': ('PIL.Image', 'mss', 'pynput', 'PyQt5', 'av'),
+    'client': ('PIL.Image', 'relay_client', 'mss', 'pynput', 'av'),
+    'server': ('PIL.Image', 'mss', 'pynput', 'av'),
+}
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def parse_importtime(output):
+    """
+    Parse the report printed by -X importtime
+    
+    Args:
+        output: stderr of the interpreter
+    
+    Returns:
+        dict: Module name -> cumulative import time in microseconds
+    """
+    modules = {}
+    for line in output.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        fields = line[len('import time:'):].split('|')
+        if len(fields) != 3 or not fields[1].strip().isdigit():
+            continue  # column header
+        modules[fields[2].strip()] = int(fields[1])
+    return modules
+
+
+def measure(module, runs=3):
+    """
+    Import a module in fresh interpreters
+    
+    Args:
+        module: Module to import
+        runs: Interpreters to start; the fastest one is kept
+    
+    Returns:
+        dict: 'ms' (import time of the fastest run) and 'modules'
+        (name -> cumulative microseconds in that run)
+    """
+    best = None
+    for _ in range(runs):
+        result = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+            cwd=HERE, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+            universal_newlines=True
+        )
+        if result.returncode != 0:
+            raise RuntimeError(f"import {module} failed:\n{result.stderr[-2000:]}")
+        modules = parse_importtime(result.stderr)
+        if module not in modules:
+            raise RuntimeError(f"no importtime report for {module}")
+        if best is None or modules[module] < best[module]:
+            best = modules
+    return {'ms': best[module] / 1000, 'modules': best}
+
+
+def report(module, result, top=10):
+    """Print the import time of a module and its most expensive imports"""
+    budget = BUDGETS_MS.get(module)
+    verdict = ''
+    if budget:
+        verdict = f" (budget {budget} ms{', OVER' if result['ms'] > budget else ''})"
+    print(f"{module}: {result['ms']:.1f} ms{verdict}")
+    costly = sorted(((us, name) for name, us in result['modules'].items() if name != module),
+                    reverse=True)[:top]
+    for us, name in costly:
+        print(f"    {us / 1000:7.1f} ms  {name}")
+    loaded = [name for name in DEFERRED.get(module, ()) if name in result['modules']]
+    if loaded:
+        print(f"    loaded at startup, should be deferred: {', '.join(loaded)}")
+
+
+def check(module, result):
+    """
+    Compare a measurement with the budget
+    
+    Returns:
+        list: Problems found (empty when within budget)
+    """
+    problems = []
+    budget = BUDGETS_MS.get(module)
+    if budget and result['ms'] > budget:
+        problems.append(f"{module} imports in {result['ms']:.1f} ms, budget {budget} ms")
+    for name in DEFERRED.get(module, ()):
+        if name in result['modules']:
+            problems.append(f"{module} loads {name} at startup")
+    return problems
+
+
+def main():
+    """Main entry point"""
+    parser = argparse.ArgumentParser(description='LiteDesk startup benchmark')
+    parser.add_argument('modules', nargs='*', default=list(BUDGETS_MS),
+                        help='Entry points to measure (default: all)')
+    parser.add_argument('--runs', type=int, default=3, help='Fresh interpreters per module')
+    parser.add_argument('--check', action='store_true', help='Exit 1 if a budget is exceeded')
+    args = parser.parse_args()
+    
+    problems = []
+    for module in args.modules:
+        result = measure(module, args.runs)
+        report(module, result)
+        problems.extend(check(module, result))
+    
+    if problems:
+        print('\n'.join(problems))
+        if args.check:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -4,22 +4,38 @@ LiteDesk Client - Connect to Remote Desktop
 
 Run this on the machine you want to control from.
 """
+import os
 import sys
+import time
 import threading
 from PyQt5.QtWidgets import (QApplication, QMainWindow, QWidget, QVBoxLayout, 
                             QHBoxLayout, QLabel, QPushButton, QLineEdit, 
-                            QMessageBox, QCheckBox, QComboBox)
+                            QMessageBox, QCheckBox, QComboBox, QFileDialog,
+                            QInputDialog)
 from PyQt5.QtCore import Qt, pyqtSignal, QObject
 from PyQt5.QtGui import QFont, QPixmap, QImage, QPainter
-from network import NetworkClient, NetworkClientWithRelay
+from network import NetworkClient, NetworkClientWithRelay, DEFAULT_COLOR_MODE
 from platform_utils import get_platform, show_permission_instructions
 
 
+# Colour modes offered in the viewer (see network.COLOR_MODES)
+COLOR_MODE_LABELS = (
+    ("Full color", DEFAULT_COLOR_MODE),
+    ("Sharp text (4:4:4)", 'text'),
+    ("Grayscale", 'gray'),
+    ("256 colors", 'palette256'),
+    ("64 colors", 'palette64'),
+)
+
+
 class ClientSignals(QObject):
     """Signals for client events"""
     connected = pyqtSignal()
     disconnected = pyqtSignal()
+    reconnecting = pyqtSignal()
     frame_received = pyqtSignal(object)  # PIL Image
+    stats_received = pyqtSignal(object)  # dict or None
+    transfer_finished = pyqtSignal(int, str, str)  # transfer id, 'done'|'error', message
     error = pyqtSignal(str)
 
 
@@ -110,7 +126,11 @@ class LiteDeskClient(QMainWindow):
         # Connect signals
         self.signals.connected.connect(self.on_connected)
         self.signals.disconnected.connect(self.on_disconnected)
+        self.signals.reconnecting.connect(self.on_reconnecting)
         self.signals.frame_received.connect(self.on_frame_received)
+        self.signals.stats_received.connect(self.on_stats_received)
+        self.signals.transfer_finished.connect(self.on_transfer_finished)
+        self.transfer_names = {}  # transfer id -> description for the status line
         self.signals.error.connect(self.on_error)
         
         self.init_ui()
@@ -158,6 +178,11 @@ class LiteDeskClient(QMainWindow):
         self.ip_input.setFont(QFont("Arial", 10))
         direct_layout.addWidget(self.ip_input)
         
+        self.udp_checkbox = QCheckBox("Video over UDP")
+        self.udp_checkbox.setFont(QFont("Arial", 10))
+        self.udp_checkbox.setToolTip("Stream frames over UDP with loss recovery (input stays on TCP)")
+        direct_layout.addWidget(self.udp_checkbox)
+        
         main_layout.addWidget(self.direct_panel)
         
         # Relay connection panel
@@ -203,6 +228,39 @@ class LiteDeskClient(QMainWindow):
         self.connect_button.clicked.connect(self.toggle_connection)
         button_layout.addWidget(self.connect_button)
         
+        self.stats_button = QPushButton("Stats")
+        self.stats_button.setFont(QFont("Arial", 10))
+        self.stats_button.setToolTip("Show where the server spends its time per frame")
+        self.stats_button.setEnabled(False)
+        self.stats_button.clicked.connect(self.show_stats)
+        button_layout.addWidget(self.stats_button)
+        
+        self.send_file_button = QPushButton("Send File")
+        self.send_file_button.setFont(QFont("Arial", 10))
+        self.send_file_button.setToolTip("Copy a file into the server's LiteDesk folder")
+        self.send_file_button.setEnabled(False)
+        self.send_file_button.clicked.connect(self.send_file)
+        button_layout.addWidget(self.send_file_button)
+        
+        self.get_file_button = QPushButton("Get File")
+        self.get_file_button.setFont(QFont("Arial", 10))
+        self.get_file_button.setToolTip("Fetch a file from the server's LiteDesk folder")
+        self.get_file_button.setEnabled(False)
+        self.get_file_button.clicked.connect(self.get_file)
+        button_layout.addWidget(self.get_file_button)
+        
+        color_label = QLabel("Colors:")
+        color_label.setFont(QFont("Arial", 10))
+        button_layout.addWidget(color_label)
+        
+        self.color_combo = QComboBox()
+        self.color_combo.setFont(QFont("Arial", 10))
+        self.color_combo.setToolTip("Fewer colors keep the session usable on slow links")
+        for label, mode in COLOR_MODE_LABELS:
+            self.color_combo.addItem(label, mode)
+        self.color_combo.currentIndexChanged.connect(self.on_color_mode_changed)
+        button_layout.addWidget(self.color_combo)
+        
         main_layout.addLayout(button_layout)
         
         # Status label
@@ -215,6 +273,11 @@ class LiteDeskClient(QMainWindow):
         self.desktop_widget = RemoteDesktopWidget()
         main_layout.addWidget(self.desktop_widget)
     
+    def on_color_mode_changed(self, index):
+        """Switch the colour mode of the running session"""
+        if self.client and self.client.connected:
+            self.client.set_color_mode(self.color_combo.itemData(index))
+    
     def on_mode_changed(self, index):
         """Handle connection mode change"""
         if index == 0:  # Direct
@@ -298,6 +361,7 @@ class LiteDeskClient(QMainWindow):
         try:
             # Create client
             self.client = NetworkClient()
+            self.client.color_mode = self.color_combo.currentData()
             self.desktop_widget.set_client(self.client)
             
             # Update UI
@@ -305,15 +369,17 @@ class LiteDeskClient(QMainWindow):
             self.status_label.setStyleSheet("color: orange; padding: 5px;")
             self.connect_button.setEnabled(False)
             self.ip_input.setEnabled(False)
+            self.udp_checkbox.setEnabled(False)
             self.mode_combo.setEnabled(False)
             
             # Connect in background thread
-            threading.Thread(target=self.connect_direct_thread, args=(ip_address,), daemon=True).start()
-            
+            use_udp = self.udp_checkbox.isChecked()
+            threading.Thread(target=self.connect_direct_thread, args=(ip_address, use_udp), daemon=True).start()
+        
         except Exception as e:
             self.signals.error.emit(f"Failed to start client: {str(e)}")
     
-    def connect_direct_thread(self, ip_address):
+    def connect_direct_thread(self, ip_address, use_udp=False):
         """Direct connection thread"""
         try:
             # Connect to server
@@ -321,22 +387,34 @@ class LiteDeskClient(QMainWindow):
                 self.signals.error.emit("Failed to connect to server")
                 return
             
+            if use_udp:
+                self.client.enable_udp()
+            
             self.running = True
             self.signals.connected.emit()
-            
-            # Receive frames loop
-            while self.running and self.client.connected:
-                frame = self.client.receive_frame()
-                if frame:
-                    self.signals.frame_received.emit(frame)
-                else:
-                    break
-            
-            self.signals.disconnected.emit()
-            
+            self.receive_frames()
+        
         except Exception as e:
             self.signals.error.emit(f"Connection error: {str(e)}")
     
+    def receive_frames(self):
+        """Receive frames until disconnected, reconnecting after drops"""
+        while self.running:
+            frame = self.client.receive_frame()
+            if frame:
+                self.signals.frame_received.emit(frame)
+                continue
+            
+            if not self.running:
+                break
+            # Connection dropped: resume the session on a new connection
+            self.signals.reconnecting.emit()
+            if not self.client.reconnect():
+                break
+            self.signals.connected.emit()
+        
+        self.signals.disconnected.emit()
+    
     def connect_via_relay(self, relay_host, target_server):
         """Connect via relay server"""
         try:
@@ -348,6 +426,7 @@ class LiteDeskClient(QMainWindow):
                 relay_port=8877,
                 peer_id=peer_id
             )
+            self.client.color_mode = self.color_combo.currentData()
             self.desktop_widget.set_client(self.client)
             
             # Update UI
@@ -365,7 +444,7 @@ class LiteDeskClient(QMainWindow):
                 args=(target_server,), 
                 daemon=True
             ).start()
-            
+        
         except Exception as e:
             self.signals.error.emit(f"Failed to start relay client: {str(e)}")
     
@@ -379,17 +458,8 @@ class LiteDeskClient(QMainWindow):
             
             self.running = True
             self.signals.connected.emit()
-            
-            # Receive frames loop
-            while self.running and self.client.connected:
-                frame = self.client.receive_frame()
-                if frame:
-                    self.signals.frame_received.emit(frame)
-                else:
-                    break
-            
-            self.signals.disconnected.emit()
-            
+            self.receive_frames()
+        
         except Exception as e:
             self.signals.error.emit(f"Relay connection error: {str(e)}")
     
@@ -405,11 +475,16 @@ class LiteDeskClient(QMainWindow):
         self.status_label.setStyleSheet("color: gray; padding: 5px;")
         self.connect_button.setText("Connect")
         self.connect_button.setEnabled(True)
+        self.stats_button.setEnabled(False)
+        self.send_file_button.setEnabled(False)
+        self.get_file_button.setEnabled(False)
+        self.transfer_names.clear()
         
         # Enable appropriate inputs based on mode
         mode = self.mode_combo.currentIndex()
         if mode == 0:  # Direct
             self.ip_input.setEnabled(True)
+            self.udp_checkbox.setEnabled(True)
         else:  # Relay
             self.relay_input.setEnabled(True)
             self.server_combo.setEnabled(True)
@@ -419,12 +494,91 @@ class LiteDeskClient(QMainWindow):
         self.desktop_widget.setText("Not connected")
         self.desktop_widget.setPixmap(QPixmap())
     
+    def show_stats(self):
+        """Query the server's per-stage timings"""
+        if not (self.client and self.client.connected):
+            return
+        
+        def query():
+            client = self.client
+            if not (client.stats and client.stats.get('enabled')):
+                # Timing is off by default: switch it on and sample a while
+                client.set_profiling(stages=True)
+                time.sleep(2)
+            self.signals.stats_received.emit(client.get_stats())
+        
+        self.stats_button.setEnabled(False)
+        threading.Thread(target=query, daemon=True).start()
+    
+    def on_stats_received(self, stats):
+        """Show the server's per-stage timings"""
+        self.stats_button.setEnabled(self.running)
+        if not stats:
+            QMessageBox.warning(self, "Stats", "The server did not answer")
+            return
+        
+        lines = ["Stage      avg     p95     max  (ms)"]
+        for name, stage in stats.get('stages', {}).items():
+            lines.append(f"{name:<8} {stage['avg_ms']:7.1f} {stage['p95_ms']:7.1f} {stage['max_ms']:7.1f}")
+        box = QMessageBox(self)
+        box.setWindowTitle("Server Stats")
+        box.setText("\n".join(lines))
+        box.setFont(QFont("Courier", 10))
+        box.exec_()
+    
+    def send_file(self):
+        """Upload a file chosen by the user"""
+        if not (self.client and self.client.connected):
+            return
+        path, _ = QFileDialog.getOpenFileName(self, "Send File")
+        if path:
+            self.start_transfer(self.client.upload(path), f"Sending {os.path.basename(path)}")
+    
+    def get_file(self):
+        """Download a file named by the user"""
+        if not (self.client and self.client.connected):
+            return
+        remote, ok = QInputDialog.getText(self, "Get File", "Path in the server's LiteDesk folder:")
+        remote = remote.strip()
+        if not (ok and remote):
+            return
+        path, _ = QFileDialog.getSaveFileName(self, "Save As", os.path.basename(remote))
+        if path:
+            self.start_transfer(self.client.download(remote, path), f"Receiving {remote}")
+    
+    def start_transfer(self, transfer_id, description):
+        """Show a transfer that was just requested"""
+        if transfer_id is None:
+            QMessageBox.warning(self, "File Transfer",
+                                "The transfer could not start (file transfers need Video over UDP off)")
+            return
+        self.transfer_names[transfer_id] = description
+        self.status_label.setText(f"⏳ {description}...")
+    
+    def on_transfer_finished(self, transfer_id, event, message):
+        """Report a finished or failed transfer"""
+        description = self.transfer_names.pop(transfer_id, "File transfer")
+        if event == 'done':
+            self.status_label.setText(f"✓ {description}: done")
+        else:
+            QMessageBox.warning(self, "File Transfer", f"{description} failed: {message}")
+    
     def on_connected(self):
         """Handle successful connection"""
         self.status_label.setText("✓ Connected - Receiving desktop...")
         self.status_label.setStyleSheet("color: green; padding: 5px;")
         self.connect_button.setText("Disconnect")
         self.connect_button.setEnabled(True)
+        self.stats_button.setEnabled(True)
+        self.send_file_button.setEnabled(True)
+        self.get_file_button.setEnabled(True)
+        # Reported from the receiving thread
+        self.client.on_transfer = self.signals.transfer_finished.emit
+    
+    def on_reconnecting(self):
+        """Handle a dropped connection being re-established"""
+        self.status_label.setText("⏳ Connection lost - reconnecting...")
+        self.status_label.setStyleSheet("color: orange; padding: 5px;")
     
     def on_disconnected(self):
         """Handle disconnection"""
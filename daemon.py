@@ -0,0 +1,238 @@
+#!/usr/bin/env python3
+"""
+LiteDesk - Server Daemon
+
+Shares the desktop without a window, for servers and kiosks that run
+without a desktop session to click "Start Sharing" in. It runs the same
+capture/stream/input loop as the PyQt5 server and never imports Qt.
+
+Settings come from the [server] section of config.ini. Send SIGHUP to
+reload it: quality, frame rate and input control change on the next frame
+without dropping the connected client. SIGTERM or Ctrl+C stops it.
+"""
+import argparse
+import configparser
+import os
+import signal
+import socket
+from network import NetworkServer, NetworkServerWithRelay, VIDEO_CODECS, DEFAULT_TRANSFER_DIR
+from streaming import StreamingLoop
+
+
+DEFAULT_CONFIG = 'config.ini'
+
+DEFAULTS = {
+    'host': '0.0.0.0',
+    'port': 9876,
+    'quality': 50,
+    'refine_quality': 90,
+    'frame_delay': 0.1,
+    'allow_input': True,
+    'video_codec': None,
+    'transfer_dir': DEFAULT_TRANSFER_DIR,
+    'relay_host': None,
+    'relay_port': 8877,
+    'peer_id': None,
+}
+
+# Settings bound when the server starts; changing them needs a restart
+RESTART_KEYS = ('host', 'port', 'relay_host', 'relay_port', 'peer_id')
+
+
+def load_server_config(path=DEFAULT_CONFIG):
+    """
+    Read the [server] section of a config file
+    
+    Args:
+        path: Config file; a missing file or key falls back to DEFAULTS
+    
+    Returns:
+        dict: Settings keyed like DEFAULTS
+    
+    Raises:
+        ValueError: The file holds an invalid value
+    """
+    parser = configparser.ConfigParser()
+    try:
+        parser.read(path, encoding='utf-8')
+    except configparser.Error as e:
+        raise ValueError(f"{path}: {e}")
+    if not parser.has_section('server'):
+        parser.add_section('server')
+    section = parser['server']
+    
+    config = {
+        'host': section.get('host', DEFAULTS['host']).strip(),
+        'port': section.getint('port', DEFAULTS['port']),
+        'quality': section.getint('quality', DEFAULTS['quality']),
+        'refine_quality': section.getint('refine_quality', DEFAULTS['refine_quality']),
+        'frame_delay': section.getfloat('frame_delay', DEFAULTS['frame_delay']),
+        'allow_input': section.getboolean('allow_input', DEFAULTS['allow_input']),
+        'video_codec': section.get('video_codec', '').strip().lower() or None,
+        'transfer_dir': os.path.expanduser(section.get('transfer_dir', DEFAULTS['transfer_dir']).strip()) or None,
+        'relay_host': section.get('relay_host', '').strip() or None,
+        'relay_port': section.getint('relay_port', DEFAULTS['relay_port']),
+        'peer_id': section.get('peer_id', '').strip() or None,
+    }
+    
+    if not 1 <= config['quality'] <= 100:
+        raise ValueError(f"quality must be between 1 and 100, got {config['quality']}")
+    if not 0 <= config['refine_quality'] <= 100:
+        raise ValueError(f"refine_quality must be between 0 and 100, got {config['refine_quality']}")
+    if config['frame_delay'] <= 0:
+        raise ValueError(f"frame_delay must be positive, got {config['frame_delay']}")
+    if config['video_codec'] not in (None,) + VIDEO_CODECS:
+        raise ValueError(f"video_codec must be one of {', '.join(VIDEO_CODECS)}, "
+                         f"got {config['video_codec']}")
+    for key in ('port', 'relay_port'):
+        if not 0 <= config[key] <= 65535:
+            raise ValueError(f"{key} must be a port number, got {config[key]}")
+    return config
+
+
+class ServerDaemon:
+    """Headless LiteDesk server driven by a config file"""
+    
+    def __init__(self, config_path=DEFAULT_CONFIG):
+        """
+        Initialize daemon
+        
+        Args:
+            config_path: Config file read at start and on every reload
+        """
+        self.config_path = config_path
+        self.config = load_server_config(config_path)
+        self.server = None
+        self.capture = None
+        self.input_controller = None
+        self.loop = None
+    
+    def create_capture(self):
+        """Create the screen capture (tests substitute a synthetic source)"""
+        from screen_capture import ScreenCapture
+        return ScreenCapture(quality=self.config['quality'],
+                             refine_quality=self.config['refine_quality'],
+                             profiler=self.server.profiler)
+    
+    def create_input(self):
+        """
+        Create the input controller
+        
+        Returns:
+            InputController, or None when input cannot be injected here
+            (the screen is still shared, view-only)
+        """
+        try:
+            from input_control import InputController
+            return InputController()
+        except Exception as e:
+            print(f"[Daemon] Input control unavailable, sharing view-only: {e}")
+            return None
+    
+    def start(self):
+        """Start listening (and register with the relay if configured)"""
+        config = self.config
+        if config['relay_host']:
+            peer_id = config['peer_id'] or f"server_{socket.gethostname()}"
+            self.server = NetworkServerWithRelay(
+                host=config['host'],
+                port=config['port'],
+                relay_host=config['relay_host'],
+                relay_port=config['relay_port'],
+                peer_id=peer_id
+            )
+            self.server.start_with_relay()
+        else:
+            self.server = NetworkServer(host=config['host'], port=config['port'])
+            self.server.start()
+        
+        self.capture = self.create_capture()
+        self.loop = StreamingLoop(
+            self.server, self.capture,
+            on_connected=lambda: print("[Daemon] Client connected"),
+            on_disconnected=lambda: print("[Daemon] Client disconnected")
+        )
+        self.apply()
+    
+    def apply(self):
+        """Push the current settings into the running loop"""
+        config = self.config
+        self.server.video_codec = config['video_codec']
+        self.server.transfer_dir = config['transfer_dir']
+        self.capture.quality = config['quality']
+        self.capture.refine_quality = config['refine_quality']
+        self.loop.frame_delay = config['frame_delay']
+        if config['allow_input'] and not self.input_controller:
+            self.input_controller = self.create_input()
+        self.loop.input_controller = self.input_controller if config['allow_input'] else None
+    
+    def reload(self):
+        """
+        Re-read the config file and apply it to the running server
+        
+        Returns:
+            bool: True if the new settings were applied
+        """
+        try:
+            config = load_server_config(self.config_path)
+        except ValueError as e:
+            print(f"[Daemon] Reload failed, keeping current settings: {e}")
+            return False
+        
+        changed = [key for key in RESTART_KEYS if config[key] != self.config[key]]
+        if changed:
+            print(f"[Daemon] {', '.join(changed)} changed; needs a restart to take effect")
+            for key in changed:
+                config[key] = self.config[key]
+        
+        self.config = config
+        if self.loop:
+            self.apply()
+        print(f"[Daemon] Reloaded {self.config_path}: quality={config['quality']}, "
+              f"frame_delay={config['frame_delay']}, allow_input={config['allow_input']}")
+        return True
+    
+    def run(self):
+        """Serve clients until stopped (blocks)"""
+        if not self.loop:
+            self.start()
+        try:
+            self.loop.run()
+        finally:
+            self.capture.close()
+    
+    def stop(self):
+        """Stop serving"""
+        if self.loop:
+            self.loop.stop()
+        if self.server:
+            self.server.stop()
+    
+    def install_signal_handlers(self):
+        """Reload on SIGHUP, stop on SIGTERM/SIGINT (call from the main thread)"""
+        if hasattr(signal, 'SIGHUP'):
+            signal.signal(signal.SIGHUP, lambda signum, frame: self.reload())
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, lambda signum, frame: self.stop())
+
+
+def main():
+    """Main entry point"""
+    parser = argparse.ArgumentParser(description='LiteDesk Server Daemon (no GUI)')
+    parser.add_argument('--config', default=DEFAULT_CONFIG,
+                        help='Config file to read ([server] section); SIGHUP reloads it')
+    args = parser.parse_args()
+    
+    try:
+        daemon = ServerDaemon(args.config)
+    except ValueError as e:
+        parser.error(str(e))
+    
+    daemon.install_signal_handlers()
+    print(f"[Daemon] Sharing desktop on {daemon.config['host']}:{daemon.config['port']}")
+    daemon.run()
+    print("[Daemon] Stopped")
+
+
+if __name__ == '__main__':
+    main()
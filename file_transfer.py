@@ -0,0 +1,361 @@
+"""
+LiteDesk - File Transfer Module
+
+Chunked, resumable file transfers over the LiteDesk connection, in either
+direction. The sender checksums each chunk (CRC-32) from a read-only map
+of the file and hands the bytes to the socket with sendfile, so they go
+from the page cache to the network without passing through Python (a
+punched UDP path, which is not a socket, gets a copy through sendall). The
+receiver writes into a preallocated, memory-mapped ".litedesk-part" file
+and records how far it got every CHECKPOINT_INTERVAL bytes and when the
+connection drops; a transfer cut off picks up from that offset.
+
+The receiver acknowledges every ACK_INTERVAL bytes and the sender stays
+at most WINDOW bytes ahead of the last acknowledgement. A bad or missing
+chunk makes the receiver acknowledge its last good offset with 'resend',
+and the sender goes back to it.
+
+Chunks always travel on the TCP connection, never on the lossy UDP
+frame path, so a resend only follows a checksum failure. Transfers only
+use the time the connection is not busy with the stream: the server
+sends chunks in the gaps between frames, the client only when its
+socket has room. TCP_NOTSENT_LOWAT keeps the kernel from queueing much
+more than a chunk, so a frame or an input command never waits behind
+more than about NOTSENT_LOWAT bytes of file data.
+"""
+import errno
+import json
+import mmap
+import os
+import select
+import socket
+import zlib
+
+
+# Bytes per chunk
+CHUNK_SIZE = 64 * 1024
+
+# Bytes a sender may be ahead of the receiver's last acknowledgement
+WINDOW = 16 * CHUNK_SIZE
+
+# Bytes between acknowledgements of the receiver
+ACK_INTERVAL = 4 * CHUNK_SIZE
+
+# Bytes between checkpoints (flush and progress record) of the receiver
+CHECKPOINT_INTERVAL = 256 * CHUNK_SIZE
+
+# Unsent bytes the kernel may queue on a socket carrying transfers
+NOTSENT_LOWAT = 2 * CHUNK_SIZE
+
+# Suffix of a partly received file; its progress record adds '.json'
+PART_SUFFIX = '.litedesk-part'
+
+
+def resolve_path(root, name):
+    """
+    Path of a file inside a directory, refusing paths that leave it
+    
+    Args:
+        root: Directory transfers are confined to
+        name: Path relative to root, as given by the peer
+    
+    Returns:
+        str: Absolute path
+    
+    Raises:
+        ValueError: name points outside root
+    """
+    root = os.path.realpath(root)
+    path = os.path.realpath(os.path.join(root, name.lstrip('/\\')))
+    if path == root or os.path.commonpath([root, path]) != root:
+        raise ValueError(f"{name} is outside the transfer directory")
+    return path
+
+
+def free_space(path):
+    """Bytes free on the file system a path is (or would be created) on"""
+    path = os.path.abspath(path)
+    while not os.path.exists(path):
+        path = os.path.dirname(path)
+    usage = os.statvfs(path)
+    return usage.f_bavail * usage.f_frsize
+
+
+def limit_unsent(sock):
+    """Keep little unsent data queued on a socket (where TCP_NOTSENT_LOWAT exists)"""
+    option = getattr(socket, 'TCP_NOTSENT_LOWAT', None)
+    if option is None or not isinstance(sock, socket.socket):
+        return
+    try:
+        sock.setsockopt(socket.IPPROTO_TCP, option, NOTSENT_LOWAT)
+    except OSError:
+        pass
+
+
+def writable(sock, timeout=0):
+    """
+    Whether a socket can take more data within timeout seconds
+    
+    Streams that are not sockets (a punched UdpStream) have nothing to
+    select on; they count as writable and their sendall() blocks while
+    their own window is full.
+    """
+    if not isinstance(sock, socket.socket):
+        return True
+    try:
+        return bool(select.select([], [sock], [], max(timeout, 0))[1])
+    except (OSError, ValueError):
+        return False
+
+
+class FileSender:
+    """Sends one file in chunks, within WINDOW of the receiver's acknowledgements"""
+    
+    def __init__(self, transfer_id, path, chunk_size=CHUNK_SIZE, window=WINDOW):
+        """
+        Open the file; sending starts once the receiver gives its offset
+        
+        Args:
+            transfer_id: Number naming the transfer on the connection
+            path: File to send
+        
+        Raises:
+            OSError: The file cannot be read
+        """
+        self.transfer_id = transfer_id
+        self.path = path
+        self.chunk_size = chunk_size
+        self.window = window
+        self.file = open(path, 'rb')
+        stat = os.fstat(self.file.fileno())
+        self.size = stat.st_size
+        self.mtime = int(stat.st_mtime)
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ) if self.size else None
+        self.offset = 0  # next byte to send
+        self.acked = 0  # bytes the receiver has written
+        self.started = False
+    
+    def resume(self, offset):
+        """Send from an offset the receiver asked for (its start, or a resend)"""
+        self.offset = self.acked = max(0, min(int(offset), self.size))
+        self.started = True
+    
+    def acknowledge(self, offset, resend=False):
+        """
+        Record the receiver's progress
+        
+        Args:
+            offset: Bytes the receiver has written
+            resend: The receiver dropped what came after offset
+        """
+        if resend or not self.started:
+            self.resume(offset)
+        else:
+            self.acked = max(self.acked, min(int(offset), self.size))
+    
+    def pending(self):
+        """Whether a chunk can be sent now"""
+        return self.started and self.offset < self.size and self.offset - self.acked < self.window
+    
+    @property
+    def done(self):
+        """Whether the receiver has the whole file"""
+        return self.started and self.acked >= self.size
+    
+    def next_chunk(self):
+        """
+        Take the next chunk to send
+        
+        Returns:
+            tuple: (offset, length, crc)
+        """
+        offset = self.offset
+        length = min(self.chunk_size, self.size - offset)
+        with memoryview(self.map)[offset:offset + length] as view:
+            crc = zlib.crc32(view)
+        self.offset += length
+        return offset, length, crc
+    
+    def read(self, offset, length):
+        """Bytes of a chunk, for transports sendfile cannot write to"""
+        return self.map[offset:offset + length]
+    
+    def send(self, sock, offset, length):
+        """
+        Write a chunk to a connection
+        
+        Sockets get it straight from the page cache with sendfile; other
+        streams (a punched UdpStream) get a copy through sendall.
+        """
+        if isinstance(sock, socket.socket):
+            sock.sendfile(self.file, offset, length)
+        else:
+            sock.sendall(self.read(offset, length))
+    
+    def close(self):
+        """Close the file"""
+        if self.map:
+            self.map.close()
+        self.file.close()
+
+
+class FileReceiver:
+    """Writes one incoming file, resuming a part file left by an earlier attempt"""
+    
+    def __init__(self, transfer_id, path, size, mtime=0):
+        """
+        Open (or create and preallocate) the part file
+        
+        Args:
+            transfer_id: Number naming the transfer on the connection
+            path: Where the finished file goes
+            size: File size announced by the sender
+            mtime: Modification time announced by the sender; a part file
+                recorded for another version of the file starts over
+        
+        Raises:
+            ValueError: size is negative
+            OSError: The part file cannot be written, or the disk has no
+                room for it
+        """
+        if size < 0:
+            raise ValueError(f"Invalid file size: {size}")
+        self.transfer_id = transfer_id
+        self.path = path
+        self.size = size
+        self.mtime = mtime
+        self.part = path + PART_SUFFIX
+        self.record = self.part + '.json'
+        self.offset = self._recorded_offset()
+        self.committed = self.offset
+        self.checkpointed = self.offset
+        self.resend = False  # a resend is to be asked for
+        self.resend_asked = False  # asked, and the chunk has not come yet
+        
+        if not self.offset:
+            # A resumed part file already holds its space
+            kept = os.path.getsize(self.part) if os.path.exists(self.part) else 0
+            if size - kept > free_space(path):
+                raise OSError(errno.ENOSPC, f"Not enough free space for {size} bytes")
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.file = open(self.part, 'r+b' if self.offset else 'w+b')
+        if not self.offset:
+            try:
+                self._preallocate()
+            except OSError:
+                self.file.close()
+                os.remove(self.part)
+                raise
+        self.map = mmap.mmap(self.file.fileno(), size) if size else None
+    
+    def _recorded_offset(self):
+        """Bytes kept from an earlier attempt at the same file, or 0"""
+        try:
+            with open(self.record, encoding='utf-8') as f:
+                record = json.load(f)
+            if (record.get('size'), record.get('mtime')) != (self.size, self.mtime):
+                return 0
+            if os.path.getsize(self.part) != self.size:
+                return 0
+            return max(0, min(int(record.get('offset', 0)), self.size))
+        except (OSError, ValueError, TypeError, AttributeError):
+            return 0
+    
+    def _preallocate(self):
+        """Reserve the whole file up front (fails early when the disk is full)"""
+        fd = self.file.fileno()
+        if self.size and hasattr(os, 'posix_fallocate'):
+            try:
+                os.posix_fallocate(fd, 0, self.size)
+                return
+            except OSError as e:
+                # Only a file system without fallocate gets a sparse file;
+                # anything else (ENOSPC above all) must fail here, not as
+                # SIGBUS on a write to the map later
+                if e.errno not in (errno.EOPNOTSUPP, errno.EINVAL):
+                    raise
+        os.ftruncate(fd, self.size)
+    
+    def write(self, offset, crc, data):
+        """
+        Write a chunk if it is the next one and intact
+        
+        A chunk past the next expected byte (one was lost) or with a bad
+        checksum asks for a resend from the last good offset.
+        
+        Returns:
+            bool: True if the chunk was written
+        """
+        if offset != self.offset or offset + len(data) > self.size:
+            # Chunks sent before the sender heard of an earlier resend
+            # request are still arriving; ask once
+            if offset > self.offset and not self.resend_asked:
+                self.resend = True
+            return False
+        if zlib.crc32(data) != crc:
+            self.resend = True
+            return False
+        self.map[offset:offset + len(data)] = data
+        self.offset += len(data)
+        self.resend = self.resend_asked = False
+        return True
+    
+    @property
+    def complete(self):
+        """Whether every byte has been written"""
+        return self.offset >= self.size
+    
+    def ack_due(self):
+        """Whether the sender should hear about progress now"""
+        return self.resend or self.complete or self.offset - self.committed >= ACK_INTERVAL
+    
+    def commit(self):
+        """
+        Take the progress to acknowledge, checkpointing it now and then
+        
+        Acknowledgements are frequent and run on the connection's command
+        reader, so only every CHECKPOINT_INTERVAL bytes is the progress
+        flushed and recorded; a crash costs at most that much resending.
+        
+        Returns:
+            tuple: (offset, resend) to acknowledge
+        """
+        if self.offset - self.checkpointed >= CHECKPOINT_INTERVAL:
+            self.checkpoint()
+        self.committed = self.offset
+        resend, self.resend = self.resend, False
+        self.resend_asked = self.resend_asked or resend
+        return self.offset, resend
+    
+    def checkpoint(self):
+        """Flush the bytes written since the last checkpoint and record them, so a later attempt resumes here"""
+        if self.map and self.offset > self.checkpointed:
+            # Flushed ranges must start on a page boundary
+            start = self.checkpointed - self.checkpointed % mmap.ALLOCATIONGRANULARITY
+            self.map.flush(start, self.offset - start)
+        with open(self.record, 'w', encoding='utf-8') as f:
+            json.dump({'size': self.size, 'mtime': self.mtime, 'offset': self.offset}, f)
+        self.checkpointed = self.offset
+    
+    def finish(self):
+        """Move the complete file into place"""
+        self._close()
+        os.replace(self.part, self.path)
+        try:
+            os.remove(self.record)
+        except OSError:
+            pass
+    
+    def close(self):
+        """Stop, keeping the part file and its progress for a later attempt"""
+        if not self.file.closed:
+            self.checkpoint()
+        self._close()
+    
+    def _close(self):
+        if self.map:
+            self.map.close()
+            self.map = None
+        self.file.close()
@@ -0,0 +1,452 @@
+"""
+LiteDesk - Hole Punch Module
+
+UDP hole punching for direct peer-to-peer sessions. Each peer learns its
+public UDP endpoint from the relay server, the relay swaps the endpoints
+between the two peers, and both send probes at the same time so that each
+NAT has seen outbound traffic before the other side's probes arrive.
+
+The punched path then carries a UdpStream: a reliable, ordered byte
+stream that stands in for the TCP socket of a direct session.
+"""
+import json
+import socket
+import struct
+import threading
+import time
+
+
+# Punch probe: magic, kind, session ID (16 bytes)
+PUNCH_HEADER = struct.Struct('!4sB16s')
+PUNCH_MAGIC = b'LDPH'
+PUNCH_SYN = 1
+PUNCH_ACK = 2
+
+# Stream segment: magic, kind, sequence number, cumulative ack
+SEGMENT_HEADER = struct.Struct('!4sBII')
+STREAM_MAGIC = b'LDST'
+SEGMENT_DATA = 1
+SEGMENT_ACK = 2
+SEGMENT_FIN = 3
+
+PUNCH_TIMEOUT = 5.0
+PUNCH_INTERVAL = 0.1
+
+SEGMENT_SIZE = 1200
+WINDOW = 256
+# Congestion window (segments): start, and floor after a timeout
+INITIAL_CWND = 10
+MIN_CWND = 2
+INITIAL_RTO = 0.2
+MIN_RTO = 0.05
+MAX_RTO = 2.0
+KEEPALIVE_INTERVAL = 5.0
+DEAD_TIMEOUT = 15.0
+
+# Receive timeout of the stream's I/O thread (timer resolution)
+TICK = 0.02
+
+
+def primary_ip():
+    """Return the address of the interface used for outbound traffic"""
+    probe = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        # No packet is sent: connect() only selects a route
+        probe.connect(('8.8.8.8', 80))
+        return probe.getsockname()[0]
+    except OSError:
+        return '127.0.0.1'
+    finally:
+        probe.close()
+
+
+def local_endpoints(sock):
+    """
+    Endpoints a peer on the same network could reach this socket at
+    
+    Returns:
+        list: [ip, port] pairs
+    """
+    ip, port = sock.getsockname()[:2]
+    if ip in ('0.0.0.0', ''):
+        ip = primary_ip()
+    return [[ip, port]]
+
+
+def discover_endpoint(sock, relay_addr, peer_id, token, timeout=2.0, attempts=3):
+    """
+    Ask the relay server which public address this UDP socket maps to
+    
+    Args:
+        sock: UDP socket that will be used for punching
+        relay_addr: (host, port) of the relay's UDP endpoint
+        peer_id: Our registered peer ID
+        token: udp_token from the relay's 'registered' reply
+        timeout: Total seconds to wait
+        attempts: Number of probes to send
+    
+    Returns:
+        list: Observed [ip, port], or None
+    """
+    probe = json.dumps({'type': 'udp_probe', 'peer_id': peer_id, 'token': token}).encode('utf-8')
+    for _ in range(attempts):
+        sock.sendto(probe, relay_addr)
+        deadline = time.monotonic() + timeout / attempts
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            sock.settimeout(remaining)
+            try:
+                data, addr = sock.recvfrom(2048)
+            except socket.timeout:
+                break
+            try:
+                msg = json.loads(data.decode('utf-8'))
+            except (ValueError, UnicodeDecodeError):
+                continue
+            if isinstance(msg, dict) and msg.get('type') == 'udp_observed':
+                return list(msg['endpoint'])
+    return None
+
+
+def punch(sock, candidates, session_id, timeout=PUNCH_TIMEOUT, interval=PUNCH_INTERVAL):
+    """
+    Punch through both NATs by probing the peer while it probes us
+    
+    Probes go to every candidate endpoint until one of them is answered.
+    Every probe received is answered, so the peer finishes as well.
+    
+    Args:
+        sock: UDP socket whose public endpoint the peer was given
+        candidates: [ip, port] endpoints of the peer
+        session_id: Hex session ID shared with the peer through the relay
+        timeout: Seconds to keep trying
+        interval: Seconds between probe rounds
+    
+    Returns:
+        tuple: Peer address that answered, or None
+    """
+    token = bytes.fromhex(session_id)
+    syn = PUNCH_HEADER.pack(PUNCH_MAGIC, PUNCH_SYN, token)
+    ack = PUNCH_HEADER.pack(PUNCH_MAGIC, PUNCH_ACK, token)
+    candidates = [tuple(c) for c in candidates]
+    
+    deadline = time.monotonic() + timeout
+    next_probe = 0.0
+    while True:
+        now = time.monotonic()
+        if now >= deadline:
+            return None
+        if now >= next_probe:
+            for candidate in candidates:
+                try:
+                    sock.sendto(syn, candidate)
+                except OSError:
+                    pass
+            next_probe = now + interval
+        
+        sock.settimeout(max(0.001, min(next_probe, deadline) - now))
+        try:
+            data, addr = sock.recvfrom(2048)
+        except socket.timeout:
+            continue
+        if len(data) != PUNCH_HEADER.size:
+            continue
+        magic, kind, received = PUNCH_HEADER.unpack(data)
+        if magic != PUNCH_MAGIC or received != token:
+            continue
+        
+        if kind == PUNCH_SYN:
+            # The peer reaches us: tell it so
+            sock.sendto(ack, addr)
+        elif kind == PUNCH_ACK:
+            # Our probe reached the peer
+            return addr
+
+
+class UdpStream:
+    """
+    Reliable, ordered byte stream over a punched UDP path
+    
+    Offers the socket calls sessions use (sendall, recv, settimeout,
+    close), so it can replace the TCP socket of a direct session. Data is
+    cut into numbered segments; the receiver acknowledges cumulatively and
+    keeps out-of-order segments, and the sender retransmits segments that
+    stay unacknowledged past a retransmission timeout estimated from
+    round-trip samples.
+    
+    Like TCP Reno, the segments in flight are also limited by a congestion
+    window that grows with each acknowledgement (slow start, then about one
+    segment per round trip), halves when the peer reports a gap and drops
+    to MIN_CWND when the retransmission timer fires, which resends only
+    the oldest segment.
+    """
+    
+    def __init__(self, sock, addr, segment_size=SEGMENT_SIZE, window=WINDOW):
+        """
+        Initialize stream
+        
+        Args:
+            sock: Punched UDP socket (owned by the stream from now on)
+            addr: Peer address returned by punch()
+            segment_size: Payload bytes per segment
+            window: Most segments in flight before sendall blocks
+        """
+        self.sock = sock
+        self.addr = tuple(addr)
+        self.segment_size = segment_size
+        self.window = window
+        self.cond = threading.Condition()
+        self.timeout = None
+        self.closed = False
+        
+        # Sending side
+        self.next_seq = 0
+        self.send_base = 0
+        self.unacked = {}  # seq -> [packet, sent_at, retransmitted]
+        self.dup_acks = 0
+        self.srtt = None
+        self.rto = INITIAL_RTO
+        self.rto_deadline = None
+        self.retransmits = 0
+        self.cwnd = float(min(INITIAL_CWND, window))
+        self.ssthresh = float(window)
+        self.recover = None  # next_seq when the last loss was detected
+        
+        # Receiving side
+        self.expected = 0
+        self.out_of_order = {}  # seq -> payload
+        self.inbuf = bytearray()
+        self.fin_seq = None
+        
+        now = time.monotonic()
+        self.last_heard = now
+        self.last_sent = now
+        
+        self.sock.settimeout(TICK)
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+    
+    def sendall(self, data):
+        """Send all bytes, blocking while the window is full"""
+        view = memoryview(data)
+        for offset in range(0, len(view), self.segment_size):
+            chunk = view[offset:offset + self.segment_size]
+            with self.cond:
+                while len(self.unacked) >= self._send_window() and not self.closed:
+                    self.cond.wait(1.0)
+                if self.closed:
+                    raise ConnectionError('stream closed')
+                seq = self.next_seq
+                self.next_seq += 1
+                packet = SEGMENT_HEADER.pack(STREAM_MAGIC, SEGMENT_DATA, seq,
+                                             self.expected) + chunk
+                now = time.monotonic()
+                self.unacked[seq] = [packet, now, False]
+                if self.rto_deadline is None:
+                    self.rto_deadline = now + self.rto
+            self._send(packet)
+    
+    def _send_window(self):
+        """Segments allowed in flight: the smaller of window and cwnd"""
+        return min(self.window, max(MIN_CWND, int(self.cwnd)))
+    
+    def recv(self, size):
+        """
+        Receive up to size bytes
+        
+        Returns:
+            bytes: Data, or b'' once the peer has closed the stream
+        """
+        with self.cond:
+            deadline = None if self.timeout is None else time.monotonic() + self.timeout
+            while not self.inbuf:
+                if self.closed or self._peer_finished():
+                    return b''
+                if deadline is None:
+                    self.cond.wait()
+                else:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise socket.timeout('timed out')
+                    self.cond.wait(remaining)
+            data = bytes(self.inbuf[:size])
+            del self.inbuf[:size]
+            return data
+    
+    def settimeout(self, timeout):
+        """Set the timeout used by recv (None blocks)"""
+        self.timeout = timeout
+    
+    def shutdown(self, how=socket.SHUT_RDWR):
+        """Close the stream (half-close is not supported)"""
+        self.close()
+    
+    def close(self):
+        """Tell the peer we are done and release the socket"""
+        with self.cond:
+            if self.closed:
+                return
+            self.closed = True
+            fin = SEGMENT_HEADER.pack(STREAM_MAGIC, SEGMENT_FIN, self.next_seq, self.expected)
+            self.cond.notify_all()
+        # FIN is not retransmitted: the peer also notices silence
+        for _ in range(3):
+            self._send(fin)
+        if threading.current_thread() is not self.thread:
+            self.thread.join(1.0)
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+    
+    def _peer_finished(self):
+        return self.fin_seq is not None and self.expected >= self.fin_seq
+    
+    def _send(self, packet):
+        try:
+            self.sock.sendto(packet, self.addr)
+            self.last_sent = time.monotonic()
+        except OSError:
+            pass
+    
+    def _run(self):
+        """I/O thread: receive segments, acknowledge, retransmit"""
+        while not self.closed:
+            try:
+                data, addr = self.sock.recvfrom(65535)
+            except socket.timeout:
+                data = None
+            except OSError:
+                break
+            
+            now = time.monotonic()
+            if data is not None and addr == self.addr:
+                self._handle(data, now)
+            self._on_timer(now)
+        
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+    
+    def _handle(self, data, now):
+        """Process one datagram from the peer"""
+        self.last_heard = now
+        if len(data) == PUNCH_HEADER.size and data.startswith(PUNCH_MAGIC):
+            # Late probe: the peer has not seen our answer yet
+            magic, kind, token = PUNCH_HEADER.unpack(data)
+            if kind == PUNCH_SYN:
+                self._send(PUNCH_HEADER.pack(PUNCH_MAGIC, PUNCH_ACK, token))
+            return
+        if len(data) < SEGMENT_HEADER.size:
+            return
+        magic, kind, seq, ack = SEGMENT_HEADER.unpack_from(data)
+        if magic != STREAM_MAGIC:
+            return
+        
+        resend = None
+        with self.cond:
+            if ack > self.send_base and ack <= self.next_seq:
+                acked_count = 0
+                for acked in range(self.send_base, ack):
+                    entry = self.unacked.pop(acked, None)
+                    if entry:
+                        acked_count += 1
+                        if not entry[2]:
+                            self._sample_rtt(now - entry[1])
+                self.send_base = ack
+                self.dup_acks = 0
+                self.rto_deadline = now + self.rto if self.unacked else None
+                
+                if self.recover is not None and ack < self.recover:
+                    # Partial ack: the next hole was lost in the same window
+                    resend = self._retransmit_oldest(now)
+                else:
+                    self.recover = None
+                    self._grow_cwnd(acked_count)
+                self.cond.notify_all()
+            elif ack == self.send_base and self.unacked and kind == SEGMENT_ACK:
+                self.dup_acks += 1
+                if self.dup_acks == 3:
+                    # Fast retransmit of the segment the peer is missing;
+                    # halve the window once per window of losses
+                    if self.recover is None:
+                        self.ssthresh = max(MIN_CWND, self.cwnd / 2)
+                        self.cwnd = self.ssthresh
+                        self.recover = self.next_seq
+                    resend = self._retransmit_oldest(now)
+            
+            if kind == SEGMENT_DATA:
+                payload = data[SEGMENT_HEADER.size:]
+                if seq == self.expected:
+                    self.inbuf += payload
+                    self.expected += 1
+                    while self.expected in self.out_of_order:
+                        self.inbuf += self.out_of_order.pop(self.expected)
+                        self.expected += 1
+                    self.cond.notify_all()
+                elif seq > self.expected and len(self.out_of_order) < 2 * self.window:
+                    self.out_of_order[seq] = payload
+                reply = SEGMENT_HEADER.pack(STREAM_MAGIC, SEGMENT_ACK, 0, self.expected)
+            elif kind == SEGMENT_FIN:
+                self.fin_seq = seq
+                self.cond.notify_all()
+                reply = None
+            else:
+                reply = None
+        
+        if resend:
+            self._send(resend)
+        if reply:
+            self._send(reply)
+    
+    def _retransmit_oldest(self, now):
+        """Mark the oldest unacknowledged segment resent and return it"""
+        entry = self.unacked.get(self.send_base)
+        if not entry:
+            return None
+        entry[1:] = [now, True]
+        self.retransmits += 1
+        return entry[0]
+    
+    def _grow_cwnd(self, acked_count):
+        """Open the congestion window for newly acknowledged segments"""
+        for _ in range(acked_count):
+            if self.cwnd < self.ssthresh:
+                self.cwnd += 1
+            else:
+                self.cwnd += 1 / self.cwnd
+        self.cwnd = min(self.cwnd, float(self.window))
+    
+    def _sample_rtt(self, rtt):
+        """Update the retransmission timeout from a round-trip sample"""
+        if self.srtt is None:
+            self.srtt = rtt
+        else:
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        self.rto = max(MIN_RTO, min(MAX_RTO, 2 * self.srtt + TICK))
+    
+    def _on_timer(self, now):
+        """Retransmit the oldest overdue segment, keep the NAT mapping open, detect death"""
+        resend = None
+        with self.cond:
+            if self.rto_deadline is not None and now >= self.rto_deadline and self.unacked:
+                # Timeout: collapse the window and back off the timer
+                self.ssthresh = max(MIN_CWND, self.cwnd / 2)
+                self.cwnd = MIN_CWND
+                self.recover = self.next_seq
+                self.rto = min(MAX_RTO, self.rto * 2)
+                self.rto_deadline = now + self.rto
+                resend = self._retransmit_oldest(now)
+            
+            if now - self.last_heard > DEAD_TIMEOUT:
+                print(f"[UDP Stream] Peer {self.addr} went silent")
+                self.closed = True
+                self.cond.notify_all()
+                return
+        
+        if resend:
+            self._send(resend)
+        if now - self.last_sent > KEEPALIVE_INTERVAL:
+            self._send(SEGMENT_HEADER.pack(STREAM_MAGIC, SEGMENT_ACK, 0, self.expected))
@@ -2,19 +2,129 @@
 LiteDesk - Network Module
 
 Handles peer-to-peer network communication between client and server.
-Supports both direct connections and relay mode via VPS server.
+Supports both direct connections and relay mode via VPS server. Behind
+NAT a direct UDP path is punched through the relay before falling back to
+a stream relayed by the VPS.
+
+Each connection belongs to a session. The server hands out a resume token
+and keeps the session (settings, last frame) for a grace period after the
+connection drops, so a client that reconnects in time carries on where it
+left off instead of starting cold.
+
+Files can be transferred both ways over the same connection (see
+file_transfer); download chunks fill the gaps between frames.
+
+PIL, PyAV and the relay client are imported on first use, so importing
+this module stays cheap for the viewer's startup and for library users.
 """
+import importlib.machinery
+import os
 import socket
 import struct
 import threading
 import json
+import queue
+import select
+import random
+import secrets
+import time
 from io import BytesIO
-from PIL import Image
-try:
-    from relay_client import RelayClient
-    RELAY_AVAILABLE = True
-except ImportError:
-    RELAY_AVAILABLE = False
+from udp_transport import UdpFrameSender, UdpFrameReceiver
+from hole_punch import punch, UdpStream
+from profiling import StageProfiler
+from file_transfer import (
+    FileSender, FileReceiver, CHUNK_SIZE, limit_unsent, resolve_path, writable
+)
+# Found without importing; relay_client is loaded when a relay is used
+RELAY_AVAILABLE = importlib.machinery.PathFinder.find_spec('relay_client') is not None
+
+
+# A frame header with width 0 marks a control message; height holds its kind
+CONTROL_FRAME = 0
+CONTROL_SESSION = 1
+CONTROL_STATS = 2
+CONTROL_COPY_RECT = 3
+CONTROL_TILES = 4
+CONTROL_KEEPALIVE = 5
+CONTROL_VIDEO = 6
+CONTROL_RAW = 7
+CONTROL_FILE = 8
+CONTROL_FILE_DATA = 9
+
+# Copy-rect update: move (x, y, w, h) by (dx, dy) in the client's framebuffer,
+# then paste the JPEG patch that follows at (x, y, w, h)
+COPY_RECT_HEADER = struct.Struct('!IIIIiiIIII')
+
+# Tile update: frame width, height, tile size, atlas columns, flags, entry
+# count; then (col, row, slot, new) per tile and the JPEG atlas of new tiles
+TILES_HEADER = struct.Struct('!IIHHBI')
+TILE_ENTRY = struct.Struct('!HHIB')
+TILES_RESET = 0x01
+
+# Video frame (see video_codec): frame width, height, codec, flags; then the
+# compressed frame. Codecs are numbered by their place in VIDEO_CODECS
+VIDEO_HEADER = struct.Struct('!IIBB')
+VIDEO_CODECS = ('h264', 'vp8')
+VIDEO_KEYFRAME = 0x01
+
+# Uncompressed frame (same-host transports, see shm_transport): frame width,
+# height; then the RGB pixels row by row
+RAW_HEADER = struct.Struct('!II')
+
+# File chunk (see file_transfer), in a CONTROL_FILE_DATA message from the
+# server or after a 'file_data' command from the client: transfer id,
+# offset, CRC-32 of the chunk; then the chunk. CONTROL_FILE carries the
+# JSON messages of a transfer: offer, ack, done, error
+FILE_CHUNK = struct.Struct('!IQI')
+
+# Where a server keeps files sent to it and serves downloads from
+DEFAULT_TRANSFER_DIR = os.path.join(os.path.expanduser('~'), 'LiteDesk')
+
+# Tiles a client offers to cache (64x64 RGB: 12 KB each, see tile_cache),
+# and the most a server tracks
+TILE_CACHE_TILES = 2048
+MAX_TILE_CACHE_TILES = 8192
+
+# Colour modes a viewer can pick (see ScreenCapture.encode): JPEG with 4:2:0
+# or 4:4:4 chroma, grayscale JPEG, or lossless PNG of a 256/64 colour palette
+COLOR_MODES = ('color', 'text', 'gray', 'palette256', 'palette64')
+DEFAULT_COLOR_MODE = 'color'
+
+# Seconds without an update before an idle server sends a keepalive (an
+# empty '{}' control message, ignored by clients that do not know it)
+KEEPALIVE_INTERVAL = 2.0
+
+# Seconds a dropped session can still be resumed
+RESUME_GRACE = 30.0
+# Seconds to wait for the session handshake
+SESSION_TIMEOUT = 2.0
+
+# Reconnect backoff (seconds)
+RECONNECT_WINDOW = 10.0
+RECONNECT_BASE_DELAY = 0.05
+RECONNECT_MAX_DELAY = 1.0
+
+
+def decode_jpeg(data):
+    """
+    Decode a JPEG (or palette PNG) frame to RGB
+    
+    PIL is imported with the first frame, not at startup.
+    """
+    from PIL import Image
+    img = Image.open(BytesIO(data))
+    # Grayscale and palette frames are pasted into the RGB framebuffer
+    return img if img.mode == 'RGB' else img.convert('RGB')
+
+
+class Session:
+    """Server-side state a client gets back when it resumes"""
+    
+    def __init__(self, token):
+        self.token = token
+        self.settings = {}
+        self.last_frame = None  # (width, height, jpeg_data)
+        self.detached_at = None
 
 
 class NetworkServer:
@@ -32,7 +142,24 @@ class NetworkServer:
         self.port = port
         self.socket = None
         self.client_socket = None
+        self.client_addr = None
+        self.udp_socket = None
+        self.udp_sender = None
+        self.keyframe_requested = False
+        self.tile_cache_size = 0  # tiles the current client caches (0: no tile updates)
+        self.color_mode = DEFAULT_COLOR_MODE  # picked by the current client
+        self.video_codec = None  # stream as video when the client decodes this codec
+        self.client_video_codecs = ()  # codecs the current client decodes
+        self.transfer_dir = DEFAULT_TRANSFER_DIR  # None refuses file transfers
+        self.downloads = {}  # transfer id -> FileSender, to the current client
+        self.uploads = {}  # transfer id -> FileReceiver, from the current client
         self.running = False
+        self.sessions = {}  # resume token -> Session
+        self.session = None
+        self.resume_grace = RESUME_GRACE
+        self.pending_command = None
+        self.profiler = StageProfiler()
+        self.send_lock = threading.Lock()  # frames and control messages share the socket
     
     def start(self):
         """Start the server and listen for connections"""
@@ -45,12 +172,130 @@ class NetworkServer:
     
     def accept_connection(self):
         """Wait for and accept a client connection"""
-        if self.socket:
+        while self.socket:
             self.client_socket, addr = self.socket.accept()
+            self.client_addr = addr
+            self.udp_sender = None
+            self.keyframe_requested = False
             print(f"Client connected from {addr}")
-            return True
+            if self.open_session():
+                return True
         return False
     
+    def open_session(self, timeout=SESSION_TIMEOUT):
+        """
+        Start or resume the session of a newly connected client
+        
+        Clients open with a 'hello' command carrying the resume token of
+        the session they lost, if any. Anything else is kept for
+        receive_command, so clients without sessions still work.
+        
+        Args:
+            timeout: Seconds to wait for the client's first command
+        
+        Returns:
+            bool: False if the client was dropped for a malformed command
+        """
+        self.session = None
+        self.pending_command = None
+        self.tile_cache_size = 0
+        self.color_mode = DEFAULT_COLOR_MODE
+        self.client_video_codecs = ()
+        self._expire_sessions()
+        
+        try:
+            self.client_socket.settimeout(timeout)
+            cmd = self._read_command()
+        except (socket.error, json.JSONDecodeError, UnicodeDecodeError):
+            cmd = None
+        finally:
+            if self.client_socket:
+                self.client_socket.settimeout(None)
+        
+        try:
+            if cmd and not self._handle_transport_command(cmd):
+                self.pending_command = cmd
+        except (TypeError, ValueError, AttributeError) as e:
+            print(f"Dropping client that sent a malformed hello: {e}")
+            self.close_client()
+            return False
+        return self.client_socket is not None
+    
+    def _resume(self, token, tile_cache=0, video_codecs=()):
+        """Answer a client's hello with its session, resumed or new"""
+        if not isinstance(video_codecs, (list, tuple)):
+            video_codecs = ()
+        self.client_video_codecs = tuple(codec for codec in video_codecs
+                                         if isinstance(codec, str) and codec in VIDEO_CODECS)
+        try:
+            self.tile_cache_size = max(0, min(int(tile_cache or 0), MAX_TILE_CACHE_TILES))
+        except (TypeError, ValueError):
+            self.tile_cache_size = 0
+        session = self.sessions.get(token) if isinstance(token, str) else None
+        resumed = session is not None
+        if not resumed:
+            session = Session(secrets.token_hex(16))
+            self.sessions[session.token] = session
+        session.detached_at = None
+        self.session = session
+        self.color_mode = session.settings.get('color_mode', DEFAULT_COLOR_MODE)
+        
+        self._send_control(CONTROL_SESSION, {
+            'resume_token': session.token,
+            'resumed': resumed,
+            'settings': session.settings,
+            'tile_cache': self.tile_cache_size
+        })
+        if resumed:
+            print(f"Session {session.token[:8]} resumed")
+            if session.last_frame:
+                # The client gets a picture at once, before the next capture
+                width, height, jpeg_data = session.last_frame
+                with self.send_lock:
+                    self.client_socket.sendall(struct.pack('!III', width, height, len(jpeg_data)) + jpeg_data)
+    
+    def _detach_session(self):
+        """Keep the session for the grace period after its connection drops"""
+        if self.session:
+            self.session.detached_at = time.monotonic()
+            self.session = None
+    
+    def _expire_sessions(self):
+        """Forget sessions that were not resumed in time"""
+        now = time.monotonic()
+        for token, session in list(self.sessions.items()):
+            if session.detached_at is not None and now - session.detached_at > self.resume_grace:
+                del self.sessions[token]
+    
+    def _send_control(self, kind, msg):
+        """Send a control message in place of a frame, on the frame channel"""
+        payload = json.dumps(msg).encode('utf-8')
+        packet = struct.pack('!III', CONTROL_FRAME, kind, len(payload)) + payload
+        with self.send_lock:
+            if self.udp_sender:
+                self.udp_sender.send_frame(packet)
+            else:
+                self.client_socket.sendall(packet)
+    
+    def enable_udp(self, port):
+        """
+        Send frames to the connected client over UDP
+        
+        Args:
+            port: UDP port the client is listening on
+        """
+        if not self.client_addr:
+            return False
+        if isinstance(port, bool) or not isinstance(port, int) or not 0 < port < 65536:
+            print(f"Ignoring UDP subscription to bad port: {port!r}")
+            return False
+        
+        if not self.udp_socket:
+            self.udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.udp_sender = UdpFrameSender(self.udp_socket, (self.client_addr[0], port))
+        print(f"Streaming frames over UDP to {self.client_addr[0]}:{port}")
+        return True
+    
     def send_frame(self, width, height, jpeg_data):
         """
         Send a screen frame to the client
@@ -60,22 +305,140 @@ class NetworkServer:
             height: Frame height
             jpeg_data: JPEG compressed image data
         """
-        if not self.client_socket:
+        # Send frame header: width (4 bytes), height (4 bytes), data length (4 bytes)
+        header = struct.pack('!III', width, height, len(jpeg_data))
+        session = self.session
+        if session:
+            session.last_frame = (width, height, jpeg_data)
+        return self._send_update(header, jpeg_data)
+    
+    def send_copy_rect(self, copy, patch_jpeg=b''):
+        """
+        Send a copy-rect update
+        
+        The client moves part of the framebuffer it already has and pastes
+        the patch over what the move leaves out of date, so a scroll costs
+        the newly exposed strip instead of a full frame.
+        
+        Args:
+            copy: scroll_detect.CopyRect
+            patch_jpeg: JPEG of copy.patch (empty when there is no patch)
+        """
+        px, py, pw, ph = copy.patch or (0, 0, 0, 0)
+        payload = COPY_RECT_HEADER.pack(copy.x, copy.y, copy.w, copy.h, copy.dx, copy.dy,
+                                        px, py, pw, ph)
+        header = struct.pack('!III', CONTROL_FRAME, CONTROL_COPY_RECT,
+                             len(payload) + len(patch_jpeg))
+        return self._send_update(header + payload, patch_jpeg)
+    
+    def send_tiles(self, tiles, atlas_jpeg=b''):
+        """
+        Send a tile update
+        
+        Args:
+            tiles: tile_cache.TileUpdate
+            atlas_jpeg: JPEG of the new tiles' atlas (empty when all are cached)
+        """
+        flags = TILES_RESET if tiles.reset else 0
+        payload = b''.join(
+            [TILES_HEADER.pack(tiles.width, tiles.height, tiles.tile_size, tiles.columns,
+                               flags, len(tiles.entries))] +
+            [TILE_ENTRY.pack(col, row, slot, new) for col, row, slot, new in tiles.entries]
+        )
+        header = struct.pack('!III', CONTROL_FRAME, CONTROL_TILES,
+                             len(payload) + len(atlas_jpeg))
+        return self._send_update(header + payload, atlas_jpeg)
+    
+    def send_video(self, width, height, video, frame_data):
+        """
+        Send a frame of the video stream
+        
+        Args:
+            width: Frame width (the encoded frame may be padded beyond it)
+            height: Frame height
+            video: video_codec.VideoUpdate
+            frame_data: Compressed frame
+        """
+        flags = VIDEO_KEYFRAME if video.keyframe else 0
+        payload = VIDEO_HEADER.pack(width, height, VIDEO_CODECS.index(video.codec), flags)
+        header = struct.pack('!III', CONTROL_FRAME, CONTROL_VIDEO,
+                             len(payload) + len(frame_data))
+        return self._send_update(header + payload, frame_data)
+    
+    def stream_video_codec(self):
+        """
+        Codec to stream the current client's screen with
+        
+        Returns:
+            str: video_codec if the client can decode it, else None
+        """
+        return self.video_codec if self.video_codec in self.client_video_codecs else None
+    
+    def send_update(self, width, height, data, update=None):
+        """
+        Send what ScreenCapture.capture_update() produced
+        
+        Args:
+            width: Frame width
+            height: Frame height
+            data: JPEG data (frame, patch or tile atlas) or a video frame
+            update: None for a full frame, or a CopyRect/TileUpdate/VideoUpdate
+        """
+        if update is None:
+            return self.send_frame(width, height, data)
+        if update.kind == 'copy_rect':
+            return self.send_copy_rect(update, data)
+        if update.kind == 'video':
+            return self.send_video(width, height, update, data)
+        return self.send_tiles(update, data)
+    
+    def send_keepalive(self):
+        """
+        Tell the client the server is alive while the screen is unchanged
+        
+        Keeps the path open (relay, NAT mappings) at 14 bytes a message.
+        
+        Returns:
+            bool: False if the client went away
+        """
+        return self._send_update(struct.pack('!III', CONTROL_FRAME, CONTROL_KEEPALIVE, 2), b'{}')
+    
+    def _send_update(self, header, data):
+        """Send a header and its data over UDP or TCP"""
+        sock = self.client_socket
+        if not sock:
             return False
         
         try:
-            # Send frame header: width (4 bytes), height (4 bytes), data length (4 bytes)
-            header = struct.pack('!III', width, height, len(jpeg_data))
-            self.client_socket.sendall(header)
-            
-            # Send frame data
-            self.client_socket.sendall(jpeg_data)
+            with self.profiler.stage('send'), self.send_lock:
+                if self.udp_sender:
+                    self.udp_sender.send_frame(header + data)
+                    return True
+                
+                sock.sendall(header)
+                
+                # Send frame data
+                sock.sendall(data)
             return True
-        except (BrokenPipeError, ConnectionResetError):
+        except OSError:
             print("Client disconnected")
-            self.client_socket = None
+            self.close_client()
             return False
     
+    def close_client(self):
+        """Drop the current client, keeping its session for resumption"""
+        for transfer_id in list(self.downloads) + list(self.uploads):
+            # The client asks again after reconnecting; uploads resume
+            self._end_transfer(transfer_id)
+        sock, self.client_socket = self.client_socket, None
+        if sock:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            sock.close()
+        self._detach_session()
+    
     def receive_command(self):
         """
         Receive a command from the client
@@ -83,33 +446,259 @@ class NetworkServer:
         Returns:
             dict: Command data or None if connection lost
         """
-        if not self.client_socket:
-            return None
-        
-        try:
-            # Receive command length (4 bytes)
-            length_data = self._recv_exact(4)
-            if not length_data:
+        # Commands for the transport (file chunks among them, often back to
+        # back) are handled here; keep reading until one is for the desktop
+        while True:
+            if not self.client_socket:
                 return None
             
-            length = struct.unpack('!I', length_data)[0]
+            if self.pending_command:
+                cmd, self.pending_command = self.pending_command, None
+                return cmd
             
-            # Receive command data
-            cmd_data = self._recv_exact(length)
-            if not cmd_data:
+            try:
+                cmd = self._read_command()
+                if cmd is None:
+                    # Client closed the connection
+                    self.close_client()
+                    return None
+                
+                if not self._handle_transport_command(cmd):
+                    return cmd
+            except (socket.error, json.JSONDecodeError, UnicodeDecodeError) as e:
+                print(f"Error receiving command: {e}")
                 return None
-            
-            # Parse JSON command
-            return json.loads(cmd_data.decode('utf-8'))
-        except (socket.error, json.JSONDecodeError, UnicodeDecodeError) as e:
-            print(f"Error receiving command: {e}")
+    
+    def _read_command(self):
+        """
+        Read one length-prefixed JSON command
+        
+        Returns:
+            dict: Command, or None if the connection closed
+        """
+        # Receive command length (4 bytes)
+        length_data = self._recv_exact(4)
+        if not length_data:
+            return None
+        
+        length = struct.unpack('!I', length_data)[0]
+        
+        # Receive command data
+        cmd_data = self._recv_exact(length)
+        if not cmd_data:
             return None
+        
+        # Parse JSON command
+        return json.loads(cmd_data.decode('utf-8'))
+    
+    def _handle_transport_command(self, cmd):
+        """
+        Handle commands addressed to the transport rather than the desktop
+        
+        Returns:
+            bool: True if the command was consumed
+        """
+        if not isinstance(cmd, dict) or not isinstance(cmd.get('data') or {}, dict):
+            print("Dropping client that sent a malformed command")
+            self.close_client()
+            return True
+        
+        cmd_type = cmd.get('type')
+        data = cmd.get('data') or {}
+        
+        if cmd_type == 'hello':
+            self._resume(data.get('resume_token'), data.get('tile_cache'),
+                         data.get('video_codecs'))
+            return True
+        
+        if cmd_type == 'udp_subscribe':
+            self.enable_udp(data.get('port'))
+            return True
+        
+        if cmd_type == 'request_keyframe':
+            self.keyframe_requested = True
+            return True
+        
+        if cmd_type == 'set_profiling':
+            self.set_profiling(data)
+            return True
+        
+        if cmd_type == 'set_color_mode':
+            self.set_color_mode(data.get('mode'))
+            return True
+        
+        if cmd_type == 'get_stats':
+            self._send_control(CONTROL_STATS, self.profiler.stats())
+            return True
+        
+        if cmd_type in ('file_get', 'file_put', 'file_data', 'file_ack', 'file_cancel'):
+            self._handle_file_command(cmd_type, data)
+            return True
+        
+        return False
+    
+    def _handle_file_command(self, cmd_type, data):
+        """Serve a file transfer command (see file_transfer)"""
+        transfer_id = data.get('id')
+        if cmd_type == 'file_data':
+            # The chunk follows the command on the socket
+            length = data.get('length')
+            if not isinstance(length, int) or not 0 <= length <= CHUNK_SIZE:
+                print(f"Dropping client that sent a bad file chunk length: {length}")
+                self.close_client()
+                return
+            chunk = self._recv_exact(length) if length else b''
+            receiver = self.uploads.get(transfer_id)
+            offset, crc = data.get('offset'), data.get('crc')
+            if receiver is None or chunk is None or not isinstance(offset, int) or not isinstance(crc, int):
+                return
+            receiver.write(offset, crc, chunk)
+            if receiver.ack_due():
+                self._acknowledge_upload(receiver)
+            return
+        
+        if cmd_type == 'file_ack':
+            sender = self.downloads.get(transfer_id)
+            if sender is None:
+                return
+            sender.acknowledge(data.get('offset', 0), data.get('resend', False))
+            if sender.done:
+                self._end_transfer(transfer_id)
+                print(f"Sent {sender.path} ({sender.size} bytes)")
+            return
+        
+        if cmd_type == 'file_cancel':
+            self._end_transfer(transfer_id)
+            return
+        
+        if self.transfer_dir is None or self.udp_sender:
+            reason = ("File transfer is disabled on this server" if self.transfer_dir is None
+                      else "File transfer needs frames over TCP, not UDP")
+            self._send_control(CONTROL_FILE, {'id': transfer_id, 'event': 'error', 'message': reason})
+            return
+        try:
+            path = resolve_path(self.transfer_dir, str(data.get('path', '')))
+            self._end_transfer(transfer_id)
+            if cmd_type == 'file_get':
+                sender = FileSender(transfer_id, path)
+                self.downloads[transfer_id] = sender
+                self._send_control(CONTROL_FILE, {'id': transfer_id, 'event': 'offer',
+                                                  'size': sender.size, 'mtime': sender.mtime})
+            else:
+                receiver = FileReceiver(transfer_id, path, int(data.get('size', 0)),
+                                        int(data.get('mtime', 0)))
+                self.uploads[transfer_id] = receiver
+                print(f"Receiving {path} from byte {receiver.offset}")
+                receiver.resend = True  # tells the client where to start
+                self._acknowledge_upload(receiver)
+            limit_unsent(self.client_socket)
+        except (OSError, ValueError, TypeError) as e:
+            self._send_control(CONTROL_FILE, {'id': transfer_id, 'event': 'error', 'message': str(e)})
+    
+    def _acknowledge_upload(self, receiver):
+        """Tell the client how far an upload got, finishing it when complete"""
+        offset, resend = receiver.commit()
+        self._send_control(CONTROL_FILE, {'id': receiver.transfer_id, 'event': 'ack',
+                                          'offset': offset, 'resend': resend})
+        if receiver.complete:
+            del self.uploads[receiver.transfer_id]
+            receiver.finish()
+            print(f"Received {receiver.path} ({receiver.size} bytes)")
+            self._send_control(CONTROL_FILE, {'id': receiver.transfer_id, 'event': 'done'})
+    
+    def _end_transfer(self, transfer_id):
+        """Stop a transfer, keeping what an upload received for a later resume"""
+        transfer = self.downloads.pop(transfer_id, None) or self.uploads.pop(transfer_id, None)
+        if transfer:
+            # Not while the streaming thread is writing one of its chunks
+            with self.send_lock:
+                transfer.close()
+    
+    def send_file_chunks(self, deadline):
+        """
+        Send download chunks until a deadline, while the socket has room
+        
+        Called by the streaming loop with the time left before the next
+        frame, so transfers never delay one.
+        
+        Args:
+            deadline: time.monotonic() by which to stop starting chunks
+        
+        Returns:
+            bool: False if the client went away
+        """
+        while self.downloads:
+            senders = [sender for sender in list(self.downloads.values()) if sender.pending()]
+            if not senders:
+                return True
+            for sender in senders:
+                remaining = deadline - time.monotonic()
+                sock = self.client_socket
+                if remaining <= 0 or not sock or not writable(sock, remaining):
+                    return True
+                try:
+                    with self.profiler.stage('file'), self.send_lock:
+                        if sender.file.closed:
+                            continue  # cancelled meanwhile
+                        offset, length, crc = sender.next_chunk()
+                        sock.sendall(struct.pack('!III', CONTROL_FRAME, CONTROL_FILE_DATA,
+                                                 FILE_CHUNK.size + length) +
+                                     FILE_CHUNK.pack(sender.transfer_id, offset, crc))
+                        sender.send(sock, offset, length)
+                except OSError:
+                    print("Client disconnected")
+                    self.close_client()
+                    return False
+        return True
+    
+    def set_color_mode(self, mode):
+        """
+        Switch the colour mode of the stream (kept with the session)
+        
+        The streaming loop applies it with a full redraw, so tiles cached
+        in the old mode are not reused.
+        
+        Args:
+            mode: One of COLOR_MODES
+        
+        Returns:
+            bool: False if the mode is unknown
+        """
+        if mode not in COLOR_MODES:
+            print(f"Ignoring unknown colour mode: {mode}")
+            return False
+        self.color_mode = mode
+        if self.session:
+            self.session.settings['color_mode'] = mode
+        return True
+    
+    def set_profiling(self, options):
+        """
+        Switch profiling on or off at runtime
+        
+        Args:
+            options: Any of 'stages', 'cprofile', 'tracemalloc' mapped to bool
+        """
+        if 'stages' in options:
+            self.profiler.set_enabled(options['stages'])
+        if 'cprofile' in options:
+            # Applied by the streaming thread, the one worth profiling
+            self.profiler.request_cprofile(options['cprofile'])
+        if 'tracemalloc' in options:
+            if options['tracemalloc']:
+                self.profiler.start_tracemalloc()
+            else:
+                self.profiler.stop_tracemalloc()
+        print(f"Profiling options changed: {options}")
     
     def _recv_exact(self, size):
         """Receive exact number of bytes"""
         data = b''
         while len(data) < size:
-            packet = self.client_socket.recv(size - len(data))
+            sock = self.client_socket
+            if not sock:
+                return None
+            packet = sock.recv(size - len(data))
             if not packet:
                 return None
             data += packet
@@ -118,9 +707,17 @@ class NetworkServer:
     def stop(self):
         """Stop the server"""
         self.running = False
-        if self.client_socket:
-            self.client_socket.close()
+        self.sessions.clear()
+        self.session = None
+        self.close_client()
+        if self.udp_socket:
+            self.udp_socket.close()
         if self.socket:
+            try:
+                # Wakes an accept() blocked in another thread
+                self.socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
             self.socket.close()
 
 
@@ -130,25 +727,168 @@ class NetworkClient:
     def __init__(self):
         """Initialize network client"""
         self.socket = None
+        self.udp_socket = None
+        self.udp_receiver = None
         self.connected = False
+        self.server_addr = None
+        self.resume_token = None
+        self.resumed = False
+        self.session_settings = {}
+        self.pending_frame = None
+        self.framebuffer = None  # last frame shown, base of copy-rect updates
+        self.tile_cache_size = TILE_CACHE_TILES  # offered to the server at hello
+        self.color_mode = DEFAULT_COLOR_MODE  # asked for again if the session is lost
+        self.video_codecs = None  # offered at hello; None: ask PyAV at first connect
+        self.video = None  # VideoDecoder once video frames arrive
+        self.tiles = {}  # cache slot -> tile image; the server picks the slots
+        self.stats = None
+        self.stats_ready = threading.Event()
+        self.send_lock = threading.Lock()  # commands and upload chunks share the socket
+        self.transfers = {}  # transfer id -> FileSender (upload) or FileReceiver (download)
+        self.requested = {}  # transfer id -> ('get'|'put', remote path, local path)
+        self.next_transfer_id = 1
+        self.uploader = None
+        self.upload_wake = threading.Event()
+        self.on_transfer = None  # called with (transfer id, 'done'|'error', message)
     
-    def connect(self, host, port=9876):
+    def connect(self, host, port=9876, timeout=None):
         """
         Connect to a remote server
         
         Args:
             host: Server IP address
             port: Server port number
+            timeout: Seconds to wait for the connection (None to block)
         """
         try:
             self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.socket.settimeout(timeout)
             self.socket.connect((host, port))
+            self.socket.settimeout(None)
             self.connected = True
+            self.server_addr = (host, port)
             print(f"Connected to {host}:{port}")
-            return True
+            return self.start_session()
         except Exception as e:
             print(f"Connection failed: {e}")
+            self.connected = False
+            if self.socket:
+                self.socket.close()
+            return False
+    
+    def start_session(self, timeout=SESSION_TIMEOUT):
+        """
+        Open or resume the session on a new connection
+        
+        Sends 'hello' with the token of the previous session. When the
+        server resumes it, the cached frame it sends right away is kept for
+        the next receive_frame.
+        
+        Args:
+            timeout: Seconds to wait for the server's answer
+        
+        Returns:
+            bool: True unless the connection failed during the handshake
+        """
+        self.resumed = False
+        self.pending_frame = None
+        if self.video_codecs is None:
+            from video_codec import decodable_codecs
+            self.video_codecs = decodable_codecs()
+        if not self.send_command('hello', {'resume_token': self.resume_token,
+                                           'tile_cache': self.tile_cache_size,
+                                           'video_codecs': self.video_codecs}):
+            return False
+        
+        try:
+            self.socket.settimeout(timeout)
+            packet = self._read_packet()
+            if packet and packet[0] == CONTROL_FRAME:
+                self._handle_control(packet[1], packet[2])
+                if self.resumed:
+                    packet = self._read_packet()
+                else:
+                    packet = None
+            if packet and packet[0] != CONTROL_FRAME:
+                # Older servers start streaming straight away
+                self.pending_frame = self.framebuffer = decode_jpeg(packet[2])
+        except socket.timeout:
+            pass
+        except (OSError, ValueError) as e:
+            print(f"Session handshake failed: {e}")
+            self.connected = False
             return False
+        finally:
+            self.socket.settimeout(None)
+        
+        if self.color_mode != DEFAULT_COLOR_MODE and not self.resumed:
+            return self.set_color_mode(self.color_mode)
+        return True
+    
+    def _handle_control(self, kind, payload):
+        """Apply a control message from the server"""
+        msg = json.loads(bytes(payload))
+        if kind == CONTROL_SESSION:
+            self.resume_token = msg.get('resume_token')
+            self.resumed = msg.get('resumed', False)
+            self.session_settings = msg.get('settings') or {}
+            self.tiles = {}
+            self.video = None
+        elif kind == CONTROL_STATS:
+            self.stats = msg
+            self.stats_ready.set()
+        elif kind == CONTROL_FILE:
+            self._handle_file_message(msg)
+    
+    def reconnect(self, window=RECONNECT_WINDOW):
+        """
+        Reconnect after the connection dropped and resume the session
+        
+        Retries with exponential backoff and full jitter, so clients cut
+        off by the same outage do not all come back in lockstep.
+        
+        Args:
+            window: Seconds to keep trying
+        
+        Returns:
+            bool: True once connected again
+        """
+        use_udp = self.udp_receiver is not None
+        self._close_transport()
+        self._pause_transfers()
+        
+        deadline = time.monotonic() + window
+        delay = RECONNECT_BASE_DELAY
+        while time.monotonic() < deadline:
+            if self._redial():
+                if use_udp:
+                    self.enable_udp()
+                else:
+                    self._restart_transfers()
+                print(f"Session {'resumed' if self.resumed else 'restarted'} after reconnect")
+                return True
+            time.sleep(random.uniform(0, delay))
+            delay = min(delay * 2, RECONNECT_MAX_DELAY)
+        return False
+    
+    def _redial(self):
+        """Open a new connection to the server of the lost one"""
+        if not self.server_addr:
+            return False
+        return self.connect(*self.server_addr, timeout=RECONNECT_MAX_DELAY)
+    
+    def _close_transport(self):
+        """Close the sockets of a dropped connection"""
+        self.connected = False
+        self.udp_receiver = None
+        for sock in (self.socket, self.udp_socket):
+            if sock:
+                try:
+                    sock.close()
+                except OSError:
+                    pass
+        self.socket = None
+        self.udp_socket = None
     
     def receive_frame(self):
         """
@@ -160,29 +900,410 @@ class NetworkClient:
         if not self.connected:
             return None
         
+        if self.pending_frame:
+            img, self.pending_frame = self.pending_frame, None
+            return img
+        
         try:
-            # Receive frame header
-            header = self._recv_exact(12)
-            if not header:
-                self.connected = False
-                return None
-            
-            width, height, data_length = struct.unpack('!III', header)
+            if self.udp_receiver:
+                return self._receive_udp_frame()
             
-            # Receive frame data
-            jpeg_data = self._recv_exact(data_length)
-            if not jpeg_data:
-                self.connected = False
-                return None
-            
-            # Decode JPEG image
-            img = Image.open(BytesIO(jpeg_data))
-            return img
+            while True:
+                packet = self._read_packet()
+                if not packet:
+                    self.connected = False
+                    return None
+                
+                img = self._apply_packet(*packet)
+                if img is not None:
+                    return img
         except Exception as e:
             print(f"Error receiving frame: {e}")
             self.connected = False
             return None
     
+    def get_stats(self, timeout=5.0):
+        """
+        Ask the server for its streaming statistics
+        
+        The answer is picked up by receive_frame, so frames must be being
+        received on another thread.
+        
+        Args:
+            timeout: Seconds to wait for the answer
+        
+        Returns:
+            dict: Stage timings and profile reports, or None
+        """
+        self.stats_ready.clear()
+        if not self.send_command('get_stats', {}):
+            return None
+        if not self.stats_ready.wait(timeout):
+            return None
+        return self.stats
+    
+    def set_color_mode(self, mode):
+        """
+        Ask the server for another colour mode (see COLOR_MODES)
+        
+        Grayscale and small palettes keep a session usable on very slow
+        links; 'text' keeps coloured text sharp at some cost in size.
+        
+        Args:
+            mode: One of COLOR_MODES
+        """
+        if mode not in COLOR_MODES:
+            raise ValueError(f"Unknown colour mode: {mode}")
+        self.color_mode = mode
+        return self.send_command('set_color_mode', {'mode': mode})
+    
+    def set_profiling(self, **options):
+        """
+        Switch profiling on the server on or off
+        
+        Args:
+            stages: Time the streaming stages
+            cprofile: Profile function calls of the streaming loop
+            tracemalloc: Trace memory allocations
+        """
+        return self.send_command('set_profiling', options)
+    
+    def _read_packet(self):
+        """
+        Read one frame or control message
+        
+        Returns:
+            tuple: (width, height, data), or None if the connection closed
+        """
+        # Receive frame header
+        header = self._recv_exact(12)
+        if not header:
+            return None
+        
+        width, height, data_length = struct.unpack('!III', header)
+        
+        # Receive frame data
+        data = self._recv_exact(data_length)
+        if data is None:
+            return None
+        return width, height, data
+    
+    def enable_udp(self, port=0, max_wait=0.1):
+        """
+        Ask the server to stream frames over UDP
+        
+        Input commands keep using the TCP connection.
+        
+        Args:
+            port: Local UDP port to listen on (0 for any free port)
+            max_wait: Seconds to wait for missing fragments of a frame
+        
+        Returns:
+            bool: True if the request was sent
+        """
+        if not self.connected:
+            return False
+        
+        self.udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.udp_socket.bind(('0.0.0.0', port))
+        self.udp_receiver = UdpFrameReceiver(
+            self.udp_socket,
+            max_wait=max_wait,
+            on_loss=lambda: self.send_command('request_keyframe', {})
+        )
+        return self.send_command('udp_subscribe', {'port': self.udp_socket.getsockname()[1]})
+    
+    def _receive_udp_frame(self):
+        """Wait for the next complete frame from the UDP receiver"""
+        while self.connected:
+            payload = self.udp_receiver.receive_frame(timeout=1.0)
+            if payload is None:
+                continue
+            
+            width, height, data_length = struct.unpack('!III', payload[:12])
+            img = self._apply_packet(width, height, payload[12:12 + data_length])
+            if img is not None:
+                return img
+        return None
+    
+    def _apply_packet(self, width, height, data):
+        """
+        Apply a packet from the server to the framebuffer
+        
+        Returns:
+            PIL.Image: Frame to show, or None for control messages
+        """
+        if width != CONTROL_FRAME:
+            # Decode JPEG image
+            self.framebuffer = decode_jpeg(data)
+            return self.framebuffer
+        if height == CONTROL_COPY_RECT:
+            return self._apply_copy_rect(data)
+        if height == CONTROL_TILES:
+            return self._apply_tiles(data)
+        if height == CONTROL_VIDEO:
+            return self._apply_video(data)
+        if height == CONTROL_FILE_DATA:
+            self._apply_file_chunk(data)
+            return None
+        if height == CONTROL_RAW:
+            from PIL import Image
+            width, height = RAW_HEADER.unpack_from(data)
+            self.framebuffer = Image.frombytes('RGB', (width, height), data[RAW_HEADER.size:])
+            return self.framebuffer
+        self._handle_control(height, data)
+        return None
+    
+    def _apply_copy_rect(self, data):
+        """Move part of the framebuffer and paste the patch (see send_copy_rect)"""
+        base = self.framebuffer
+        if base is None:
+            # Nothing to copy from yet (updates were lost)
+            self.send_command('request_keyframe', {})
+            return None
+        
+        x, y, w, h, dx, dy, px, py, pw, ph = COPY_RECT_HEADER.unpack_from(data)
+        # Work on a copy: the previous frame may still be on its way to the screen
+        frame = base.copy()
+        frame.paste(base.crop((x, y, x + w, y + h)), (x + dx, y + dy))
+        if pw and ph:
+            frame.paste(decode_jpeg(data[COPY_RECT_HEADER.size:]), (px, py))
+        self.framebuffer = frame
+        return frame
+    
+    def _apply_tiles(self, data):
+        """
+        Draw a tile update (see send_tiles)
+        
+        Returns:
+            PIL.Image: New frame, or None if nothing changed or the update
+            cannot be applied (a keyframe is then requested)
+        """
+        width, height, size, columns, flags, count = TILES_HEADER.unpack_from(data)
+        offset = TILES_HEADER.size
+        entries = TILE_ENTRY.iter_unpack(data[offset:offset + count * TILE_ENTRY.size])
+        atlas_jpeg = data[offset + count * TILE_ENTRY.size:]
+        
+        if flags & TILES_RESET:
+            from PIL import Image
+            self.tiles = {}
+            base = Image.new('RGB', (width, height))
+        else:
+            base = self.framebuffer
+            if base is None or base.size != (width, height):
+                self.send_command('request_keyframe', {})
+                return None
+            if not count:
+                return None
+        
+        atlas = decode_jpeg(atlas_jpeg) if atlas_jpeg else None
+        frame = base.copy()
+        new = 0
+        for col, row, slot, is_new in entries:
+            x, y = col * size, row * size
+            box_width, box_height = min(size, width - x), min(size, height - y)
+            if is_new:
+                ax, ay = (new % columns) * size, (new // columns) * size
+                tile = atlas.crop((ax, ay, ax + box_width, ay + box_height))
+                self.tiles[slot] = tile
+                new += 1
+            else:
+                tile = self.tiles.get(slot)
+                if tile is None:
+                    # Lost an update that filled this slot
+                    self.send_command('request_keyframe', {})
+                    return None
+            frame.paste(tile, (x, y))
+        self.framebuffer = frame
+        return frame
+    
+    def _apply_video(self, data):
+        """
+        Decode a frame of the video stream (see send_video)
+        
+        Returns:
+            PIL.Image: New frame, or None if it cannot be shown yet (a
+            keyframe is requested when frames were lost)
+        """
+        width, height, codec, flags = VIDEO_HEADER.unpack_from(data)
+        if self.video is None:
+            from video_codec import VideoDecoder
+            self.video = VideoDecoder()
+        img = self.video.decode(VIDEO_CODECS[codec], data[VIDEO_HEADER.size:],
+                                bool(flags & VIDEO_KEYFRAME))
+        if img is None:
+            if not self.video.synced:
+                self.send_command('request_keyframe', {})
+            return None
+        if img.size != (width, height):
+            img = img.crop((0, 0, width, height))
+        self.framebuffer = img
+        return img
+    
+    def upload(self, local_path, remote_path=None):
+        """
+        Send a file into the server's transfer directory
+        
+        A transfer cut off by a dropped connection resumes after reconnect;
+        on_transfer hears when it is done or failed.
+        
+        Args:
+            local_path: File to send
+            remote_path: Path under the server's transfer directory
+                (default: the file's name)
+        
+        Returns:
+            int: Transfer id, or None if it could not start
+        """
+        return self._start_transfer('put', remote_path or os.path.basename(local_path), local_path)
+    
+    def download(self, remote_path, local_path):
+        """
+        Fetch a file from the server's transfer directory
+        
+        A part file left by an earlier attempt at the same file is resumed.
+        
+        Args:
+            remote_path: Path under the server's transfer directory
+            local_path: Where to save it
+        
+        Returns:
+            int: Transfer id, or None if it could not start
+        """
+        return self._start_transfer('get', remote_path, local_path)
+    
+    def _start_transfer(self, kind, remote_path, local_path):
+        """Register a transfer and ask the server for it"""
+        if not self.connected:
+            return None
+        if self.udp_receiver:
+            print("File transfer needs frames over TCP, not UDP")
+            return None
+        transfer_id = self.next_transfer_id
+        self.next_transfer_id += 1
+        self.requested[transfer_id] = (kind, remote_path, local_path)
+        if not self._request_transfer(transfer_id):
+            return None
+        return transfer_id
+    
+    def _request_transfer(self, transfer_id):
+        """Ask the server to start or resume a transfer"""
+        kind, remote_path, local_path = self.requested[transfer_id]
+        if kind == 'get':
+            return self.send_command('file_get', {'id': transfer_id, 'path': remote_path})
+        try:
+            sender = FileSender(transfer_id, local_path)
+        except OSError as e:
+            self._transfer_ended(transfer_id, 'error', str(e))
+            return False
+        self.transfers[transfer_id] = sender
+        return self.send_command('file_put', {'id': transfer_id, 'path': remote_path,
+                                              'size': sender.size, 'mtime': sender.mtime})
+    
+    def _handle_file_message(self, msg):
+        """Apply a transfer message from the server (see file_transfer)"""
+        transfer_id = msg.get('id')
+        event = msg.get('event')
+        transfer = self.transfers.get(transfer_id)
+        if event == 'offer':
+            request = self.requested.get(transfer_id)
+            if not request or request[0] != 'get':
+                return
+            try:
+                receiver = FileReceiver(transfer_id, request[2], int(msg['size']),
+                                        int(msg.get('mtime', 0)))
+            except (OSError, KeyError, TypeError, ValueError) as e:
+                self.send_command('file_cancel', {'id': transfer_id})
+                self._transfer_ended(transfer_id, 'error', str(e))
+                return
+            self.transfers[transfer_id] = receiver
+            receiver.resend = True  # tells the server where to start
+            self._acknowledge_download(receiver)
+        elif event == 'ack' and isinstance(transfer, FileSender):
+            transfer.acknowledge(msg.get('offset', 0), msg.get('resend', False))
+            self.upload_wake.set()
+            if self.uploader is None or not self.uploader.is_alive():
+                self.uploader = threading.Thread(target=self._send_uploads, daemon=True)
+                self.uploader.start()
+        elif event in ('done', 'error'):
+            self._transfer_ended(transfer_id, event, msg.get('message', ''))
+    
+    def _apply_file_chunk(self, data):
+        """Write a download chunk (see NetworkServer.send_file_chunks)"""
+        transfer_id, offset, crc = FILE_CHUNK.unpack_from(data)
+        receiver = self.transfers.get(transfer_id)
+        if not isinstance(receiver, FileReceiver):
+            return
+        receiver.write(offset, crc, memoryview(data)[FILE_CHUNK.size:])
+        if receiver.ack_due():
+            self._acknowledge_download(receiver)
+    
+    def _acknowledge_download(self, receiver):
+        """Tell the server how far a download got, finishing it when complete"""
+        offset, resend = receiver.commit()
+        self.send_command('file_ack', {'id': receiver.transfer_id, 'offset': offset,
+                                       'resend': resend})
+        if receiver.complete:
+            receiver.finish()
+            self._transfer_ended(receiver.transfer_id, 'done', '')
+    
+    def _send_uploads(self):
+        """Send upload chunks while the socket has room (runs while uploads are pending)"""
+        while self.connected:
+            self.upload_wake.clear()
+            uploads = [transfer for transfer in list(self.transfers.values())
+                       if isinstance(transfer, FileSender)]
+            if not uploads:
+                return
+            senders = [sender for sender in uploads if sender.pending()]
+            if not senders:
+                # Window full: wait for the server's acknowledgement
+                self.upload_wake.wait(0.5)
+                continue
+            for sender in senders:
+                sock = self.socket
+                if not sock or not writable(sock, 0.5):
+                    break
+                try:
+                    with self.send_lock:
+                        if sender.file.closed:
+                            continue  # cancelled meanwhile
+                        offset, length, crc = sender.next_chunk()
+                        cmd = json.dumps({'type': 'file_data', 'data': {
+                            'id': sender.transfer_id, 'offset': offset, 'crc': crc, 'length': length
+                        }}).encode('utf-8')
+                        sock.sendall(struct.pack('!I', len(cmd)) + cmd)
+                        sender.send(sock, offset, length)
+                except OSError as e:
+                    # receive_frame notices the dropped connection and reconnects
+                    print(f"Upload interrupted: {e}")
+                    return
+    
+    def _transfer_ended(self, transfer_id, event, message):
+        """Forget a finished or failed transfer and report it"""
+        self.requested.pop(transfer_id, None)
+        transfer = self.transfers.pop(transfer_id, None)
+        if transfer:
+            with self.send_lock:
+                transfer.close()
+        if event == 'error':
+            print(f"File transfer {transfer_id} failed: {message}")
+        if self.on_transfer:
+            self.on_transfer(transfer_id, event, message)
+    
+    def _pause_transfers(self):
+        """Close the files of running transfers; they resume once reconnected"""
+        for transfer_id in list(self.transfers):
+            transfer = self.transfers.pop(transfer_id, None)
+            if transfer:
+                with self.send_lock:
+                    transfer.close()
+    
+    def _restart_transfers(self):
+        """Ask again for the transfers a dropped connection interrupted"""
+        for transfer_id in list(self.requested):
+            self._request_transfer(transfer_id)
+    
     def send_command(self, command_type, data):
         """
         Send a command to the server
@@ -201,7 +1322,8 @@ class NetworkClient:
             
             # Send command length and data
             length = struct.pack('!I', len(cmd_json))
-            self.socket.sendall(length + cmd_json)
+            with self.send_lock:
+                self.socket.sendall(length + cmd_json)
             return True
         except (socket.error, json.JSONEncodeError, UnicodeEncodeError) as e:
             print(f"Error sending command: {e}")
@@ -221,14 +1343,24 @@ class NetworkClient:
     def disconnect(self):
         """Disconnect from server"""
         self.connected = False
+        self._pause_transfers()
+        self.requested.clear()
         if self.socket:
+            try:
+                # Wakes a receive_frame() blocked in another thread
+                self.socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
             self.socket.close()
+        if self.udp_socket:
+            self.udp_socket.close()
 
 
 class NetworkServerWithRelay(NetworkServer):
     """Server with relay support for NAT traversal"""
     
-    def __init__(self, host='0.0.0.0', port=9876, relay_host=None, relay_port=8877, peer_id=None):
+    def __init__(self, host='0.0.0.0', port=9876, relay_host=None, relay_port=8877, peer_id=None,
+                 tags=None):
         """
         Initialize network server with relay support
         
@@ -238,13 +1370,16 @@ class NetworkServerWithRelay(NetworkServer):
             relay_host: Relay server address (None to disable relay)
             relay_port: Relay server port
             peer_id: Unique peer identifier for relay
+            tags: Groups this server is listed under on the relay
         """
         super().__init__(host, port)
         self.relay_host = relay_host
         self.relay_port = relay_port
         self.peer_id = peer_id or f"server_{port}"
+        self.tags = tags or []
         self.relay_client = None
         self.use_relay = relay_host is not None and RELAY_AVAILABLE
+        self.relay_streams = queue.Queue()
     
     def start_with_relay(self):
         """Start server and register with relay server"""
@@ -254,9 +1389,12 @@ class NetworkServerWithRelay(NetworkServer):
         # Register with relay if configured
         if self.use_relay:
             try:
+                from relay_client import RelayClient
                 self.relay_client = RelayClient(self.relay_host, self.relay_port)
-                if self.relay_client.connect(self.peer_id, 'server'):
+                if self.relay_client.connect(self.peer_id, 'server', self.tags):
                     print(f"[Server] Registered with relay server as '{self.peer_id}'")
+                    self.relay_client.set_callback('stream_request', self._on_stream_request)
+                    self.relay_client.set_callback('connection_request', self._on_connection_request)
                 else:
                     print(f"[Server] Failed to register with relay server")
                     self.relay_client = None
@@ -264,6 +1402,69 @@ class NetworkServerWithRelay(NetworkServer):
                 print(f"[Server] Relay registration error: {e}")
                 self.relay_client = None
     
+    def _on_stream_request(self, msg):
+        """Attach to a relayed stream requested by a client"""
+        def attach():
+            sock = self.relay_client.open_stream(msg.get('session_id'))
+            if sock:
+                self.relay_streams.put((sock, msg.get('from_peer_id'), 'relay stream'))
+        
+        threading.Thread(target=attach, daemon=True).start()
+    
+    def create_punch_socket(self):
+        """Create the UDP socket used to punch a direct path to a client"""
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind(('0.0.0.0', 0))
+        return sock
+    
+    def _on_connection_request(self, msg):
+        """Punch a direct UDP path for a client that asked for one"""
+        if not msg.get('session_id') or not msg.get('udp_endpoints'):
+            return
+        
+        def punch_path():
+            sock = self.create_punch_socket()
+            addr = None
+            try:
+                self.relay_client.accept_punch(msg, sock)
+                addr = punch(sock, msg['udp_endpoints'], msg['session_id'])
+            except Exception as e:
+                print(f"[Server] Hole punching error: {e}")
+            if addr:
+                self.relay_streams.put((UdpStream(sock, addr), msg.get('from_peer_id'), 'direct UDP path'))
+            else:
+                sock.close()
+        
+        threading.Thread(target=punch_path, daemon=True).start()
+    
+    def accept_connection(self):
+        """Wait for a direct connection or a stream relayed by the relay server"""
+        if not self.relay_client:
+            return super().accept_connection()
+        
+        while self.running and self.socket:
+            try:
+                readable, _, _ = select.select([self.socket], [], [], 0.2)
+            except (OSError, ValueError):
+                return False
+            if readable:
+                return super().accept_connection()
+            
+            try:
+                sock, from_peer_id, route = self.relay_streams.get_nowait()
+            except queue.Empty:
+                continue
+            
+            self.client_socket = sock
+            # No TCP address: the UDP frame channel cannot be set up
+            self.client_addr = None
+            self.udp_sender = None
+            self.keyframe_requested = False
+            print(f"Client '{from_peer_id}' connected via {route}")
+            if self.open_session():
+                return True
+        return False
+    
     def stop(self):
         """Stop server and disconnect from relay"""
         super().stop()
@@ -290,6 +1491,8 @@ class NetworkClientWithRelay(NetworkClient):
         self.relay_client = None
         self.use_relay = relay_host is not None and RELAY_AVAILABLE
         self.available_servers = []
+        self.server_port = 9876
+        self.target_peer_id = None
     
     def connect_via_relay(self, target_peer_id=None):
         """
@@ -307,6 +1510,7 @@ class NetworkClientWithRelay(NetworkClient):
         
         try:
             # Connect to relay server
+            from relay_client import RelayClient
             self.relay_client = RelayClient(self.relay_host, self.relay_port)
             if not self.relay_client.connect(self.peer_id, 'client'):
                 print("[Client] Failed to connect to relay server")
@@ -314,8 +1518,7 @@ class NetworkClientWithRelay(NetworkClient):
             
             # List available servers if no target specified
             if not target_peer_id:
-                peers = self.relay_client.list_peers()
-                servers = [p for p in peers if p.get('peer_type') == 'server']
+                servers = self.relay_client.list_peers(peer_type='server')
                 
                 if not servers:
                     print("[Client] No servers available")
@@ -328,45 +1531,105 @@ class NetworkClientWithRelay(NetworkClient):
                 target_peer_id = servers[0]['peer_id']
                 print(f"[Client] Connecting to server: {target_peer_id}")
             
+            self.target_peer_id = target_peer_id
+            
             # Get target server info
             peer_info = self.relay_client.get_peer_info(target_peer_id)
             if not peer_info:
                 print(f"[Client] Could not get info for server: {target_peer_id}")
                 return False
             
-            # Try direct connection first
-            print(f"[Client] Attempting direct connection to {peer_info['public_ip']}:{peer_info['public_port']}")
-            
-            # Note: Direct connection after NAT traversal is complex and may not work
-            # For now, we rely on the relay server for connection info
-            # In a full implementation, we would attempt hole punching here
-            
-            # For this implementation, we'll use the server's listening port
-            # which we know from the relay (typically 9876)
-            try:
-                direct_result = self.connect(peer_info['public_ip'], 9876)
-                if direct_result:
-                    print("[Client] Direct connection successful!")
-                    return True
-            except:
-                print("[Client] Direct connection failed, this is expected behind NAT")
+            # Try direct connection first, using the server's listening
+            # port (typically 9876) at its public address
+            print(f"[Client] Attempting direct connection to {peer_info['public_ip']}:{self.server_port}")
+            if self.connect(peer_info['public_ip'], self.server_port, timeout=3):
+                print("[Client] Direct connection successful!")
+                return True
+            print("[Client] Direct connection failed, this is expected behind NAT")
             
-            print("[Client] Connected via relay server")
-            print("[Client] Note: For data transfer, direct P2P connection is recommended")
-            print("[Client] You may need to configure port forwarding on the server side")
-            
-            return True
+            # Then punch a direct UDP path through both NATs
+            if self.connect_via_punch(target_peer_id):
+                return True
             
+            # Fall back to a raw stream spliced by the relay server
+            return self.connect_via_stream(target_peer_id)
+        
         except Exception as e:
             print(f"[Client] Relay connection error: {e}")
             if self.relay_client:
                 self.relay_client.disconnect()
             return False
     
+    def create_punch_socket(self):
+        """Create the UDP socket used to punch a direct path to the server"""
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind(('0.0.0.0', 0))
+        return sock
+    
+    def connect_via_punch(self, target_peer_id):
+        """
+        Open a direct UDP path to a server by hole punching
+        
+        Args:
+            target_peer_id: Server ID on the relay
+        
+        Returns:
+            bool: True if the punched path is now the session socket
+        """
+        sock = self.create_punch_socket()
+        addr = None
+        try:
+            session_id, endpoints = self.relay_client.request_punch(target_peer_id, sock)
+            if session_id:
+                addr = punch(sock, endpoints, session_id)
+        except Exception as e:
+            print(f"[Client] Hole punching error: {e}")
+        
+        if not addr:
+            sock.close()
+            print("[Client] Hole punching failed, falling back to relay stream")
+            return False
+        
+        self.socket = UdpStream(sock, addr)
+        self.connected = True
+        print(f"[Client] Direct UDP path to {addr[0]}:{addr[1]} established!")
+        return self.start_session()
+    
+    def connect_via_stream(self, target_peer_id):
+        """
+        Connect to a server through a stream spliced by the relay server
+        
+        Args:
+            target_peer_id: Server ID on the relay
+        
+        Returns:
+            bool: True if the relay stream is now the session socket
+        """
+        stream = self.relay_client.request_stream(target_peer_id)
+        if not stream:
+            print(f"[Client] Could not open relay stream to {target_peer_id}")
+            return False
+        
+        self.socket = stream
+        self.connected = True
+        print("[Client] Connected via relay server")
+        return self.start_session()
+    
+    def _redial(self):
+        """Reconnect over the same kind of path the lost connection used"""
+        if self.server_addr:
+            return super()._redial()
+        if not (self.relay_client and self.relay_client.connected and self.target_peer_id):
+            return False
+        return self.connect_via_punch(self.target_peer_id) or self.connect_via_stream(self.target_peer_id)
+    
     def list_available_servers(self):
         """
         List available servers from relay
         
+        The first call subscribes to server presence updates; later calls
+        return the locally maintained list without asking the relay again.
+        
         Returns:
             list: List of available servers
         """
@@ -375,12 +1638,14 @@ class NetworkClientWithRelay(NetworkClient):
         
         try:
             if not self.relay_client or not self.relay_client.connected:
+                from relay_client import RelayClient
                 self.relay_client = RelayClient(self.relay_host, self.relay_port)
                 if not self.relay_client.connect(self.peer_id, 'client'):
                     return []
             
-            peers = self.relay_client.list_peers()
-            servers = [p for p in peers if p.get('peer_type') == 'server']
+            if not self.relay_client.directory:
+                self.relay_client.subscribe(peer_type='server')
+            servers = self.relay_client.directory.list() if self.relay_client.directory else []
             self.available_servers = servers
             return servers
         except Exception as e:
@@ -109,23 +109,38 @@ def show_permission_instructions():
     return "No special permissions required."
 
 
-def get_default_network_interface():
+# Default interface address, looked up once (see get_default_network_interface)
+_default_interface = {}
+
+
+def get_default_network_interface(refresh=False):
     """
     Get the default network interface IP address
     
+    The lookup asks the OS for a route, which can stall while the network
+    is coming up, so the answer is cached: call it off the GUI thread the
+    first time, and pass refresh=True after the network changes.
+    
+    Args:
+        refresh: Look the address up again instead of using the cache
+    
     Returns:
         str: IP address or None
     """
-    import socket
-    try:
-        # Create a socket to get the default route
-        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        s.connect(("8.8.8.8", 80))
-        ip = s.getsockname()[0]
-        s.close()
-        return ip
-    except Exception:
-        return None
+    if refresh or 'ip' not in _default_interface:
+        import socket
+        try:
+            # Create a socket to get the default route
+            s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            try:
+                s.connect(("8.8.8.8", 80))
+                ip = s.getsockname()[0]
+            finally:
+                s.close()
+        except Exception:
+            ip = None
+        _default_interface['ip'] = ip
+    return _default_interface['ip']
 
 
 def get_all_ip_addresses():
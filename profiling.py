@@ -0,0 +1,222 @@
+"""
+LiteDesk - Profiling Module
+
+Low-overhead timers around the stages of the streaming loop (grab,
+convert, encode, send, command), kept as rolling windows of recent
+samples, plus cProfile and tracemalloc captures that can be switched on
+and off at runtime. Everything is off by default, and cProfile, pstats and
+tracemalloc are only imported once asked for.
+"""
+import sys
+import threading
+import time
+from collections import deque
+
+
+# Recent samples kept per stage
+WINDOW = 512
+
+# Functions / allocation sites listed in reports
+REPORT_LIMIT = 20
+
+
+class _NullTimer:
+    """Stage timer used while profiling is off"""
+    
+    __slots__ = ()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+NULL_TIMER = _NullTimer()
+
+
+class _StageTimer:
+    """Times one pass through a stage"""
+    
+    __slots__ = ('samples', 'started')
+    
+    def __init__(self, samples):
+        self.samples = samples
+        self.started = 0.0
+    
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+    
+    def __exit__(self, exc_type, exc, tb):
+        self.samples.append(time.perf_counter() - self.started)
+        return False
+
+
+def percentile(ordered, fraction):
+    """Nearest-rank percentile of a sorted list"""
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+class StageProfiler:
+    """
+    Per-stage timings and on-demand profiles of the streaming loop
+    
+    Usage:
+        with profiler.stage('encode'):
+            ...
+    
+    While disabled, stage() hands back a shared no-op timer, so the
+    instrumentation costs one method call per stage.
+    """
+    
+    def __init__(self, window=WINDOW):
+        """
+        Initialize profiler
+        
+        Args:
+            window: Recent samples kept per stage
+        """
+        self.window = window
+        self.enabled = False
+        self.samples = {}  # stage -> deque of seconds
+        self.counts = {}  # stage -> samples taken since enabled
+        self.profile = None
+        self.profile_report = None
+        self.cprofile_wanted = None  # requested cProfile state, applied by sync()
+        self.lock = threading.Lock()
+    
+    def stage(self, name):
+        """
+        Timer for one pass through a stage
+        
+        Args:
+            name: Stage name
+        
+        Returns:
+            Context manager recording the time spent inside it
+        """
+        if not self.enabled:
+            return NULL_TIMER
+        samples = self.samples.get(name)
+        if samples is None:
+            samples = self.samples.setdefault(name, deque(maxlen=self.window))
+        self.counts[name] = self.counts.get(name, 0) + 1
+        return _StageTimer(samples)
+    
+    def set_enabled(self, enabled):
+        """Turn stage timing on or off (turning it on clears old samples)"""
+        if enabled and not self.enabled:
+            self.samples = {}
+            self.counts = {}
+        self.enabled = bool(enabled)
+    
+    def start_cprofile(self):
+        """
+        Start profiling function calls
+        
+        cProfile follows the thread that calls this, which should be the
+        streaming loop.
+        """
+        import cProfile
+        with self.lock:
+            if self.profile:
+                return
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+    
+    def stop_cprofile(self, limit=REPORT_LIMIT):
+        """
+        Stop profiling function calls and keep the report
+        
+        Returns:
+            str: Functions with the most cumulative time, or None
+        """
+        import io
+        import pstats
+        with self.lock:
+            if not self.profile:
+                return self.profile_report
+            self.profile.disable()
+            out = io.StringIO()
+            pstats.Stats(self.profile, stream=out).sort_stats('cumulative').print_stats(limit)
+            self.profile = None
+            self.profile_report = out.getvalue()
+            return self.profile_report
+    
+    def request_cprofile(self, enabled):
+        """Ask the streaming thread to start or stop cProfile at its next sync()"""
+        self.cprofile_wanted = bool(enabled)
+    
+    def sync(self):
+        """Apply a pending cProfile request (called by the streaming thread)"""
+        wanted = self.cprofile_wanted
+        if wanted is None:
+            return
+        self.cprofile_wanted = None
+        if wanted:
+            self.start_cprofile()
+        else:
+            self.stop_cprofile()
+    
+    def start_tracemalloc(self):
+        """Start tracing memory allocations"""
+        import tracemalloc
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+    
+    def stop_tracemalloc(self):
+        """Stop tracing memory allocations"""
+        tracemalloc = sys.modules.get('tracemalloc')
+        if tracemalloc and tracemalloc.is_tracing():
+            tracemalloc.stop()
+    
+    def allocations(self, limit=REPORT_LIMIT):
+        """
+        Largest allocation sites while tracemalloc is on
+        
+        Returns:
+            list: {'site', 'size_kb', 'count'} dicts, or None when not tracing
+        """
+        tracemalloc = sys.modules.get('tracemalloc')
+        if not tracemalloc or not tracemalloc.is_tracing():
+            return None
+        top = tracemalloc.take_snapshot().statistics('lineno')[:limit]
+        return [{'site': str(stat.traceback), 'size_kb': round(stat.size / 1024, 1),
+                 'count': stat.count} for stat in top]
+    
+    def stage_stats(self):
+        """
+        Summarize the recent samples of every stage
+        
+        Returns:
+            dict: stage -> count, avg/p50/p95/p99/max in milliseconds
+        """
+        stats = {}
+        for name, samples in list(self.samples.items()):
+            ordered = sorted(samples)
+            if not ordered:
+                continue
+            stats[name] = {
+                'count': self.counts.get(name, len(ordered)),
+                'avg_ms': sum(ordered) / len(ordered) * 1000,
+                'p50_ms': percentile(ordered, 0.50) * 1000,
+                'p95_ms': percentile(ordered, 0.95) * 1000,
+                'p99_ms': percentile(ordered, 0.99) * 1000,
+                'max_ms': ordered[-1] * 1000,
+            }
+        return stats
+    
+    def stats(self):
+        """
+        Everything a get_stats request reports
+        
+        Returns:
+            dict: Stage statistics and profile/allocation reports
+        """
+        return {
+            'enabled': self.enabled,
+            'stages': self.stage_stats(),
+            'cprofile': 'running' if self.profile or self.cprofile_wanted else self.profile_report,
+            'tracemalloc': self.allocations(),
+        }
@@ -2,12 +2,77 @@
 LiteDesk - Relay Client Module
 
 Provides relay server connectivity for NAT traversal.
+
+Requests carry a request_id that the relay echoes in its reply. A single
+reader thread owns the control socket and completes the matching future,
+so any number of requests can be in flight at once.
 """
 import socket
 import struct
 import json
+import itertools
 import threading
 import time
+import secrets
+from concurrent.futures import Future, TimeoutError as FutureTimeout, wait, FIRST_COMPLETED
+
+from hole_punch import local_endpoints, discover_endpoint, PUNCH_TIMEOUT
+
+
+class PeerDirectory:
+    """
+    Local copy of the relay's peer list, kept current by presence updates
+    
+    Filled from 'subscribed' pages and then patched by 'presence' deltas.
+    Every entry remembers the registry version it was last updated at, so
+    a page or delta that arrives after a newer update is ignored.
+    """
+    
+    def __init__(self, peer_type=None, tag=None):
+        self.peer_type = peer_type
+        self.tag = tag
+        self.peers = {}  # peer_id -> entry
+        self.versions = {}  # peer_id -> version of the last update applied
+        self.version = 0
+        self.ready = threading.Event()
+        self.lock = threading.Lock()
+        self.on_change = None
+    
+    def apply_page(self, entries, version):
+        """Merge one list page taken at a registry version"""
+        with self.lock:
+            for entry in entries:
+                if self.versions.get(entry['peer_id'], 0) <= version:
+                    self.peers[entry['peer_id']] = entry
+                    self.versions[entry['peer_id']] = version
+            self.version = max(self.version, version)
+    
+    def apply_delta(self, msg):
+        """
+        Apply a presence update
+        
+        Returns:
+            bool: True if the update changed the directory
+        """
+        peer = msg['peer']
+        version = msg['version']
+        with self.lock:
+            if self.versions.get(peer['peer_id'], 0) > version:
+                return False
+            self.versions[peer['peer_id']] = version
+            if msg['event'] == 'join':
+                self.peers[peer['peer_id']] = peer
+            else:
+                self.peers.pop(peer['peer_id'], None)
+            self.version = max(self.version, version)
+        if self.on_change:
+            self.on_change(msg['event'], peer)
+        return True
+    
+    def list(self):
+        """Peers currently known, in peer ID order"""
+        with self.lock:
+            return [self.peers[peer_id] for peer_id in sorted(self.peers)]
 
 
 class RelayClient:
@@ -31,14 +96,26 @@ class RelayClient:
         self.public_port = None
         self.callbacks = {}
         self.running = False
+        self.directory = None
+        self.pending = {}  # request_id -> Future awaiting the reply
+        self.pending_lock = threading.Lock()
+        self.send_lock = threading.Lock()
+        self.request_ids = itertools.count(1)
+        self.heartbeat_interval = None
+        self.udp_port = None
+        self.udp_token = None
+        self.punch_waiters = {}  # session_id -> Future awaiting 'punch_ready'
+        self.last_sent = 0.0
+        self.stopped = threading.Event()
     
-    def connect(self, peer_id, peer_type):
+    def connect(self, peer_id, peer_type, tags=None):
         """
         Connect to relay server and register
         
         Args:
             peer_id: Unique identifier for this peer
             peer_type: 'server' or 'client'
+            tags: Optional list of groups to be listed under
         
         Returns:
             bool: True if connected and registered
@@ -49,6 +126,7 @@ class RelayClient:
             
             # Connect to relay server
             self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
             self.socket.connect((self.relay_host, self.relay_port))
             self.connected = True
             
@@ -58,7 +136,8 @@ class RelayClient:
             self.send_message({
                 'type': 'register',
                 'peer_id': peer_id,
-                'peer_type': peer_type
+                'peer_type': peer_type,
+                'tags': list(tags or [])
             })
             
             # Wait for registration confirmation
@@ -66,11 +145,17 @@ class RelayClient:
             if msg and msg.get('type') == 'registered':
                 self.public_ip = msg.get('public_ip')
                 self.public_port = msg.get('public_port')
+                self.heartbeat_interval = msg.get('heartbeat_interval')
+                self.udp_port = msg.get('udp_port')
+                self.udp_token = msg.get('udp_token')
                 print(f"[Relay Client] Registered as '{peer_id}' (public: {self.public_ip}:{self.public_port})")
                 
                 # Start message handler thread
                 self.running = True
+                self.stopped.clear()
                 threading.Thread(target=self._message_handler, daemon=True).start()
+                if self.heartbeat_interval:
+                    threading.Thread(target=self._heartbeat_loop, daemon=True).start()
                 
                 return True
             else:
@@ -83,9 +168,15 @@ class RelayClient:
             self.connected = False
             return False
     
-    def list_peers(self):
+    def list_peers(self, peer_type=None, tag=None, after=None, limit=None):
         """
-        Get list of available peers from relay server
+        Get one page of available peers from relay server
+        
+        Args:
+            peer_type: Peer type to list (default: the opposite of ours)
+            tag: Only list peers registered with this tag
+            after: Cursor returned with the previous page
+            limit: Maximum peers to return (the relay caps this)
         
         Returns:
             list: List of peer dictionaries
@@ -93,11 +184,11 @@ class RelayClient:
         if not self.connected:
             return []
         
+        request = {'type': 'list_peers', 'peer_type': peer_type, 'tag': tag, 'after': after}
+        if limit:
+            request['limit'] = limit
         try:
-            self.send_message({'type': 'list_peers'})
-            
-            # Wait for response
-            msg = self.recv_message(timeout=5)
+            msg = self.request(request, timeout=5)
             if msg and msg.get('type') == 'peer_list':
                 return msg.get('peers', [])
         except Exception as e:
@@ -105,12 +196,66 @@ class RelayClient:
         
         return []
     
-    def get_peer_info(self, target_peer_id):
+    def subscribe(self, peer_type=None, tag=None, timeout=5):
+        """
+        Subscribe to presence updates for peers of one type (and tag)
+        
+        The relay answers with list pages, fetched here until the directory
+        is complete, and then pushes a join or leave update whenever a
+        matching peer registers or disconnects.
+        
+        Args:
+            peer_type: Peer type to follow (default: the opposite of ours)
+            tag: Only follow peers registered with this tag
+            timeout: Seconds to wait for the initial listing
+        
+        Returns:
+            PeerDirectory: Live directory, or None on failure
+        """
+        if not self.connected:
+            return None
+        
+        self.directory = PeerDirectory(peer_type, tag)
+        try:
+            self.send_message({'type': 'subscribe', 'peer_type': peer_type, 'tag': tag})
+        except Exception as e:
+            print(f"[Relay Client] Error subscribing: {e}")
+            return None
+        
+        if not self.directory.ready.wait(timeout):
+            print("[Relay Client] Timed out waiting for peer list")
+        return self.directory
+    
+    def unsubscribe(self):
+        """Stop presence updates"""
+        self.directory = None
+        if self.connected:
+            self.send_message({'type': 'unsubscribe'})
+    
+    def _on_subscribed(self, msg):
+        """Merge a subscription page and request the next one"""
+        directory = self.directory
+        if not directory:
+            return
+        directory.peer_type = msg.get('peer_type')
+        directory.apply_page(msg.get('peers', []), msg.get('version', 0))
+        if msg.get('next_cursor'):
+            self.send_message({
+                'type': 'subscribe',
+                'peer_type': directory.peer_type,
+                'tag': directory.tag,
+                'after': msg['next_cursor']
+            })
+        else:
+            directory.ready.set()
+    
+    def get_peer_info(self, target_peer_id, notify=True):
         """
         Get connection info for a specific peer
         
         Args:
             target_peer_id: ID of target peer
+            notify: Let the target know we intend to connect
         
         Returns:
             dict: Peer info or None
@@ -119,25 +264,135 @@ class RelayClient:
             return None
         
         try:
-            self.send_message({
-                'type': 'get_peer_info',
-                'target_id': target_peer_id
-            })
-            
-            # Wait for response
-            msg = self.recv_message(timeout=10)
-            if msg and msg.get('type') == 'peer_info':
-                return {
-                    'peer_id': msg.get('peer_id'),
-                    'peer_type': msg.get('peer_type'),
-                    'public_ip': msg.get('public_ip'),
-                    'public_port': msg.get('public_port')
-                }
+            msg = self.request(self._peer_info_request(target_peer_id, notify), timeout=10)
+            return self._peer_info_result(msg)
         except Exception as e:
             print(f"[Relay Client] Error getting peer info: {e}")
         
         return None
     
+    def get_peer_info_many(self, target_peer_ids, notify=False, timeout=10):
+        """
+        Look up several peers with all requests in flight at once
+        
+        Args:
+            target_peer_ids: IDs of the peers to look up
+            notify: Let each target know we intend to connect
+            timeout: Seconds to wait for all replies
+        
+        Returns:
+            dict: Peer ID -> peer info, or None where the lookup failed
+        """
+        if not self.connected:
+            return {peer_id: None for peer_id in target_peer_ids}
+        
+        try:
+            futures = dict(zip(target_peer_ids, self.request_many_async(
+                [self._peer_info_request(peer_id, notify) for peer_id in target_peer_ids]
+            )))
+        except Exception as e:
+            print(f"[Relay Client] Error getting peer info: {e}")
+            futures = {}
+        wait(list(futures.values()), timeout=timeout)
+        
+        results = {}
+        for peer_id in target_peer_ids:
+            future = futures.get(peer_id)
+            if future and future.done() and not future.exception():
+                results[peer_id] = self._peer_info_result(future.result())
+            else:
+                results[peer_id] = None
+                if future:
+                    self._forget(future)
+        return results
+    
+    def _peer_info_request(self, target_peer_id, notify):
+        request = {'type': 'get_peer_info', 'target_id': target_peer_id}
+        if not notify:
+            request['notify'] = False
+        return request
+    
+    def _peer_info_result(self, msg):
+        if msg and msg.get('type') == 'peer_info':
+            return {
+                'peer_id': msg.get('peer_id'),
+                'peer_type': msg.get('peer_type'),
+                'public_ip': msg.get('public_ip'),
+                'public_port': msg.get('public_port')
+            }
+        return None
+    
+    def request(self, msg, timeout=10):
+        """
+        Send a request and wait for its reply
+        
+        Args:
+            msg: Request message (a request_id is added)
+            timeout: Seconds to wait for the reply
+        
+        Returns:
+            dict: Reply message, or None on timeout or disconnect
+        """
+        future = self.request_async(msg)
+        try:
+            return future.result(timeout)
+        except FutureTimeout:
+            self._forget(future)
+            return None
+        except ConnectionError:
+            return None
+    
+    def request_async(self, msg):
+        """
+        Send a request without waiting
+        
+        Returns:
+            Future: Completed with the reply message by the reader thread
+        """
+        return self.request_many_async([msg])[0]
+    
+    def request_many_async(self, msgs):
+        """
+        Send several requests in one write without waiting
+        
+        Returns:
+            list: One Future per request, in order
+        """
+        futures = []
+        data = b''
+        with self.pending_lock:
+            for msg in msgs:
+                future = Future()
+                future.request_id = next(self.request_ids)
+                self.pending[future.request_id] = future
+                futures.append(future)
+                msg_json = json.dumps(dict(msg, request_id=future.request_id)).encode('utf-8')
+                data += struct.pack('!I', len(msg_json)) + msg_json
+        try:
+            with self.send_lock:
+                self.socket.sendall(data)
+            self.last_sent = time.monotonic()
+        except Exception:
+            self.connected = False
+            for future in futures:
+                self._forget(future)
+            raise
+        return futures
+    
+    def _forget(self, future):
+        """Stop waiting for a request's reply"""
+        with self.pending_lock:
+            self.pending.pop(future.request_id, None)
+    
+    def _fail_pending(self):
+        """Fail every outstanding request (connection lost)"""
+        with self.pending_lock:
+            pending = list(self.pending.values())
+            self.pending.clear()
+        for future in pending:
+            if not future.done():
+                future.set_exception(ConnectionError('relay connection closed'))
+    
     def relay_data(self, target_peer_id, data):
         """
         Relay data to another peer through server
@@ -160,22 +415,172 @@ class RelayClient:
             print(f"[Relay Client] Error relaying data: {e}")
             return False
     
+    def udp_endpoints(self, sock):
+        """
+        Endpoints the peer should probe to reach a UDP socket
+        
+        Args:
+            sock: Bound UDP socket that will be used for punching
+        
+        Returns:
+            list: [ip, port] pairs, public endpoint first when known
+        """
+        endpoints = local_endpoints(sock)
+        if self.udp_port and self.udp_token:
+            observed = discover_endpoint(sock, (self.relay_host, self.udp_port),
+                                         self.peer_id, self.udp_token)
+            if observed and observed not in endpoints:
+                endpoints.insert(0, observed)
+        return endpoints
+    
+    def request_punch(self, target_peer_id, sock, timeout=PUNCH_TIMEOUT):
+        """
+        Ask another peer to punch a direct UDP path with us
+        
+        Args:
+            target_peer_id: Target peer ID
+            sock: Bound UDP socket that will be used for punching
+            timeout: Seconds to wait for the peer's endpoints
+        
+        Returns:
+            tuple: (session_id, peer endpoints), or (None, None)
+        """
+        if not self.connected:
+            return None, None
+        
+        session_id = secrets.token_hex(16)
+        ready = Future()
+        with self.pending_lock:
+            self.punch_waiters[session_id] = ready
+        failed = None
+        try:
+            # The relay only replies to the request itself on error
+            failed = self.request_async({
+                'type': 'request_punch',
+                'target_id': target_peer_id,
+                'session_id': session_id,
+                'udp_endpoints': self.udp_endpoints(sock)
+            })
+            wait([ready, failed], timeout=timeout, return_when=FIRST_COMPLETED)
+        except Exception as e:
+            print(f"[Relay Client] Error requesting punch: {e}")
+        finally:
+            with self.pending_lock:
+                self.punch_waiters.pop(session_id, None)
+            if failed:
+                self._forget(failed)
+        
+        if ready.done():
+            return session_id, ready.result()['udp_endpoints']
+        return None, None
+    
+    def accept_punch(self, msg, sock):
+        """
+        Answer a punch request with our own UDP endpoints
+        
+        Args:
+            msg: 'connection_request' message carrying session_id
+            sock: Bound UDP socket that will be used for punching
+        """
+        self.send_message({
+            'type': 'punch_accept',
+            'to_peer_id': msg['from_peer_id'],
+            'session_id': msg['session_id'],
+            'udp_endpoints': self.udp_endpoints(sock)
+        })
+    
+    def request_stream(self, target_peer_id, timeout=10):
+        """
+        Open a raw byte stream to another peer through the relay
+        
+        Args:
+            target_peer_id: Target peer ID
+            timeout: Seconds to wait for the target to attach
+        
+        Returns:
+            socket: Connected stream socket, or None
+        """
+        if not self.connected:
+            return None
+        
+        session_id = secrets.token_hex(16)
+        try:
+            self.send_message({
+                'type': 'request_stream',
+                'target_id': target_peer_id,
+                'session_id': session_id
+            })
+        except Exception as e:
+            print(f"[Relay Client] Error requesting stream: {e}")
+            return None
+        
+        return self.open_stream(session_id, timeout)
+    
+    def open_stream(self, session_id, timeout=10):
+        """
+        Attach a new data connection to a stream session
+        
+        Once both peers are attached the relay splices the two connections
+        and forwards bytes without parsing them.
+        
+        Args:
+            session_id: Stream session to join
+            timeout: Seconds to wait for the other peer
+        
+        Returns:
+            socket: Connected stream socket, or None
+        """
+        sock = None
+        try:
+            sock = socket.create_connection((self.relay_host, self.relay_port), timeout=timeout)
+            self.send_message({
+                'type': 'stream_attach',
+                'session_id': session_id,
+                'peer_id': self.peer_id
+            }, sock=sock)
+            
+            msg = self.recv_message(timeout=timeout, sock=sock)
+            if msg and msg.get('type') == 'stream_started':
+                sock.settimeout(None)
+                print(f"[Relay Client] Stream {session_id[:8]} started")
+                return sock
+            print(f"[Relay Client] Stream {session_id[:8]} was not started")
+        except Exception as e:
+            print(f"[Relay Client] Error opening stream: {e}")
+        
+        if sock:
+            sock.close()
+        return None
+    
     def set_callback(self, event_type, callback):
         """
         Set callback for relay events
         
         Args:
-            event_type: 'connection_request' or 'relayed_data'
+            event_type: 'connection_request', 'relayed_data' or 'stream_request'
+                (a connection_request carrying session_id and udp_endpoints
+                asks for a hole punch, see accept_punch)
             callback: Function to call with message data
         """
         self.callbacks[event_type] = callback
     
     def _message_handler(self):
-        """Handle incoming messages from relay server"""
+        """Read every message from the relay: replies and pushed events"""
         while self.running and self.connected:
             try:
-                msg = self.recv_message(timeout=1)
+                msg = self.recv_message()
                 if not msg:
+                    # Connection closed
+                    self.connected = False
+                    break
+                
+                request_id = msg.get('request_id')
+                if request_id is not None:
+                    # Reply to one of our requests
+                    with self.pending_lock:
+                        future = self.pending.pop(request_id, None)
+                    if future and not future.done():
+                        future.set_result(msg)
                     continue
                 
                 msg_type = msg.get('type')
@@ -192,6 +597,28 @@ class RelayClient:
                     if callback:
                         callback(msg)
                 
+                elif msg_type == 'stream_request':
+                    # Another peer wants a relayed data stream
+                    callback = self.callbacks.get('stream_request')
+                    if callback:
+                        callback(msg)
+                
+                elif msg_type == 'punch_ready':
+                    # The peer we asked to punch sent its endpoints
+                    with self.pending_lock:
+                        ready = self.punch_waiters.get(msg.get('session_id'))
+                    if ready and not ready.done():
+                        ready.set_result(msg)
+                
+                elif msg_type == 'subscribed':
+                    # Page of the peer list for our subscription
+                    self._on_subscribed(msg)
+                
+                elif msg_type == 'presence':
+                    # A followed peer joined or left
+                    if self.directory:
+                        self.directory.apply_delta(msg)
+                
                 elif msg_type == 'ping':
                     # Respond to ping
                     self.send_message({'type': 'heartbeat'})
@@ -199,39 +626,60 @@ class RelayClient:
                 elif msg_type == 'heartbeat_ack':
                     # Heartbeat acknowledged
                     pass
-                
+            
             except Exception as e:
                 if self.running:
                     print(f"[Relay Client] Message handler error: {e}")
                 break
+        
+        self._fail_pending()
+    
+    def _heartbeat_loop(self):
+        """Keep the registration alive while nothing else is being sent"""
+        interval = self.heartbeat_interval
+        while not self.stopped.wait(interval / 2):
+            if not (self.running and self.connected):
+                break
+            if time.monotonic() - self.last_sent >= interval:
+                try:
+                    self.send_message({'type': 'heartbeat'})
+                except Exception:
+                    break
     
-    def send_message(self, msg):
+    def send_message(self, msg, sock=None):
         """Send a JSON message to relay server"""
         try:
             msg_json = json.dumps(msg).encode('utf-8')
             length = struct.pack('!I', len(msg_json))
-            self.socket.sendall(length + msg_json)
+            if sock is not None:
+                sock.sendall(length + msg_json)
+            else:
+                with self.send_lock:
+                    self.socket.sendall(length + msg_json)
+                self.last_sent = time.monotonic()
         except Exception as e:
-            self.connected = False
+            if sock is None:
+                self.connected = False
             raise
     
-    def recv_message(self, timeout=None):
+    def recv_message(self, timeout=None, sock=None):
         """Receive a JSON message from relay server"""
+        sock = sock or self.socket
         if timeout:
-            self.socket.settimeout(timeout)
+            sock.settimeout(timeout)
         else:
-            self.socket.settimeout(None)
+            sock.settimeout(None)
         
         try:
             # Receive message length
-            length_data = self._recv_exact(4)
+            length_data = self._recv_exact(4, sock)
             if not length_data:
                 return None
             
             length = struct.unpack('!I', length_data)[0]
             
             # Receive message data
-            msg_data = self._recv_exact(length)
+            msg_data = self._recv_exact(length, sock)
             if not msg_data:
                 return None
             
@@ -241,11 +689,12 @@ class RelayClient:
         except:
             return None
     
-    def _recv_exact(self, size):
+    def _recv_exact(self, size, sock=None):
         """Receive exact number of bytes"""
+        sock = sock or self.socket
         data = b''
         while len(data) < size:
-            packet = self.socket.recv(size - len(data))
+            packet = sock.recv(size - len(data))
             if not packet:
                 return None
             data += packet
@@ -255,7 +704,13 @@ class RelayClient:
         """Disconnect from relay server"""
         self.running = False
         self.connected = False
+        self.stopped.set()
         if self.socket:
+            try:
+                # Wake the reader thread blocked on this socket
+                self.socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
             try:
                 self.socket.close()
             except:
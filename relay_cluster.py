@@ -0,0 +1,715 @@
+"""
+LiteDesk - Relay Cluster Module
+
+Runs several event-loop relay workers on one port using SO_REUSEPORT so
+the relay can use every core. Workers share a SQLite peer registry and
+reach each other through Unix datagram mailboxes: control messages for a
+peer on another worker are forwarded there, presence updates are
+broadcast to every worker's subscribers, and stream connections are
+handed to the worker that owns the stream session by passing the socket
+file descriptor (SCM_RIGHTS).
+
+Linux only. Started through relay_server.py:
+    python3 relay_server.py --workers 4
+"""
+import array
+import json
+import multiprocessing
+import os
+import queue
+import secrets
+import selectors
+import shutil
+import signal
+import socket
+import sqlite3
+import tempfile
+import threading
+import time
+
+from relay_server import (
+    EventLoopRelayServer, STREAM_ATTACH_TIMEOUT, DEFAULT_PAGE_SIZE, IDLE_TIMEOUT,
+    HEARTBEAT_INTERVAL, presence_message
+)
+from relay_metrics import MetricsServer
+
+
+# Largest mailbox datagram (control messages forwarded between workers)
+MAILBOX_SIZE = 256 * 1024
+
+
+class SharedPeerRegistry:
+    """Peer registry shared by all workers through a SQLite database"""
+    
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS peers (
+            peer_id TEXT PRIMARY KEY,
+            peer_type TEXT NOT NULL,
+            public_ip TEXT,
+            public_port INTEGER,
+            worker INTEGER NOT NULL,
+            tags TEXT NOT NULL DEFAULT '[]'
+        );
+        CREATE INDEX IF NOT EXISTS peers_by_type ON peers (peer_type, peer_id);
+        CREATE TABLE IF NOT EXISTS peer_tags (
+            peer_type TEXT NOT NULL,
+            tag TEXT NOT NULL,
+            peer_id TEXT NOT NULL,
+            PRIMARY KEY (peer_type, tag, peer_id)
+        );
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value INTEGER NOT NULL
+        );
+        INSERT OR IGNORE INTO meta VALUES ('version', 0);
+        CREATE TABLE IF NOT EXISTS streams (
+            session_id TEXT PRIMARY KEY,
+            worker INTEGER NOT NULL,
+            created_at REAL NOT NULL
+        );
+    """
+    
+    def __init__(self, path):
+        """
+        Open the registry
+        
+        Args:
+            path: SQLite database file created by SharedPeerRegistry.create
+        """
+        self.path = path
+        self.db = sqlite3.connect(path, timeout=10, isolation_level=None)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=OFF')
+    
+    @classmethod
+    def create(cls, path):
+        """Create an empty registry database"""
+        registry = cls(path)
+        registry.db.executescript(cls.SCHEMA)
+        registry.close()
+    
+    def register(self, peer_id, peer_type, public_ip, public_port, worker, tags=()):
+        """
+        Record a peer as connected to a worker
+        
+        Returns:
+            tuple: (worker that previously held this peer ID or None,
+                    registry version)
+        """
+        self.db.execute('BEGIN IMMEDIATE')
+        try:
+            row = self.db.execute(
+                'SELECT worker FROM peers WHERE peer_id = ?', (peer_id,)
+            ).fetchone()
+            self.db.execute('DELETE FROM peer_tags WHERE peer_id = ?', (peer_id,))
+            self.db.execute(
+                'INSERT OR REPLACE INTO peers VALUES (?, ?, ?, ?, ?, ?)',
+                (peer_id, peer_type, public_ip, public_port, worker, json.dumps(list(tags)))
+            )
+            self.db.executemany(
+                'INSERT INTO peer_tags VALUES (?, ?, ?)',
+                [(peer_type, tag, peer_id) for tag in tags]
+            )
+            version = self._bump_version()
+            self.db.execute('COMMIT')
+        except Exception:
+            self.db.execute('ROLLBACK')
+            raise
+        return (row[0] if row else None), version
+    
+    def unregister(self, peer_id, worker):
+        """
+        Remove a peer unless another worker has taken it over
+        
+        Returns:
+            int: Registry version after removal, or None if not removed
+        """
+        self.db.execute('BEGIN IMMEDIATE')
+        try:
+            cursor = self.db.execute(
+                'DELETE FROM peers WHERE peer_id = ? AND worker = ?', (peer_id, worker)
+            )
+            version = None
+            if cursor.rowcount:
+                self.db.execute('DELETE FROM peer_tags WHERE peer_id = ?', (peer_id,))
+                version = self._bump_version()
+            self.db.execute('COMMIT')
+        except Exception:
+            self.db.execute('ROLLBACK')
+            raise
+        return version
+    
+    def _bump_version(self):
+        """Increment the registry version (inside a transaction)"""
+        self.db.execute("UPDATE meta SET value = value + 1 WHERE key = 'version'")
+        return self.version()
+    
+    def version(self):
+        """Current registry version"""
+        return self.db.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()[0]
+    
+    def get(self, peer_id):
+        """
+        Look up a peer
+        
+        Returns:
+            dict: Peer fields including its worker, or None
+        """
+        row = self.db.execute(
+            'SELECT peer_id, peer_type, public_ip, public_port, worker '
+            'FROM peers WHERE peer_id = ?', (peer_id,)
+        ).fetchone()
+        if not row:
+            return None
+        return dict(zip(('peer_id', 'peer_type', 'public_ip', 'public_port', 'worker'), row))
+    
+    def page(self, peer_type, tag=None, after=None, limit=DEFAULT_PAGE_SIZE, exclude_id=None):
+        """
+        List peers of one type (and tag) in peer ID order
+        
+        Both queries walk an index from the cursor, so a page costs the
+        same however many peers are registered.
+        
+        Returns:
+            tuple: (entries, next cursor or None)
+        """
+        if tag is None:
+            rows = self.db.execute(
+                'SELECT peer_id, peer_type, tags FROM peers '
+                'WHERE peer_type = ? AND peer_id > ? AND peer_id != ? '
+                'ORDER BY peer_id LIMIT ?',
+                (peer_type, after or '', exclude_id or '', limit + 1)
+            ).fetchall()
+        else:
+            rows = self.db.execute(
+                'SELECT p.peer_id, p.peer_type, p.tags FROM peer_tags t '
+                'JOIN peers p ON p.peer_id = t.peer_id '
+                'WHERE t.peer_type = ? AND t.tag = ? AND t.peer_id > ? AND t.peer_id != ? '
+                'ORDER BY t.peer_id LIMIT ?',
+                (peer_type, tag, after or '', exclude_id or '', limit + 1)
+            ).fetchall()
+        entries = [
+            {'peer_id': peer_id, 'peer_type': kind, 'tags': json.loads(tags)}
+            for peer_id, kind, tags in rows[:limit]
+        ]
+        next_cursor = entries[-1]['peer_id'] if len(rows) > limit else None
+        return entries, next_cursor
+    
+    def add_stream(self, session_id, worker):
+        """Record which worker owns a stream session"""
+        self.db.execute(
+            'INSERT OR REPLACE INTO streams VALUES (?, ?, ?)',
+            (session_id, worker, time.time())
+        )
+    
+    def remove_stream(self, session_id):
+        """Forget a stream session"""
+        self.db.execute('DELETE FROM streams WHERE session_id = ?', (session_id,))
+    
+    def stream_owner(self, session_id):
+        """Return the worker owning a stream session, or None"""
+        row = self.db.execute(
+            'SELECT worker FROM streams WHERE session_id = ?', (session_id,)
+        ).fetchone()
+        return row[0] if row else None
+    
+    def expire_streams(self, max_age):
+        """Forget stream sessions older than max_age seconds"""
+        self.db.execute(
+            'DELETE FROM streams WHERE created_at < ?', (time.time() - max_age,)
+        )
+    
+    def clear_worker(self, worker):
+        """Drop everything recorded by a worker (on worker start)"""
+        self.db.execute(
+            'DELETE FROM peer_tags WHERE peer_id IN '
+            '(SELECT peer_id FROM peers WHERE worker = ?)', (worker,)
+        )
+        self.db.execute('DELETE FROM peers WHERE worker = ?', (worker,))
+        self.db.execute('DELETE FROM streams WHERE worker = ?', (worker,))
+    
+    def close(self):
+        """Close the database connection"""
+        self.db.close()
+
+
+class RemotePeer:
+    """A peer registered on another worker"""
+    
+    def __init__(self, peer_id, peer_type, public_ip, public_port, worker):
+        self.peer_id = peer_id
+        self.peer_type = peer_type
+        self.public_ip = public_ip
+        self.public_port = public_port
+        self.worker = worker
+        self.socket = None
+        self.outbox = None
+
+
+class RelayWorker(EventLoopRelayServer):
+    """
+    Event-loop relay that shares its registry with sibling workers
+    
+    Writes to the shared registry run on a writer thread so a busy
+    database never stalls the loop; a peer is confirmed and announced
+    once its registration is written. Peers on sibling workers are found
+    in an in-memory table kept up to date from their presence broadcasts.
+    """
+    
+    # Short ticks so parked stream attaches are routed promptly
+    HOUSEKEEPING_INTERVAL = 0.1
+    
+    # Seconds between registry stream cleanups
+    STREAM_CLEANUP_INTERVAL = 10
+    
+    # Peers per envelope when sending our peer table to a new sibling
+    PEERS_PER_ENVELOPE = 1000
+    
+    def __init__(self, worker_id, host, port, run_dir, registry_path,
+                 idle_timeout=IDLE_TIMEOUT, heartbeat_interval=HEARTBEAT_INTERVAL,
+                 udp_secret=None):
+        """
+        Initialize relay worker
+        
+        Args:
+            worker_id: Index of this worker
+            host: IP address to bind to
+            port: Port number shared by all workers
+            run_dir: Directory holding the workers' mailbox sockets
+            registry_path: Shared SQLite registry file
+            idle_timeout: Seconds without any message before a peer is dropped
+            heartbeat_interval: Seconds between heartbeats asked of clients
+            udp_secret: Key for UDP probe tokens, shared by all workers since
+                any of them may receive a peer's probe
+        """
+        super().__init__(host, port, idle_timeout, heartbeat_interval)
+        if udp_secret:
+            self.udp_secret = udp_secret
+        self.worker_id = worker_id
+        self.run_dir = run_dir
+        self.registry_path = registry_path
+        self.registry = None
+        self.mailbox = None
+        self.next_stream_cleanup = 0
+        self.siblings = set()  # worker IDs with a mailbox
+        self.remote_peers = {}  # peer_id -> RemotePeer on a sibling worker
+        self.writes = queue.Queue()  # (job, callback) for the writer thread
+        self.written = queue.Queue()  # (callback, result) for the loop
+        self.writer = None
+        self.wakeup = None
+    
+    def mailbox_path(self, worker_id):
+        """Path of a worker's mailbox socket"""
+        return os.path.join(self.run_dir, f'worker-{worker_id}.sock')
+    
+    def create_listener(self):
+        """Create a listening socket shared with sibling workers"""
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind((self.host, self.port))
+        sock.listen(1024)
+        return sock
+    
+    def create_udp_socket(self, port):
+        """Create a UDP rendezvous socket shared with sibling workers"""
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind((self.host, port))
+        return sock
+    
+    def serve_forever(self):
+        """Open the registry, writer and mailbox, then run the event loop"""
+        self.registry = SharedPeerRegistry(self.registry_path)
+        self.registry.clear_worker(self.worker_id)
+        
+        wakeup, self.wakeup = socket.socketpair()
+        wakeup.setblocking(False)
+        self.wakeup.setblocking(False)
+        self.selector.register(wakeup, selectors.EVENT_READ,
+                               lambda: self._on_written(wakeup))
+        self.writer = threading.Thread(target=self._write_loop, daemon=True)
+        self.writer.start()
+        
+        path = self.mailbox_path(self.worker_id)
+        if os.path.exists(path):
+            os.unlink(path)
+        self.mailbox = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.mailbox.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * MAILBOX_SIZE)
+        self.mailbox.bind(path)
+        self.mailbox.setblocking(False)
+        self.selector.register(self.mailbox, selectors.EVENT_READ, self._on_mailbox)
+        
+        # Workers bound before us are listed here; they add us on our hello
+        # and answer with their peers. Workers bound later send us theirs.
+        for name in os.listdir(self.run_dir):
+            if name.startswith('worker-') and name.endswith('.sock'):
+                worker = int(name[len('worker-'):-len('.sock')])
+                if worker != self.worker_id:
+                    self.siblings.add(worker)
+        for worker in self.sibling_workers():
+            self.post(worker, {'op': 'hello', 'worker': self.worker_id})
+        
+        print(f"[Relay Worker {self.worker_id}] Serving (pid {os.getpid()})")
+        try:
+            super().serve_forever()
+        finally:
+            self.writes.put(None)
+            self.writer.join(5)
+            self.registry.clear_worker(self.worker_id)
+            self.registry.close()
+            self.mailbox.close()
+            self.wakeup.close()
+            wakeup.close()
+    
+    # Registry writes
+    
+    def write_registry(self, job, callback=None):
+        """
+        Run job(registry) on the writer thread
+        
+        Args:
+            job: Function of the writer's SharedPeerRegistry
+            callback: Called with the job's result on the loop thread
+        """
+        self.writes.put((job, callback))
+    
+    def _write_loop(self):
+        """Writer thread: apply registry writes in order"""
+        registry = SharedPeerRegistry(self.registry_path)
+        try:
+            while True:
+                item = self.writes.get()
+                if item is None:
+                    break
+                job, callback = item
+                try:
+                    result = job(registry)
+                except Exception as e:
+                    print(f"[Relay Worker {self.worker_id}] Registry write failed: {e}")
+                    continue
+                if callback:
+                    self.written.put((callback, result))
+                    try:
+                        self.wakeup.send(b'\0')
+                    except (BlockingIOError, OSError):
+                        # Loop already has a wakeup pending, or is stopping
+                        pass
+        finally:
+            registry.close()
+    
+    def _on_written(self, wakeup):
+        """Run the loop-side callbacks of finished registry writes"""
+        try:
+            while wakeup.recv(4096):
+                pass
+        except (BlockingIOError, InterruptedError):
+            pass
+        while True:
+            try:
+                callback, result = self.written.get_nowait()
+            except queue.Empty:
+                return
+            callback(result)
+    
+    # Registry
+    
+    def add_peer(self, peer_info):
+        """Register locally now and in the shared registry on the writer"""
+        old_peer, _ = super().add_peer(peer_info)
+        self.remote_peers.pop(peer_info.peer_id, None)
+        self.write_registry(
+            lambda registry: registry.register(
+                peer_info.peer_id, peer_info.peer_type, peer_info.public_ip,
+                peer_info.public_port, self.worker_id, peer_info.tags
+            ),
+            lambda result: self._registered(peer_info, *result)
+        )
+        # Confirmed by _registered, with the shared registry's version
+        return old_peer, None
+    
+    def _registered(self, peer_info, previous, version):
+        """Confirm and announce a peer once the shared registry has it"""
+        if previous is not None and previous != self.worker_id:
+            # Same peer re-registered through another worker
+            self.post(previous, {'op': 'drop', 'peer_id': peer_info.peer_id})
+        self.confirm_peer(peer_info, version)
+    
+    def confirm_peer(self, peer_info, version):
+        """Confirm a peer that is still connected; announce it regardless"""
+        if self.peers.get(peer_info.peer_id) is peer_info:
+            super().confirm_peer(peer_info, version)
+        else:
+            # Gone already: its leave follows this join
+            self.publish_presence('join', peer_info, version)
+    
+    def remove_peer(self, peer_info):
+        """Unregister locally and, if still ours, in the shared registry"""
+        if super().remove_peer(peer_info) is not None:
+            self.write_registry(
+                lambda registry: registry.unregister(peer_info.peer_id, self.worker_id),
+                lambda version: self._unregistered(peer_info, version)
+            )
+        # The leave is announced by _unregistered
+        return None
+    
+    def _unregistered(self, peer_info, version):
+        """Announce a leave unless another worker has taken the peer over"""
+        if version is not None:
+            print(f"[Relay Server] Unregistered '{peer_info.peer_id}'")
+            self.publish_presence('leave', peer_info, version)
+    
+    def find_peer(self, peer_id):
+        """Look up a peer on this worker or any sibling"""
+        return self.peers.get(peer_id) or self.remote_peers.get(peer_id)
+    
+    def list_peer_page(self, peer_type, tag, after, limit, exclude_id):
+        """List one page of peers across all workers"""
+        # Read the version first: the page is at least this recent
+        version = self.registry.version()
+        entries, next_cursor = self.registry.page(peer_type, tag, after, limit, exclude_id)
+        return entries, next_cursor, version
+    
+    def publish_presence(self, event, peer_info, version):
+        """Announce a join or leave here and on every sibling worker"""
+        super().publish_presence(event, peer_info, version)
+        envelope = {
+            'op': 'presence',
+            'msg': presence_message(event, peer_info, version),
+            'location': self._location(peer_info)
+        }
+        for worker in self.sibling_workers():
+            self.post(worker, envelope)
+    
+    def _location(self, peer_info):
+        """Fields a sibling needs to reach a peer of ours"""
+        return {'peer_id': peer_info.peer_id, 'peer_type': peer_info.peer_type,
+                'public_ip': peer_info.public_ip, 'public_port': peer_info.public_port,
+                'worker': self.worker_id}
+    
+    def sibling_workers(self):
+        """IDs of the other workers with a mailbox in the run directory"""
+        return sorted(self.siblings)
+    
+    def _forget_worker(self, worker):
+        """Drop the peers a sibling worker held"""
+        for peer_id, peer in list(self.remote_peers.items()):
+            if peer.worker == worker:
+                del self.remote_peers[peer_id]
+    
+    def send_to_peer(self, peer, msg):
+        """Send to a local peer, or forward to the worker holding it"""
+        if isinstance(peer, RemotePeer):
+            self.post(peer.worker, {'op': 'deliver', 'peer_id': peer.peer_id, 'msg': msg})
+        else:
+            super().send_to_peer(peer, msg)
+    
+    # Streams
+    
+    def handle_request_stream(self, requester, target_id, session_id, request_id=None):
+        """Own the stream session and publish it to sibling workers"""
+        if session_id:
+            self.write_registry(lambda registry: registry.add_stream(session_id, self.worker_id))
+        super().handle_request_stream(requester, target_id, session_id, request_id)
+        if session_id and session_id not in self.streams:
+            self.write_registry(lambda registry: registry.remove_stream(session_id))
+    
+    def handle_stream_attach(self, client_socket, addr, msg):
+        """Hand stream connections to the worker owning the session"""
+        session_id = msg.get('session_id')
+        if session_id not in self.streams:
+            owner = self.registry.stream_owner(session_id)
+            if owner is not None and owner != self.worker_id:
+                self._forward_attach(owner, client_socket, addr, msg)
+                return
+        super().handle_stream_attach(client_socket, addr, msg)
+    
+    def _forward_attach(self, worker, client_socket, addr, msg):
+        """Pass a stream socket to another worker"""
+        self.post(worker, {'op': 'attach', 'addr': list(addr), 'msg': msg},
+                  fds=[client_socket.fileno()])
+        client_socket.close()
+    
+    def housekeeping(self):
+        """Route parked stream attaches and expire old stream records"""
+        super().housekeeping()
+        
+        for session_id, early in list(self.early_attaches.items()):
+            owner = self.registry.stream_owner(session_id)
+            if owner is not None and owner != self.worker_id:
+                del self.early_attaches[session_id]
+                self._forward_attach(owner, *early[:3])
+        
+        now = time.monotonic()
+        if now >= self.next_stream_cleanup:
+            self.write_registry(lambda registry: registry.expire_streams(STREAM_ATTACH_TIMEOUT))
+            self.next_stream_cleanup = now + self.STREAM_CLEANUP_INTERVAL
+    
+    # Mailbox
+    
+    def post(self, worker, envelope, fds=()):
+        """Send an envelope to a sibling worker's mailbox"""
+        ancdata = []
+        if fds:
+            ancdata.append((socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array('i', fds)))
+        try:
+            self.mailbox.sendmsg([json.dumps(envelope).encode('utf-8')], ancdata, 0,
+                                 self.mailbox_path(worker))
+        except (FileNotFoundError, ConnectionRefusedError):
+            # Worker gone; it says hello again if it restarts
+            print(f"[Relay Worker {self.worker_id}] Worker {worker} has stopped")
+            self.siblings.discard(worker)
+            self._forget_worker(worker)
+        except OSError as e:
+            print(f"[Relay Worker {self.worker_id}] Cannot reach worker {worker}: {e}")
+    
+    def _on_mailbox(self):
+        """Handle envelopes from sibling workers"""
+        while True:
+            try:
+                data, fds = self._receive_envelope()
+            except (BlockingIOError, InterruptedError):
+                return
+            
+            try:
+                envelope = json.loads(data.decode('utf-8'))
+                self._handle_envelope(envelope, fds)
+            except Exception as e:
+                print(f"[Relay Worker {self.worker_id}] Bad mailbox message: {e}")
+                for fd in fds:
+                    os.close(fd)
+    
+    def _receive_envelope(self):
+        """Read one mailbox datagram and the descriptors passed with it"""
+        # recvmsg rather than socket.recv_fds, which needs Python 3.9
+        fds = array.array('i')
+        data, ancdata, _, _ = self.mailbox.recvmsg(MAILBOX_SIZE, socket.CMSG_SPACE(fds.itemsize))
+        for level, kind, cmsg_data in ancdata:
+            if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+                fds.frombytes(cmsg_data[:len(cmsg_data) - len(cmsg_data) % fds.itemsize])
+        return data, list(fds)
+    
+    def _handle_envelope(self, envelope, fds):
+        """Act on one envelope from a sibling worker"""
+        op = envelope.get('op')
+        
+        if op == 'deliver':
+            peer = self.peers.get(envelope['peer_id'])
+            if peer:
+                self.send_message(peer.socket, envelope['msg'])
+        
+        elif op == 'presence':
+            location = envelope['location']
+            peer_id = location['peer_id']
+            if envelope['msg']['event'] == 'join':
+                self.remote_peers[peer_id] = RemotePeer(**location)
+            else:
+                peer = self.remote_peers.get(peer_id)
+                if peer and peer.worker == location['worker']:
+                    del self.remote_peers[peer_id]
+            self.deliver_presence(envelope['msg'])
+        
+        elif op == 'hello':
+            # A sibling (re)started: it holds no peers yet, send it ours
+            worker = envelope['worker']
+            self.siblings.add(worker)
+            self._forget_worker(worker)
+            locations = [self._location(peer) for peer in self.peers.values()]
+            for start in range(0, len(locations), self.PEERS_PER_ENVELOPE):
+                self.post(worker, {'op': 'peers',
+                                   'peers': locations[start:start + self.PEERS_PER_ENVELOPE]})
+        
+        elif op == 'peers':
+            for location in envelope['peers']:
+                if location['peer_id'] not in self.peers:
+                    self.remote_peers[location['peer_id']] = RemotePeer(**location)
+        
+        elif op == 'drop':
+            peer = self.peers.get(envelope['peer_id'])
+            if peer:
+                self.drop_socket(peer.socket)
+        
+        elif op == 'attach' and fds:
+            sock = socket.socket(fileno=fds[0])
+            sock.setblocking(True)
+            self.handle_stream_attach(sock, tuple(envelope['addr']), envelope['msg'])
+
+
+def run_worker(worker_id, host, port, run_dir, registry_path, idle_timeout, heartbeat_interval,
+               metrics_port=None, udp_secret=None):
+    """Process entry point for one relay worker"""
+    worker = RelayWorker(worker_id, host, port, run_dir, registry_path,
+                         idle_timeout, heartbeat_interval, udp_secret)
+    if metrics_port is not None:
+        MetricsServer(worker, port=metrics_port + worker_id).start()
+    signal.signal(signal.SIGTERM, lambda signum, frame: worker.stop())
+    try:
+        worker.start()
+    except KeyboardInterrupt:
+        worker.stop()
+
+
+class RelayCluster:
+    """Starts and supervises relay worker processes"""
+    
+    def __init__(self, host='0.0.0.0', port=8877, workers=None, idle_timeout=IDLE_TIMEOUT,
+                 heartbeat_interval=HEARTBEAT_INTERVAL, metrics_port=None):
+        """
+        Initialize relay cluster
+        
+        Args:
+            host: IP address to bind to
+            port: Port number shared by all workers
+            workers: Number of worker processes (default: one per CPU)
+            idle_timeout: Seconds without any message before a peer is dropped
+            heartbeat_interval: Seconds between heartbeats asked of clients
+            metrics_port: First metrics port; worker N serves on this port + N
+        """
+        self.host = host
+        self.port = port
+        self.workers = workers or os.cpu_count() or 1
+        self.metrics_port = metrics_port
+        self.idle_timeout = idle_timeout
+        self.heartbeat_interval = heartbeat_interval
+        self.processes = []
+        self.run_dir = None
+    
+    def start(self):
+        """Create the shared registry and spawn the workers"""
+        if not hasattr(socket, 'SO_REUSEPORT'):
+            raise RuntimeError('SO_REUSEPORT is not supported on this platform')
+        
+        self.run_dir = tempfile.mkdtemp(prefix='litedesk-relay-')
+        registry_path = os.path.join(self.run_dir, 'registry.db')
+        SharedPeerRegistry.create(registry_path)
+        udp_secret = secrets.token_bytes(16)
+        
+        for worker_id in range(self.workers):
+            process = multiprocessing.Process(
+                target=run_worker,
+                args=(worker_id, self.host, self.port, self.run_dir, registry_path,
+                      self.idle_timeout, self.heartbeat_interval, self.metrics_port,
+                      udp_secret),
+                daemon=True
+            )
+            process.start()
+            self.processes.append(process)
+        
+        print(f"[Relay Server] Started {self.workers} workers on {self.host}:{self.port}")
+    
+    def wait(self):
+        """Block until all workers exit"""
+        for process in self.processes:
+            process.join()
+    
+    def stop(self):
+        """Stop all workers and remove the shared state"""
+        for process in self.processes:
+            if process.is_alive():
+                process.terminate()
+        for process in self.processes:
+            process.join(5)
+        self.processes = []
+        if self.run_dir:
+            shutil.rmtree(self.run_dir, ignore_errors=True)
+            self.run_dir = None
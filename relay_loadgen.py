@@ -0,0 +1,669 @@
+#!/usr/bin/env python3
+"""
+LiteDesk Relay Load Generator
+
+Measures what a relay server can carry, for sizing relay hosts and for
+comparing relay changes run over run. Two scenarios:
+
+- idle: registers many silent peers, then measures list and lookup
+  latency and the relay's memory use per peer.
+- mixed: registers many peers that keep listing, looking each other up,
+  heart-beating and relaying data at set rates, and reports throughput,
+  p50/p99/p99.9 latency, errors and the relay's memory and file
+  descriptors.
+
+The mixed scenario speaks the RelayClient protocol from one event loop
+rather than running a RelayClient per peer (each of which costs two
+threads), so a single process can drive thousands of peers. Requests are
+issued on a fixed schedule and latency is counted from when a request
+was due, not when it went out: if the relay (or this tool) falls behind,
+that shows up as latency instead of as a quietly lower request rate.
+
+Usage:
+    python3 relay_loadgen.py --spawn --peers 10000
+    python3 relay_loadgen.py --host relay.example.com --port 8877 --peers 2000
+    python3 relay_loadgen.py --spawn --scenario mixed --peers 5000 --relays 2000 \\
+        --output after.json --compare before.json
+"""
+import argparse
+import json
+import os
+import random
+import selectors
+import socket
+import struct
+import subprocess
+import sys
+import time
+
+from relay_server import encode_message
+
+try:
+    import resource
+    RESOURCE_AVAILABLE = True
+except ImportError:
+    RESOURCE_AVAILABLE = False
+
+
+# Request kinds of the mixed scenario, in report order
+OPERATIONS = ('list', 'lookup', 'heartbeat', 'relay')
+
+# Seconds to wait for replies still outstanding when a run ends
+DRAIN_SECONDS = 2.0
+
+
+def recv_exact(sock, size):
+    """Receive exact number of bytes"""
+    data = b''
+    while len(data) < size:
+        packet = sock.recv(size - len(data))
+        if not packet:
+            return None
+        data += packet
+    return data
+
+
+def recv_message(sock):
+    """Receive one length-prefixed JSON message"""
+    header = recv_exact(sock, 4)
+    if not header:
+        return None
+    length = struct.unpack('!I', header)[0]
+    return json.loads(recv_exact(sock, length))
+
+
+def request(sock, msg):
+    """Send a message and wait for the reply"""
+    sock.sendall(encode_message(msg))
+    return recv_message(sock)
+
+
+def process_tree(pid):
+    """A process and all its descendants (Linux), e.g. relay workers"""
+    pids = [pid]
+    for current in pids:
+        try:
+            for task in os.listdir(f'/proc/{current}/task'):
+                with open(f'/proc/{current}/task/{task}/children') as f:
+                    pids.extend(int(child) for child in f.read().split())
+        except OSError:
+            pass
+    return pids
+
+
+def process_stats(pid, children=True):
+    """
+    Read memory and file-descriptor use of a local process
+    
+    Args:
+        pid: Process to read
+        children: Add up its descendants too (relay workers)
+    
+    Returns:
+        dict: rss_kb and fds, or None values where unavailable
+    """
+    stats = {'rss_kb': None, 'fds': None}
+    for member in process_tree(pid) if children else [pid]:
+        try:
+            with open(f'/proc/{member}/status') as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        stats['rss_kb'] = (stats['rss_kb'] or 0) + int(line.split()[1])
+            stats['fds'] = (stats['fds'] or 0) + len(os.listdir(f'/proc/{member}/fd'))
+        except OSError:
+            pass
+    return stats
+
+
+def raise_fd_limit():
+    """Raise this process's open-file limit to the hard limit (one socket per peer)"""
+    if not RESOURCE_AVAILABLE:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft != hard:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+        except (ValueError, OSError):
+            pass
+
+
+def percentile(samples, pct):
+    """Return the pct-th percentile of a list of samples"""
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(len(ordered) * pct / 100))
+    return ordered[index]
+
+
+def latency_summary(timings):
+    """
+    Summarize latency samples
+    
+    Args:
+        timings: Latencies in milliseconds
+    
+    Returns:
+        dict: p50_ms, p99_ms, p999_ms and max_ms (None without samples)
+    """
+    summary = {}
+    for name, pct in (('p50_ms', 50), ('p99_ms', 99), ('p999_ms', 99.9), ('max_ms', 100)):
+        value = percentile(timings, pct)
+        summary[name] = round(value, 3) if value is not None else None
+    return summary
+
+
+def spawn_relay(port, mode, workers=1, idle_timeout=3600):
+    """Start a local relay server subprocess and wait until it accepts"""
+    here = os.path.dirname(os.path.abspath(__file__))
+    proc = subprocess.Popen(
+        [sys.executable, os.path.join(here, 'relay_server.py'),
+         '--host', '127.0.0.1', '--port', str(port), '--mode', mode,
+         '--workers', str(workers),
+         # Idle load peers stay silent on purpose: keep them registered
+         '--idle-timeout', str(idle_timeout)],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    for _ in range(100):
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=0.5).close()
+            return proc
+        except OSError:
+            time.sleep(0.05)
+    proc.kill()
+    raise RuntimeError('relay server did not start')
+
+
+def register_idle_peers(host, port, count):
+    """Open count connections, each registered as an idle server peer"""
+    socks = []
+    for i in range(count):
+        sock = socket.create_connection((host, port))
+        sock.sendall(encode_message({
+            'type': 'register', 'peer_id': f'load_server_{i}', 'peer_type': 'server'
+        }))
+        socks.append(sock)
+    for sock in socks:
+        sock.settimeout(30)
+        reply = recv_message(sock)
+        if not reply or reply.get('type') != 'registered':
+            raise RuntimeError('registration failed')
+    return socks
+
+
+def measure_latency(sock, msg, samples):
+    """Time request/reply round trips in milliseconds"""
+    timings = []
+    for _ in range(samples):
+        start = time.perf_counter()
+        request(sock, msg)
+        timings.append((time.perf_counter() - start) * 1000)
+    return timings
+
+
+def run_idle(host, port, peers, samples, relay_pid=None):
+    """
+    Register idle peers and measure control-plane latency
+    
+    Returns:
+        dict: Results suitable for JSON output
+    """
+    baseline = process_stats(relay_pid) if relay_pid else None
+    
+    start = time.perf_counter()
+    socks = register_idle_peers(host, port, peers)
+    register_s = time.perf_counter() - start
+    
+    probe = socket.create_connection((host, port))
+    probe.settimeout(30)
+    request(probe, {'type': 'register', 'peer_id': 'load_probe', 'peer_type': 'client'})
+    
+    results = {
+        'scenario': 'idle',
+        'peers': peers,
+        'register_seconds': round(register_s, 3),
+        'registrations_per_second': round(peers / register_s, 1) if register_s else None,
+    }
+    for name, msg in (
+        ('list', {'type': 'list_peers'}),
+        ('lookup', {'type': 'get_peer_info', 'target_id': f'load_server_{peers // 2}'}),
+    ):
+        timings = measure_latency(probe, msg, samples)
+        results[f'{name}_p50_ms'] = round(percentile(timings, 50), 3)
+        results[f'{name}_p99_ms'] = round(percentile(timings, 99), 3)
+    
+    if relay_pid:
+        stats = process_stats(relay_pid)
+        results['relay_rss_kb'] = stats['rss_kb']
+        results['relay_fds'] = stats['fds']
+        if baseline and baseline['rss_kb'] and stats['rss_kb']:
+            results['rss_kb_per_peer'] = round((stats['rss_kb'] - baseline['rss_kb']) / peers, 2)
+    
+    probe.close()
+    for sock in socks:
+        sock.close()
+    return results
+
+
+class LoadPeer:
+    """One simulated peer: a non-blocking connection and its buffers"""
+    
+    __slots__ = ('peer_id', 'peer_type', 'sock', 'inbox', 'outbox', 'register_sent', 'registered')
+    
+    def __init__(self, peer_id, peer_type, sock):
+        self.peer_id = peer_id
+        self.peer_type = peer_type
+        self.sock = sock
+        self.inbox = bytearray()
+        self.outbox = bytearray()
+        self.register_sent = None
+        self.registered = False
+
+
+class LoadGenerator:
+    """Drives many relay peers issuing requests on a fixed schedule"""
+    
+    def __init__(self, host, port, peers, rates, heartbeat_interval=10.0,
+                 relay_size=256, server_fraction=0.5, seed=0):
+        """
+        Initialize load generator
+        
+        Args:
+            host: Relay server host
+            port: Relay server port
+            peers: Peers to register
+            rates: Requests per second across all peers, by kind ('list',
+                'lookup', 'relay'; missing or 0: none)
+            heartbeat_interval: Seconds between heartbeats of each peer
+                (0: none)
+            relay_size: Payload characters per relayed message
+            server_fraction: Share of peers registered as servers (the rest
+                are clients)
+            seed: Seed for choosing peers, so runs are repeatable
+        """
+        self.host = host
+        self.port = port
+        self.peer_count = peers
+        self.rates = {kind: rates.get(kind, 0) for kind in OPERATIONS if kind != 'heartbeat'}
+        if heartbeat_interval:
+            self.rates['heartbeat'] = peers / heartbeat_interval
+        self.relay_size = relay_size
+        self.server_fraction = server_fraction
+        self.random = random.Random(seed)
+        self.selector = selectors.DefaultSelector()
+        self.peers = []
+        self.by_socket = {}
+        self.next_request = 0
+        self.pending = {}  # request_id -> (kind, due)
+        self.sent = {kind: 0 for kind in OPERATIONS}
+        self.errors = {kind: 0 for kind in OPERATIONS}
+        self.latencies = {kind: [] for kind in OPERATIONS}
+        self.register_latencies = []
+        self.ignored = 0  # pushed messages nobody asked for (presence, notices)
+        self.run_seconds = 0
+    
+    def connect(self, timeout=60):
+        """
+        Open and register every peer
+        
+        Returns:
+            float: Seconds the registrations took
+        
+        Raises:
+            RuntimeError: Not every peer was registered within timeout
+        """
+        servers = int(self.peer_count * self.server_fraction)
+        start = time.perf_counter()
+        for i in range(self.peer_count):
+            peer_type = 'server' if i < servers else 'client'
+            sock = socket.create_connection((self.host, self.port), timeout=timeout)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            sock.setblocking(False)
+            peer = LoadPeer(f'load_{peer_type}_{i}', peer_type, sock)
+            self.peers.append(peer)
+            self.by_socket[sock] = peer
+            self.selector.register(sock, selectors.EVENT_READ, peer)
+            peer.register_sent = time.perf_counter()
+            self.send(peer, {'type': 'register', 'peer_id': peer.peer_id,
+                             'peer_type': peer_type})
+            # Read replies as we go so the relay's send buffers never fill up
+            self.poll(0)
+        
+        deadline = time.perf_counter() + timeout
+        while len(self.register_latencies) < self.peer_count:
+            if time.perf_counter() > deadline:
+                raise RuntimeError(f'only {len(self.register_latencies)} of '
+                                   f'{self.peer_count} peers registered')
+            self.poll(0.05)
+        return time.perf_counter() - start
+    
+    def send(self, peer, msg):
+        """Queue a message for a peer and write what the socket takes now"""
+        peer.outbox += encode_message(msg)
+        self.flush(peer)
+    
+    def flush(self, peer):
+        """Write a peer's queued bytes, waiting for writability if they do not fit"""
+        was_waiting = len(peer.outbox) > 0
+        try:
+            sent = peer.sock.send(peer.outbox)
+            del peer.outbox[:sent]
+        except (BlockingIOError, InterruptedError):
+            pass
+        events = selectors.EVENT_READ | (selectors.EVENT_WRITE if peer.outbox else 0)
+        if was_waiting or peer.outbox:
+            self.selector.modify(peer.sock, events, peer)
+    
+    def poll(self, timeout):
+        """Handle socket events for up to timeout seconds"""
+        for key, events in self.selector.select(timeout):
+            peer = key.data
+            if events & selectors.EVENT_WRITE:
+                self.flush(peer)
+            if events & selectors.EVENT_READ:
+                self.receive(peer)
+    
+    def receive(self, peer):
+        """Read from a peer's socket and handle every complete message"""
+        try:
+            data = peer.sock.recv(256 * 1024)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            data = b''
+        if not data:
+            raise RuntimeError(f'relay closed the connection of {peer.peer_id}')
+        inbox = peer.inbox
+        inbox += data
+        offset = 0
+        while len(inbox) - offset >= 4:
+            length = struct.unpack_from('!I', inbox, offset)[0]
+            if len(inbox) - offset - 4 < length:
+                break
+            msg = json.loads(bytes(inbox[offset + 4:offset + 4 + length]))
+            offset += 4 + length
+            self.handle(peer, msg, time.perf_counter())
+        del inbox[:offset]
+    
+    def handle(self, peer, msg, now):
+        """Match a message from the relay to the request it answers"""
+        msg_type = msg.get('type')
+        if msg_type == 'registered':
+            peer.registered = True
+            self.register_latencies.append((now - peer.register_sent) * 1000)
+            return
+        if msg_type == 'relayed_data':
+            # Delivered to the target: the request ID leads the payload
+            try:
+                request_id = int(str(msg.get('data')).partition(':')[0])
+            except ValueError:
+                request_id = None
+        else:
+            request_id = msg.get('request_id')
+        request = self.pending.pop(request_id, None)
+        if request is None:
+            self.ignored += 1
+            return
+        kind, due = request
+        if msg_type == 'error':
+            self.errors[kind] += 1
+        else:
+            self.latencies[kind].append((now - due) * 1000)
+    
+    def issue(self, kind, due, heartbeat_peer):
+        """Send one request of a kind that was due at a given time"""
+        request_id = self.next_request
+        self.next_request += 1
+        if kind == 'heartbeat':
+            peer = heartbeat_peer
+            msg = {'type': 'heartbeat'}
+        else:
+            peer, target = self.random.sample(self.peers, 2)
+            if kind == 'list':
+                msg = {'type': 'list_peers'}
+            elif kind == 'lookup':
+                msg = {'type': 'get_peer_info', 'target_id': target.peer_id, 'notify': False}
+            else:
+                payload = f'{request_id}:'
+                msg = {'type': 'relay_data', 'target_id': target.peer_id,
+                       'data': payload + 'x' * max(0, self.relay_size - len(payload))}
+        msg['request_id'] = request_id
+        self.pending[request_id] = (kind, due)
+        self.sent[kind] += 1
+        self.send(peer, msg)
+    
+    def run(self, duration, on_tick=None):
+        """
+        Issue requests at the configured rates for a while
+        
+        Args:
+            duration: Seconds to generate load
+            on_tick: Called about once a second (e.g. to sample the relay)
+        """
+        if len(self.peers) < 2:
+            raise RuntimeError('at least two peers are needed')
+        start = time.perf_counter()
+        end = start + duration
+        # Kind -> [seconds between requests, next due time]; first requests
+        # are spread so the kinds do not all fire at once
+        schedule = {kind: [1.0 / rate, start + self.random.random() / rate]
+                    for kind, rate in self.rates.items() if rate > 0}
+        heartbeats = 0
+        next_tick = start + 1
+        now = start
+        while now < end:
+            for kind, timing in schedule.items():
+                interval = timing[0]
+                while timing[1] <= now and timing[1] < end:
+                    peer = None
+                    if kind == 'heartbeat':
+                        # Round robin: every peer beats once per interval
+                        peer = self.peers[heartbeats % len(self.peers)]
+                        heartbeats += 1
+                    self.issue(kind, timing[1], peer)
+                    timing[1] += interval
+            if on_tick and now >= next_tick:
+                on_tick()
+                next_tick += 1
+            wait = min([timing[1] for timing in schedule.values()] + [end]) - now
+            self.poll(max(0.0, min(wait, 0.05)))
+            now = time.perf_counter()
+        self.run_seconds = now - start
+        
+        deadline = now + DRAIN_SECONDS
+        while self.pending and time.perf_counter() < deadline:
+            self.poll(0.05)
+    
+    def results(self):
+        """
+        Summarize a run
+        
+        Returns:
+            dict: Registration and per-kind figures, suitable for JSON output
+        """
+        lost = {kind: 0 for kind in OPERATIONS}
+        for kind, _ in self.pending.values():
+            lost[kind] += 1
+        operations = {}
+        for kind in OPERATIONS:
+            if not self.sent[kind]:
+                continue
+            completed = len(self.latencies[kind])
+            operations[kind] = {
+                'rate': round(float(self.rates[kind]), 1),
+                'sent': self.sent[kind],
+                'completed': completed,
+                'errors': self.errors[kind],
+                'lost': lost[kind],
+                'per_second': round(completed / self.run_seconds, 1) if self.run_seconds else None,
+                **latency_summary(self.latencies[kind]),
+            }
+        return {
+            'register': latency_summary(self.register_latencies),
+            'operations': operations,
+            'ignored_messages': self.ignored,
+        }
+    
+    def close(self):
+        """Disconnect every peer"""
+        for peer in self.peers:
+            self.selector.unregister(peer.sock)
+            peer.sock.close()
+        self.peers = []
+        self.selector.close()
+
+
+def run_mixed(host, port, peers, rates, duration, heartbeat_interval=10.0,
+              relay_size=256, relay_pid=None):
+    """
+    Register peers that keep the relay busy and measure it
+    
+    Args:
+        host: Relay server host
+        port: Relay server port
+        peers: Peers to register
+        rates: Requests per second across all peers, by kind
+        duration: Seconds to generate load
+        heartbeat_interval: Seconds between heartbeats of each peer
+        relay_size: Payload characters per relayed message
+        relay_pid: Local relay process to sample, if any
+    
+    Returns:
+        dict: Results suitable for JSON output
+    """
+    baseline = process_stats(relay_pid) if relay_pid else None
+    generator = LoadGenerator(host, port, peers, rates, heartbeat_interval, relay_size)
+    peak = {'rss_kb': 0, 'fds': 0}
+    
+    def sample():
+        stats = process_stats(relay_pid)
+        for name in peak:
+            peak[name] = max(peak[name], stats[name] or 0)
+    
+    try:
+        register_s = generator.connect()
+        generator.run(duration, on_tick=sample if relay_pid else None)
+        results = {
+            'scenario': 'mixed',
+            'peers': peers,
+            'duration_seconds': round(generator.run_seconds, 3),
+            'register_seconds': round(register_s, 3),
+            'registrations_per_second': round(peers / register_s, 1) if register_s else None,
+            **generator.results(),
+        }
+        if relay_pid:
+            stats = process_stats(relay_pid)
+            results['relay'] = {
+                'rss_kb': stats['rss_kb'],
+                'rss_kb_peak': max(peak['rss_kb'], stats['rss_kb'] or 0),
+                'fds': stats['fds'],
+                'fds_peak': max(peak['fds'], stats['fds'] or 0),
+            }
+            if baseline and baseline['rss_kb'] and stats['rss_kb']:
+                results['relay']['rss_kb_per_peer'] = round(
+                    (stats['rss_kb'] - baseline['rss_kb']) / peers, 2)
+        results['loadgen'] = process_stats(os.getpid(), children=False)
+    finally:
+        generator.close()
+    return results
+
+
+def flatten(results, prefix=''):
+    """Numeric figures of a (nested) result dict, keyed by dotted path"""
+    figures = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            figures.update(flatten(value, f'{prefix}{key}.'))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            figures[f'{prefix}{key}'] = value
+    return figures
+
+
+def compare_results(old, new):
+    """
+    Compare two runs figure by figure
+    
+    Args:
+        old: Results of the earlier run
+        new: Results of this run
+    
+    Returns:
+        list: (name, old, new, change in percent or None) for every figure
+        both runs have
+    """
+    old_figures, new_figures = flatten(old), flatten(new)
+    rows = []
+    for name, value in new_figures.items():
+        if name not in old_figures:
+            continue
+        before = old_figures[name]
+        change = round((value - before) * 100 / before, 1) if before else None
+        rows.append((name, before, value, change))
+    return rows
+
+
+def print_comparison(rows):
+    """Print a comparison table from compare_results"""
+    width = max([len(name) for name, _, _, _ in rows] + [6])
+    print(f"{'figure':<{width}}  {'before':>12}  {'after':>12}  change")
+    for name, before, after, change in rows:
+        shown = f'{change:+.1f}%' if change is not None else '-'
+        print(f'{name:<{width}}  {before:>12}  {after:>12}  {shown}')
+
+
+def main():
+    """Main entry point"""
+    parser = argparse.ArgumentParser(description='LiteDesk Relay Load Generator')
+    parser.add_argument('--host', default='127.0.0.1', help='Relay server host')
+    parser.add_argument('--port', type=int, default=8877, help='Relay server port')
+    parser.add_argument('--scenario', choices=['idle', 'mixed'], default='idle',
+                        help='Silent peers, or peers issuing requests at set rates')
+    parser.add_argument('--peers', type=int, default=1000, help='Peers to register')
+    parser.add_argument('--samples', type=int, default=200,
+                        help='Latency samples per request type (idle)')
+    parser.add_argument('--duration', type=float, default=30, help='Seconds of load (mixed)')
+    parser.add_argument('--lists', type=float, default=20,
+                        help='list_peers requests per second across all peers (mixed)')
+    parser.add_argument('--lookups', type=float, default=200,
+                        help='get_peer_info requests per second across all peers (mixed)')
+    parser.add_argument('--relays', type=float, default=500,
+                        help='relay_data messages per second across all peers (mixed)')
+    parser.add_argument('--relay-size', type=int, default=256,
+                        help='Payload characters per relayed message (mixed)')
+    parser.add_argument('--heartbeat-interval', type=float, default=10,
+                        help='Seconds between heartbeats of each peer, 0 for none (mixed)')
+    parser.add_argument('--spawn', action='store_true', help='Start a local relay server to test')
+    parser.add_argument('--mode', choices=['eventloop', 'threaded'], default='eventloop',
+                        help='Relay core to spawn')
+    parser.add_argument('--workers', type=int, default=1, help='Relay worker processes to spawn')
+    parser.add_argument('--output', help='Write results as JSON to this file')
+    parser.add_argument('--compare', help='Results JSON of an earlier run to compare with')
+    args = parser.parse_args()
+    
+    raise_fd_limit()
+    proc = spawn_relay(args.port, args.mode, args.workers) if args.spawn else None
+    relay_pid = proc.pid if proc else None
+    try:
+        if args.scenario == 'mixed':
+            rates = {'list': args.lists, 'lookup': args.lookups, 'relay': args.relays}
+            results = run_mixed(args.host, args.port, args.peers, rates, args.duration,
+                                args.heartbeat_interval, args.relay_size, relay_pid)
+        else:
+            results = run_idle(args.host, args.port, args.peers, args.samples, relay_pid)
+    finally:
+        if proc:
+            proc.terminate()
+            proc.wait()
+    
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            print()
+            print_comparison(compare_results(json.load(f), results))
+
+
+if __name__ == '__main__':
+    main()
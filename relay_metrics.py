@@ -0,0 +1,202 @@
+"""
+LiteDesk - Relay Metrics Module
+
+Counters and latency histograms for the relay server, served over HTTP in
+the Prometheus text format for capacity planning and alerting.
+
+Handlers only bump plain integers; everything else (peer counts, queue
+depths, lock times) is read from the server when the endpoint is scraped,
+so metrics cost almost nothing on the hot path.
+"""
+import heapq
+import threading
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+# Handler latency histogram buckets (seconds)
+LATENCY_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025,
+                   0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+
+# Message types tracked separately; later ones are counted as 'other'
+MAX_MESSAGE_TYPES = 32
+
+# Peers listed individually by queue depth (deepest first)
+TOP_QUEUES = 20
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class Histogram:
+    """
+    Fixed-bucket histogram
+    
+    Updates are unlocked: under heavy contention an observation may
+    occasionally be lost, which is acceptable for monitoring.
+    """
+    
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)  # last slot is +Inf
+        self.total = 0.0
+    
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.total += value
+    
+    def count(self):
+        return sum(self.counts)
+    
+    def render(self, name, labels):
+        """Exposition lines for this histogram"""
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.bounds, self.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+        cumulative += self.counts[-1]
+        lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {cumulative}')
+        lines.append(f'{name}_sum{{{labels}}} {self.total}')
+        lines.append(f'{name}_count{{{labels}}} {cumulative}')
+        return lines
+
+
+def escape_label(value):
+    """Escape a label value for the text format"""
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class RelayMetrics:
+    """Message counters and handler latencies of one relay server"""
+    
+    def __init__(self):
+        self.latency = {}  # message type -> Histogram
+    
+    def observe(self, msg_type, seconds):
+        """
+        Record one handled message
+        
+        Args:
+            msg_type: Message type
+            seconds: Time spent in the handler
+        """
+        histogram = self.latency.get(msg_type)
+        if histogram is None:
+            if not isinstance(msg_type, str) or len(self.latency) >= MAX_MESSAGE_TYPES:
+                msg_type = 'other'
+            histogram = self.latency.setdefault(msg_type, Histogram())
+        histogram.observe(seconds)
+    
+    def render(self, snapshot):
+        """
+        Render all metrics in the Prometheus text format
+        
+        Args:
+            snapshot: Gauges read from the server (RelayServer.metrics_snapshot)
+        
+        Returns:
+            str: Exposition text
+        """
+        lines = []
+        
+        def metric(name, kind, help_text, samples):
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {kind}')
+            for labels, value in samples:
+                lines.append(f'{name}{{{labels}}} {value}' if labels else f'{name} {value}')
+        
+        metric('litedesk_relay_peers', 'gauge', 'Registered peers by type',
+               [(f'type="{escape_label(t)}"', n) for t, n in sorted(snapshot['peers_by_type'].items())])
+        metric('litedesk_relay_subscriptions', 'gauge', 'Peers subscribed to presence updates',
+               [('', snapshot['subscriptions'])])
+        metric('litedesk_relay_pending_streams', 'gauge', 'Stream sessions waiting for both peers',
+               [('', snapshot['pending_streams'])])
+        metric('litedesk_relay_stream_bytes_total', 'counter', 'Bytes relayed by streams',
+               [('', snapshot['bytes_relayed'])])
+        
+        latency = sorted(self.latency.items())
+        metric('litedesk_relay_messages_total', 'counter', 'Control messages handled by type',
+               [(f'type="{escape_label(t)}"', h.count()) for t, h in latency])
+        
+        lines.append('# HELP litedesk_relay_handler_seconds Time spent handling a control message')
+        lines.append('# TYPE litedesk_relay_handler_seconds histogram')
+        for msg_type, histogram in latency:
+            lines.extend(histogram.render('litedesk_relay_handler_seconds',
+                                          f'type="{escape_label(msg_type)}"'))
+        
+        depths = snapshot['queue_depths']
+        unit = snapshot['queue_unit']
+        deepest = heapq.nlargest(TOP_QUEUES, ((d, p) for p, d in depths.items() if d))
+        metric('litedesk_relay_peer_queue_depth', 'gauge',
+               f'Outbound backlog of the most backlogged peers ({unit})',
+               [(f'peer_id="{escape_label(p)}"', d) for d, p in deepest])
+        metric('litedesk_relay_peer_queue_depth_max', 'gauge',
+               f'Largest outbound backlog of any peer ({unit})',
+               [('', max(depths.values(), default=0))])
+        metric('litedesk_relay_queue_depth_total', 'gauge',
+               f'Outbound backlog summed over all peers ({unit})',
+               [('', sum(depths.values()))])
+        
+        lock = snapshot['lock']
+        metric('litedesk_relay_lock_acquisitions_total', 'counter',
+               'Acquisitions of the registry lock', [('', lock.acquisitions)])
+        metric('litedesk_relay_lock_wait_seconds_total', 'counter',
+               'Time spent waiting for the registry lock', [('', lock.wait_total)])
+        metric('litedesk_relay_lock_hold_seconds_total', 'counter',
+               'Time the registry lock was held', [('', lock.hold_total)])
+        metric('litedesk_relay_lock_wait_seconds_max', 'gauge',
+               'Longest wait for the registry lock', [('', lock.wait_max)])
+        metric('litedesk_relay_lock_hold_seconds_max', 'gauge',
+               'Longest hold of the registry lock', [('', lock.hold_max)])
+        
+        return '\n'.join(lines) + '\n'
+
+
+class MetricsServer:
+    """HTTP endpoint serving a relay server's metrics at /metrics"""
+    
+    def __init__(self, relay, host='127.0.0.1', port=9100):
+        """
+        Initialize metrics server
+        
+        Args:
+            relay: RelayServer whose metrics are served
+            host: IP address to bind to (local only by default)
+            port: Port number to listen on
+        """
+        self.relay = relay
+        self.host = host
+        self.port = port
+        self.httpd = None
+    
+    def start(self):
+        """Start serving in a background thread"""
+        relay = self.relay
+        
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = relay.metrics.render(relay.metrics_snapshot()).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', CONTENT_TYPE)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            
+            def log_message(self, format, *args):
+                pass
+        
+        self.httpd = ThreadingHTTPServer((self.host, self.port), Handler)
+        self.httpd.daemon_threads = True
+        self.port = self.httpd.server_address[1]
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        print(f"[Relay Server] Metrics on http://{self.host}:{self.port}/metrics")
+    
+    def stop(self):
+        """Stop serving"""
+        if self.httpd:
+            self.httpd.shutdown()
+            self.httpd.server_close()
+            self.httpd = None
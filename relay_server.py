@@ -6,29 +6,422 @@ This server runs on a VPS with public IP and helps peers behind NAT
 to discover each other and exchange connection information.
 
 Run this on your VPS:
-    python3 relay_server.py [--port 8877]
+    python3 relay_server.py [--port 8877] [--metrics-port 9100]
 """
+import os
+import hashlib
+import hmac
+import secrets
 import socket
+import selectors
 import struct
 import json
+import queue
 import threading
 import argparse
 import time
+from bisect import bisect_left, bisect_right, insort
 from datetime import datetime
 
+from relay_metrics import RelayMetrics, MetricsServer
+
+
+# Bytes moved per forwarding call on a spliced stream
+STREAM_CHUNK_SIZE = 256 * 1024
+
+# Seconds a requested stream may wait for both peers to attach
+STREAM_ATTACH_TIMEOUT = 30
+
+# Seconds an attach may arrive ahead of its request_stream
+EARLY_ATTACH_TIMEOUT = 5
+
+# Peers returned per list_peers page unless the request asks for fewer
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+# Tags (groups) a peer may register with
+MAX_TAGS = 8
+
+# Seconds of silence after which a peer is probed and then dropped
+IDLE_TIMEOUT = 30
+
+# Seconds between client heartbeats (sent to clients on registration)
+HEARTBEAT_INTERVAL = 10
+
+# UDP endpoints a peer may offer for hole punching
+MAX_PUNCH_ENDPOINTS = 4
+
+SPLICE_AVAILABLE = hasattr(os, 'splice')
+
+
+class ByteCounter:
+    """Running byte total shared by the threads forwarding streams"""
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.value = 0
+    
+    def add(self, count):
+        with self._lock:
+            self.value += count
+
+
+def forward_stream(src, dst, chunk_size=STREAM_CHUNK_SIZE, counter=None):
+    """
+    Copy bytes from one socket to another until EOF
+    
+    Uses os.splice through a pipe where available so payloads never enter
+    user space, otherwise a reusable buffer with recv_into/sendall.
+    
+    Args:
+        src: Socket to read from
+        dst: Socket to write to
+        chunk_size: Most bytes moved per call
+        counter: ByteCounter credited with each chunk as it is forwarded
+    
+    Returns:
+        int: Number of bytes forwarded
+    """
+    total = 0
+    try:
+        if SPLICE_AVAILABLE:
+            pipe_r, pipe_w = os.pipe()
+            try:
+                while True:
+                    n = os.splice(src.fileno(), pipe_w, chunk_size)
+                    if n == 0:
+                        break
+                    total += n
+                    left = n
+                    while left:
+                        left -= os.splice(pipe_r, dst.fileno(), left)
+                    if counter:
+                        counter.add(n)
+            finally:
+                os.close(pipe_r)
+                os.close(pipe_w)
+        else:
+            buffer = bytearray(chunk_size)
+            view = memoryview(buffer)
+            while True:
+                n = src.recv_into(buffer)
+                if n == 0:
+                    break
+                dst.sendall(view[:n])
+                total += n
+                if counter:
+                    counter.add(n)
+    except OSError:
+        pass
+    
+    # Propagate EOF to the other side
+    try:
+        dst.shutdown(socket.SHUT_WR)
+    except OSError:
+        pass
+    return total
+
+
+def normalize_tags(tags):
+    """Validate the tag list sent with a registration"""
+    if not isinstance(tags, list):
+        return []
+    return sorted({str(tag) for tag in tags if tag})[:MAX_TAGS]
+
+
+def clean_endpoints(endpoints):
+    """Validate the [ip, port] endpoints offered for hole punching"""
+    if not isinstance(endpoints, list):
+        return []
+    cleaned = []
+    for endpoint in endpoints[:MAX_PUNCH_ENDPOINTS]:
+        if (isinstance(endpoint, list) and len(endpoint) == 2
+                and isinstance(endpoint[0], str) and isinstance(endpoint[1], int)
+                and 0 < endpoint[1] < 65536):
+            cleaned.append(endpoint)
+    return cleaned
+
+
+def page_size(limit):
+    """Clamp a requested page size"""
+    try:
+        return max(1, min(int(limit), MAX_PAGE_SIZE))
+    except (TypeError, ValueError):
+        return DEFAULT_PAGE_SIZE
+
+
+def presence_message(event, peer_info, version):
+    """Build the presence update pushed to subscribers"""
+    return {
+        'type': 'presence',
+        'event': event,
+        'version': version,
+        'peer': peer_info.summary()
+    }
+
+
+def encode_message(msg):
+    """Frame a control message as length-prefixed JSON"""
+    msg_json = json.dumps(msg).encode('utf-8')
+    return struct.pack('!I', len(msg_json)) + msg_json
+
+
+class StreamSession:
+    """A raw byte stream between two peers, spliced by the relay"""
+    
+    def __init__(self, session_id, requester_id, target_id, counter=None):
+        self.session_id = session_id
+        self.peer_ids = (requester_id, target_id)
+        self.sockets = {}  # peer_id -> socket
+        self.created_at = time.time()
+        self.bytes_relayed = 0
+        self.counter = counter  # relay-wide ByteCounter, updated while the stream runs
+    
+    def splice(self, on_done=None):
+        """Forward bytes in both directions until either side closes"""
+        a, b = (self.sockets[peer_id] for peer_id in self.peer_ids)
+        
+        totals = [0, 0]
+        
+        def pump(index, src, dst):
+            totals[index] = forward_stream(src, dst, counter=self.counter)
+        
+        def run():
+            reverse = threading.Thread(target=pump, args=(1, b, a), daemon=True)
+            reverse.start()
+            pump(0, a, b)
+            reverse.join()
+            self.bytes_relayed = sum(totals)
+            for sock in (a, b):
+                try:
+                    sock.close()
+                except OSError:
+                    pass
+            if on_done:
+                on_done(self)
+        
+        threading.Thread(target=run, daemon=True).start()
+    
+    def close(self):
+        """Close any sockets attached so far"""
+        for sock in self.sockets.values():
+            try:
+                sock.close()
+            except OSError:
+                pass
+
+
+class InstrumentedLock:
+    """
+    Lock that records how long callers wait for it and hold it
+    
+    Statistics are updated while the lock is held, so they need no
+    locking of their own.
+    """
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._acquired_at = 0.0
+        self.acquisitions = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.hold_total = 0.0
+        self.hold_max = 0.0
+    
+    def __enter__(self):
+        start = time.perf_counter()
+        self._lock.acquire()
+        self._acquired_at = time.perf_counter()
+        wait = self._acquired_at - start
+        self.acquisitions += 1
+        self.wait_total += wait
+        if wait > self.wait_max:
+            self.wait_max = wait
+        return self
+    
+    def __exit__(self, exc_type, exc, tb):
+        hold = time.perf_counter() - self._acquired_at
+        self.hold_total += hold
+        if hold > self.hold_max:
+            self.hold_max = hold
+        self._lock.release()
+    
+    def stats(self):
+        """
+        Get lock timing statistics
+        
+        Returns:
+            dict: Acquisition count and wait/hold times in milliseconds
+        """
+        count = self.acquisitions or 1
+        return {
+            'acquisitions': self.acquisitions,
+            'wait_avg_ms': self.wait_total / count * 1000,
+            'wait_max_ms': self.wait_max * 1000,
+            'hold_avg_ms': self.hold_total / count * 1000,
+            'hold_max_ms': self.hold_max * 1000,
+        }
+
+
+class TimingWheel:
+    """
+    Hashed timing wheel for idle-peer expiry
+    
+    Items sit in the slot of the tick they are due at. Advancing the
+    wheel only visits the slots whose time has come, so the cost per
+    tick depends on how many items are due, not on how many exist.
+    Deadlines beyond one revolution land in the last slot and are simply
+    rescheduled by the caller when they come up early.
+    """
+    
+    def __init__(self, tick=1.0, slots=64, now=None):
+        """
+        Initialize timing wheel
+        
+        Args:
+            tick: Seconds per slot
+            slots: Number of slots (one revolution is tick * slots seconds)
+            now: Start time (default: time.monotonic())
+        """
+        self.tick = tick
+        self.slots = [dict() for _ in range(slots)]
+        self.where = {}  # key -> slot index
+        self.current = int((time.monotonic() if now is None else now) / tick)
+    
+    def __len__(self):
+        return len(self.where)
+    
+    def schedule(self, key, item, deadline, now=None):
+        """Place (or move) an item so it comes due at deadline"""
+        now = time.monotonic() if now is None else now
+        ticks = int((deadline - now) / self.tick) + 1
+        ticks = max(1, min(ticks, len(self.slots) - 1))
+        self.cancel(key)
+        index = (self.current + ticks) % len(self.slots)
+        self.slots[index][key] = item
+        self.where[key] = index
+    
+    def cancel(self, key):
+        """Remove an item if it is scheduled"""
+        index = self.where.pop(key, None)
+        if index is not None:
+            self.slots[index].pop(key, None)
+    
+    def advance(self, now=None):
+        """
+        Move the wheel up to now
+        
+        Returns:
+            list: Items whose slots came due
+        """
+        now = time.monotonic() if now is None else now
+        target = int(now / self.tick)
+        due = []
+        # Never sweep more than one revolution, however late we are
+        start = max(self.current, target - len(self.slots))
+        for tick in range(start + 1, target + 1):
+            slot = self.slots[tick % len(self.slots)]
+            if slot:
+                for key in slot:
+                    del self.where[key]
+                due.extend(slot.values())
+                slot.clear()
+        self.current = max(self.current, target)
+        return due
+
+
+class PeerOutbox:
+    """
+    Outbound message queue for one peer, drained by its own writer thread
+    
+    Handlers enqueue and return immediately, so a slow or dead peer socket
+    only ever blocks its own writer.
+    """
+    
+    # Messages queued for one peer before it is dropped as too slow
+    MAX_QUEUED = 1024
+    
+    def __init__(self, sock):
+        self.socket = sock
+        self.queue = queue.Queue(self.MAX_QUEUED)
+        self.closed = False
+        threading.Thread(target=self._run, daemon=True).start()
+    
+    def put(self, data):
+        """
+        Queue encoded bytes for sending
+        
+        Returns:
+            bool: False if the peer is closed or too far behind
+        """
+        if self.closed:
+            return False
+        try:
+            self.queue.put_nowait(data)
+            return True
+        except queue.Full:
+            print("[Relay Server] Dropping slow peer (outbound queue full)")
+            self.close()
+            return False
+    
+    def depth(self):
+        """Number of messages waiting to be written"""
+        return self.queue.qsize()
+    
+    def close(self):
+        """Stop the writer and shut the socket down so its reader wakes up"""
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        try:
+            self.queue.put_nowait(None)
+        except queue.Full:
+            pass
+    
+    def _run(self):
+        """Writer thread: send queued messages in order"""
+        while not self.closed:
+            batch = [self.queue.get()]
+            # Coalesce whatever else is already queued into one write
+            while batch[-1] is not None and len(batch) < 256:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            stop = batch[-1] is None
+            try:
+                self.socket.sendall(b''.join(data for data in batch if data is not None))
+            except OSError:
+                self.close()
+                break
+            if stop:
+                break
+
 
 class PeerInfo:
     """Information about a registered peer"""
     
-    def __init__(self, peer_id, peer_type, socket_conn, addr):
+    def __init__(self, peer_id, peer_type, socket_conn, addr, outbox=None):
         self.peer_id = peer_id
         self.peer_type = peer_type  # 'server' or 'client'
         self.socket = socket_conn
+        self.outbox = outbox
         self.addr = addr
         self.public_ip = addr[0]
         self.public_port = addr[1]
         self.registered_at = datetime.now()
         self.partner_id = None
+        self.tags = []
+        self.last_seen = time.monotonic()
+        self.pinged_at = 0.0
+    
+    def summary(self):
+        """Entry used in peer lists and presence updates"""
+        return {'peer_id': self.peer_id, 'peer_type': self.peer_type, 'tags': self.tags}
     
     def to_dict(self):
         """Convert to dictionary for JSON serialization"""
@@ -41,23 +434,145 @@ class PeerInfo:
         }
 
 
+class PeerRegistry:
+    """
+    Registered peers, indexed by type and by (type, tag)
+    
+    Each index is a sorted list of peer IDs, so a list page is a bisect
+    plus a bounded walk and its cost does not grow with the fleet. Every
+    join and leave bumps the registry version.
+    """
+    
+    def __init__(self):
+        self.peers = {}  # peer_id -> PeerInfo
+        self.index = {}  # (peer_type, tag or None) -> sorted peer IDs
+        self.version = 0
+    
+    def __len__(self):
+        return len(self.peers)
+    
+    def __contains__(self, peer_id):
+        return peer_id in self.peers
+    
+    def get(self, peer_id):
+        return self.peers.get(peer_id)
+    
+    def values(self):
+        return self.peers.values()
+    
+    def add(self, peer):
+        """
+        Add or replace a peer
+        
+        Returns:
+            tuple: (replaced PeerInfo or None, new version)
+        """
+        old_peer = self.peers.get(peer.peer_id)
+        if old_peer:
+            self._unindex(old_peer)
+        self.peers[peer.peer_id] = peer
+        for key in self._keys(peer):
+            insort(self.index.setdefault(key, []), peer.peer_id)
+        self.version += 1
+        return old_peer, self.version
+    
+    def remove(self, peer):
+        """
+        Remove a peer unless it has already been replaced
+        
+        Returns:
+            int: New version, or None if nothing was removed
+        """
+        if self.peers.get(peer.peer_id) is not peer:
+            return None
+        del self.peers[peer.peer_id]
+        self._unindex(peer)
+        self.version += 1
+        return self.version
+    
+    def counts_by_type(self):
+        """
+        Count registered peers of each type
+        
+        Returns:
+            dict: peer_type -> number of peers
+        """
+        return {peer_type: len(ids) for (peer_type, tag), ids in self.index.items() if tag is None}
+    
+    def page(self, peer_type, tag=None, after=None, limit=DEFAULT_PAGE_SIZE, exclude_id=None):
+        """
+        List peers of one type (and tag) in peer ID order
+        
+        Args:
+            peer_type: Peer type to list
+            tag: Only list peers registered with this tag
+            after: Cursor from the previous page (last peer ID returned)
+            limit: Maximum entries to return
+            exclude_id: Peer ID to leave out (the requester)
+        
+        Returns:
+            tuple: (entries, next cursor or None)
+        """
+        ids = self.index.get((peer_type, tag), [])
+        i = bisect_right(ids, after) if after else 0
+        entries = []
+        while i < len(ids) and len(entries) < limit:
+            peer_id = ids[i]
+            i += 1
+            if peer_id != exclude_id:
+                entries.append(self.peers[peer_id].summary())
+        next_cursor = entries[-1]['peer_id'] if entries and i < len(ids) else None
+        return entries, next_cursor
+    
+    @staticmethod
+    def _keys(peer):
+        return [(peer.peer_type, None)] + [(peer.peer_type, tag) for tag in peer.tags]
+    
+    def _unindex(self, peer):
+        for key in self._keys(peer):
+            ids = self.index.get(key)
+            if not ids:
+                continue
+            i = bisect_left(ids, peer.peer_id)
+            if i < len(ids) and ids[i] == peer.peer_id:
+                del ids[i]
+            if not ids:
+                del self.index[key]
+
+
 class RelayServer:
     """Relay server for NAT traversal"""
     
-    def __init__(self, host='0.0.0.0', port=8877):
+    # What a peer's outbound queue depth counts
+    QUEUE_UNIT = 'messages'
+    
+    def __init__(self, host='0.0.0.0', port=8877, idle_timeout=IDLE_TIMEOUT,
+                 heartbeat_interval=HEARTBEAT_INTERVAL):
         """
         Initialize relay server
         
         Args:
             host: IP address to bind to
             port: Port number to listen on
+            idle_timeout: Seconds without any message before a peer is dropped
+            heartbeat_interval: Seconds between heartbeats asked of clients
         """
         self.host = host
         self.port = port
+        self.idle_timeout = idle_timeout
+        self.heartbeat_interval = heartbeat_interval
         self.socket = None
+        self.udp_socket = None
         self.running = False
-        self.peers = {}  # peer_id -> PeerInfo
-        self.lock = threading.Lock()
+        self.peers = PeerRegistry()
+        self.subscriptions = {}  # peer_id -> (PeerInfo, peer_type, tag)
+        self.streams = {}  # session_id -> StreamSession awaiting both peers
+        self.early_attaches = {}  # session_id -> (socket, addr, msg, arrived_at)
+        self.stream_bytes = ByteCounter()
+        self.lock = InstrumentedLock()
+        self.liveness = TimingWheel(tick=max(0.05, min(1.0, idle_timeout / 10)))
+        self.metrics = RelayMetrics()
+        self.udp_secret = secrets.token_bytes(16)
     
     def start(self):
         """Start the relay server"""
@@ -65,18 +580,22 @@ class RelayServer:
         self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.socket.bind((self.host, self.port))
         self.socket.listen(10)
+        self.open_udp()
         self.running = True
         
         print(f"[Relay Server] Started on {self.host}:{self.port}")
         print(f"[Relay Server] Waiting for peer connections...")
         
-        # Start cleanup thread
-        threading.Thread(target=self.cleanup_stale_peers, daemon=True).start()
+        # Start liveness thread
+        threading.Thread(target=self.liveness_loop, daemon=True).start()
+        if self.udp_socket:
+            threading.Thread(target=self.udp_loop, daemon=True).start()
         
         # Accept connections
         while self.running:
             try:
                 client_socket, addr = self.socket.accept()
+                client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
                 print(f"[Relay Server] New connection from {addr}")
                 threading.Thread(
                     target=self.handle_peer,
@@ -87,13 +606,75 @@ class RelayServer:
                 if self.running:
                     print(f"[Relay Server] Error accepting connection: {e}")
     
+    def open_udp(self):
+        """Open the UDP rendezvous endpoint on the same port as the listener"""
+        port = self.socket.getsockname()[1]
+        try:
+            self.udp_socket = self.create_udp_socket(port)
+        except OSError as e:
+            print(f"[Relay Server] UDP rendezvous unavailable: {e}")
+            self.udp_socket = None
+    
+    def create_udp_socket(self, port):
+        """Create the UDP rendezvous socket"""
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind((self.host, port))
+        return sock
+    
+    def udp_loop(self):
+        """Answer UDP rendezvous probes"""
+        while self.running:
+            try:
+                data, addr = self.udp_socket.recvfrom(2048)
+            except OSError:
+                break
+            self.handle_udp(data, addr)
+    
+    def udp_token(self, peer_id):
+        """Token a registered peer puts in its UDP probes"""
+        digest = hmac.new(self.udp_secret, str(peer_id).encode('utf-8'), hashlib.sha256)
+        return digest.hexdigest()[:32]
+    
+    def handle_udp(self, data, addr):
+        """
+        Tell a peer which public address its UDP probe came from
+        
+        Only probes carrying the token from the peer's 'registered' reply
+        are answered, and a probe is larger than the reply, so spoofed
+        probes cannot turn the relay into a reflector.
+        """
+        try:
+            msg = json.loads(data.decode('utf-8'))
+        except (ValueError, UnicodeDecodeError):
+            return
+        if not isinstance(msg, dict) or msg.get('type') != 'udp_probe':
+            return
+        peer_id, token = msg.get('peer_id'), msg.get('token')
+        if not isinstance(peer_id, str) or not isinstance(token, str):
+            return
+        if not hmac.compare_digest(token.encode('utf-8'), self.udp_token(peer_id).encode('utf-8')):
+            return
+        
+        reply = {'type': 'udp_observed', 'endpoint': [addr[0], addr[1]]}
+        try:
+            self.udp_socket.sendto(json.dumps(reply).encode('utf-8'), addr)
+        except OSError:
+            pass
+    
     def handle_peer(self, client_socket, addr):
         """Handle a peer connection"""
         peer_info = None
+        handed_off = False
         
         try:
             # Receive registration message
             msg = self.recv_message(client_socket)
+            if msg and msg.get('type') == 'stream_attach':
+                # Data connection: hand the socket over to the stream session
+                handed_off = True
+                self.handle_stream_attach(client_socket, addr, msg)
+                return
+            
             if not msg or msg.get('type') != 'register':
                 print(f"[Relay Server] Invalid registration from {addr}")
                 client_socket.close()
@@ -107,161 +688,499 @@ class RelayServer:
                 client_socket.close()
                 return
             
-            # Register peer
-            with self.lock:
-                if peer_id in self.peers:
-                    # Update existing peer
-                    old_peer = self.peers[peer_id]
-                    if old_peer.socket:
-                        try:
-                            old_peer.socket.close()
-                        except:
-                            pass
-                
-                peer_info = PeerInfo(peer_id, peer_type, client_socket, addr)
-                self.peers[peer_id] = peer_info
-                print(f"[Relay Server] Registered {peer_type} '{peer_id}' from {addr}")
-            
-            # Send registration confirmation
-            self.send_message(client_socket, {
-                'type': 'registered',
-                'peer_id': peer_id,
-                'public_ip': addr[0],
-                'public_port': addr[1]
-            })
+            peer_info = self.register_peer(peer_id, peer_type, client_socket, addr,
+                                           msg.get('tags'))
             
             # Handle peer requests
             while self.running:
                 msg = self.recv_message(client_socket)
                 if not msg:
                     break
-                
-                msg_type = msg.get('type')
-                
-                if msg_type == 'list_peers':
-                    # List available peers
-                    self.handle_list_peers(peer_info)
-                
-                elif msg_type == 'get_peer_info':
-                    # Get specific peer info for connection
-                    target_id = msg.get('target_id')
-                    self.handle_get_peer_info(peer_info, target_id)
-                
-                elif msg_type == 'relay_data':
-                    # Relay data to another peer
-                    target_id = msg.get('target_id')
-                    data = msg.get('data')
-                    self.handle_relay_data(peer_info, target_id, data)
-                
-                elif msg_type == 'heartbeat':
-                    # Peer is alive
-                    self.send_message(client_socket, {'type': 'heartbeat_ack'})
-                
-                else:
-                    print(f"[Relay Server] Unknown message type: {msg_type}")
+                self.dispatch_message(peer_info, msg)
         
         except Exception as e:
             print(f"[Relay Server] Error handling peer {addr}: {e}")
         
         finally:
-            # Unregister peer
             if peer_info:
-                with self.lock:
-                    if peer_info.peer_id in self.peers:
-                        del self.peers[peer_info.peer_id]
-                        print(f"[Relay Server] Unregistered '{peer_info.peer_id}'")
+                self.unregister_peer(peer_info)
             
-            try:
-                client_socket.close()
-            except:
-                pass
+            if not handed_off:
+                try:
+                    client_socket.close()
+                except:
+                    pass
+    
+    def register_peer(self, peer_id, peer_type, client_socket, addr, tags=None):
+        """
+        Register a peer, confirm the registration and announce it
+        
+        Returns:
+            PeerInfo: The new registry entry
+        """
+        peer_info = self.make_peer(peer_id, peer_type, client_socket, addr)
+        peer_info.tags = normalize_tags(tags)
+        old_peer, version = self.add_peer(peer_info)
+        with self.lock:
+            self.liveness.schedule(peer_info, peer_info,
+                                   peer_info.last_seen + self.idle_timeout)
+        print(f"[Relay Server] Registered {peer_type} '{peer_id}' from {addr}")
+        
+        if old_peer and old_peer.socket:
+            # Same peer re-registered: drop the old connection
+            self.drop_socket(old_peer.socket)
+        
+        if version is not None:
+            self.confirm_peer(peer_info, version)
+        return peer_info
+    
+    def confirm_peer(self, peer_info, version):
+        """Send a peer its registration confirmation and announce it"""
+        self.send_to_peer(peer_info, {
+            'type': 'registered',
+            'peer_id': peer_info.peer_id,
+            'public_ip': peer_info.public_ip,
+            'public_port': peer_info.public_port,
+            'heartbeat_interval': self.heartbeat_interval,
+            'idle_timeout': self.idle_timeout,
+            'udp_port': self.udp_socket.getsockname()[1] if self.udp_socket else None,
+            'udp_token': self.udp_token(peer_info.peer_id) if self.udp_socket else None
+        })
+        self.publish_presence('join', peer_info, version)
+    
+    def make_peer(self, peer_id, peer_type, client_socket, addr):
+        """Create the registry entry for a new peer, with its outbound queue"""
+        return PeerInfo(peer_id, peer_type, client_socket, addr, PeerOutbox(client_socket))
+    
+    def add_peer(self, peer_info):
+        """
+        Insert a peer in the registry
+        
+        Returns:
+            tuple: (replaced local PeerInfo or None, registry version, or
+                    None if confirm_peer will be called later)
+        """
+        with self.lock:
+            return self.peers.add(peer_info)
+    
+    def remove_peer(self, peer_info):
+        """
+        Remove a peer from the registry unless it has been replaced
+        
+        Returns:
+            int: Registry version after removal, or None if not removed
+        """
+        with self.lock:
+            self.liveness.cancel(peer_info)
+            version = self.peers.remove(peer_info)
+            subscription = self.subscriptions.get(peer_info.peer_id)
+            if subscription and subscription[0] is peer_info:
+                del self.subscriptions[peer_info.peer_id]
+        return version
+    
+    def unregister_peer(self, peer_info):
+        """Remove a peer unless it has already been replaced"""
+        version = self.remove_peer(peer_info)
+        if peer_info.outbox:
+            peer_info.outbox.close()
+        if version is not None:
+            print(f"[Relay Server] Unregistered '{peer_info.peer_id}'")
+            self.publish_presence('leave', peer_info, version)
+    
+    def publish_presence(self, event, peer_info, version):
+        """Announce a join or leave to subscribed peers"""
+        self.deliver_presence(presence_message(event, peer_info, version))
     
-    def handle_list_peers(self, requester):
-        """Send list of available peers"""
+    def deliver_presence(self, delta):
+        """Send a presence update to the local subscribers it matches"""
+        peer = delta['peer']
         with self.lock:
-            # Get peers of opposite type
-            opposite_type = 'client' if requester.peer_type == 'server' else 'server'
-            available_peers = [
-                {'peer_id': p.peer_id, 'peer_type': p.peer_type}
-                for p in self.peers.values()
-                if p.peer_type == opposite_type and p.peer_id != requester.peer_id
+            targets = [
+                subscriber for subscriber, peer_type, tag in self.subscriptions.values()
+                if peer_type == peer['peer_type'] and (tag is None or tag in peer['tags'])
             ]
+        for subscriber in targets:
+            self.send_to_peer(subscriber, delta)
+    
+    def dispatch_message(self, peer_info, msg):
+        """
+        Handle one control message from a registered peer
+        
+        A request may carry a 'request_id', which is echoed in its reply so
+        clients can have many requests in flight on one connection.
+        """
+        started = time.perf_counter()
+        peer_info.last_seen = time.monotonic()
+        msg_type = msg.get('type')
+        request_id = msg.get('request_id')
+        
+        if msg_type == 'list_peers':
+            # List available peers, one page at a time
+            self.handle_list_peers(peer_info, msg)
+        
+        elif msg_type == 'subscribe':
+            # Push presence updates, starting with the first page
+            self.handle_subscribe(peer_info, msg)
+        
+        elif msg_type == 'unsubscribe':
+            with self.lock:
+                self.subscriptions.pop(peer_info.peer_id, None)
+        
+        elif msg_type == 'get_peer_info':
+            # Get specific peer info for connection
+            target_id = msg.get('target_id')
+            self.handle_get_peer_info(peer_info, target_id, request_id,
+                                      msg.get('notify', True))
+        
+        elif msg_type == 'relay_data':
+            # Relay data to another peer
+            target_id = msg.get('target_id')
+            data = msg.get('data')
+            self.handle_relay_data(peer_info, target_id, data, request_id)
+        
+        elif msg_type == 'request_stream':
+            # Pair a raw data stream with another peer
+            self.handle_request_stream(
+                peer_info, msg.get('target_id'), msg.get('session_id'), request_id
+            )
+        
+        elif msg_type == 'request_punch':
+            # Start UDP hole punching towards another peer
+            self.handle_request_punch(
+                peer_info, msg.get('target_id'), msg.get('session_id'),
+                msg.get('udp_endpoints'), request_id
+            )
+        
+        elif msg_type == 'punch_accept':
+            # Target's answer: pass its endpoints back to the requester
+            self.handle_punch_accept(
+                peer_info, msg.get('to_peer_id'), msg.get('session_id'),
+                msg.get('udp_endpoints')
+            )
+        
+        elif msg_type == 'heartbeat':
+            # Peer is alive
+            self.reply(peer_info, request_id, {'type': 'heartbeat_ack'})
+        
+        else:
+            print(f"[Relay Server] Unknown message type: {msg_type}")
+        
+        self.metrics.observe(msg_type, time.perf_counter() - started)
+    
+    def queue_depth(self, peer):
+        """Outbound messages queued for a peer"""
+        return peer.outbox.depth() if peer.outbox else 0
+    
+    def metrics_snapshot(self):
+        """
+        Read the gauges served by the metrics endpoint
+        
+        Returns:
+            dict: Peer counts, queue depths, stream and lock figures
+        """
+        with self.lock:
+            snapshot = {
+                'peers_by_type': self.peers.counts_by_type(),
+                'subscriptions': len(self.subscriptions),
+                'pending_streams': len(self.streams),
+                'bytes_relayed': self.bytes_relayed,
+                'queue_unit': self.QUEUE_UNIT,
+                'lock': self.lock
+            }
+            peers = list(self.peers.values())
+        # Walking every peer's queue is left until the lock is released
+        snapshot['queue_depths'] = {peer.peer_id: self.queue_depth(peer) for peer in peers}
+        return snapshot
+    
+    def drop_socket(self, sock):
+        """Close a peer connection, waking any thread blocked on it"""
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        try:
+            sock.close()
+        except:
+            pass
+    
+    def find_peer(self, peer_id):
+        """Look up a registered peer (called with the lock held)"""
+        return self.peers.get(peer_id)
+    
+    def list_peer_page(self, peer_type, tag, after, limit, exclude_id):
+        """
+        List one page of registered peers (called with the lock held)
+        
+        Returns:
+            tuple: (entries, next cursor or None, registry version)
+        """
+        entries, next_cursor = self.peers.page(peer_type, tag, after, limit, exclude_id)
+        return entries, next_cursor, self.peers.version
+    
+    def reply(self, peer, request_id, msg):
+        """Send a reply, tagged with the request's ID if it had one"""
+        if request_id is not None:
+            msg['request_id'] = request_id
+        self.send_to_peer(peer, msg)
+    
+    def send_to_peer(self, peer, msg):
+        """Queue a control message for a registered peer's writer"""
+        if peer.outbox:
+            peer.outbox.put(encode_message(msg))
+        else:
+            self.send_message(peer.socket, msg)
+    
+    def _page_request(self, requester, msg):
+        """Read the filter and cursor of a list or subscribe request"""
+        # Peers of the opposite type unless the request names one
+        peer_type = msg.get('peer_type') or (
+            'client' if requester.peer_type == 'server' else 'server'
+        )
+        limit = page_size(msg.get('limit', DEFAULT_PAGE_SIZE))
+        return peer_type, msg.get('tag'), msg.get('after'), limit
+    
+    def handle_list_peers(self, requester, msg):
+        """Send one page of available peers"""
+        peer_type, tag, after, limit = self._page_request(requester, msg)
+        with self.lock:
+            entries, next_cursor, version = self.list_peer_page(
+                peer_type, tag, after, limit, requester.peer_id
+            )
         
-        self.send_message(requester.socket, {
+        self.reply(requester, msg.get('request_id'), {
             'type': 'peer_list',
-            'peers': available_peers
+            'peers': entries,
+            'next_cursor': next_cursor,
+            'version': version
         })
     
-    def handle_get_peer_info(self, requester, target_id):
+    def handle_subscribe(self, requester, msg):
+        """Subscribe a peer to presence updates and send a list page"""
+        peer_type, tag, after, limit = self._page_request(requester, msg)
+        with self.lock:
+            self.subscriptions[requester.peer_id] = (requester, peer_type, tag)
+            entries, next_cursor, version = self.list_peer_page(
+                peer_type, tag, after, limit, requester.peer_id
+            )
+        
+        self.reply(requester, msg.get('request_id'), {
+            'type': 'subscribed',
+            'peer_type': peer_type,
+            'tag': tag,
+            'peers': entries,
+            'next_cursor': next_cursor,
+            'version': version
+        })
+    
+    def handle_get_peer_info(self, requester, target_id, request_id=None, notify=True):
         """Send connection info for a specific peer"""
         with self.lock:
-            target = self.peers.get(target_id)
+            target = self.find_peer(target_id)
+        
+        if target:
+            # Send target's connection info to requester
+            self.reply(requester, request_id, {
+                'type': 'peer_info',
+                'peer_id': target.peer_id,
+                'peer_type': target.peer_type,
+                'public_ip': target.public_ip,
+                'public_port': target.public_port
+            })
             
-            if target:
-                # Send target's connection info to requester
-                self.send_message(requester.socket, {
-                    'type': 'peer_info',
-                    'peer_id': target.peer_id,
-                    'peer_type': target.peer_type,
-                    'public_ip': target.public_ip,
-                    'public_port': target.public_port
-                })
-                
-                # Notify target about requester
-                self.send_message(target.socket, {
-                    'type': 'connection_request',
-                    'from_peer_id': requester.peer_id,
-                    'from_peer_type': requester.peer_type,
-                    'from_public_ip': requester.public_ip,
-                    'from_public_port': requester.public_port
-                })
-            else:
-                self.send_message(requester.socket, {
-                    'type': 'error',
-                    'message': f'Peer {target_id} not found'
-                })
-    
-    def handle_relay_data(self, sender, target_id, data):
+            if not notify:
+                # Plain lookup, no connection attempt follows
+                return
+            
+            # Notify target about requester
+            self.send_to_peer(target, {
+                'type': 'connection_request',
+                'from_peer_id': requester.peer_id,
+                'from_peer_type': requester.peer_type,
+                'from_public_ip': requester.public_ip,
+                'from_public_port': requester.public_port
+            })
+        else:
+            self.reply(requester, request_id, {
+                'type': 'error',
+                'message': f'Peer {target_id} not found'
+            })
+    
+    def handle_relay_data(self, sender, target_id, data, request_id=None):
         """Relay data between peers"""
         with self.lock:
-            target = self.peers.get(target_id)
+            target = self.find_peer(target_id)
+        
+        if target:
+            self.send_to_peer(target, {
+                'type': 'relayed_data',
+                'from_peer_id': sender.peer_id,
+                'data': data
+            })
+        else:
+            self.reply(sender, request_id, {
+                'type': 'error',
+                'message': f'Peer {target_id} not found'
+            })
+    
+    def handle_request_punch(self, requester, target_id, session_id, endpoints, request_id=None):
+        """Pass the requester's UDP endpoints to the target peer"""
+        with self.lock:
+            target = self.find_peer(target_id)
+        endpoints = clean_endpoints(endpoints)
+        
+        if not target or not session_id or not endpoints:
+            self.reply(requester, request_id, {
+                'type': 'error',
+                'message': f'Cannot punch to {target_id}'
+            })
+            return
+        
+        # A connection request that also carries the punching details
+        self.send_to_peer(target, {
+            'type': 'connection_request',
+            'from_peer_id': requester.peer_id,
+            'from_peer_type': requester.peer_type,
+            'from_public_ip': requester.public_ip,
+            'from_public_port': requester.public_port,
+            'session_id': session_id,
+            'udp_endpoints': endpoints
+        })
+    
+    def handle_punch_accept(self, target, requester_id, session_id, endpoints):
+        """Pass the target's UDP endpoints to the peer that asked to punch"""
+        with self.lock:
+            requester = self.find_peer(requester_id)
+        endpoints = clean_endpoints(endpoints)
+        
+        if requester and session_id and endpoints:
+            self.send_to_peer(requester, {
+                'type': 'punch_ready',
+                'session_id': session_id,
+                'from_peer_id': target.peer_id,
+                'udp_endpoints': endpoints
+            })
+    
+    def handle_request_stream(self, requester, target_id, session_id, request_id=None):
+        """Announce a stream session to the target peer"""
+        with self.lock:
+            target = self.find_peer(target_id)
+            accepted = target and session_id and session_id not in self.streams
+            if accepted:
+                self.streams[session_id] = StreamSession(
+                    session_id, requester.peer_id, target_id, self.stream_bytes
+                )
+                early = self.early_attaches.pop(session_id, None)
+        
+        if not accepted:
+            self.reply(requester, request_id, {
+                'type': 'error',
+                'message': f'Cannot open stream to {target_id}'
+            })
+            return
+        
+        self.send_to_peer(target, {
+            'type': 'stream_request',
+            'session_id': session_id,
+            'from_peer_id': requester.peer_id,
+            'from_peer_type': requester.peer_type
+        })
+        
+        if early:
+            # The requester's data connection overtook its control message
+            self.handle_stream_attach(*early[:3])
+    
+    def handle_stream_attach(self, client_socket, addr, msg):
+        """Attach a data connection to its stream and splice once both are in"""
+        session_id = msg.get('session_id')
+        peer_id = msg.get('peer_id')
+        
+        with self.lock:
+            session = self.streams.get(session_id)
+            if not session and session_id and session_id not in self.early_attaches:
+                # request_stream travels on another connection and may lag
+                self.early_attaches[session_id] = (client_socket, addr, msg, time.time())
+                return
             
-            if target:
-                self.send_message(target.socket, {
-                    'type': 'relayed_data',
-                    'from_peer_id': sender.peer_id,
-                    'data': data
-                })
-            else:
-                self.send_message(sender.socket, {
-                    'type': 'error',
-                    'message': f'Peer {target_id} not found'
-                })
-    
-    def cleanup_stale_peers(self):
-        """Remove stale peer connections"""
+            if not session or peer_id not in session.peer_ids or peer_id in session.sockets:
+                print(f"[Relay Server] Rejected stream attach from {addr}")
+                client_socket.close()
+                return
+            
+            session.sockets[peer_id] = client_socket
+            if len(session.sockets) < 2:
+                return
+            del self.streams[session_id]
+        
+        for sock in session.sockets.values():
+            self.send_message(sock, {'type': 'stream_started', 'session_id': session_id})
+        print(f"[Relay Server] Splicing stream {session_id[:8]} between "
+              f"'{session.peer_ids[0]}' and '{session.peer_ids[1]}'")
+        session.splice(on_done=self._stream_finished)
+    
+    @property
+    def bytes_relayed(self):
+        """Bytes forwarded by stream sessions so far, running ones included"""
+        return self.stream_bytes.value
+    
+    def _stream_finished(self, session):
+        """Log a finished stream session (its bytes are already counted)"""
+        print(f"[Relay Server] Stream {session.session_id[:8]} closed "
+              f"({session.bytes_relayed} bytes relayed)")
+    
+    def liveness_loop(self):
+        """Expire idle peers and stale stream sessions"""
         while self.running:
-            time.sleep(60)  # Check every minute
+            time.sleep(self.liveness.tick)
+            self.check_liveness()
+            self.expire_streams()
+    
+    def check_liveness(self):
+        """
+        Handle peers whose idle deadline has come up on the timing wheel
+        
+        A peer heard from since it was scheduled is rescheduled. A silent
+        peer gets one ping (for clients that only answer pings) and is
+        dropped if it is still silent a heartbeat interval later.
+        """
+        now = time.monotonic()
+        probe, expired = [], []
+        with self.lock:
+            for peer in self.liveness.advance(now):
+                deadline = peer.last_seen + self.idle_timeout
+                if now < deadline:
+                    self.liveness.schedule(peer, peer, deadline, now)
+                elif peer.pinged_at <= peer.last_seen:
+                    peer.pinged_at = now
+                    probe.append(peer)
+                    self.liveness.schedule(peer, peer, now + self.heartbeat_interval, now)
+                else:
+                    expired.append(peer)
+        
+        for peer in probe:
+            self.send_to_peer(peer, {'type': 'ping'})
+        for peer in expired:
+            print(f"[Relay Server] Dropping idle peer '{peer.peer_id}'")
+            # The peer's reader notices the closed socket and unregisters it
+            self.drop_socket(peer.socket)
+    
+    def expire_streams(self):
+        """Drop stream sessions that never got both peers attached"""
+        now = time.time()
+        with self.lock:
+            for session_id, session in list(self.streams.items()):
+                if now - session.created_at > STREAM_ATTACH_TIMEOUT:
+                    session.close()
+                    del self.streams[session_id]
             
-            with self.lock:
-                stale_peers = []
-                for peer_id, peer in list(self.peers.items()):
-                    try:
-                        # Check if connection is still alive
-                        self.send_message(peer.socket, {'type': 'ping'})
-                    except:
-                        stale_peers.append(peer_id)
-                
-                for peer_id in stale_peers:
-                    print(f"[Relay Server] Removing stale peer: {peer_id}")
-                    del self.peers[peer_id]
+            for session_id, early in list(self.early_attaches.items()):
+                if now - early[3] > EARLY_ATTACH_TIMEOUT:
+                    early[0].close()
+                    del self.early_attaches[session_id]
     
     def send_message(self, sock, msg):
         """Send a JSON message"""
         try:
-            msg_json = json.dumps(msg).encode('utf-8')
-            length = struct.pack('!I', len(msg_json))
-            sock.sendall(length + msg_json)
+            sock.sendall(encode_message(msg))
         except Exception as e:
             raise
     
@@ -294,11 +1213,330 @@ class RelayServer:
             data += packet
         return data
     
+    def stop(self):
+        """Stop the relay server"""
+        self.running = False
+        if self.socket:
+            try:
+                # Wakes the accept() blocked in start(); close() alone does not
+                self.socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self.socket.close()
+        if self.udp_socket:
+            self.udp_socket.close()
+
+
+class _Connection:
+    """Per-socket state for the event-loop relay"""
+    
+    __slots__ = ('sock', 'addr', 'inbuf', 'outbuf', 'peer', 'writing', 'closing')
+    
+    def __init__(self, sock, addr):
+        self.sock = sock
+        self.addr = addr
+        self.inbuf = bytearray()
+        self.outbuf = bytearray()
+        self.peer = None
+        self.writing = False
+        self.closing = False
+
+
+class EventLoopRelayServer(RelayServer):
+    """
+    Relay server running every peer connection on one selector loop
+    
+    Speaks the same JSON control protocol as RelayServer, but keeps
+    non-blocking read and write buffers per peer instead of a thread per
+    peer, so idle peers cost only a socket and a few small objects.
+    Spliced data streams still get their own forwarding threads.
+    """
+    
+    # Bytes read per recv call
+    READ_SIZE = 65536
+    
+    # Largest control message accepted from a peer
+    MAX_MESSAGE_SIZE = 1024 * 1024
+    
+    # Outbound bytes queued for one peer before it is dropped as too slow
+    MAX_OUTBUF = 4 * 1024 * 1024
+    
+    # Seconds between housekeeping passes
+    HOUSEKEEPING_INTERVAL = 1.0
+    
+    # Output is buffered as encoded bytes
+    QUEUE_UNIT = 'bytes'
+    
+    def __init__(self, host='0.0.0.0', port=8877, idle_timeout=IDLE_TIMEOUT,
+                 heartbeat_interval=HEARTBEAT_INTERVAL):
+        super().__init__(host, port, idle_timeout, heartbeat_interval)
+        self.selector = None
+        self.connections = {}  # socket -> _Connection
+        self.closing = []  # connections to close once the current handler returns
+        self.unflushed = set()  # connections with output queued this iteration
+    
+    def start(self):
+        """Start the relay server and run the event loop"""
+        self.socket = self.create_listener()
+        self.socket.setblocking(False)
+        self.open_udp()
+        
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.socket, selectors.EVENT_READ)
+        if self.udp_socket:
+            self.udp_socket.setblocking(False)
+            self.selector.register(self.udp_socket, selectors.EVENT_READ, self._on_udp)
+        self.running = True
+        
+        print(f"[Relay Server] Started on {self.host}:{self.port} (event loop)")
+        print(f"[Relay Server] Waiting for peer connections...")
+        
+        self.serve_forever()
+    
+    def create_listener(self):
+        """Create the listening socket"""
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((self.host, self.port))
+        sock.listen(1024)
+        return sock
+    
+    def serve_forever(self):
+        """Run the selector loop until stopped"""
+        # Tick at least as often as the liveness wheel
+        interval = min(self.HOUSEKEEPING_INTERVAL, self.liveness.tick)
+        next_housekeeping = time.monotonic() + interval
+        try:
+            while self.running:
+                timeout = max(0.0, next_housekeeping - time.monotonic())
+                for key, mask in self.selector.select(timeout):
+                    if key.fileobj is self.socket:
+                        self._accept()
+                        continue
+                    if callable(key.data):
+                        # Auxiliary socket registered with its own handler
+                        key.data()
+                        continue
+                    conn = key.data
+                    if mask & selectors.EVENT_READ:
+                        self._on_readable(conn)
+                    if mask & selectors.EVENT_WRITE and not conn.closing:
+                        self._flush(conn)
+                    if self.closing:
+                        self._close_pending()
+                
+                if time.monotonic() >= next_housekeeping:
+                    self.housekeeping()
+                    next_housekeeping = time.monotonic() + interval
+                
+                # One write per connection for all replies produced above
+                self._flush_unflushed()
+        finally:
+            for conn in list(self.connections.values()):
+                self._close(conn)
+            self.selector.close()
+    
+    def housekeeping(self):
+        """Periodic maintenance run from the event loop"""
+        self.check_liveness()
+        self.expire_streams()
+    
+    def _on_udp(self):
+        """Answer every pending UDP rendezvous probe"""
+        while True:
+            try:
+                data, addr = self.udp_socket.recvfrom(2048)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError:
+                return
+            self.handle_udp(data, addr)
+    
+    def _accept(self):
+        """Accept all pending connections"""
+        while True:
+            try:
+                client_socket, addr = self.socket.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                if self.running:
+                    print(f"[Relay Server] Error accepting connection: {e}")
+                return
+            
+            client_socket.setblocking(False)
+            client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            conn = _Connection(client_socket, addr)
+            self.connections[client_socket] = conn
+            self.selector.register(client_socket, selectors.EVENT_READ, conn)
+    
+    def _on_readable(self, conn):
+        """Read available bytes and dispatch every complete message"""
+        try:
+            data = conn.sock.recv(self.READ_SIZE)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            data = b''
+        
+        if not data:
+            self._close(conn)
+            return
+        
+        conn.inbuf += data
+        while len(conn.inbuf) >= 4:
+            length = struct.unpack_from('!I', conn.inbuf)[0]
+            if length > self.MAX_MESSAGE_SIZE:
+                print(f"[Relay Server] Oversized message from {conn.addr}")
+                self._close(conn)
+                return
+            if len(conn.inbuf) < 4 + length:
+                break
+            
+            payload = bytes(conn.inbuf[4:4 + length])
+            del conn.inbuf[:4 + length]
+            try:
+                msg = json.loads(payload.decode('utf-8'))
+            except (ValueError, UnicodeDecodeError):
+                self._close(conn)
+                return
+            
+            try:
+                self._handle_message(conn, msg)
+            except Exception as e:
+                print(f"[Relay Server] Error handling peer {conn.addr}: {e}")
+                self._close(conn)
+                return
+            
+            if conn.closing or conn.sock not in self.connections:
+                # Connection was closed or handed off by the handler
+                return
+    
+    def make_peer(self, peer_id, peer_type, client_socket, addr):
+        """Create a registry entry; the loop buffers output itself"""
+        return PeerInfo(peer_id, peer_type, client_socket, addr)
+    
+    def queue_depth(self, peer):
+        """Outbound bytes buffered for a peer"""
+        conn = self.connections.get(peer.socket)
+        return len(conn.outbuf) if conn else 0
+    
+    def _handle_message(self, conn, msg):
+        """Route a message to registration or the shared dispatcher"""
+        if conn.peer:
+            self.dispatch_message(conn.peer, msg)
+            return
+        
+        msg_type = msg.get('type')
+        if msg_type == 'stream_attach':
+            # Data connection: take it off the loop and hand it to the stream
+            self._detach(conn)
+            conn.sock.setblocking(True)
+            self.handle_stream_attach(conn.sock, conn.addr, msg)
+            return
+        
+        peer_id = msg.get('peer_id')
+        peer_type = msg.get('peer_type')
+        if msg_type != 'register' or not peer_id or not peer_type:
+            print(f"[Relay Server] Invalid registration from {conn.addr}")
+            self._close(conn)
+            return
+        
+        conn.peer = self.register_peer(peer_id, peer_type, conn.sock, conn.addr,
+                                       msg.get('tags'))
+    
+    def send_message(self, sock, msg):
+        """Queue a JSON message on the peer's write buffer"""
+        conn = self.connections.get(sock)
+        if conn is None:
+            # Not on the loop (e.g. a stream socket): send directly
+            super().send_message(sock, msg)
+            return
+        if conn.closing:
+            return
+        
+        conn.outbuf += encode_message(msg)
+        if len(conn.outbuf) > self.MAX_OUTBUF:
+            print(f"[Relay Server] Dropping slow peer {conn.addr}")
+            self._schedule_close(conn)
+            return
+        if not conn.writing:
+            # Flushed at the end of the loop iteration
+            self.unflushed.add(conn)
+    
+    def _flush_unflushed(self):
+        """Write the output queued during this loop iteration"""
+        unflushed, self.unflushed = self.unflushed, set()
+        for conn in unflushed:
+            if not conn.closing and conn.sock in self.connections:
+                self._flush(conn)
+        if self.closing:
+            self._close_pending()
+    
+    def _flush(self, conn):
+        """Write as much buffered output as the socket accepts"""
+        try:
+            sent = conn.sock.send(conn.outbuf)
+            del conn.outbuf[:sent]
+        except (BlockingIOError, InterruptedError):
+            pass
+        except OSError:
+            # Handlers may hold the registry lock: close after they return
+            self._schedule_close(conn)
+            return
+        
+        want_write = bool(conn.outbuf)
+        if want_write != conn.writing:
+            events = selectors.EVENT_READ | (selectors.EVENT_WRITE if want_write else 0)
+            self.selector.modify(conn.sock, events, conn)
+            conn.writing = want_write
+    
+    def drop_socket(self, sock):
+        """Close a peer connection owned by the loop"""
+        conn = self.connections.get(sock)
+        if conn:
+            self._schedule_close(conn)
+        else:
+            super().drop_socket(sock)
+    
+    def _schedule_close(self, conn):
+        """Mark a connection for closing at the end of the current event"""
+        if not conn.closing:
+            conn.closing = True
+            self.closing.append(conn)
+    
+    def _close_pending(self):
+        """Close connections scheduled by handlers"""
+        closing, self.closing = self.closing, []
+        for conn in closing:
+            self._close(conn)
+    
+    def _detach(self, conn):
+        """Remove a connection from the loop without closing it"""
+        self.connections.pop(conn.sock, None)
+        try:
+            self.selector.unregister(conn.sock)
+        except (KeyError, ValueError):
+            pass
+    
+    def _close(self, conn):
+        """Close a connection and unregister its peer"""
+        self._detach(conn)
+        if conn.peer:
+            self.unregister_peer(conn.peer)
+            conn.peer = None
+        try:
+            conn.sock.close()
+        except OSError:
+            pass
+    
     def stop(self):
         """Stop the relay server"""
         self.running = False
         if self.socket:
             self.socket.close()
+        if self.udp_socket:
+            self.udp_socket.close()
 
 
 def main():
@@ -306,9 +1544,39 @@ def main():
     parser = argparse.ArgumentParser(description='LiteDesk Relay Server')
     parser.add_argument('--host', default='0.0.0.0', help='Host to bind to')
     parser.add_argument('--port', type=int, default=8877, help='Port to listen on')
+    parser.add_argument('--mode', choices=['eventloop', 'threaded'], default='eventloop',
+                        help='Relay core: one event loop (default) or a thread per peer')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Event-loop worker processes sharing the port (Linux, SO_REUSEPORT)')
+    parser.add_argument('--idle-timeout', type=float, default=IDLE_TIMEOUT,
+                        help='Seconds without any message before a peer is dropped')
+    parser.add_argument('--heartbeat-interval', type=float, default=HEARTBEAT_INTERVAL,
+                        help='Seconds between heartbeats asked of clients')
+    parser.add_argument('--metrics-port', type=int, default=None,
+                        help='Serve Prometheus metrics on this local port '
+                             '(worker N of a cluster uses the port + N)')
     args = parser.parse_args()
+    liveness = {'idle_timeout': args.idle_timeout,
+                'heartbeat_interval': args.heartbeat_interval}
+    
+    if args.workers > 1:
+        from relay_cluster import RelayCluster
+        cluster = RelayCluster(host=args.host, port=args.port, workers=args.workers,
+                               metrics_port=args.metrics_port, **liveness)
+        try:
+            cluster.start()
+            cluster.wait()
+        except KeyboardInterrupt:
+            print("\n[Relay Server] Shutting down...")
+            cluster.stop()
+        return
     
-    server = RelayServer(host=args.host, port=args.port)
+    if args.mode == 'threaded':
+        server = RelayServer(host=args.host, port=args.port, **liveness)
+    else:
+        server = EventLoopRelayServer(host=args.host, port=args.port, **liveness)
+    if args.metrics_port is not None:
+        MetricsServer(server, port=args.metrics_port).start()
     
     try:
         server.start()
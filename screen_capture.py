@@ -3,26 +3,76 @@ LiteDesk - Simple Peer-to-Peer Remote Desktop
 Inspired by RustDesk architecture
 
 This module handles screen capture functionality.
+
+With NumPy installed, capture_update() spots scrolled and moved regions
+(see scroll_detect) and sends them as copy-rect updates, and sends other
+changes as tiles the client may already have cached (see tile_cache).
+When the screen has not changed at all it returns None before converting
+or encoding anything. Tiles are sent at the motion quality and, once they
+stay still, refined at refine_quality.
+
+For slow links the colour mode trades fidelity for size: grayscale JPEG,
+or a 256/64 colour palette sent as lossless PNG (see network.COLOR_MODES).
+
+For video-heavy screens the whole stream can instead go through an
+inter-frame video codec (see video_codec, needs PyAV).
+
+On X11 only the rectangles the X server reports as damaged are grabbed
+and compared (see x11_capture); elsewhere the whole monitor is grabbed.
 """
 import mss
 import io
+import sys
 from PIL import Image
+from network import COLOR_MODES, DEFAULT_COLOR_MODE
+from profiling import StageProfiler
+from scroll_detect import NUMPY_AVAILABLE, CopyRectDetector, bounding_box
+from tile_cache import TileEncoder
+
+if NUMPY_AVAILABLE:
+    import numpy as np
+
+
+# Palette size of the palette colour modes
+PALETTE_COLORS = {'palette256': 256, 'palette64': 64}
+
+# JPEG quality still tiles are refined to
+REFINE_QUALITY = 90
 
 
 class ScreenCapture:
     """Handles screen capture operations"""
     
-    def __init__(self, monitor_number=1, quality=50):
+    def __init__(self, monitor_number=1, quality=50, profiler=None, copy_rect=True,
+                 color_mode=DEFAULT_COLOR_MODE, refine_quality=REFINE_QUALITY, damage=True):
         """
         Initialize screen capture
         
         Args:
             monitor_number: Monitor to capture (1 for primary)
             quality: JPEG quality (1-100, lower = smaller size)
+            profiler: StageProfiler timing the grab/convert/encode stages
+            copy_rect: Send scrolls and moves as copy-rect updates (needs NumPy)
+            color_mode: One of network.COLOR_MODES
+            refine_quality: JPEG quality still tiles are resent at once
+                changes around them settle (0 disables refinement)
+            damage: On X11, grab only what the X server reports as damaged
         """
         self.sct = mss.mss()
         self.monitor = self.sct.monitors[monitor_number]
         self.quality = quality
+        self.refine_quality = refine_quality
+        self.color_mode = color_mode
+        self.profiler = profiler or StageProfiler()
+        self.detector = CopyRectDetector() if copy_rect and NUMPY_AVAILABLE else None
+        self.tiles = None  # TileEncoder once a client has a tile cache
+        self.video = None  # VideoEncoder while streaming video
+        self.video_codec = None
+        self.previous_raw = None  # (size, pixels) of the last capture sent
+        self.damage_capture = None
+        if damage and sys.platform.startswith('linux'):
+            from x11_capture import create_damage_capture
+            self.damage_capture = create_damage_capture(self.sct, self.monitor)
     
     def capture_screen(self):
         """
@@ -31,18 +81,194 @@ class ScreenCapture:
         Returns:
             tuple: (width, height, jpeg_bytes)
         """
-        # Capture screen
-        screenshot = self.sct.grab(self.monitor)
+        with self.profiler.stage('grab'):
+            screenshot = self.grab()
+        with self.profiler.stage('convert'):
+            img = self.to_image(screenshot)
+        with self.profiler.stage('encode'):
+            jpeg_bytes = self.encode(img)
         
-        # Convert to PIL Image
-        img = Image.frombytes('RGB', screenshot.size, screenshot.rgb)
+        return (screenshot.size[0], screenshot.size[1], jpeg_bytes)
+    
+    def capture_update(self):
+        """
+        Capture screen as the cheapest update that brings the client up to date
         
-        # Compress to JPEG
-        buffer = io.BytesIO()
-        img.save(buffer, format='JPEG', quality=self.quality, optimize=True)
-        jpeg_bytes = buffer.getvalue()
+        A moved region goes out as a copy-rect carrying only the patch the
+        move leaves out of date. With a tile cache, other changes go out as
+        the changed tiles, those the client holds by reference. Otherwise
+        the whole frame is sent.
         
-        return (screenshot.size[0], screenshot.size[1], jpeg_bytes)
+        All of these use the motion quality (self.quality). Tiles that have
+        since stayed unchanged are resent at refine_quality first, in place
+        of a capture. While streaming video every change is a video frame.
+        
+        Returns:
+            tuple: (width, height, jpeg_bytes, update) where update is None
+            for a full frame, or the CopyRect/TileUpdate/VideoUpdate that
+            jpeg_bytes (the patch, the atlas of new tiles or the compressed
+            video frame) belongs to; None when the
+            screen is unchanged and there is nothing to send
+        """
+        refine = (self.tiles and not self.video and self.refine_quality > self.quality
+                  and self.color_mode not in PALETTE_COLORS)
+        if refine:
+            with self.profiler.stage('refine'):
+                refinement = self.tiles.refinement()
+                if refinement:
+                    update, atlas = refinement
+                    data = self.encode(Image.fromarray(atlas), self.refine_quality) if atlas is not None else b''
+                    return (update.width, update.height, data, update)
+        
+        with self.profiler.stage('grab'):
+            screenshot = self.grab()
+            if not self.screen_changed(screenshot):
+                if refine:
+                    self.tiles.age()
+                return None
+        with self.profiler.stage('convert'):
+            img = self.to_image(screenshot)
+        width, height = screenshot.size
+        
+        if self.video:
+            with self.profiler.stage('encode'):
+                encoded = self.video.encode(img, self.quality)
+            if encoded is None:
+                return None
+            return (width, height) + encoded
+        
+        update = atlas = None
+        if self.detector or self.tiles:
+            with self.profiler.stage('detect'):
+                pixels = np.frombuffer(screenshot.rgb, dtype=np.uint8).reshape(height, width, 3)
+                # Rectangles the capture backend saw change (None: look everywhere)
+                damage = getattr(screenshot, 'damage', None)
+                if self.detector:
+                    region = bounding_box(damage) if damage is not None else None
+                    update = self.detector.update(pixels, region)
+                if self.tiles:
+                    if update:
+                        self.tiles.sync(pixels, damage)
+                    else:
+                        update, atlas = self.tiles.update(pixels, damage)
+                        if not update.entries:
+                            return None
+        
+        with self.profiler.stage('encode'):
+            if update is None:
+                return (width, height, self.encode(img), None)
+            if update.kind == 'tiles':
+                data = self.encode(Image.fromarray(atlas)) if atlas is not None else b''
+                return (width, height, data, update)
+            if not update.patch:
+                return (width, height, b'', update)
+            x, y, w, h = update.patch
+            return (width, height, self.encode(img.crop((x, y, x + w, y + h))), update)
+    
+    def screen_changed(self, screenshot):
+        """
+        Compare a capture with the previous one, byte for byte
+        
+        Comparing the raw buffers is a memcmp, far cheaper than converting
+        and encoding a frame nobody needs. Captures that list their damage
+        have already been compared.
+        
+        Returns:
+            bool: False if the capture is identical to the previous one
+        """
+        damage = getattr(screenshot, 'damage', None)
+        if damage is not None:
+            return bool(damage)
+        raw = (tuple(screenshot.size), screenshot.raw)
+        if raw == self.previous_raw:
+            return False
+        # Copy: a capture backend may reuse its buffer for the next grab
+        self.previous_raw = (raw[0], bytes(raw[1]))
+        return True
+    
+    def set_color_mode(self, mode):
+        """
+        Switch colour mode, redrawing the whole screen in the new one
+        
+        Args:
+            mode: One of network.COLOR_MODES
+        """
+        if mode not in COLOR_MODES:
+            raise ValueError(f"Unknown colour mode: {mode}")
+        self.color_mode = mode
+        self.request_keyframe()
+    
+    def set_video_codec(self, codec):
+        """
+        Stream as inter-frame video, or go back to images
+        
+        Args:
+            codec: Key of video_codec.CODECS, or None for images
+        """
+        if codec:
+            from video_codec import VideoEncoder
+            self.video = VideoEncoder(codec)
+        else:
+            self.video = None
+        self.video_codec = codec
+        self.request_keyframe()
+    
+    def set_tile_cache(self, capacity):
+        """
+        Size the tile cache of a newly connected client
+        
+        Args:
+            capacity: Tiles the client caches (0 disables tile updates)
+        """
+        self.tiles = TileEncoder(capacity) if capacity and NUMPY_AVAILABLE else None
+        self.request_keyframe()
+    
+    def request_keyframe(self):
+        """Redraw the whole screen with the next capture_update()"""
+        self.previous_raw = None
+        if self.damage_capture:
+            self.damage_capture.invalidate()
+        if self.video:
+            self.video.request_keyframe()
+        if self.detector:
+            self.detector.reset()
+        if self.tiles:
+            self.tiles.reset()
+    
+    def grab(self):
+        """Capture the raw screen pixels"""
+        if self.damage_capture:
+            return self.damage_capture.grab()
+        return self.sct.grab(self.monitor)
+    
+    def to_image(self, screenshot):
+        """Convert a raw capture to a PIL Image"""
+        return Image.frombytes('RGB', screenshot.size, screenshot.rgb)
+    
+    def encode(self, img, quality=None):
+        """
+        Compress an image to JPEG bytes (PNG in the palette colour modes)
+        
+        Args:
+            img: PIL Image
+            quality: JPEG quality (default: self.quality)
+        """
+        buffer = io.BytesIO()
+        quality = quality or self.quality
+        mode = self.color_mode
+        if mode in PALETTE_COLORS:
+            # No dithering: flat colour areas are what makes the PNG small
+            img = img.quantize(colors=PALETTE_COLORS[mode], method=Image.Quantize.FASTOCTREE,
+                               dither=Image.Dither.NONE)
+            img.save(buffer, format='PNG')
+        elif mode == 'gray':
+            img.convert('L').save(buffer, format='JPEG', quality=quality, optimize=True)
+        else:
+            # 4:4:4 keeps coloured text sharp; 4:2:0 halves the chroma data
+            subsampling = 0 if mode == 'text' else 2
+            img.save(buffer, format='JPEG', quality=quality, optimize=True,
+                     subsampling=subsampling)
+        return buffer.getvalue()
     
     def get_screen_size(self):
         """Get screen dimensions"""
@@ -50,4 +276,6 @@ class ScreenCapture:
     
     def close(self):
         """Clean up resources"""
+        if self.damage_capture:
+            self.damage_capture.close()
         self.sct.close()
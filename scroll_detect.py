@@ -0,0 +1,230 @@
+"""
+LiteDesk - Scroll Detection Module
+
+Finds regions of the screen that moved between two captures, such as a
+scrolled document or a window dragged along one axis. Instead of
+re-encoding every pixel that changed, the server tells the client to copy
+the moved rectangle within its own framebuffer and sends only what the
+copy cannot explain (usually the newly exposed strip).
+
+Rows (or columns) of the changed area are hashed and matched between the
+two captures; the shift most rows agree on wins. Requires NumPy.
+"""
+from collections import Counter, namedtuple
+
+try:
+    import numpy as np
+    NUMPY_AVAILABLE = True
+except ImportError:
+    NUMPY_AVAILABLE = False
+
+
+# Fewest moved rows/columns worth a copy-rect update
+MIN_SHIFT_LINES = 32
+
+# Fewest distinctive rows that must agree on a shift
+MIN_VOTES = 8
+
+# A full frame is sent instead when the patch left after a move covers
+# more than this share of the screen
+MAX_PATCH_FRACTION = 0.5
+
+
+class CopyRect(namedtuple('CopyRect', 'x y w h dx dy patch')):
+    """
+    Copy the w x h rectangle at (x, y) of the client's framebuffer to
+    (x + dx, y + dy), then paste the patch image at patch (x, y, w, h)
+    """
+    __slots__ = ()
+    kind = 'copy_rect'
+
+
+def bounding_box(rects):
+    """
+    Smallest rectangle holding all of some rectangles
+    
+    Args:
+        rects: (x, y, w, h) rectangles
+    
+    Returns:
+        tuple: (x, y, w, h), or None for no rectangles
+    """
+    if not rects:
+        return None
+    left = min(x for x, _, _, _ in rects)
+    top = min(y for _, y, _, _ in rects)
+    right = max(x + w for x, _, w, _ in rects)
+    bottom = max(y + h for _, y, _, h in rects)
+    return (left, top, right - left, bottom - top)
+
+
+def changed_bounds(prev, cur, region=None):
+    """
+    Bounding box of the pixels that differ between two captures
+    
+    Args:
+        prev: Previous capture, (height, width, 3) uint8 array
+        cur: Current capture of the same shape
+        region: (x, y, w, h) outside which nothing changed (None: anywhere)
+    
+    Returns:
+        tuple: (x, y, w, h), or None if nothing changed
+    """
+    if region:
+        x, y, w, h = region
+        found = changed_bounds(prev[y:y + h, x:x + w], cur[y:y + h, x:x + w])
+        return found and (found[0] + x, found[1] + y, found[2], found[3])
+    diff = prev != cur
+    # Reduce over the long axes first: any() over the 3 channels is slow
+    rows = np.flatnonzero(diff.reshape(diff.shape[0], -1).any(axis=1))
+    if not rows.size:
+        return None
+    top, bottom = int(rows[0]), int(rows[-1]) + 1
+    cols = np.flatnonzero(diff[top:bottom].any(axis=0).any(axis=1))
+    return (int(cols[0]), top, int(cols[-1] - cols[0] + 1), bottom - top)
+
+
+def row_hashes(pixels):
+    """Hash each row of a (height, width, 3) array"""
+    rows = np.ascontiguousarray(pixels).reshape(pixels.shape[0], -1)
+    return [hash(row.tobytes()) for row in rows]
+
+
+def find_row_shift(prev, cur, min_lines=MIN_SHIFT_LINES):
+    """
+    Find the longest run of rows that moved vertically by the same amount
+    
+    Args:
+        prev: Previous pixels of a region, (height, width, 3)
+        cur: Current pixels of the same region
+        min_lines: Fewest rows the run must span
+    
+    Returns:
+        tuple: (first, end, shift): rows [first, end) of cur equal rows
+        [first - shift, end - shift) of prev; or None
+    """
+    prev_hashes = row_hashes(prev)
+    cur_hashes = row_hashes(cur)
+    
+    # Only rows that occur once on both sides can vote: blank lines and
+    # repeated borders match everywhere and say nothing about the shift
+    prev_counts = Counter(prev_hashes)
+    cur_counts = Counter(cur_hashes)
+    prev_rows = {h: y for y, h in enumerate(prev_hashes) if prev_counts[h] == 1}
+    votes = Counter()
+    for y, h in enumerate(cur_hashes):
+        source = prev_rows.get(h)
+        if source is not None and source != y and cur_counts[h] == 1:
+            votes[y - source] += 1
+    if not votes:
+        return None
+    shift, count = votes.most_common(1)[0]
+    if count < MIN_VOTES:
+        return None
+    
+    # Longest run of rows the shift explains
+    best = (0, 0)
+    start = None
+    height = len(cur_hashes)
+    for y in range(height + 1):
+        source = y - shift
+        if y < height and 0 <= source < height and cur_hashes[y] == prev_hashes[source]:
+            if start is None:
+                start = y
+        elif start is not None:
+            if y - start > best[1] - best[0]:
+                best = (start, y)
+            start = None
+    first, end = best
+    if end - first < min_lines:
+        return None
+    return first, end, shift
+
+
+def detect_copy_rect(prev, cur, min_lines=MIN_SHIFT_LINES, region=None):
+    """
+    Find a region that moved between two captures
+    
+    Vertical moves (scrolling) are tried first, then horizontal ones.
+    
+    Args:
+        prev: Previous capture, (height, width, 3) uint8 array
+        cur: Current capture of the same shape
+        min_lines: Fewest rows/columns the moved region must span
+        region: (x, y, w, h) outside which nothing changed (None: anywhere)
+    
+    Returns:
+        CopyRect: Move plus the patch left to send (patch is None when the
+        move explains every changed pixel), or None if nothing moved
+    """
+    bounds = changed_bounds(prev, cur, region)
+    if bounds is None:
+        return None
+    x, y, w, h = bounds
+    prev_region = prev[y:y + h, x:x + w]
+    cur_region = cur[y:y + h, x:x + w]
+    
+    found = find_row_shift(prev_region, cur_region, min_lines)
+    if found:
+        first, end, dy = found
+        move = CopyRect(x, y + first - dy, w, end - first, 0, dy, None)
+    else:
+        found = find_row_shift(prev_region.transpose(1, 0, 2),
+                               cur_region.transpose(1, 0, 2), min_lines)
+        if not found:
+            return None
+        first, end, dx = found
+        move = CopyRect(x + first - dx, y, end - first, h, dx, 0, None)
+    
+    # What the client will have after the copy, versus what it should see
+    predicted = prev_region.copy()
+    src = prev[move.y:move.y + move.h, move.x:move.x + move.w]
+    predicted[move.y + move.dy - y:move.y + move.dy - y + move.h,
+              move.x + move.dx - x:move.x + move.dx - x + move.w] = src
+    patch = changed_bounds(predicted, cur_region)
+    if patch:
+        patch = (x + patch[0], y + patch[1], patch[2], patch[3])
+    return move._replace(patch=patch)
+
+
+class CopyRectDetector:
+    """Finds moves between each capture and the one before it"""
+    
+    def __init__(self, max_patch_fraction=MAX_PATCH_FRACTION, min_lines=MIN_SHIFT_LINES):
+        """
+        Initialize detector
+        
+        Args:
+            max_patch_fraction: Largest patch, as a share of the screen,
+                worth sending with a move
+            min_lines: Fewest rows/columns a moved region must span
+        """
+        self.max_patch_fraction = max_patch_fraction
+        self.min_lines = min_lines
+        self.previous = None
+    
+    def update(self, pixels, region=None):
+        """
+        Compare a capture with the previous one
+        
+        Args:
+            pixels: Capture as a (height, width, 3) uint8 array
+            region: (x, y, w, h) outside which nothing changed, when the
+                capture backend knows (None: compare everything)
+        
+        Returns:
+            CopyRect: Update to send instead of a full frame, or None
+        """
+        prev, self.previous = self.previous, pixels
+        if prev is None or prev.shape != pixels.shape:
+            return None
+        copy = detect_copy_rect(prev, pixels, self.min_lines, region)
+        if copy and copy.patch:
+            area = copy.patch[2] * copy.patch[3]
+            if area > self.max_patch_fraction * pixels.shape[0] * pixels.shape[1]:
+                return None
+        return copy
+    
+    def reset(self):
+        """Forget the previous capture, so the next one goes out in full"""
+        self.previous = None
@@ -5,15 +5,14 @@ LiteDesk Server - Host/Share Desktop
 Run this on the machine you want to share.
 """
 import sys
-import time
 import threading
 from PyQt5.QtWidgets import (QApplication, QMainWindow, QWidget, QVBoxLayout, 
                             QLabel, QPushButton, QMessageBox)
 from PyQt5.QtCore import Qt, pyqtSignal, QObject
 from PyQt5.QtGui import QFont
-from screen_capture import ScreenCapture
-from input_control import InputController
 from network import NetworkServer, NetworkServerWithRelay
+from streaming import StreamingLoop
+from daemon import load_server_config
 from platform_utils import (get_platform, get_default_network_interface, 
                             show_permission_instructions, check_display_available)
 
@@ -22,6 +21,7 @@ class ServerSignals(QObject):
     """Signals for server events"""
     client_connected = pyqtSignal(str)
     client_disconnected = pyqtSignal()
+    local_ip_found = pyqtSignal(str)
     error = pyqtSignal(str)
 
 
@@ -33,12 +33,14 @@ class LiteDeskServer(QMainWindow):
         self.server = None
         self.screen_capture = None
         self.input_controller = None
+        self.loop = None
         self.running = False
         self.signals = ServerSignals()
         
         # Connect signals
         self.signals.client_connected.connect(self.on_client_connected)
         self.signals.client_disconnected.connect(self.on_client_disconnected)
+        self.signals.local_ip_found.connect(self.on_local_ip_found)
         self.signals.error.connect(self.on_error)
         
         self.init_ui()
@@ -84,8 +86,7 @@ class LiteDeskServer(QMainWindow):
         
         # Platform info label
         platform_name = get_platform().capitalize()
-        local_ip = get_default_network_interface() or "N/A"
-        self.platform_label = QLabel(f"Platform: {platform_name} | Local IP: {local_ip}")
+        self.platform_label = QLabel(f"Platform: {platform_name} | Local IP: ...")
         self.platform_label.setFont(QFont("Arial", 9))
         self.platform_label.setAlignment(Qt.AlignCenter)
         self.platform_label.setStyleSheet("color: #666; padding: 5px;")
@@ -113,6 +114,18 @@ class LiteDeskServer(QMainWindow):
         layout.addWidget(self.start_button)
         
         layout.addStretch(1)
+        
+        # Look the address up without holding up the window
+        threading.Thread(target=self.find_local_ip, daemon=True).start()
+    
+    def find_local_ip(self):
+        """Look up the local IP address (runs off the GUI thread)"""
+        self.signals.local_ip_found.emit(get_default_network_interface() or "N/A")
+    
+    def on_local_ip_found(self, local_ip):
+        """Show the local IP address once known"""
+        platform_name = get_platform().capitalize()
+        self.platform_label.setText(f"Platform: {platform_name} | Local IP: {local_ip}")
     
     def toggle_sharing(self):
         """Start or stop sharing"""
@@ -131,6 +144,9 @@ class LiteDeskServer(QMainWindow):
                 QMessageBox.warning(self, "Display Not Available", msg)
                 # Continue anyway as this might work in some cases
             
+            config = load_server_config()
+            port = config['port']
+            
             # Check if relay mode is enabled
             use_relay = self.use_relay_checkbox.isChecked()
             relay_host = self.relay_input.text().strip() if use_relay else None
@@ -140,24 +156,37 @@ class LiteDeskServer(QMainWindow):
                 import socket
                 peer_id = f"server_{socket.gethostname()}"
                 self.server = NetworkServerWithRelay(
-                    host='0.0.0.0', 
-                    port=9876,
+                    host=config['host'], 
+                    port=port,
                     relay_host=relay_host,
                     relay_port=8877,
                     peer_id=peer_id
                 )
                 self.server.start_with_relay()
-                info_text = f"Server is listening on port 9876\n"
+                info_text = f"Server is listening on port {port}\n"
                 info_text += f"Registered with relay: {relay_host}\n"
                 info_text += f"Server ID: {peer_id}\n"
                 info_text += "Clients can connect via relay or direct IP"
             else:
-                self.server = NetworkServer(host='0.0.0.0', port=9876)
+                self.server = NetworkServer(host=config['host'], port=port)
                 self.server.start()
-                info_text = "Server is listening on port 9876\nShare your IP address with the client"
+                info_text = f"Server is listening on port {port}\nShare your IP address with the client"
             
-            self.screen_capture = ScreenCapture(quality=50)
-            self.input_controller = InputController()
+            # mss and pynput are only loaded once sharing starts
+            from screen_capture import ScreenCapture
+            from input_control import InputController
+            self.screen_capture = ScreenCapture(quality=config['quality'],
+                                                refine_quality=config['refine_quality'],
+                                                profiler=self.server.profiler)
+            self.server.video_codec = config['video_codec']
+            self.server.transfer_dir = config['transfer_dir']
+            self.input_controller = InputController() if config['allow_input'] else None
+            self.loop = StreamingLoop(
+                self.server, self.screen_capture, self.input_controller,
+                frame_delay=config['frame_delay'],
+                on_connected=lambda: self.signals.client_connected.emit("Client connected"),
+                on_disconnected=self.signals.client_disconnected.emit
+            )
             
             self.running = True
             
@@ -171,66 +200,27 @@ class LiteDeskServer(QMainWindow):
             
             # Start server thread
             threading.Thread(target=self.server_loop, daemon=True).start()
-            
+        
         except Exception as e:
             self.signals.error.emit(f"Failed to start server: {str(e)}")
     
     def server_loop(self):
         """Main server loop"""
         try:
-            # Wait for client connection
-            if self.server.accept_connection():
-                self.signals.client_connected.emit("Client connected")
-                
-                # Main streaming loop
-                while self.running and self.server.client_socket:
-                    # Capture and send frame
-                    width, height, jpeg_data = self.screen_capture.capture_screen()
-                    if not self.server.send_frame(width, height, jpeg_data):
-                        break
-                    
-                    # Check for commands (non-blocking)
-                    cmd = self.server.receive_command()
-                    if cmd:
-                        self.process_command(cmd)
-                    
-                    # Control frame rate (approx 10 FPS)
-                    time.sleep(0.1)
-                
-                self.signals.client_disconnected.emit()
-        except Exception as e:
-            self.signals.error.emit(f"Server error: {str(e)}")
-    
-    def process_command(self, cmd):
-        """Process a command from the client"""
-        try:
-            cmd_type = cmd.get('type')
-            data = cmd.get('data', {})
-            
-            if cmd_type == 'mouse_move':
-                x, y = data.get('x'), data.get('y')
-                self.input_controller.move_mouse(x, y)
-            
-            elif cmd_type == 'mouse_click':
-                button = data.get('button', 'left')
-                press = data.get('press', True)
-                self.input_controller.click_mouse(button, press)
-            
-            elif cmd_type == 'mouse_scroll':
-                dx, dy = data.get('dx', 0), data.get('dy', 0)
-                self.input_controller.scroll_mouse(dx, dy)
-            
-            elif cmd_type == 'key_press':
-                key = data.get('key')
-                self.input_controller.press_key(key)
-            
+            # Stream frames and apply input until stopped; a client that
+            # drops can come back and resume its session
+            self.loop.run()
         except Exception as e:
-            print(f"Error processing command: {e}")
+            if self.running:
+                self.signals.error.emit(f"Server error: {str(e)}")
     
     def stop_sharing(self):
         """Stop the server"""
         self.running = False
         
+        if self.loop:
+            self.loop.stop()
+        
         if self.server:
             self.server.stop()
         
@@ -35,10 +35,15 @@ setup(
         "pynput>=1.7.6",
         "PyQt5>=5.15.0",
     ],
+    extras_require={
+        "scroll": ["numpy>=1.20"],
+        "video": ["av>=12.0"],
+    },
     entry_points={
         "console_scripts": [
             "litedesk-server=server:main",
             "litedesk-client=client:main",
+            "litedesk-daemon=daemon:main",
         ],
     },
 )
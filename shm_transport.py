@@ -0,0 +1,522 @@
+"""
+LiteDesk - Shared Memory Transport Module
+
+Same-host transport for local consumers of the stream (a recorder or a
+transcoder next to the server) and for benchmarking capture and encode
+without network noise. The server writes each packet, exactly as it
+would go over TCP, into a ring of fixed-size slots in a
+multiprocessing.shared_memory segment; consumers read the slots in place
+instead of receiving copies through the kernel.
+
+There is one writer and any number of readers. Every packet gets the
+next sequence number, which is stamped on its slot once written; a
+reader that falls more than a ring behind finds its slot stamped with a
+later number and skips ahead, asking for a keyframe like a viewer that
+lost UDP datagrams. Readers never block the writer. Requires Python 3.8.
+
+Run as a script it streams the screen into a ring as fast as capture and
+encode allow and reports the frame rate and stage timings:
+    python shm_transport.py --frames 200 --quality 50 --decode
+"""
+import argparse
+import struct
+import sys
+import threading
+import time
+from collections import namedtuple
+from network import (
+    NetworkServer, NetworkClient, CONTROL_FRAME, CONTROL_RAW, RAW_HEADER,
+    TILE_CACHE_TILES, VIDEO_CODECS
+)
+
+try:
+    from multiprocessing import shared_memory
+    SHM_AVAILABLE = True
+except ImportError:
+    SHM_AVAILABLE = False
+
+
+# Ring header: magic, slot count, slot size, tile cache size, packets
+# written, keyframe requests (native byte order: the ring never leaves the host)
+RING_HEADER = struct.Struct('=4sIIIQQ')
+RING_MAGIC = b'LDR1'
+COUNTER = struct.Struct('=Q')
+WRITTEN_OFFSET = 16
+KEYFRAMES_OFFSET = 24
+
+# Slot header: sequence number + 1 (0 while the slot is being written),
+# packet length; padded so packets start 16-byte aligned
+SLOT_HEADER = struct.Struct('=QI')
+SLOT_HEADER_SIZE = 16
+
+# Default ring: 4 slots of 8 MB, room for a raw 1920x1200 frame per slot
+DEFAULT_SLOTS = 4
+DEFAULT_SLOT_SIZE = 8 * 1024 * 1024
+
+# Seconds between checks for a new packet while a reader waits
+POLL_INTERVAL = 0.001
+
+
+class ShmPacket(namedtuple('ShmPacket', 'seq width height data')):
+    """
+    A packet read in place: width and height of its frame header, and a
+    memoryview of the data that stays valid only until the writer laps it
+    (check with FrameRing.intact, and release the view when done)
+    """
+    __slots__ = ()
+
+
+def _attach(name):
+    """
+    Open an existing segment without registering it with this process's
+    resource tracker, which would unlink it when the consumer exits
+    """
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name=name, track=False)
+    from multiprocessing import resource_tracker
+    register = resource_tracker.register
+    resource_tracker.register = lambda name, rtype: None
+    try:
+        return shared_memory.SharedMemory(name=name)
+    finally:
+        resource_tracker.register = register
+
+
+class FrameRing:
+    """Ring of packet slots in a shared memory segment"""
+    
+    def __init__(self, shm, owner):
+        """
+        Wrap a segment (use create() or attach())
+        
+        Args:
+            shm: SharedMemory holding the ring
+            owner: Whether this process created it (and unlinks it on close)
+        """
+        magic, slots, slot_size, tile_cache, _, _ = RING_HEADER.unpack_from(shm.buf)
+        if magic != RING_MAGIC:
+            shm.close()
+            raise ValueError(f"{shm.name} is not a LiteDesk frame ring")
+        self.shm = shm
+        self.buf = shm.buf
+        self.owner = owner
+        self.name = shm.name
+        self.slots = slots
+        self.slot_size = slot_size
+        self.tile_cache = tile_cache
+    
+    @classmethod
+    def create(cls, name=None, slots=DEFAULT_SLOTS, slot_size=DEFAULT_SLOT_SIZE,
+               tile_cache=TILE_CACHE_TILES):
+        """
+        Create a ring
+        
+        Args:
+            name: Segment name (None: a random one)
+            slots: Packets kept at once
+            slot_size: Largest packet in bytes (12-byte header included)
+            tile_cache: Tiles readers must cache to follow tile updates
+        
+        Returns:
+            FrameRing: Ring owned by this process
+        """
+        if not SHM_AVAILABLE:
+            raise RuntimeError("Shared memory transport requires Python 3.8 or later")
+        slot_size = -(-slot_size // SLOT_HEADER_SIZE) * SLOT_HEADER_SIZE
+        size = RING_HEADER.size + slots * (SLOT_HEADER_SIZE + slot_size)
+        shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+        RING_HEADER.pack_into(shm.buf, 0, RING_MAGIC, slots, slot_size, tile_cache, 0, 0)
+        for slot in range(slots):
+            SLOT_HEADER.pack_into(shm.buf, RING_HEADER.size + slot * (SLOT_HEADER_SIZE + slot_size), 0, 0)
+        return cls(shm, owner=True)
+    
+    @classmethod
+    def attach(cls, name):
+        """
+        Open a ring another process created
+        
+        Raises:
+            FileNotFoundError: No such segment
+            ValueError: The segment is not a frame ring
+        """
+        if not SHM_AVAILABLE:
+            raise RuntimeError("Shared memory transport requires Python 3.8 or later")
+        return cls(_attach(name), owner=False)
+    
+    def _slot(self, seq):
+        """Offset of the slot a sequence number goes into"""
+        return RING_HEADER.size + (seq % self.slots) * (SLOT_HEADER_SIZE + self.slot_size)
+    
+    def written(self):
+        """Packets written so far (the next packet gets this sequence number)"""
+        return COUNTER.unpack_from(self.buf, WRITTEN_OFFSET)[0]
+    
+    def write(self, header, data=b''):
+        """
+        Write a packet into the next slot (single writer)
+        
+        Args:
+            header: Frame header (and any update header)
+            data: Rest of the packet, any bytes-like object
+        
+        Returns:
+            int: Sequence number of the packet
+        
+        Raises:
+            ValueError: The packet does not fit a slot
+        """
+        data = memoryview(data).cast('B')
+        length = len(header) + len(data)
+        if length > self.slot_size:
+            raise ValueError(f"{length}-byte packet does not fit {self.slot_size}-byte ring slots")
+        seq = self.written()
+        offset = self._slot(seq)
+        # Readers still on the packet this one replaces see the stamp change
+        SLOT_HEADER.pack_into(self.buf, offset, 0, length)
+        start = offset + SLOT_HEADER_SIZE
+        self.buf[start:start + len(header)] = header
+        self.buf[start + len(header):start + length] = data
+        SLOT_HEADER.pack_into(self.buf, offset, seq + 1, length)
+        COUNTER.pack_into(self.buf, WRITTEN_OFFSET, seq + 1)
+        return seq
+    
+    def read(self, seq):
+        """
+        Packet with a sequence number, in place
+        
+        Args:
+            seq: Sequence number, below written()
+        
+        Returns:
+            ShmPacket, or None when the slot already holds a later packet
+        """
+        offset = self._slot(seq)
+        stamp, length = SLOT_HEADER.unpack_from(self.buf, offset)
+        if stamp != seq + 1 or not 12 <= length <= self.slot_size:
+            return None
+        start = offset + SLOT_HEADER_SIZE
+        width, height, data_length = struct.unpack_from('!III', self.buf, start)
+        data = self.buf[start + 12:start + 12 + min(data_length, length - 12)]
+        return ShmPacket(seq, width, height, data)
+    
+    def intact(self, packet):
+        """Whether a packet read earlier has not been overwritten since"""
+        return SLOT_HEADER.unpack_from(self.buf, self._slot(packet.seq))[0] == packet.seq + 1
+    
+    def request_keyframe(self):
+        """Ask the writer for a packet readers can start from"""
+        # Readers racing here may both write the same count; either way it changed
+        count = COUNTER.unpack_from(self.buf, KEYFRAMES_OFFSET)[0]
+        COUNTER.pack_into(self.buf, KEYFRAMES_OFFSET, count + 1)
+    
+    def keyframe_requests(self):
+        """Keyframe requests made so far"""
+        return COUNTER.unpack_from(self.buf, KEYFRAMES_OFFSET)[0]
+    
+    def close(self):
+        """Detach from the ring (its creator also removes it)"""
+        self.buf = None
+        try:
+            self.shm.close()
+        except BufferError:
+            print("Frame ring closed while packets were still being read")
+            return
+        if self.owner:
+            try:
+                self.shm.unlink()
+            except FileNotFoundError:
+                pass
+
+
+class ShmServer(NetworkServer):
+    """
+    Streams into a frame ring instead of a socket
+    
+    Drop-in for NetworkServer in StreamingLoop. The ring stands in for the
+    connected client: consumers attach and detach without the server
+    noticing, and their only message back is a keyframe request.
+    """
+    
+    def __init__(self, name=None, slots=DEFAULT_SLOTS, slot_size=DEFAULT_SLOT_SIZE,
+                 tile_cache=TILE_CACHE_TILES):
+        """
+        Initialize server
+        
+        Args:
+            name: Shared memory segment name (None: a random one)
+            slots: Packets the ring keeps
+            slot_size: Largest packet in bytes
+            tile_cache: Tiles consumers cache (0 sends full frames)
+        """
+        self.ring = None  # before NetworkServer sets keyframe_requested
+        super().__init__(host=None, port=None)
+        self.name = name
+        self.slots = slots
+        self.slot_size = slot_size
+        self.tile_cache = tile_cache
+        self.transfer_dir = None  # no way back for acknowledgements
+        self.keyframes_seen = 0
+        self.detached = threading.Event()
+    
+    @property
+    def keyframe_requested(self):
+        """Whether a consumer asked for a keyframe since the last one"""
+        ring = self.ring
+        return ring is not None and ring.keyframe_requests() != self.keyframes_seen
+    
+    @keyframe_requested.setter
+    def keyframe_requested(self, requested):
+        if not requested and self.ring is not None:
+            self.keyframes_seen = self.ring.keyframe_requests()
+    
+    def start(self):
+        """Create the ring"""
+        self.ring = FrameRing.create(self.name, self.slots, self.slot_size, self.tile_cache)
+        self.name = self.ring.name
+        self.running = True
+        print(f"Streaming into shared memory ring {self.name}")
+    
+    def accept_connection(self):
+        """Start streaming into the ring (returns at once)"""
+        if not self.running:
+            return False
+        self.client_socket = self.ring
+        self.detached.clear()
+        self.tile_cache_size = self.tile_cache
+        # Consumers share this host's PyAV, so they decode whatever it encodes
+        self.client_video_codecs = VIDEO_CODECS
+        self.keyframe_requested = False
+        return True
+    
+    def receive_command(self):
+        """Wait until streaming stops: consumers send no commands"""
+        if self.client_socket:
+            self.detached.wait()
+        return None
+    
+    def _send_control(self, kind, msg):
+        """Control messages go into the ring like any packet"""
+        import json
+        payload = json.dumps(msg).encode('utf-8')
+        self._send_update(struct.pack('!III', CONTROL_FRAME, kind, len(payload)), payload)
+    
+    def _send_update(self, header, data):
+        """Write a header and its data into the ring"""
+        try:
+            with self.profiler.stage('send'), self.send_lock:
+                if not self.client_socket or not self.ring:
+                    return False
+                self.ring.write(header, data)
+            return True
+        except ValueError as e:
+            # Consumers would lose the stream; stop rather than skip packets
+            print(f"Stopping shared memory stream: {e}")
+            self.running = False
+            return False
+    
+    def send_raw(self, width, height, pixels):
+        """
+        Send an uncompressed frame
+        
+        Args:
+            width: Frame width
+            height: Frame height
+            pixels: RGB pixels row by row (bytes, or a uint8 array)
+        """
+        size = RAW_HEADER.size + width * height * 3
+        header = struct.pack('!III', CONTROL_FRAME, CONTROL_RAW, size) + RAW_HEADER.pack(width, height)
+        return self._send_update(header, pixels)
+    
+    def close_client(self):
+        """Stop streaming into the ring (consumers stay attached)"""
+        self.client_socket = None
+        self.detached.set()
+    
+    def stop(self):
+        """Stop the server and remove the ring"""
+        self.running = False
+        self.close_client()
+        with self.send_lock:
+            if self.ring:
+                self.ring.close()
+                self.ring = None
+
+
+class ShmClient(NetworkClient):
+    """
+    Reads a ShmServer's stream from its ring
+    
+    receive_frame() works as on NetworkClient; read_packet() hands out
+    packets in place for consumers that forward them without decoding.
+    Input commands have no way back and are dropped.
+    """
+    
+    def __init__(self):
+        """Initialize client"""
+        super().__init__()
+        self.ring = None
+        self.next_seq = 0
+        self.lost = 0  # times the writer lapped this reader
+    
+    def connect(self, name):
+        """
+        Attach to a server's ring and ask for a keyframe to start from
+        
+        Args:
+            name: Ring name printed by the server
+        """
+        try:
+            self.ring = FrameRing.attach(name)
+        except (OSError, ValueError) as e:
+            print(f"Cannot attach to frame ring {name}: {e}")
+            return False
+        self.next_seq = self.ring.written()
+        self.tile_cache_size = self.ring.tile_cache
+        self.tiles = {}
+        self.framebuffer = None
+        self.video = None
+        self.connected = True
+        self.ring.request_keyframe()
+        print(f"Attached to shared memory ring {name}")
+        return True
+    
+    def read_packet(self, timeout=None):
+        """
+        Wait for the next packet and return it in place
+        
+        Args:
+            timeout: Seconds to wait (None to wait while connected)
+        
+        Returns:
+            ShmPacket, or None on timeout or disconnect. Its data must be
+            released, and trusted only if ring.intact(packet) still holds
+            after it was used.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self.connected:
+            ring = self.ring
+            written = ring.written()
+            if written > self.next_seq:
+                if written - self.next_seq > ring.slots:
+                    self._lapped(written)
+                packet = ring.read(self.next_seq)
+                if packet is None:
+                    self._lapped(ring.written())
+                    continue
+                self.next_seq += 1
+                return packet
+            if deadline is not None and time.monotonic() >= deadline:
+                return None
+            time.sleep(POLL_INTERVAL)
+        return None
+    
+    def _lapped(self, written):
+        """Skip to the newest packet after the writer overtook this reader"""
+        self.lost += 1
+        self.next_seq = max(written - 1, self.next_seq)
+        self.ring.request_keyframe()
+    
+    def receive_frame(self):
+        """
+        Receive a screen frame from the ring
+        
+        Returns:
+            PIL.Image: Screen frame or None once disconnected
+        """
+        while self.connected:
+            packet = self.read_packet(timeout=1.0)
+            if packet is None:
+                continue
+            error = None
+            try:
+                img = self._apply_packet(packet.width, packet.height, packet.data)
+            except Exception as e:
+                # e is unbound once the handler ends
+                img, error = None, e
+            finally:
+                packet.data.release()
+            if not self.ring.intact(packet):
+                # Overwritten while being decoded
+                self._lapped(self.ring.written())
+                continue
+            if error is not None:
+                print(f"Error applying packet {packet.seq}: {error}")
+                self.ring.request_keyframe()
+                continue
+            if img is not None:
+                return img
+        return None
+    
+    def send_command(self, command_type, data):
+        """Pass keyframe requests to the writer; other commands are dropped"""
+        if not self.connected or command_type != 'request_keyframe':
+            return False
+        self.ring.request_keyframe()
+        return True
+    
+    def disconnect(self):
+        """Detach from the ring"""
+        self.connected = False
+        if self.ring:
+            self.ring.close()
+            self.ring = None
+
+
+def main():
+    """Benchmark capture and encode through the ring"""
+    parser = argparse.ArgumentParser(description='LiteDesk capture/encode benchmark over shared memory')
+    parser.add_argument('--frames', type=int, default=200, help='Packets to read')
+    parser.add_argument('--quality', type=int, default=50, help='JPEG quality')
+    parser.add_argument('--tiles', type=int, default=TILE_CACHE_TILES,
+                        help='Tile cache size (0: full frames)')
+    parser.add_argument('--video', choices=VIDEO_CODECS, help='Stream as video')
+    parser.add_argument('--decode', action='store_true', help='Also decode every frame')
+    parser.add_argument('--redraw', action='store_true',
+                        help='Ask for a full redraw before every packet (a still screen sends nothing otherwise)')
+    args = parser.parse_args()
+    
+    from screen_capture import ScreenCapture
+    from streaming import StreamingLoop
+    
+    server = ShmServer(tile_cache=args.tiles)
+    server.video_codec = args.video
+    server.start()
+    server.profiler.set_enabled(True)
+    capture = ScreenCapture(quality=args.quality, profiler=server.profiler)
+    # No frame delay: the loop runs as fast as capture and encode allow
+    loop = StreamingLoop(server, capture, frame_delay=0)
+    runner = threading.Thread(target=loop.run, daemon=True)
+    runner.start()
+    
+    client = ShmClient()
+    client.connect(server.name)
+    total = 0
+    started = time.perf_counter()
+    try:
+        for _ in range(args.frames):
+            if args.redraw:
+                client.send_command('request_keyframe', {})
+            if args.decode:
+                client.receive_frame()
+                continue
+            packet = client.read_packet()
+            total += len(packet.data)
+            packet.data.release()
+    finally:
+        elapsed = time.perf_counter() - started
+        client.disconnect()
+        loop.stop()
+        server.stop()
+        runner.join(2)
+        capture.close()
+    
+    print(f"{args.frames} packets in {elapsed:.2f}s: {args.frames / elapsed:.1f}/s"
+          + ('' if args.decode else f", {total / elapsed / 1e6:.1f} MB/s"))
+    for stage, stats in server.profiler.stage_stats().items():
+        print(f"  {stage:8s} avg {stats['avg_ms']:7.2f} ms  p95 {stats['p95_ms']:7.2f} ms")
+    if client.lost:
+        print(f"  reader fell behind {client.lost} times")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,158 @@
+"""
+LiteDesk - Streaming Module
+
+The capture/stream/input loop of the sharing side, shared by the PyQt5
+server window and the headless daemon. It never imports Qt.
+
+Frames are captured and sent at a steady rate on one thread while a
+second thread reads commands, so input is applied as soon as it arrives
+and a quiet client still receives frames. While the screen is unchanged
+nothing is encoded or sent except a keepalive every few seconds. File
+downloads use the time left over before the next frame is due.
+"""
+import threading
+import time
+from network import KEEPALIVE_INTERVAL
+
+
+class StreamingLoop:
+    """Serves clients one at a time: stream frames, apply their input"""
+    
+    def __init__(self, server, capture, input_controller=None, frame_delay=0.1,
+                 on_connected=None, on_disconnected=None, keepalive_interval=KEEPALIVE_INTERVAL):
+        """
+        Initialize streaming loop
+        
+        Args:
+            server: Started NetworkServer (or NetworkServerWithRelay)
+            capture: ScreenCapture; copy-rect and tile updates are sent when
+                it has capture_update(), full frames from capture_screen() otherwise
+            input_controller: InputController, or None for view-only sharing
+            frame_delay: Seconds between frames
+            on_connected: Called when a client connects
+            on_disconnected: Called when the client goes away
+            keepalive_interval: Seconds of unchanged screen between keepalives
+        """
+        self.server = server
+        self.capture = capture
+        self.input_controller = input_controller
+        self.frame_delay = frame_delay
+        self.on_connected = on_connected
+        self.on_disconnected = on_disconnected
+        self.keepalive_interval = keepalive_interval
+        self.running = False
+        self.wake = threading.Event()
+    
+    def run(self):
+        """Accept and serve clients until stopped (blocks)"""
+        self.running = True
+        try:
+            while self.running and self.server.accept_connection():
+                if self.on_connected:
+                    self.on_connected()
+                self.stream_client()
+                if self.on_disconnected:
+                    self.on_disconnected()
+        except OSError:
+            # Listening socket closed by stop()
+            if self.running:
+                raise
+    
+    def stream_client(self):
+        """Stream frames to the connected client until it goes away"""
+        reader = threading.Thread(target=self._read_commands, daemon=True)
+        reader.start()
+        profiler = self.server.profiler
+        capture_update = getattr(self.capture, 'capture_update', None)
+        
+        # A new or resumed client starts from a full redraw and an empty tile cache
+        if capture_update is not None:
+            self.capture.set_tile_cache(self.server.tile_cache_size)
+        last_sent = time.monotonic()
+        
+        while self.running and self.server.client_socket:
+            started = time.monotonic()
+            profiler.sync()
+            
+            if capture_update is None:
+                sent = self.server.send_frame(*self.capture.capture_screen())
+            else:
+                if self.server.color_mode != self.capture.color_mode:
+                    self.capture.set_color_mode(self.server.color_mode)
+                video_codec = self.server.stream_video_codec()
+                if video_codec != self.capture.video_codec:
+                    self.capture.set_video_codec(video_codec)
+                if self.server.keyframe_requested:
+                    self.server.keyframe_requested = False
+                    self.capture.request_keyframe()
+                update = capture_update()
+                if update is not None:
+                    sent = self.server.send_update(*update)
+                    last_sent = started
+                elif started - last_sent >= self.keepalive_interval:
+                    sent = self.server.send_keepalive()
+                    last_sent = started
+                else:
+                    sent = True
+            if not sent:
+                break
+            
+            # Keep the frame rate steady whatever capture and send cost
+            delay = self.frame_delay - (time.monotonic() - started)
+            if delay > 0 and self.server.downloads:
+                if not self.server.send_file_chunks(started + self.frame_delay):
+                    break
+                delay = self.frame_delay - (time.monotonic() - started)
+            if delay > 0:
+                self.wake.wait(delay)
+        
+        self.server.close_client()
+        reader.join(1.0)
+    
+    def _read_commands(self):
+        """Apply commands from the client as they arrive"""
+        profiler = self.server.profiler
+        client = self.server.client_socket
+        while self.running:
+            cmd = self.server.receive_command()
+            if cmd is None:
+                break
+            with profiler.stage('command'):
+                self.process_command(cmd)
+        # Stop streaming to a client we can no longer hear
+        if self.server.client_socket is client:
+            self.server.close_client()
+    
+    def process_command(self, cmd):
+        """Process a command from the client"""
+        if not self.input_controller:
+            return
+        
+        try:
+            cmd_type = cmd.get('type')
+            data = cmd.get('data', {})
+            
+            if cmd_type == 'mouse_move':
+                x, y = data.get('x'), data.get('y')
+                self.input_controller.move_mouse(x, y)
+            
+            elif cmd_type == 'mouse_click':
+                button = data.get('button', 'left')
+                press = data.get('press', True)
+                self.input_controller.click_mouse(button, press)
+            
+            elif cmd_type == 'mouse_scroll':
+                dx, dy = data.get('dx', 0), data.get('dy', 0)
+                self.input_controller.scroll_mouse(dx, dy)
+            
+            elif cmd_type == 'key_press':
+                key = data.get('key')
+                self.input_controller.press_key(key)
+        
+        except Exception as e:
+            print(f"Error processing command: {e}")
+    
+    def stop(self):
+        """Stop after the current frame"""
+        self.running = False
+        self.wake.set()
@@ -3,7 +3,9 @@
 LiteDesk Comprehensive Test Suite
 Tests all components for cross-platform compatibility
 """
+import os
 import sys
+import signal
 import unittest
 import socket
 import threading
@@ -87,6 +89,89 @@ class TestImports(unittest.TestCase):
             self.fail(f"Failed to import PyQt5: {e}")
 
 
+class TestStartup(unittest.TestCase):
+    """Test heavy imports stay off the startup path"""
+    
+    def test_import_budgets(self):
+        """Test entry points import within budget without heavy dependencies"""
+        import bench_startup
+        
+        for module in ('network', 'daemon', 'client'):
+            result = bench_startup.measure(module)
+            print(f"  import {module}: {result['ms']:.1f} ms")
+            self.assertEqual(bench_startup.check(module, result), [])
+    
+    def test_package_attributes_are_lazy(self):
+        """Test importing the package loads nothing until a name is used"""
+        import subprocess
+        here = os.path.dirname(os.path.abspath(__file__))
+        code = (
+            "import importlib.util, sys\n"
+            f"spec = importlib.util.spec_from_file_location('litedesk', {os.path.join(here, '__init__.py')!r}, "
+            f"submodule_search_locations=[{here!r}])\n"
+            "litedesk = importlib.util.module_from_spec(spec)\n"
+            "sys.modules['litedesk'] = litedesk\n"
+            "spec.loader.exec_module(litedesk)\n"
+            "assert not {'litedesk.network', 'mss', 'pynput', 'PIL'} & set(sys.modules)\n"
+            "assert litedesk.NetworkClient.__name__ == 'NetworkClient'\n"
+            "assert 'litedesk.network' in sys.modules and 'pynput' not in sys.modules\n"
+            "assert 'NetworkServer' in dir(litedesk)\n"
+        )
+        result = subprocess.run([sys.executable, '-c', code], cwd=here,
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        self.assertEqual(result.returncode, 0, result.stderr.decode())
+    
+    def test_interface_lookup_cached(self):
+        """Test the default interface is looked up once"""
+        from unittest import mock
+        from platform_utils import get_default_network_interface
+        
+        ip = get_default_network_interface()
+        with mock.patch('socket.socket') as sock:
+            self.assertEqual(get_default_network_interface(), ip)
+            self.assertFalse(sock.called)
+            get_default_network_interface(refresh=True)
+            self.assertTrue(sock.called)
+        get_default_network_interface(refresh=True)
+
+
+class TestMicroBenchmarks(unittest.TestCase):
+    """Test the microbenchmark suite and its regression gate"""
+    
+    def test_benchmarks_run(self):
+        """Test every benchmark whose dependencies are installed runs"""
+        import bench_micro
+        
+        benchmarks = bench_micro.all_benchmarks()
+        self.assertEqual(len({bench.name for bench in benchmarks}), len(benchmarks))
+        for bench in benchmarks:
+            if bench_micro.missing_modules(bench):
+                continue
+            result = bench_micro.measure(bench, repeats=1, number=1)
+            self.assertGreater(result['us'], 0, bench.name)
+        self.assertEqual([bench.name for bench in bench_micro.select(benchmarks, ['header_*'])],
+                         ['header_pack', 'header_unpack'])
+    
+    def test_regression_gate(self):
+        """Test slowdowns past the tolerance fail and baselines merge"""
+        import tempfile
+        import bench_micro
+        
+        baseline = {'a': {'us': 10.0}, 'update_frame_x': {'us': 10.0}}
+        self.assertEqual(bench_micro.check({'a': {'us': 12.0}}, baseline, tolerance=0.25), [])
+        self.assertEqual(len(bench_micro.check({'a': {'us': 13.0}}, baseline, tolerance=0.25)), 1)
+        # Own, wider tolerance
+        self.assertEqual(bench_micro.check({'update_frame_x': {'us': 14.0}}, baseline), [])
+        # Not in the baseline: nothing to compare with
+        self.assertEqual(bench_micro.check({'new': {'us': 99.0}}, baseline), [])
+        
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'baseline.json')
+            bench_micro.save_baseline(path, {'a': {'us': 1.0}})
+            bench_micro.save_baseline(path, {'b': {'us': 2.0}})
+            self.assertEqual(bench_micro.load_baseline(path), {'a': {'us': 1.0}, 'b': {'us': 2.0}})
+
+
 class TestScreenCapture(unittest.TestCase):
     """Test screen capture functionality"""
     
@@ -114,6 +199,115 @@ class TestScreenCapture(unittest.TestCase):
             print(f"  Note: Screen size test failed (expected in headless): {e}")
 
 
+class TestProfiling(unittest.TestCase):
+    """Test stage timers and runtime profiling"""
+    
+    def test_disabled_by_default(self):
+        """Test stage timing is off and free until switched on"""
+        from profiling import StageProfiler, NULL_TIMER
+        
+        profiler = StageProfiler()
+        self.assertIs(profiler.stage('encode'), NULL_TIMER)
+        with profiler.stage('encode'):
+            pass
+        self.assertEqual(profiler.stats()['stages'], {})
+    
+    def test_stage_stats(self):
+        """Test rolling per-stage statistics"""
+        from profiling import StageProfiler
+        
+        profiler = StageProfiler(window=50)
+        profiler.set_enabled(True)
+        for i in range(100):
+            with profiler.stage('grab'):
+                time.sleep(0.002 if i == 99 else 0)
+            with profiler.stage('send'):
+                pass
+        
+        stages = profiler.stats()['stages']
+        self.assertEqual(set(stages), {'grab', 'send'})
+        self.assertEqual(stages['grab']['count'], 100)
+        self.assertLessEqual(stages['grab']['p50_ms'], stages['grab']['p99_ms'])
+        self.assertGreaterEqual(stages['grab']['max_ms'], 2.0)
+        self.assertEqual(len(profiler.samples['grab']), 50)
+    
+    def test_overhead(self):
+        """Test a timed stage costs microseconds"""
+        from profiling import StageProfiler
+        
+        profiler = StageProfiler()
+        results = {}
+        for enabled in (False, True):
+            profiler.set_enabled(enabled)
+            start = time.perf_counter()
+            for _ in range(20000):
+                with profiler.stage('encode'):
+                    pass
+            results[enabled] = (time.perf_counter() - start) / 20000 * 1e6
+        print(f"  Per stage: {results[False]:.2f} us off, {results[True]:.2f} us on")
+        self.assertLess(results[True], 20)
+    
+    def test_cprofile_and_tracemalloc(self):
+        """Test profiles can be captured at runtime"""
+        from profiling import StageProfiler
+        
+        def busy():
+            return sorted(str(i) for i in range(20000))
+        
+        profiler = StageProfiler()
+        profiler.start_cprofile()
+        profiler.start_tracemalloc()
+        kept = busy()
+        self.assertEqual(profiler.stats()['cprofile'], 'running')
+        allocations = profiler.allocations()
+        report = profiler.stop_cprofile()
+        profiler.stop_tracemalloc()
+        
+        self.assertIn('busy', report)
+        self.assertEqual(profiler.stats()['cprofile'], report)
+        self.assertTrue(allocations)
+        self.assertIsNone(profiler.allocations())
+        del kept
+    
+    def test_get_stats_command(self):
+        """Test a client switches profiling on and reads the server's stats"""
+        from PIL import Image
+        from network import NetworkServer, NetworkClient
+        
+        server = NetworkServer(host='127.0.0.1', port=0)
+        server.start()
+        port = server.socket.getsockname()[1]
+        buffer = BytesIO()
+        Image.new('RGB', (64, 48), color='red').save(buffer, format='JPEG')
+        jpeg = buffer.getvalue()
+        
+        def serve():
+            if server.accept_connection():
+                while server.send_frame(64, 48, jpeg) and server.receive_command():
+                    pass
+        
+        threading.Thread(target=serve, daemon=True).start()
+        client = NetworkClient()
+        try:
+            self.assertTrue(client.connect('127.0.0.1', port))
+            
+            def receive():
+                while client.receive_frame():
+                    pass
+            
+            threading.Thread(target=receive, daemon=True).start()
+            client.set_profiling(stages=True)
+            for _ in range(5):
+                client.send_command('mouse_move', {'x': 1, 'y': 1})
+            stats = client.get_stats()
+            self.assertTrue(stats['enabled'])
+            self.assertGreater(stats['stages']['send']['count'], 0)
+            self.assertIsNone(stats['tracemalloc'])
+        finally:
+            client.disconnect()
+            server.stop()
+
+
 class TestInputControl(unittest.TestCase):
     """Test input control functionality"""
     
@@ -281,6 +475,2515 @@ class TestImageProcessing(unittest.TestCase):
         print("  Image compression/decompression successful")
 
 
+def text_screen(first_line, size=(800, 600), line_height=14):
+    """Synthetic editor window: a sidebar and numbered lines of text"""
+    from PIL import Image, ImageDraw
+    
+    img = Image.new('RGB', size, color=(30, 30, 30))
+    draw = ImageDraw.Draw(img)
+    draw.rectangle((0, 0, 119, size[1]), fill=(60, 60, 90))
+    draw.text((10, 10), "Explorer", fill=(255, 255, 255))
+    for row in range(size[1] // line_height + 1):
+        line = first_line + row
+        draw.text((130, 4 + row * line_height),
+                  f"{line:4d}  log entry {line * 7919 % 10007} value={line * line % 997}",
+                  fill=(200, 220, 200))
+    draw.rectangle((0, size[1] - 20, size[0], size[1]), fill=(0, 90, 160))
+    return img
+
+
+@unittest.skipUnless(__import__('scroll_detect').NUMPY_AVAILABLE, "NumPy not installed")
+class TestScrollDetect(unittest.TestCase):
+    """Test scroll/move detection and copy-rect updates"""
+    
+    def _apply(self, prev, copy, cur):
+        """Apply a copy-rect to prev, taking the patch from cur"""
+        out = prev.copy()
+        out[copy.y + copy.dy:copy.y + copy.dy + copy.h,
+            copy.x + copy.dx:copy.x + copy.dx + copy.w] = prev[copy.y:copy.y + copy.h,
+                                                               copy.x:copy.x + copy.w]
+        if copy.patch:
+            x, y, w, h = copy.patch
+            out[y:y + h, x:x + w] = cur[y:y + h, x:x + w]
+        return out
+    
+    def test_vertical_scroll(self):
+        """Test a scrolled text region becomes a move plus the exposed strip"""
+        import numpy as np
+        from scroll_detect import detect_copy_rect
+        
+        prev = np.asarray(text_screen(0))
+        cur = np.asarray(text_screen(3))
+        copy = detect_copy_rect(prev, cur)
+        
+        self.assertIsNotNone(copy)
+        self.assertEqual((copy.dx, copy.dy), (0, -42))
+        self.assertGreaterEqual(copy.x, 120)  # the sidebar did not move
+        self.assertTrue((self._apply(prev, copy, cur) == cur).all())
+        patch_rows = copy.patch[3]
+        self.assertLess(patch_rows, prev.shape[0] // 4)
+    
+    def test_horizontal_move(self):
+        """Test a region dragged sideways is found"""
+        import numpy as np
+        from scroll_detect import detect_copy_rect
+        
+        rng = np.random.default_rng(7)
+        window = rng.integers(0, 255, (200, 300, 3), dtype=np.uint8)
+        prev = np.zeros((480, 640, 3), dtype=np.uint8)
+        cur = prev.copy()
+        prev[100:300, 50:350] = window
+        cur[100:300, 90:390] = window
+        copy = detect_copy_rect(prev, cur)
+        
+        self.assertEqual((copy.x, copy.y, copy.w, copy.h, copy.dx, copy.dy),
+                         (50, 100, 300, 200, 40, 0))
+        self.assertTrue((self._apply(prev, copy, cur) == cur).all())
+    
+    def test_unrelated_change_sends_full_frame(self):
+        """Test new content is not mistaken for a move"""
+        import numpy as np
+        from scroll_detect import CopyRectDetector
+        
+        rng = np.random.default_rng(3)
+        detector = CopyRectDetector()
+        first = rng.integers(0, 255, (240, 320, 3), dtype=np.uint8)
+        self.assertIsNone(detector.update(first))
+        self.assertIsNone(detector.update(first.copy()))  # unchanged
+        self.assertIsNone(detector.update(rng.integers(0, 255, (240, 320, 3), dtype=np.uint8)))
+    
+    def test_copy_rect_over_network(self):
+        """Test the client applies a copy-rect update and it costs a fraction of a frame"""
+        import numpy as np
+        from network import NetworkServer, NetworkClient
+        from scroll_detect import CopyRectDetector
+        
+        def jpeg(img):
+            buffer = BytesIO()
+            img.save(buffer, format='JPEG', quality=50)
+            return buffer.getvalue()
+        
+        prev, cur = text_screen(0), text_screen(5)
+        detector = CopyRectDetector()
+        detector.update(np.asarray(prev))
+        copy = detector.update(np.asarray(cur))
+        x, y, w, h = copy.patch
+        patch = jpeg(cur.crop((x, y, x + w, y + h)))
+        full = jpeg(cur)
+        
+        server = NetworkServer(host='127.0.0.1', port=0)
+        server.start()
+        
+        def serve():
+            if server.accept_connection():
+                server.send_frame(prev.width, prev.height, jpeg(prev))
+                server.send_copy_rect(copy, patch)
+        
+        server_thread = threading.Thread(target=serve, daemon=True)
+        server_thread.start()
+        client = NetworkClient()
+        try:
+            self.assertTrue(client.connect('127.0.0.1', server.socket.getsockname()[1]))
+            first = client.receive_frame()
+            frame = client.receive_frame()
+            self.assertEqual(frame.size, cur.size)
+            self.assertIsNot(frame, first)
+            error = np.abs(np.asarray(frame, dtype=np.int16) - np.asarray(cur, dtype=np.int16))
+            self.assertLess(error.mean(), 8)
+        finally:
+            client.disconnect()
+            server.stop()
+            server_thread.join(2)
+        
+        print(f"  Scroll update {len(patch)} bytes vs full frame {len(full)} bytes")
+        self.assertLess(len(patch), len(full) / 4)
+
+
+@unittest.skipUnless(__import__('tile_cache').NUMPY_AVAILABLE, "NumPy not installed")
+class TestTileCache(unittest.TestCase):
+    """Test the content-addressed tile cache"""
+    
+    def _jpeg(self, pixels):
+        from PIL import Image
+        buffer = BytesIO()
+        Image.fromarray(pixels).save(buffer, format='JPEG', quality=90)
+        return buffer.getvalue()
+    
+    def test_lru_slots(self):
+        """Test slots are reused least recently used first"""
+        from tile_cache import TileCache
+        
+        cache = TileCache(3)
+        self.assertEqual([cache.insert(d) for d in (b'a', b'b', b'c')], [0, 1, 2])
+        self.assertEqual(cache.lookup(b'a'), 0)
+        self.assertEqual(cache.insert(b'd'), 1)  # 'b' was least recently used
+        self.assertIsNone(cache.lookup(b'b'))
+        self.assertEqual(len(cache), 3)
+    
+    def test_alt_tab_uses_cache(self):
+        """Test switching back to a seen window sends references, not pixels"""
+        import numpy as np
+        from network import TILES_HEADER, TILE_ENTRY
+        from tile_cache import TileEncoder
+        
+        editor = np.asarray(text_screen(0, size=(640, 400)))
+        browser = np.asarray(text_screen(500, size=(640, 400)))[:, ::-1].copy()
+        encoder = TileEncoder(capacity=256)
+        
+        update, atlas = encoder.update(editor)
+        self.assertTrue(update.reset)
+        self.assertEqual(len(update.entries), 10 * 7)
+        first = len(self._jpeg(atlas))
+        update, atlas = encoder.update(browser)
+        self.assertIsNotNone(atlas)
+        
+        for screen in (editor, browser, editor):
+            update, atlas = encoder.update(screen)
+            self.assertFalse(update.reset)
+            self.assertIsNone(atlas)
+            self.assertTrue(update.entries)
+            self.assertFalse(any(new for _, _, _, new in update.entries))
+        switch = 12 + TILES_HEADER.size + len(update.entries) * TILE_ENTRY.size
+        print(f"  Alt-tab: {switch} bytes vs {first} bytes for the window")
+        self.assertLess(switch, first / 20)
+        
+        update, atlas = encoder.update(editor)
+        self.assertEqual(update.entries, [])  # nothing changed
+    
+    def test_eviction_in_sync_over_network(self):
+        """Test a small cache keeps client and server in step through evictions"""
+        import numpy as np
+        from network import NetworkServer, NetworkClient
+        from tile_cache import TileEncoder
+        
+        rng = np.random.default_rng(11)
+        # Smooth tiles so JPEG keeps them close to the original
+        gradient = np.linspace(0, 1, 64)[:, None] * np.linspace(0, 1, 64)[None, :]
+        palette = [(gradient[..., None] * rng.integers(40, 255, 3)).astype(np.uint8)
+                   for _ in range(12)]
+        screens = []
+        for _ in range(15):
+            choice = rng.integers(0, len(palette), (4, 5))
+            screen = np.block([[[palette[c]] for c in row] for row in choice])
+            screens.append(np.ascontiguousarray(screen.reshape(256, 320, 3)[:230]))
+        
+        encoder = TileEncoder(capacity=6)
+        server = NetworkServer(host='127.0.0.1', port=0)
+        server.start()
+        
+        def serve():
+            if server.accept_connection():
+                for screen in screens:
+                    update, atlas = encoder.update(screen)
+                    server.send_tiles(update, self._jpeg(atlas) if atlas is not None else b'')
+        
+        server_thread = threading.Thread(target=serve, daemon=True)
+        server_thread.start()
+        client = NetworkClient()
+        client.tile_cache_size = 6
+        try:
+            self.assertTrue(client.connect('127.0.0.1', server.socket.getsockname()[1]))
+            self.assertEqual(server.tile_cache_size, 6)
+            for screen in screens:
+                frame = client.receive_frame()
+                self.assertIsNotNone(frame)
+                error = np.abs(np.asarray(frame, dtype=np.int16) - screen.astype(np.int16))
+                self.assertLess(error.mean(), 4)
+            self.assertLessEqual(len(client.tiles), 6)
+        finally:
+            client.disconnect()
+            server.stop()
+            server_thread.join(2)
+    
+    def test_streaming_loop_end_to_end(self):
+        """Test a capture sequence streams as tiles and copy-rects and redraws exactly"""
+        import numpy as np
+        from collections import namedtuple
+        from network import NetworkServer, NetworkClient
+        from profiling import StageProfiler
+        from screen_capture import ScreenCapture
+        from scroll_detect import CopyRectDetector
+        from streaming import StreamingLoop
+        
+        Shot = namedtuple('Shot', 'size rgb raw')
+        screens = [text_screen(0), text_screen(4), text_screen(400), text_screen(0)]
+        sent = []
+        
+        class SyntheticCapture(ScreenCapture):
+            def __init__(self):
+                self.quality = 90
+                self.refine_quality = 0
+                self.profiler = StageProfiler()
+                self.detector = CopyRectDetector()
+                self.tiles = None
+                self.video = self.video_codec = None
+                self.previous_raw = None
+                self.damage_capture = None
+                self.color_mode = 'color'
+                self.index = 0
+            
+            def grab(self):
+                img = screens[min(self.index, len(screens) - 1)]
+                self.index += 1
+                return Shot(img.size, img.tobytes(), img.tobytes())
+        
+        server = NetworkServer(host='127.0.0.1', port=0)
+        server.start()
+        original = server.send_update
+        server.send_update = lambda *update: sent.append(update[3]) or original(*update)
+        loop = StreamingLoop(server, SyntheticCapture(), frame_delay=0.01)
+        runner = threading.Thread(target=loop.run, daemon=True)
+        runner.start()
+        
+        client = NetworkClient()
+        try:
+            self.assertTrue(client.connect('127.0.0.1', server.socket.getsockname()[1]))
+            for expected in screens:
+                frame = client.receive_frame()
+                error = np.abs(np.asarray(frame, dtype=np.int16) - np.asarray(expected, dtype=np.int16))
+                self.assertLess(error.mean(), 4)
+        finally:
+            client.disconnect()
+            loop.stop()
+            server.stop()
+            runner.join(2)
+        
+        kinds = [update.kind for update in sent[:4]]
+        self.assertEqual(kinds, ['tiles', 'copy_rect', 'tiles', 'tiles'])
+        self.assertTrue(sent[0].reset)
+        self.assertFalse(any(new for _, _, _, new in sent[3].entries))  # back to a cached screen
+
+
+def replay_capture(screens):
+    """ScreenCapture replaying a list of images (the last one repeats)"""
+    from collections import namedtuple
+    from profiling import StageProfiler
+    from screen_capture import ScreenCapture
+    
+    Shot = namedtuple('Shot', 'size rgb raw')
+    
+    class ReplayCapture(ScreenCapture):
+        def __init__(self):
+            self.quality = 80
+            self.refine_quality = 0
+            self.color_mode = 'color'
+            self.profiler = StageProfiler()
+            self.detector = None
+            self.tiles = None
+            self.video = self.video_codec = None
+            self.previous_raw = None
+            self.damage_capture = None
+            self.encoded = 0
+        
+        def grab(self):
+            img = screens[0] if len(screens) == 1 else screens.pop(0)
+            return Shot(img.size, img.tobytes(), bytearray(img.tobytes()))
+        
+        def encode(self, img, quality=None):
+            self.encoded += 1
+            return ScreenCapture.encode(self, img, quality)
+    
+    return ReplayCapture()
+
+
+def stream_transfers(server, client, start, count, timeout=10):
+    """
+    Stream frames to a connected client until some transfers end
+    
+    Args:
+        server: Server with a client connected
+        client: Its client
+        start: Called once streaming runs, to start the transfers
+        count: Transfers to wait for
+    
+    Returns:
+        tuple: (events, frames): transfer id -> 'done' or 'error', and the
+        frames the client received meanwhile
+    """
+    from streaming import StreamingLoop
+    
+    screens = [text_screen(line, (160, 120)) for line in range(100)]
+    loop = StreamingLoop(server, replay_capture(screens), frame_delay=0.01)
+    
+    def serve():
+        # A session accepted through the relay is already connected
+        loop.running = True
+        loop.stream_client()
+    
+    runner = threading.Thread(target=serve if server.client_socket else loop.run, daemon=True)
+    runner.start()
+    events = {}
+    client.on_transfer = lambda transfer_id, event, message: events.update({transfer_id: event})
+    frames = 0
+    try:
+        start()
+        deadline = time.monotonic() + timeout
+        while len(events) < count and time.monotonic() < deadline:
+            if client.receive_frame() is not None:
+                frames += 1
+    finally:
+        loop.stop()
+    return events, frames
+
+
+class TestIdleScreen(unittest.TestCase):
+    """Test that an unchanged screen is neither encoded nor sent"""
+    
+    def test_unchanged_capture_skipped(self):
+        """Test identical captures return None until the screen or a keyframe changes it"""
+        from PIL import Image
+        first, second = Image.new('RGB', (64, 48), 'blue'), Image.new('RGB', (64, 48), 'red')
+        capture = replay_capture([first, first, second, second])
+        
+        self.assertIsNotNone(capture.capture_update())
+        self.assertIsNone(capture.capture_update())
+        self.assertIsNotNone(capture.capture_update())
+        self.assertIsNone(capture.capture_update())
+        self.assertEqual(capture.encoded, 2)
+        
+        capture.request_keyframe()
+        width, height, data, update = capture.capture_update()
+        self.assertEqual((width, height, update), (64, 48, None))
+        self.assertEqual(capture.encoded, 3)
+    
+    def test_idle_stream_sends_keepalives(self):
+        """Test an idle stream sends only keepalives and the client reads through them"""
+        from PIL import Image
+        from network import NetworkServer, NetworkClient
+        from streaming import StreamingLoop
+        
+        screens = [Image.new('RGB', (64, 48), 'blue')]
+        capture = replay_capture(screens)
+        server = NetworkServer(host='127.0.0.1', port=0)
+        server.start()
+        sent = []
+        original_update, original_keepalive = server.send_update, server.send_keepalive
+        server.send_update = lambda *update: sent.append('update') or original_update(*update)
+        server.send_keepalive = lambda: sent.append('keepalive') or original_keepalive()
+        loop = StreamingLoop(server, capture, frame_delay=0.01, keepalive_interval=0.05)
+        runner = threading.Thread(target=loop.run, daemon=True)
+        runner.start()
+        
+        client = NetworkClient()
+        try:
+            self.assertTrue(client.connect('127.0.0.1', server.socket.getsockname()[1]))
+            self.assertGreater(client.receive_frame().getpixel((0, 0))[2], 200)  # blue
+            time.sleep(0.4)
+            self.assertEqual(sent.count('update'), 1)
+            self.assertGreaterEqual(sent.count('keepalive'), 3)
+            self.assertEqual(capture.encoded, 1)
+            
+            screens[0] = Image.new('RGB', (64, 48), 'red')
+            self.assertGreater(client.receive_frame().getpixel((0, 0))[0], 200)  # red
+            self.assertTrue(client.connected)
+        finally:
+            client.disconnect()
+            loop.stop()
+            server.stop()
+            runner.join(2)
+
+
+class TestColorModes(unittest.TestCase):
+    """Test reduced colour modes and switching them mid-session"""
+    
+    def test_modes_encode_and_decode(self):
+        """Test every colour mode decodes to RGB and palettes shrink a text screen"""
+        from network import COLOR_MODES, decode_jpeg
+        screen = text_screen(0)
+        capture = replay_capture([screen])
+        capture.quality = 50
+        
+        sizes = {}
+        for mode in COLOR_MODES:
+            capture.set_color_mode(mode)
+            data = capture.encode(screen)
+            sizes[mode] = len(data)
+            frame = decode_jpeg(data)
+            self.assertEqual((frame.mode, frame.size), ('RGB', screen.size))
+            if mode == 'gray':
+                r, g, b = frame.split()
+                self.assertEqual(r.tobytes(), b.tobytes())
+            if mode == 'palette64':
+                self.assertIsNotNone(frame.getcolors(64))
+        
+        self.assertGreater(sizes['text'], sizes['color'])
+        self.assertLess(sizes['palette64'], sizes['color'] / 2)
+        with self.assertRaises(ValueError):
+            capture.set_color_mode('sepia')
+    
+    def test_switch_mid_session(self):
+        """Test the viewer switches colour mode and gets a full redraw in it"""
+        from PIL import Image
+        from network import NetworkServer, NetworkClient
+        from streaming import StreamingLoop
+        
+        capture = replay_capture([Image.new('RGB', (64, 48), (200, 40, 40))])
+        server = NetworkServer(host='127.0.0.1', port=0)
+        server.start()
+        loop = StreamingLoop(server, capture, frame_delay=0.01)
+        runner = threading.Thread(target=loop.run, daemon=True)
+        runner.start()
+        
+        client = NetworkClient()
+        try:
+            self.assertTrue(client.connect('127.0.0.1', server.socket.getsockname()[1]))
+            r, g, b = client.receive_frame().getpixel((0, 0))
+            self.assertGreater(r - g, 100)
+            
+            # The screen is static: only the mode switch triggers a new frame
+            self.assertTrue(client.set_color_mode('gray'))
+            r, g, b = client.receive_frame().getpixel((0, 0))
+            self.assertEqual(r, g)
+            self.assertEqual(server.session.settings['color_mode'], 'gray')
+            
+            # Unknown modes are refused
+            with self.assertRaises(ValueError):
+                client.set_color_mode('sepia')
+            self.assertFalse(server.set_color_mode('sepia'))
+            self.assertEqual(server.color_mode, 'gray')
+        finally:
+            client.disconnect()
+            loop.stop()
+            server.stop()
+            runner.join(2)
+
+
+@unittest.skipUnless(__import__('tile_cache').NUMPY_AVAILABLE, "NumPy not installed")
+class TestProgressiveRefinement(unittest.TestCase):
+    """Test still tiles are resent sharp after motion settles"""
+    
+    def test_still_tiles_refined_once(self):
+        """Test tiles are refined after refine_after still captures, into their own slots"""
+        import numpy as np
+        from tile_cache import TileEncoder
+        
+        first = np.asarray(text_screen(0, size=(256, 128)))
+        second = np.asarray(text_screen(9, size=(256, 128)))
+        encoder = TileEncoder(capacity=64, refine_after=2)
+        update, _ = encoder.update(first)
+        slots = {(col, row): slot for col, row, slot, _ in update.entries}
+        
+        encoder.age()
+        self.assertIsNone(encoder.refinement())
+        encoder.age()
+        update, atlas = encoder.refinement()
+        self.assertEqual(len(update.entries), 4 * 2)
+        self.assertEqual({(col, row): slot for col, row, slot, _ in update.entries}, slots)
+        self.assertEqual(atlas.shape[:2], (64, 8 * 64))
+        encoder.age()
+        self.assertIsNone(encoder.refinement())
+        
+        # Changed tiles settle again; tiles back from the cache are already sharp
+        encoder.update(second)
+        changed = len(encoder.settling)
+        self.assertTrue(changed)
+        encoder.update(first)
+        self.assertLess(len(encoder.settling), changed)
+    
+    def _stream(self, screens, quality, refine_quality):
+        """Stream a replayed screen sequence; return bytes sent and the client's picture"""
+        from network import NetworkServer, NetworkClient
+        from streaming import StreamingLoop
+        
+        capture = replay_capture(list(screens))
+        capture.quality, capture.refine_quality = quality, refine_quality
+        server = NetworkServer(host='127.0.0.1', port=0)
+        server.start()
+        sent = []
+        original = server.send_update
+        server.send_update = lambda *update: sent.append(len(update[2])) or original(*update)
+        loop = StreamingLoop(server, capture, frame_delay=0.01)
+        runner = threading.Thread(target=loop.run, daemon=True)
+        runner.start()
+        
+        client = NetworkClient()
+        reader = threading.Thread(target=lambda: [None for _ in iter(client.receive_frame, None)],
+                                  daemon=True)
+        try:
+            self.assertTrue(client.connect('127.0.0.1', server.socket.getsockname()[1]))
+            reader.start()
+            count = -1
+            while count != len(sent):  # until the picture has settled
+                count = len(sent)
+                time.sleep(0.2)
+            return sum(sent), client.framebuffer
+        finally:
+            client.disconnect()
+            loop.stop()
+            server.stop()
+            runner.join(2)
+            reader.join(2)
+    
+    def test_motion_cheap_and_still_sharp(self):
+        """Test progressive streaming costs less than fixed high quality and ends as sharp"""
+        import numpy as np
+        screens = [text_screen(line) for line in range(0, 60, 3)]
+        final = np.asarray(screens[-1], dtype=np.int16)
+        
+        def error(frame):
+            return np.abs(np.asarray(frame, dtype=np.int16) - final).mean()
+        
+        progressive, sharp = self._stream(screens, quality=30, refine_quality=90)
+        fixed, fixed_frame = self._stream(screens, quality=90, refine_quality=0)
+        _, draft = self._stream(screens, quality=30, refine_quality=0)
+        print(f"  Progressive: {progressive} bytes, fixed quality 90: {fixed} bytes")
+        self.assertLess(progressive, fixed * 0.75)
+        self.assertLess(error(sharp), error(draft) * 0.75)
+        self.assertLess(error(sharp), error(fixed_frame) * 1.1)
+
+
+def video_scene(count, size=(320, 180)):
+    """Synthetic video: a camera panning over a textured scene, with a ball moving"""
+    import numpy as np
+    from PIL import Image
+    
+    width, height = size
+    rng = np.random.default_rng(5)
+    noise = (rng.random((height // 8, width // 8, 3)) * 255).astype(np.uint8)
+    texture = np.asarray(Image.fromarray(noise).resize((width * 2, height * 2), Image.BICUBIC))
+    y, x = np.mgrid[0:height, 0:width]
+    frames = []
+    for i in range(count):
+        frame = texture[i * 2:i * 2 + height, i * 4:i * 4 + width].copy()
+        frame[(x - (20 + i * 6) % width) ** 2 + (y - height // 2) ** 2 < 400] = (255, 240, 20)
+        frames.append(Image.fromarray(frame))
+    return frames
+
+
+@unittest.skipUnless(__import__('video_codec').AV_AVAILABLE and __import__('tile_cache').NUMPY_AVAILABLE,
+                     "PyAV or NumPy not installed")
+class TestVideoCodec(unittest.TestCase):
+    """Test inter-frame video streaming through PyAV"""
+    
+    def _psnr(self, frame, expected):
+        import numpy as np
+        error = np.asarray(frame, dtype=np.float64) - np.asarray(expected, dtype=np.float64)
+        return 10 * np.log10(255 ** 2 / (error ** 2).mean())
+    
+    def test_video_smaller_than_jpeg(self):
+        """Test full-motion content costs a fraction of per-frame JPEG at about the same picture"""
+        from network import decode_jpeg
+        from video_codec import VideoEncoder, VideoDecoder, decodable_codecs
+        frames = video_scene(40)
+        
+        capture = replay_capture(frames[:1])
+        capture.quality = 50
+        jpeg = [capture.encode(frame) for frame in frames]
+        jpeg_psnr = sum(self._psnr(decode_jpeg(data), frame)
+                        for data, frame in zip(jpeg, frames)) / len(frames)
+        jpeg_bytes = sum(len(data) for data in jpeg)
+        
+        for codec in decodable_codecs():
+            encoder, decoder = VideoEncoder(codec), VideoDecoder()
+            video_bytes = video_psnr = 0
+            for index, frame in enumerate(frames):
+                data, update = encoder.encode(frame, 50)
+                self.assertEqual(update.keyframe, index == 0)
+                video_bytes += len(data)
+                video_psnr += self._psnr(decoder.decode(codec, data, update.keyframe), frame)
+            video_psnr /= len(frames)
+            print(f"  {codec}: {video_bytes} bytes ({video_psnr:.1f} dB) vs JPEG "
+                  f"{jpeg_bytes} bytes ({jpeg_psnr:.1f} dB)")
+            self.assertLess(video_bytes * 2, jpeg_bytes)
+            self.assertGreater(video_psnr, jpeg_psnr - 1.5)
+    
+    def test_stream_with_keyframes_on_demand(self):
+        """Test the viewer decodes a video stream and recovers from a lost frame"""
+        from network import NetworkServer, NetworkClient
+        from streaming import StreamingLoop
+        from video_codec import VideoDecoder
+        
+        frames = [frame.crop((0, 0, 161, 91)) for frame in video_scene(80)]  # odd size
+        server = NetworkServer(host='127.0.0.1', port=0)
+        server.start()
+        server.video_codec = 'h264'
+        sent = []
+        original = server.send_update
+        server.send_update = lambda *update: sent.append(update[3]) or original(*update)
+        loop = StreamingLoop(server, replay_capture(list(frames)), frame_delay=0.02)
+        runner = threading.Thread(target=loop.run, daemon=True)
+        runner.start()
+        
+        client = NetworkClient()
+        try:
+            self.assertTrue(client.connect('127.0.0.1', server.socket.getsockname()[1]))
+            first = client.receive_frame()
+            self.assertEqual(first.size, (161, 91))
+            self.assertGreater(self._psnr(first, frames[0]), 25)
+            client.receive_frame()
+            
+            # A decoder that missed frames asks for a keyframe and carries on
+            client.video = VideoDecoder()
+            self.assertIsNotNone(client.receive_frame())
+            self.assertTrue(client.video.synced)
+        finally:
+            client.disconnect()
+            loop.stop()
+            server.stop()
+            runner.join(2)
+        
+        self.assertTrue(all(update.kind == 'video' for update in sent))
+        keyframes = [index for index, update in enumerate(sent) if update.keyframe]
+        self.assertEqual(keyframes[0], 0)
+        self.assertGreaterEqual(len(keyframes), 2)
+    
+    def test_images_for_clients_without_decoder(self):
+        """Test a client that cannot decode the codec keeps getting images"""
+        from network import NetworkServer, NetworkClient
+        from streaming import StreamingLoop
+        
+        server = NetworkServer(host='127.0.0.1', port=0)
+        server.start()
+        server.video_codec = 'h264'
+        sent = []
+        original = server.send_update
+        server.send_update = lambda *update: sent.append(update[3]) or original(*update)
+        loop = StreamingLoop(server, replay_capture(video_scene(1)), frame_delay=0.01)
+        runner = threading.Thread(target=loop.run, daemon=True)
+        runner.start()
+        
+        client = NetworkClient()
+        client.video_codecs = []
+        try:
+            self.assertTrue(client.connect('127.0.0.1', server.socket.getsockname()[1]))
+            self.assertIsNotNone(client.receive_frame())
+            self.assertIsNone(server.stream_video_codec())
+        finally:
+            client.disconnect()
+            loop.stop()
+            server.stop()
+            runner.join(2)
+        self.assertFalse(any(update and update.kind == 'video' for update in sent))
+    
+    def test_malformed_video_codecs(self):
+        """Test a hello with a malformed codec list offers the client no video"""
+        from network import NetworkServer
+        
+        server = NetworkServer(host='127.0.0.1', port=0)
+        server.client_socket, peer = socket.socketpair()
+        try:
+            for codecs in (5, 'h264', {'h264': 1}, None):
+                server._resume(None, 0, codecs)
+                self.assertEqual(server.client_video_codecs, ())
+            server._resume(None, 0, [5, ['h264'], 'vp8'])
+            self.assertEqual(server.client_video_codecs, ('vp8',))
+        finally:
+            server.client_socket.close()
+            peer.close()
+
+
+def x11_damage_available():
+    """Whether an X server with DAMAGE is reachable (e.g. under Xvfb)"""
+    import x11_capture
+    if not (x11_capture.XLIB_AVAILABLE and x11_capture.NUMPY_AVAILABLE and os.environ.get('DISPLAY')):
+        return False
+    try:
+        from Xlib import display
+        connection = display.Display()
+    except Exception:
+        return False
+    try:
+        return connection.has_extension('DAMAGE')
+    finally:
+        connection.close()
+
+
+@unittest.skipUnless(__import__('x11_capture').NUMPY_AVAILABLE, "NumPy not installed")
+class TestDamageRegions(unittest.TestCase):
+    """Test that damaged rectangles narrow the search without changing results"""
+    
+    def test_merge_and_clip(self):
+        """Test nested rectangles are dropped and too many collapse to one"""
+        from x11_capture import clip_rects, merge_rects
+        
+        self.assertEqual(clip_rects([(-10, 5, 30, 10), (90, 90, 20, 20), (200, 0, 5, 5)], 100, 100),
+                         [(0, 5, 20, 10), (90, 90, 10, 10)])
+        self.assertEqual(sorted(merge_rects([(0, 0, 50, 50), (10, 10, 5, 5), (60, 0, 10, 10)])),
+                         [(0, 0, 50, 50), (60, 0, 10, 10)])
+        self.assertEqual(merge_rects([(x * 10, 0, 5, 5) for x in range(8)], max_rects=4),
+                         [(0, 0, 75, 5)])
+    
+    def test_regions_find_same_tiles(self):
+        """Test dirty tiles and change bounds inside regions match a full comparison"""
+        import numpy as np
+        from scroll_detect import changed_bounds
+        from tile_cache import dirty_tiles
+        
+        prev = np.zeros((300, 400, 3), dtype=np.uint8)
+        cur = prev.copy()
+        cur[70:75, 130:200] = 255
+        cur[250:260, 390:400] = 128
+        regions = [(120, 60, 90, 20), (385, 245, 15, 55)]
+        
+        self.assertEqual(dirty_tiles(prev, cur, 64, regions), dirty_tiles(prev, cur, 64))
+        self.assertEqual(changed_bounds(prev, cur, (120, 60, 280, 240)), changed_bounds(prev, cur))
+        self.assertEqual(dirty_tiles(prev, cur, 64, []), [])
+    
+    def test_capture_trusts_damage(self):
+        """Test a capture listing no damage is skipped without comparing pixels"""
+        from collections import namedtuple
+        from tile_cache import TileEncoder
+        from PIL import Image
+        import numpy as np
+        
+        Shot = namedtuple('Shot', 'size rgb damage')
+        img = Image.new('RGB', (128, 128), 'white')
+        changed = img.copy()
+        changed.paste((0, 0, 0), (70, 70, 80, 80))
+        shots = [Shot(img.size, img.tobytes(), [(0, 0, 128, 128)]),
+                 Shot(img.size, changed.tobytes(), [(70, 70, 10, 10)]),
+                 Shot(img.size, changed.tobytes(), [])]
+        capture = replay_capture([img])
+        capture.grab = lambda: shots.pop(0)
+        capture.tiles = TileEncoder(64)
+        
+        self.assertTrue(capture.capture_update()[3].reset)
+        update = capture.capture_update()[3]
+        self.assertEqual([(col, row) for col, row, _, _ in update.entries], [(1, 1)])
+        self.assertIsNone(capture.capture_update())
+        self.assertTrue(np.array_equal(capture.tiles.previous, np.asarray(changed)))
+
+
+@unittest.skipUnless(x11_damage_available(), "No X server with DAMAGE (run under Xvfb)")
+class TestX11DamageCapture(unittest.TestCase):
+    """Test damage-driven capture against a live X server"""
+    
+    def setUp(self):
+        import mss
+        from Xlib import X, display
+        from x11_capture import DamageCapture
+        
+        self.sct = mss.mss()
+        self.capture = DamageCapture(self.sct, self.sct.monitors[1])
+        self.display = display.Display()
+        screen = self.display.screen()
+        self.window = screen.root.create_window(20, 30, 100, 80, 0, screen.root_depth,
+                                                background_pixel=screen.black_pixel,
+                                                override_redirect=True)
+        self.gc = self.window.create_gc(foreground=screen.white_pixel)
+        self.window.map()
+        self.display.sync()
+        time.sleep(0.2)
+        self.capture.grab()  # initial full frame
+    
+    def tearDown(self):
+        self.window.destroy()
+        self.display.close()
+        self.capture.close()
+        self.sct.close()
+    
+    def test_reports_drawn_rect(self):
+        """Test drawing is reported as damage and patched into the frame"""
+        self.window.fill_rectangle(self.gc, 10, 10, 30, 20)
+        self.display.sync()
+        time.sleep(0.2)
+        shot = self.capture.grab()
+        
+        from scroll_detect import bounding_box
+        x, y, w, h = bounding_box(shot.damage)
+        self.assertTrue(x <= 30 and y <= 40 and x + w >= 60 and y + h >= 60)
+        self.assertEqual(tuple(shot.pixels[45, 40]), (255, 255, 255))
+        self.assertEqual(tuple(shot.pixels[35, 25]), (0, 0, 0))
+    
+    def test_idle_grab_has_no_damage(self):
+        """Test nothing is grabbed or reported while nothing is drawn"""
+        time.sleep(0.1)
+        self.capture.grab()
+        self.assertEqual(self.capture.grab().damage, [])
+
+
+@unittest.skipUnless(__import__('shm_transport').SHM_AVAILABLE, "multiprocessing.shared_memory unavailable")
+class TestShmTransport(unittest.TestCase):
+    """Test streaming through a shared memory ring"""
+    
+    @unittest.skipUnless(__import__('tile_cache').NUMPY_AVAILABLE, "NumPy not installed")
+    def test_stream_through_ring(self):
+        """Test StreamingLoop into the ring reaches a ShmClient like a NetworkClient"""
+        import numpy as np
+        from shm_transport import ShmServer, ShmClient
+        from streaming import StreamingLoop
+        
+        screens = [text_screen(0, (320, 240)), text_screen(400, (320, 240))]
+        expected = list(screens)
+        server = ShmServer(slot_size=1 << 20)
+        server.start()
+        client = ShmClient()
+        self.assertTrue(client.connect(server.name))
+        self.assertTrue(server.keyframe_requested)
+        loop = StreamingLoop(server, replay_capture(screens), frame_delay=0.01)
+        runner = threading.Thread(target=loop.run, daemon=True)
+        runner.start()
+        try:
+            for image in expected:
+                frame = client.receive_frame()
+                error = np.abs(np.asarray(frame, dtype=np.int16) - np.asarray(image, dtype=np.int16))
+                self.assertLess(error.mean(), 4)
+        finally:
+            client.disconnect()
+            loop.stop()
+            server.stop()
+            runner.join(2)
+        self.assertFalse(runner.is_alive())
+    
+    def test_bad_packet_requests_keyframe(self):
+        """Test a packet that cannot be applied is skipped with a keyframe request"""
+        import struct
+        from shm_transport import ShmServer, ShmClient
+        
+        server = ShmServer(slot_size=1 << 16)
+        server.start()
+        server.accept_connection()
+        client = ShmClient()
+        try:
+            self.assertTrue(client.connect(server.name))
+            server.keyframe_requested = False
+            server.ring.write(struct.pack('!III', 64, 48, 5), b'bogus')  # not a JPEG
+            self.assertTrue(server.send_raw(2, 1, bytes(range(6))))
+            frame = client.receive_frame()
+            self.assertEqual((frame.size, frame.getpixel((1, 0))), ((2, 1), (3, 4, 5)))
+            self.assertTrue(server.keyframe_requested)
+        finally:
+            client.disconnect()
+            server.stop()
+        self.assertEqual(client.lost, 0)
+    
+    def test_lapped_reader_skips_ahead(self):
+        """Test a reader the writer overtook resyncs and asks for a keyframe"""
+        from shm_transport import ShmServer, ShmClient
+        
+        server = ShmServer(slots=2, slot_size=4096)
+        server.start()
+        server.accept_connection()
+        client = ShmClient()
+        client.connect(server.name)
+        server.keyframe_requested = False
+        try:
+            server.send_raw(4, 4, bytes(48))
+            held = client.read_packet(timeout=1)
+            for value in range(1, 4):
+                server.send_raw(4, 4, bytes([value]) * 48)
+            self.assertFalse(client.ring.intact(held))
+            held.data.release()
+            
+            packet = client.read_packet(timeout=1)
+            self.assertEqual(packet.seq, 3)
+            self.assertEqual(bytes(packet.data[-1:]), b'\x03')
+            packet.data.release()
+            self.assertEqual(client.lost, 1)
+            self.assertTrue(server.keyframe_requested)
+            
+            # A packet too large for a slot stops the stream instead of losing it
+            self.assertFalse(server.send_raw(64, 64, bytes(64 * 64 * 3)))
+            self.assertFalse(server.running)
+        finally:
+            client.disconnect()
+            server.stop()
+    
+    def test_consumer_process_reads_in_place(self):
+        """Test another process reads raw pixels in place and leaves the ring behind"""
+        import subprocess
+        from shm_transport import ShmServer, ShmClient
+        
+        server = ShmServer(slot_size=4096)
+        server.start()
+        server.accept_connection()
+        code = (
+            "import sys\n"
+            "from shm_transport import ShmClient, RAW_HEADER\n"
+            "client = ShmClient()\n"
+            f"assert client.connect({server.name!r})\n"
+            "packet = client.read_packet(timeout=5)\n"
+            "pixels = packet.data[RAW_HEADER.size:]\n"
+            "print(RAW_HEADER.unpack_from(packet.data), sum(pixels), client.ring.intact(packet))\n"
+            "pixels.release(); packet.data.release()\n"
+            "client.disconnect()\n"
+        )
+        try:
+            consumer = subprocess.Popen([sys.executable, '-c', code], stdout=subprocess.PIPE,
+                                        stderr=subprocess.PIPE,
+                                        cwd=os.path.dirname(os.path.abspath(__file__)))
+            deadline = time.monotonic() + 5
+            while not server.keyframe_requested and time.monotonic() < deadline:
+                time.sleep(0.01)
+            server.send_raw(8, 2, bytes(range(48)))
+            out, err = consumer.communicate(timeout=10)
+            self.assertEqual(consumer.returncode, 0, err.decode())
+            self.assertIn('(8, 2) 1128 True', out.decode())
+            
+            # The consumer exiting must not remove the server's ring
+            client = ShmClient()
+            self.assertTrue(client.connect(server.name))
+            client.disconnect()
+        finally:
+            server.stop()
+
+
+class TestFileTransfer(unittest.TestCase):
+    """Test chunked, resumable file transfers"""
+    
+    def setUp(self):
+        import tempfile
+        self.dir = tempfile.mkdtemp()
+    
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.dir, ignore_errors=True)
+    
+    def make_file(self, name, size):
+        """Random file of some size in the test directory"""
+        path = os.path.join(self.dir, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(os.urandom(size))
+        return path
+    
+    def read(self, path):
+        with open(path, 'rb') as f:
+            return f.read()
+    
+    def test_paths_stay_in_transfer_dir(self):
+        """Test peers cannot reach files outside the transfer directory"""
+        from file_transfer import resolve_path
+        
+        root = os.path.join(self.dir, 'root')
+        self.assertEqual(resolve_path(root, 'a/b.txt'), os.path.join(os.path.realpath(root), 'a', 'b.txt'))
+        self.assertEqual(resolve_path(root, '/etc/passwd'),
+                         os.path.join(os.path.realpath(root), 'etc', 'passwd'))
+        for name in ('..', '../x', 'a/../../x', ''):
+            with self.assertRaises(ValueError):
+                resolve_path(root, name)
+    
+    def test_checkpoints(self):
+        """Test progress is flushed and recorded per checkpoint, one new range at a time"""
+        import json
+        from unittest import mock
+        from file_transfer import FileSender, FileReceiver, CHUNK_SIZE
+        
+        class RecordingMap:
+            def __init__(self, mapped):
+                self.mapped = mapped
+                self.flushes = []
+            
+            def __setitem__(self, key, value):
+                self.mapped[key] = value
+            
+            def flush(self, *args):
+                self.flushes.append(args)
+                self.mapped.flush(*args)
+            
+            def close(self):
+                self.mapped.close()
+        
+        source = self.make_file('source.bin', 6 * CHUNK_SIZE)
+        target = os.path.join(self.dir, 'target.bin')
+        sender = FileSender(1, source)
+        receiver = FileReceiver(1, target, sender.size, sender.mtime)
+        receiver.map = mapped = RecordingMap(receiver.map)
+        record = target + '.litedesk-part.json'
+        
+        with mock.patch('file_transfer.CHECKPOINT_INTERVAL', 2 * CHUNK_SIZE):
+            for index in range(5):
+                offset, length, crc = sender.next_chunk()
+                receiver.write(offset, crc, sender.read(offset, length))
+                self.assertEqual(receiver.commit(), ((index + 1) * CHUNK_SIZE, False))
+                if index == 0:
+                    # Acknowledged, but not yet worth a disk round trip
+                    self.assertFalse(os.path.exists(record))
+        self.assertEqual(mapped.flushes, [(0, 2 * CHUNK_SIZE), (2 * CHUNK_SIZE, 2 * CHUNK_SIZE)])
+        with open(record) as f:
+            self.assertEqual(json.load(f)['offset'], 4 * CHUNK_SIZE)
+        
+        receiver.close()  # the rest is checkpointed on the way out
+        self.assertEqual(mapped.flushes[-1], (4 * CHUNK_SIZE, CHUNK_SIZE))
+        resumed = FileReceiver(2, target, sender.size, sender.mtime)
+        self.assertEqual(resumed.offset, 5 * CHUNK_SIZE)
+        resumed.close()
+        sender.close()
+    
+    def test_resend_and_resume(self):
+        """Test a bad chunk is resent and a stopped receiver resumes where it left off"""
+        from file_transfer import FileSender, FileReceiver, CHUNK_SIZE, WINDOW
+        
+        source = self.make_file('source.bin', 10 * CHUNK_SIZE + 5)
+        target = os.path.join(self.dir, 'out', 'target.bin')
+        sender = FileSender(1, source)
+        receiver = FileReceiver(1, target, sender.size, sender.mtime)
+        self.assertTrue(os.path.exists(target + '.litedesk-part'))
+        self.assertEqual(os.path.getsize(target + '.litedesk-part'), sender.size)  # preallocated
+        sender.acknowledge(*receiver.commit())
+        self.assertTrue(sender.pending())
+        self.assertEqual(sender.offset, 0)  # starts at the receiver's offset
+        
+        def deliver(count, corrupt=None):
+            for _ in range(count):
+                offset, length, crc = sender.next_chunk()
+                data = sender.read(offset, length)
+                if offset == corrupt:
+                    data = b'x' + data[1:]
+                receiver.write(offset, crc, data)
+                if receiver.ack_due():
+                    sender.acknowledge(*receiver.commit())
+        
+        deliver(4, corrupt=2 * CHUNK_SIZE)
+        self.assertEqual(receiver.offset, 2 * CHUNK_SIZE)
+        self.assertEqual(sender.offset, 2 * CHUNK_SIZE)  # went back after 'resend'
+        self.assertLessEqual(sender.offset - sender.acked, WINDOW)
+        deliver(3)
+        receiver.close()  # connection lost: progress is recorded
+        
+        resumed = FileReceiver(2, target, sender.size, sender.mtime)
+        self.assertEqual(resumed.offset, 5 * CHUNK_SIZE)
+        receiver = resumed
+        sender.acknowledge(resumed.offset, resend=True)
+        while not receiver.complete:
+            deliver(1)
+        receiver.finish()
+        sender.close()
+        self.assertEqual(self.read(target), self.read(source))
+        self.assertEqual(sorted(os.listdir(os.path.dirname(target))), ['target.bin'])
+        
+        # A changed source starts over instead of mixing versions
+        with open(target + '.litedesk-part.json', 'w') as f:
+            f.write('{"size": 10, "mtime": 1, "offset": 5}')
+        with open(target + '.litedesk-part', 'wb') as f:
+            f.write(bytes(10))
+        changed = FileReceiver(3, target, 10, 2)
+        self.assertEqual(changed.offset, 0)
+        changed.close()
+    
+    def test_preallocation_failures(self):
+        """Test a full disk fails up front and bad upload sizes are refused"""
+        import errno
+        from unittest import mock
+        from file_transfer import FileReceiver
+        from network import NetworkServer, CONTROL_FILE
+        
+        target = os.path.join(self.dir, 'out.bin')
+        full = OSError(errno.ENOSPC, 'No space left on device')
+        with mock.patch('os.posix_fallocate', side_effect=full, create=True):
+            with self.assertRaises(OSError):
+                FileReceiver(1, target, 4096)
+        self.assertEqual(os.listdir(self.dir), [])
+        
+        # Without fallocate support the part file is sized sparsely
+        unsupported = OSError(errno.EOPNOTSUPP, 'Operation not supported')
+        with mock.patch('os.posix_fallocate', side_effect=unsupported, create=True):
+            receiver = FileReceiver(2, target, 4096)
+        self.assertEqual(os.path.getsize(target + '.litedesk-part'), 4096)
+        receiver.close()
+        
+        server = NetworkServer(host='127.0.0.1', port=0)
+        server.transfer_dir = os.path.join(self.dir, 'server')
+        replies = []
+        server._send_control = lambda kind, msg: replies.append((kind, msg))
+        huge = os.statvfs(self.dir).f_bavail * os.statvfs(self.dir).f_frsize + 1
+        for transfer_id, size in ((3, -1), (4, huge)):
+            server._handle_file_command('file_put', {'id': transfer_id, 'path': 'x.bin',
+                                                     'size': size})
+            kind, msg = replies.pop()
+            self.assertEqual((kind, msg['id'], msg['event']), (CONTROL_FILE, transfer_id, 'error'))
+        self.assertEqual(server.uploads, {})
+        self.assertFalse(os.path.exists(os.path.join(self.dir, 'server', 'x.bin.litedesk-part')))
+    
+    def test_transfers_between_frames(self):
+        """Test uploads and resumed downloads over a streaming connection"""
+        from file_transfer import FileReceiver, CHUNK_SIZE
+        from network import NetworkServer, NetworkClient
+        from streaming import StreamingLoop
+        
+        root = os.path.join(self.dir, 'server')
+        remote = self.make_file('server/docs/report.bin', 40 * CHUNK_SIZE + 99)
+        local = self.make_file('client/photo.bin', 3 * CHUNK_SIZE)
+        saved = os.path.join(self.dir, 'client', 'report.bin')
+        
+        # Half of the download survived an earlier connection
+        partial = FileReceiver(1, saved, os.path.getsize(remote), int(os.stat(remote).st_mtime))
+        half = 20 * CHUNK_SIZE
+        with open(remote, 'rb') as f:
+            partial.map[:half] = f.read(half)
+        partial.offset = half
+        partial.close()
+        
+        server = NetworkServer(host='127.0.0.1', port=0)
+        server.transfer_dir = root
+        server.start()
+        screens = [text_screen(line, (160, 120)) for line in range(100)]
+        loop = StreamingLoop(server, replay_capture(screens), frame_delay=0.01)
+        runner = threading.Thread(target=loop.run, daemon=True)
+        runner.start()
+        
+        client = NetworkClient()
+        events = {}
+        client.on_transfer = lambda transfer_id, event, message: events.update({transfer_id: event})
+        offsets = []
+        apply_chunk = client._apply_file_chunk
+        client._apply_file_chunk = lambda data: offsets.append(data[4:12]) or apply_chunk(data)
+        try:
+            self.assertTrue(client.connect('127.0.0.1', server.socket.getsockname()[1]))
+            download = client.download('docs/report.bin', saved)
+            upload = client.upload(local, 'inbox/photo.bin')
+            escape = client.download('../secret', os.path.join(self.dir, 'secret'))
+            frames = 0
+            deadline = time.monotonic() + 10
+            while len(events) < 3 and time.monotonic() < deadline:
+                if client.receive_frame() is not None:
+                    frames += 1
+        finally:
+            client.disconnect()
+            loop.stop()
+            server.stop()
+            runner.join(2)
+        
+        self.assertEqual(events, {download: 'done', upload: 'done', escape: 'error'})
+        self.assertEqual(self.read(saved), self.read(remote))
+        self.assertEqual(self.read(os.path.join(root, 'inbox', 'photo.bin')), self.read(local))
+        self.assertEqual(int.from_bytes(offsets[0], 'big'), half)  # resumed, not restarted
+        self.assertGreater(frames, 0)
+    
+    def test_upload_longer_than_recursion_limit(self):
+        """Test an upload of more chunks than the recursion limit completes"""
+        from file_transfer import CHUNK_SIZE
+        from network import NetworkServer, NetworkClient
+        
+        local = os.path.join(self.dir, 'big.bin')
+        with open(local, 'wb') as f:
+            block = os.urandom(CHUNK_SIZE)
+            for index in range(sys.getrecursionlimit() + 10):
+                f.write(index.to_bytes(4, 'big') + block[4:])
+        
+        server = NetworkServer(host='127.0.0.1', port=0)
+        server.transfer_dir = os.path.join(self.dir, 'server')
+        server.start()
+        client = NetworkClient()
+        started = []
+        try:
+            self.assertTrue(client.connect('127.0.0.1', server.socket.getsockname()[1]))
+            events, _ = stream_transfers(
+                server, client, lambda: started.append(client.upload(local, 'big.bin')), 1,
+                timeout=60)
+        finally:
+            client.disconnect()
+            server.stop()
+        
+        # Every chunk went through the one command reader thread
+        self.assertEqual(events, {started[0]: 'done'})
+        self.assertEqual(self.read(os.path.join(self.dir, 'server', 'big.bin')), self.read(local))
+
+
+class TestUdpTransport(unittest.TestCase):
+    """Test UDP frame transport on loopback"""
+    
+    def setUp(self):
+        self.send_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.recv_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.recv_sock.bind(('127.0.0.1', 0))
+        self.recv_sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20)
+        self.addr = self.recv_sock.getsockname()
+    
+    def tearDown(self):
+        self.send_sock.close()
+        self.recv_sock.close()
+    
+    def _frames(self, count, size=9000):
+        import random
+        rng = random.Random(1)
+        return [bytes(rng.getrandbits(8) for _ in range(size)) for _ in range(count)]
+    
+    def test_fragment_and_reassemble(self):
+        """Test frames survive fragmentation on a clean link"""
+        from udp_transport import UdpFrameSender, UdpFrameReceiver
+        
+        sender = UdpFrameSender(self.send_sock, self.addr)
+        receiver = UdpFrameReceiver(self.recv_sock)
+        for frame in self._frames(3):
+            sender.send_frame(frame)
+            self.assertEqual(receiver.receive_frame(timeout=2), frame)
+    
+    def test_parity_recovers_loss(self):
+        """Test XOR parity rebuilds a dropped fragment"""
+        from udp_transport import ImpairedSocket, UdpFrameSender, UdpFrameReceiver
+        
+        lossy = ImpairedSocket(self.send_sock, loss_rate=0.05, seed=7)
+        sender = UdpFrameSender(lossy, self.addr, fec_group=4)
+        receiver = UdpFrameReceiver(self.recv_sock, max_wait=0.05)
+        delivered = []
+        for frame in self._frames(20):
+            sender.send_frame(frame)
+            received = receiver.receive_frame(timeout=0.2)
+            if received is not None:
+                self.assertEqual(received, frame)
+                delivered.append(received)
+        
+        self.assertGreater(lossy.dropped, 0)
+        self.assertGreater(receiver.frames_recovered, 0)
+        self.assertGreater(len(delivered), 15)
+        print(f"  Dropped {lossy.dropped} datagrams, recovered {receiver.frames_recovered} frames")
+    
+    def test_reordering(self):
+        """Test reordered datagrams still reassemble"""
+        from udp_transport import ImpairedSocket, UdpFrameSender, UdpFrameReceiver
+        
+        reordering = ImpairedSocket(self.send_sock, reorder_rate=0.3, seed=3)
+        sender = UdpFrameSender(reordering, self.addr)
+        receiver = UdpFrameReceiver(self.recv_sock)
+        for frame in self._frames(5):
+            sender.send_frame(frame)
+            self.assertEqual(receiver.receive_frame(timeout=2), frame)
+    
+    def test_unrecoverable_loss_requests_keyframe(self):
+        """Test a frame lost beyond repair triggers the loss callback"""
+        from udp_transport import ImpairedSocket, UdpFrameSender, UdpFrameReceiver
+        
+        losses = []
+        lossy = ImpairedSocket(self.send_sock, loss_rate=0.5, seed=11)
+        sender = UdpFrameSender(lossy, self.addr, fec_group=2)
+        receiver = UdpFrameReceiver(self.recv_sock, max_wait=0.02,
+                                    on_loss=lambda: losses.append(True))
+        sender.send_frame(self._frames(1)[0])
+        self.assertIsNone(receiver.receive_frame(timeout=0.1))
+        self.assertEqual(len(losses), 1)
+    
+    def test_network_udp_subscribe(self):
+        """Test NetworkClient switches frames to UDP while commands stay on TCP"""
+        from PIL import Image
+        from network import NetworkServer, NetworkClient
+        
+        server = NetworkServer(host='127.0.0.1', port=0)
+        server.start()
+        port = server.socket.getsockname()[1]
+        client = NetworkClient()
+        
+        try:
+            accepted = threading.Thread(target=server.accept_connection)
+            accepted.start()
+            self.assertTrue(client.connect('127.0.0.1', port))
+            accepted.join(5)
+            
+            client.enable_udp()
+            client.send_command('mouse_move', {'x': 1, 'y': 2})
+            cmd = server.receive_command()
+            self.assertEqual(cmd['type'], 'mouse_move')
+            self.assertIsNotNone(server.udp_sender)
+            
+            buffer = BytesIO()
+            Image.new('RGB', (64, 48), color='red').save(buffer, format='JPEG')
+            self.assertTrue(server.send_frame(64, 48, buffer.getvalue()))
+            frame = client.receive_frame()
+            self.assertEqual(frame.size, (64, 48))
+        finally:
+            client.disconnect()
+            server.stop()
+    
+    def test_udp_subscribe_bad_port(self):
+        """Test subscriptions to missing or out-of-range ports keep frames on TCP"""
+        from network import NetworkServer, NetworkClient
+        
+        server = NetworkServer(host='127.0.0.1', port=0)
+        server.start()
+        port = server.socket.getsockname()[1]
+        client = NetworkClient()
+        
+        try:
+            accepted = threading.Thread(target=server.accept_connection)
+            accepted.start()
+            self.assertTrue(client.connect('127.0.0.1', port))
+            accepted.join(5)
+            
+            for bad_port in ({}, {'port': 'x'}, {'port': 70000}, {'port': 0}, {'port': True}):
+                client.send_command('udp_subscribe', bad_port)
+            client.send_command('mouse_move', {'x': 1, 'y': 2})
+            self.assertEqual(server.receive_command()['type'], 'mouse_move')
+            self.assertIsNone(server.udp_sender)
+        finally:
+            client.disconnect()
+            server.stop()
+
+
+class TestSessionResume(unittest.TestCase):
+    """Test resume tokens and automatic reconnect"""
+    
+    def setUp(self):
+        from network import NetworkServer
+        self.server = NetworkServer(host='127.0.0.1', port=0)
+        self.server.start()
+        self.port = self.server.socket.getsockname()[1]
+        self.sizes = iter([(64, 48), (80, 60), (96, 72)])
+        threading.Thread(target=self._serve, daemon=True).start()
+    
+    def tearDown(self):
+        self.server.stop()
+    
+    def _serve(self):
+        """Send one new frame per connection, then wait for commands"""
+        from PIL import Image
+        try:
+            while self.server.running and self.server.accept_connection():
+                buffer = BytesIO()
+                size = next(self.sizes)
+                Image.new('RGB', size, color='green').save(buffer, format='JPEG')
+                self.server.send_frame(size[0], size[1], buffer.getvalue())
+                while self.server.receive_command():
+                    pass
+        except OSError:
+            pass
+    
+    def _drop(self, client):
+        """Cut the connection under the client, like a network blip"""
+        client.socket.shutdown(socket.SHUT_RDWR)
+        self.assertIsNone(client.receive_frame())
+        self.assertFalse(client.connected)
+    
+    def test_resume_after_drop(self):
+        """Test a dropped client resumes its session and gets the cached frame"""
+        from network import NetworkClient
+        
+        client = NetworkClient()
+        self.assertTrue(client.connect('127.0.0.1', self.port))
+        self.assertFalse(client.resumed)
+        token = client.resume_token
+        self.assertIsNotNone(token)
+        self.assertEqual(client.receive_frame().size, (64, 48))
+        
+        self._drop(client)
+        start = time.perf_counter()
+        self.assertTrue(client.reconnect())
+        frame = client.receive_frame()
+        stall = time.perf_counter() - start
+        
+        self.assertTrue(client.resumed)
+        self.assertEqual(client.resume_token, token)
+        # The cached frame arrives before the server captures a new one
+        self.assertEqual(frame.size, (64, 48))
+        self.assertEqual(client.receive_frame().size, (80, 60))
+        self.assertLess(stall, 0.5)
+        print(f"  Resumed after {stall * 1000:.1f} ms")
+        client.disconnect()
+    
+    def test_expired_session_starts_fresh(self):
+        """Test a session past its grace period is not resumed"""
+        from network import NetworkClient
+        
+        self.server.resume_grace = 0
+        client = NetworkClient()
+        self.assertTrue(client.connect('127.0.0.1', self.port))
+        token = client.resume_token
+        client.receive_frame()
+        
+        self._drop(client)
+        time.sleep(0.05)
+        self.assertTrue(client.reconnect())
+        self.assertFalse(client.resumed)
+        self.assertNotEqual(client.resume_token, token)
+        self.assertEqual(client.receive_frame().size, (80, 60))
+        client.disconnect()
+    
+    def test_reconnect_gives_up(self):
+        """Test reconnect backs off and stops once its window has passed"""
+        from network import NetworkClient
+        
+        client = NetworkClient()
+        self.assertTrue(client.connect('127.0.0.1', self.port))
+        self.server.stop()
+        start = time.perf_counter()
+        self.assertFalse(client.reconnect(window=0.5))
+        self.assertLess(time.perf_counter() - start, 2.0)
+    
+    def test_client_without_hello(self):
+        """Test clients that skip the session handshake still work"""
+        sock = socket.create_connection(('127.0.0.1', self.port))
+        try:
+            payload = b'{"type": "mouse_move", "data": {"x": 1, "y": 2}}'
+            sock.sendall(len(payload).to_bytes(4, 'big') + payload)
+            sock.settimeout(5)
+            header = b''
+            while len(header) < 12:
+                header += sock.recv(12 - len(header))
+            self.assertEqual(int.from_bytes(header[:4], 'big'), 64)
+        finally:
+            sock.close()
+    
+    def test_malformed_hello_drops_client(self):
+        """Test a malformed hello drops that client and the server keeps accepting"""
+        from network import NetworkClient
+        
+        sock = socket.create_connection(('127.0.0.1', self.port))
+        try:
+            payload = b'{"type": "hello", "data": "resume"}'
+            sock.sendall(len(payload).to_bytes(4, 'big') + payload)
+            sock.settimeout(5)
+            self.assertEqual(sock.recv(12), b'')
+        finally:
+            sock.close()
+        
+        # A token that is not a string just starts a new session
+        client = NetworkClient()
+        client.resume_token = [1, 2]
+        self.assertTrue(client.connect('127.0.0.1', self.port))
+        self.assertFalse(client.resumed)
+        self.assertIsInstance(client.resume_token, str)
+        self.assertEqual(client.receive_frame().size, (64, 48))
+        client.disconnect()
+    
+    def test_malformed_command_drops_client(self):
+        """Test commands that are not JSON objects drop the client mid-session"""
+        from network import NetworkClient
+        
+        client = NetworkClient()
+        self.assertTrue(client.connect('127.0.0.1', self.port))
+        self.assertEqual(client.receive_frame().size, (64, 48))
+        payload = b'[1, 2]'
+        client.socket.sendall(len(payload).to_bytes(4, 'big') + payload)
+        self.assertIsNone(client.receive_frame())
+        
+        other = NetworkClient()
+        self.assertTrue(other.connect('127.0.0.1', self.port))
+        self.assertEqual(other.receive_frame().size, (80, 60))
+        other.disconnect()
+        client.disconnect()
+
+
+class FakeCapture:
+    """Synthetic screen whose frame width reports the JPEG quality in use"""
+    
+    def __init__(self, quality=50):
+        self.quality = quality
+        self.closed = False
+    
+    def capture_screen(self):
+        from PIL import Image
+        buffer = BytesIO()
+        Image.new('RGB', (self.quality, 10), color='blue').save(buffer, format='JPEG')
+        return self.quality, 10, buffer.getvalue()
+    
+    def close(self):
+        self.closed = True
+
+
+class FakeInput:
+    """Records injected input instead of moving the real mouse"""
+    
+    def __init__(self):
+        self.moves = []
+        self.moved = threading.Event()
+    
+    def move_mouse(self, x, y):
+        self.moves.append((x, y))
+        self.moved.set()
+
+
+class TestDaemon(unittest.TestCase):
+    """Test the headless server daemon and its streaming loop"""
+    
+    def setUp(self):
+        import tempfile
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.config_path = os.path.join(self.tmpdir.name, 'config.ini')
+    
+    def tearDown(self):
+        self.tmpdir.cleanup()
+    
+    def _write_config(self, **values):
+        with open(self.config_path, 'w', encoding='utf-8') as f:
+            f.write('[server]\n')
+            for key, value in values.items():
+                f.write(f'{key} = {value}\n')
+    
+    def test_load_config(self):
+        """Test config values, defaults and validation"""
+        from daemon import load_server_config, DEFAULTS
+        
+        self.assertEqual(load_server_config(self.config_path), DEFAULTS)
+        
+        self._write_config(port=9000, quality=30, frame_delay=0.05,
+                           allow_input='false', relay_host='')
+        config = load_server_config(self.config_path)
+        self.assertEqual(config['port'], 9000)
+        self.assertEqual(config['quality'], 30)
+        self.assertEqual(config['frame_delay'], 0.05)
+        self.assertFalse(config['allow_input'])
+        self.assertIsNone(config['relay_host'])
+        self.assertEqual(config['host'], DEFAULTS['host'])
+        
+        for bad in ({'quality': 0}, {'frame_delay': 0}, {'port': 'abc'}, {'video_codec': 'mjpeg'}):
+            self._write_config(**bad)
+            with self.assertRaises(ValueError):
+                load_server_config(self.config_path)
+    
+    def test_no_qt_import(self):
+        """Test the daemon runs without loading Qt"""
+        import subprocess
+        code = "import sys, daemon, streaming; sys.exit('PyQt5' in sys.modules)"
+        result = subprocess.run([sys.executable, '-c', code],
+                                cwd=os.path.dirname(os.path.abspath(__file__)))
+        self.assertEqual(result.returncode, 0)
+    
+    def test_streams_without_commands(self):
+        """Test frames keep flowing to a quiet client and input applies at once"""
+        from network import NetworkServer, NetworkClient
+        from streaming import StreamingLoop
+        
+        server = NetworkServer(host='127.0.0.1', port=0)
+        server.start()
+        fake_input = FakeInput()
+        loop = StreamingLoop(server, FakeCapture(), fake_input, frame_delay=0.01)
+        runner = threading.Thread(target=loop.run, daemon=True)
+        runner.start()
+        
+        client = NetworkClient()
+        try:
+            self.assertTrue(client.connect('127.0.0.1', server.socket.getsockname()[1]))
+            # The old loop waited for a command between frames
+            for _ in range(5):
+                self.assertEqual(client.receive_frame().size, (50, 10))
+            
+            client.send_command('mouse_move', {'x': 3, 'y': 4})
+            self.assertTrue(fake_input.moved.wait(2))
+            self.assertEqual(fake_input.moves, [(3, 4)])
+        finally:
+            client.disconnect()
+            loop.stop()
+            server.stop()
+            runner.join(2)
+    
+    @unittest.skipUnless(hasattr(signal, 'SIGHUP'), "SIGHUP not available")
+    def test_sighup_reload_keeps_client(self):
+        """Test SIGHUP applies a new quality without dropping the client"""
+        from daemon import ServerDaemon
+        from network import NetworkClient
+        
+        class TestServerDaemon(ServerDaemon):
+            def create_capture(self):
+                return FakeCapture(self.config['quality'])
+            
+            def create_input(self):
+                return FakeInput()
+        
+        self._write_config(host='127.0.0.1', port=0, quality=40, frame_delay=0.01)
+        daemon = TestServerDaemon(self.config_path)
+        daemon.start()
+        port = daemon.server.socket.getsockname()[1]
+        runner = threading.Thread(target=daemon.run, daemon=True)
+        runner.start()
+        
+        handlers = {signum: signal.getsignal(signum)
+                    for signum in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT)}
+        client = NetworkClient()
+        try:
+            daemon.install_signal_handlers()
+            self.assertTrue(client.connect('127.0.0.1', port))
+            self.assertEqual(client.receive_frame().size, (40, 10))
+            
+            # A restart-only change is reported and left alone
+            self._write_config(host='127.0.0.1', port=1, quality=80, frame_delay=0.01)
+            os.kill(os.getpid(), signal.SIGHUP)
+            for _ in range(100):
+                frame = client.receive_frame()
+                if frame.size != (40, 10):
+                    break
+            self.assertEqual(frame.size, (80, 10))
+            self.assertTrue(client.connected)
+            self.assertFalse(client.resumed)
+            self.assertEqual(daemon.config['port'], 0)
+            
+            # An invalid file keeps the running settings
+            self._write_config(quality=500)
+            self.assertFalse(daemon.reload())
+            self.assertEqual(daemon.config['quality'], 80)
+        finally:
+            for signum, handler in handlers.items():
+                signal.signal(signum, handler)
+            client.disconnect()
+            daemon.stop()
+            runner.join(2)
+        self.assertFalse(runner.is_alive())
+        self.assertTrue(daemon.capture.closed)
+
+
+class TestRelayServer(unittest.TestCase):
+    """Test the relay server control and data planes"""
+    
+    server_class = 'RelayServer'
+    
+    def setUp(self):
+        self._start_relay()
+        self.clients = []
+    
+    def _start_relay(self, **options):
+        import relay_server
+        self.relay = getattr(relay_server, self.server_class)(host='127.0.0.1', port=0,
+                                                              **options)
+        self.relay_thread = threading.Thread(target=self.relay.start, daemon=True)
+        self.relay_thread.start()
+        for _ in range(100):
+            if self.relay.running:
+                break
+            time.sleep(0.01)
+        self.port = self.relay.socket.getsockname()[1]
+    
+    def tearDown(self):
+        for client in self.clients:
+            client.disconnect()
+        self.relay.stop()
+        # Let the relay thread finish so later tests count threads reliably
+        self.relay_thread.join(2)
+    
+    def _peer(self, peer_id, peer_type):
+        from relay_client import RelayClient
+        client = RelayClient('127.0.0.1', self.port)
+        self.assertTrue(client.connect(peer_id, peer_type))
+        self.clients.append(client)
+        return client
+    
+    def _register_raw(self, peer_id, peer_type):
+        from relay_server import encode_message
+        sock = socket.create_connection(('127.0.0.1', self.port))
+        sock.settimeout(5)
+        sock.sendall(encode_message({'type': 'register', 'peer_id': peer_id,
+                                     'peer_type': peer_type}))
+        self.assertEqual(self._read(sock)['type'], 'registered')
+        return sock
+    
+    def _read(self, sock):
+        from relay_loadgen import recv_message
+        return recv_message(sock)
+    
+    def _request(self, sock, msg):
+        from relay_server import encode_message
+        sock.sendall(encode_message(msg))
+        return self._read(sock)
+    
+    def test_stream_splice(self):
+        """Test a paired stream forwards raw bytes in both directions"""
+        host = self._peer('host', 'server')
+        viewer = self._peer('viewer', 'client')
+        attached = []
+        host.set_callback('stream_request',
+                          lambda msg: attached.append(host.open_stream(msg['session_id'])))
+        
+        viewer_sock = viewer.request_stream('host')
+        self.assertIsNotNone(viewer_sock)
+        for _ in range(100):
+            if attached:
+                break
+            time.sleep(0.01)
+        host_sock = attached[0]
+        self.assertIsNotNone(host_sock)
+        
+        payload = bytes(range(256)) * 4096
+        threading.Thread(target=viewer_sock.sendall, args=(payload,), daemon=True).start()
+        received = b''
+        while len(received) < len(payload):
+            received += host_sock.recv(65536)
+        self.assertEqual(received, payload)
+        # Counted as it moves, before the stream ends
+        for _ in range(100):
+            if self.relay.metrics_snapshot()['bytes_relayed'] >= len(payload):
+                break
+            time.sleep(0.01)
+        self.assertEqual(self.relay.metrics_snapshot()['bytes_relayed'], len(payload))
+        
+        host_sock.sendall(b'frame')
+        self.assertEqual(viewer_sock.recv(16), b'frame')
+        
+        viewer_sock.close()
+        self.assertEqual(host_sock.recv(16), b'')
+        host_sock.close()
+        for _ in range(100):
+            if self.relay.bytes_relayed:
+                break
+            time.sleep(0.01)
+        self.assertEqual(self.relay.bytes_relayed, len(payload) + 5)
+    
+    def test_stream_attach_rejected_without_request(self):
+        """Test the relay refuses to attach to an unknown session"""
+        viewer = self._peer('viewer', 'client')
+        self.assertIsNone(viewer.open_stream('unknown-session', timeout=1))
+    
+    def test_reregister_keeps_new_entry(self):
+        """Test a peer re-registering replaces, not removes, its entry"""
+        first = self._register_raw('host', 'server')
+        second = self._register_raw('host', 'server')
+        viewer = self._register_raw('viewer', 'client')
+        try:
+            self.assertEqual(first.recv(16), b'')
+            reply = self._request(viewer, {'type': 'list_peers'})
+            self.assertEqual([p['peer_id'] for p in reply['peers']], ['host'])
+        finally:
+            for sock in (first, second, viewer):
+                sock.close()
+    
+    def test_paginated_list_with_tags(self):
+        """Test list_peers pages through the type and tag indexes"""
+        from relay_server import encode_message
+        socks = []
+        for i in range(25):
+            sock = socket.create_connection(('127.0.0.1', self.port))
+            sock.settimeout(5)
+            tags = ['lab'] if i % 5 == 0 else []
+            sock.sendall(encode_message({'type': 'register', 'peer_id': f'host{i:02d}',
+                                         'peer_type': 'server', 'tags': tags}))
+            self.assertEqual(self._read(sock)['type'], 'registered')
+            socks.append(sock)
+        viewer = self._register_raw('viewer', 'client')
+        socks.append(viewer)
+        try:
+            seen = []
+            after = None
+            while True:
+                reply = self._request(viewer, {'type': 'list_peers', 'limit': 10,
+                                               'after': after})
+                self.assertLessEqual(len(reply['peers']), 10)
+                seen += [p['peer_id'] for p in reply['peers']]
+                after = reply['next_cursor']
+                if not after:
+                    break
+            self.assertEqual(seen, [f'host{i:02d}' for i in range(25)])
+            
+            reply = self._request(viewer, {'type': 'list_peers', 'tag': 'lab'})
+            self.assertEqual([p['peer_id'] for p in reply['peers']],
+                             ['host00', 'host05', 'host10', 'host15', 'host20'])
+            self.assertIsNone(reply['next_cursor'])
+            self.assertEqual(reply['peers'][0]['tags'], ['lab'])
+        finally:
+            for sock in socks:
+                sock.close()
+    
+    def test_presence_subscription(self):
+        """Test subscribers get versioned join and leave updates"""
+        viewer = self._register_raw('viewer', 'client')
+        host = None
+        try:
+            reply = self._request(viewer, {'type': 'subscribe', 'peer_type': 'server'})
+            self.assertEqual(reply['type'], 'subscribed')
+            self.assertEqual(reply['peers'], [])
+            
+            host = self._register_raw('host', 'server')
+            join = self._read(viewer)
+            self.assertEqual((join['type'], join['event']), ('presence', 'join'))
+            self.assertEqual(join['peer']['peer_id'], 'host')
+            self.assertGreater(join['version'], reply['version'])
+            
+            # Peers of the other type are not pushed
+            self._register_raw('viewer2', 'client').close()
+            host.close()
+            leave = self._read(viewer)
+            self.assertEqual((leave['event'], leave['peer']['peer_id']), ('leave', 'host'))
+            self.assertGreater(leave['version'], join['version'])
+        finally:
+            viewer.close()
+            if host:
+                host.close()
+    
+    def test_peer_directory(self):
+        """Test RelayClient.subscribe keeps a live server list"""
+        viewer = self._peer('viewer', 'client')
+        for i in range(3):
+            self._peer(f'host{i}', 'server')
+        directory = viewer.subscribe(peer_type='server')
+        self.assertEqual([p['peer_id'] for p in directory.list()], ['host0', 'host1', 'host2'])
+        
+        changes = []
+        directory.on_change = lambda event, peer: changes.append((event, peer['peer_id']))
+        self.clients.pop().disconnect()
+        self._peer('host3', 'server')
+        for _ in range(200):
+            if len(changes) == 2:
+                break
+            time.sleep(0.01)
+        self.assertEqual(sorted(changes), [('join', 'host3'), ('leave', 'host2')])
+        self.assertEqual([p['peer_id'] for p in directory.list()], ['host0', 'host1', 'host3'])
+    
+    def test_pipelined_peer_lookup(self):
+        """Test many lookups share one connection with replies routed by ID"""
+        hosts = [self._register_raw(f'host{i:03d}', 'server') for i in range(100)]
+        viewer = self._peer('viewer', 'client')
+        try:
+            ids = [f'host{i:03d}' for i in range(100)] + ['missing']
+            start = time.perf_counter()
+            results = viewer.get_peer_info_many(ids)
+            batch_ms = (time.perf_counter() - start) * 1000
+            self.assertIsNone(results.pop('missing'))
+            self.assertEqual(sorted(results), ids[:100])
+            self.assertTrue(all(info['peer_type'] == 'server' for info in results.values()))
+            print(f"  100 pipelined lookups: {batch_ms:.1f} ms")
+            
+            # Plain lookups do not announce a connection to the target
+            hosts[0].settimeout(0.2)
+            self.assertRaises(socket.timeout, hosts[0].recv, 1)
+            self.assertEqual(viewer.pending, {})
+        finally:
+            for sock in hosts:
+                sock.close()
+    
+    def test_concurrent_requests_and_pushes(self):
+        """Test replies are not stolen by the reader or by other callers"""
+        viewer = self._peer('viewer', 'client')
+        host = self._peer('host', 'server')
+        pushed = []
+        host.set_callback('connection_request', pushed.append)
+        directory = viewer.subscribe(peer_type='server')
+        
+        errors = []
+        def lookup():
+            for _ in range(20):
+                if viewer.get_peer_info('host') is None:
+                    errors.append('lookup')
+                if 'host' not in [p['peer_id'] for p in viewer.list_peers()]:
+                    errors.append('list')
+        threads = [threading.Thread(target=lookup) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for i in range(5):
+            self._peer(f'extra{i}', 'server')
+        for thread in threads:
+            thread.join()
+        
+        self.assertEqual(errors, [])
+        for _ in range(200):
+            if len(pushed) == 80 and len(directory.list()) == 6:
+                break
+            time.sleep(0.01)
+        self.assertEqual(len(pushed), 80)
+        self.assertEqual(len(directory.list()), 6)
+    
+    def test_idle_peers_expire(self):
+        """Test silent peers are dropped while heartbeating peers stay"""
+        self.relay.stop()
+        self._start_relay(idle_timeout=1.0, heartbeat_interval=0.3)
+        alive = self._peer('alive', 'server')
+        self.assertEqual(alive.heartbeat_interval, 0.3)
+        silent = self._register_raw('silent', 'server')
+        try:
+            start = time.monotonic()
+            self.assertEqual(self._read(silent)['type'], 'ping')
+            self.assertIsNone(self._read(silent))
+            self.assertLess(time.monotonic() - start, 3.0)
+            
+            for _ in range(100):
+                if 'silent' not in self.relay.peers:
+                    break
+                time.sleep(0.01)
+            self.assertNotIn('silent', self.relay.peers)
+            self.assertIn('alive', self.relay.peers)
+            self.assertEqual(len(self.relay.liveness), 1)
+        finally:
+            silent.close()
+    
+    def test_stalled_peer_does_not_block_others(self):
+        """Test a peer that stops reading does not delay other peers"""
+        from relay_server import encode_message
+        stalled = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        stalled.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+        stalled.connect(('127.0.0.1', self.port))
+        stalled.sendall(encode_message({'type': 'register', 'peer_id': 'stalled',
+                                        'peer_type': 'client'}))
+        flooder = self._register_raw('flooder', 'server')
+        host = self._register_raw('host', 'server')
+        viewer = self._register_raw('viewer', 'client')
+        try:
+            blob = 'x' * 32768
+            flood = encode_message({'type': 'relay_data', 'target_id': 'stalled',
+                                    'data': blob}) * 200
+            threading.Thread(target=flooder.sendall, args=(flood,), daemon=True).start()
+            time.sleep(0.2)
+            
+            timings = []
+            for _ in range(20):
+                start = time.perf_counter()
+                reply = self._request(viewer, {'type': 'get_peer_info', 'target_id': 'host'})
+                timings.append(time.perf_counter() - start)
+                self.assertEqual(reply['peer_id'], 'host')
+                self.assertEqual(self._read(host)['type'], 'connection_request')
+            self.assertLess(max(timings), 0.5)
+            
+            stats = self.relay.lock.stats()
+            self.assertGreater(stats['acquisitions'], 0)
+            self.assertLess(stats['hold_max_ms'], 100)
+        finally:
+            for sock in (stalled, flooder, host, viewer):
+                sock.close()
+    
+    def test_metrics_snapshot_outside_lock(self):
+        """Test queue depths are read without holding the registry lock"""
+        self._peer('host', 'server')
+        self._peer('viewer', 'client')
+        held = []
+        depth = self.relay.queue_depth
+        self.relay.queue_depth = lambda peer: held.append(self.relay.lock._lock.locked()) or depth(peer)
+        
+        snapshot = self.relay.metrics_snapshot()
+        self.assertEqual(sorted(snapshot['queue_depths']), ['host', 'viewer'])
+        self.assertEqual(held, [False, False])
+    
+    def test_metrics_endpoint(self):
+        """Test the metrics endpoint reports peers, messages and lock times"""
+        import urllib.request
+        from relay_metrics import MetricsServer
+        
+        metrics = MetricsServer(self.relay, port=0)
+        metrics.start()
+        try:
+            host = self._peer('host', 'server')
+            viewer = self._peer('viewer', 'client')
+            for _ in range(5):
+                self.assertIsNotNone(viewer.get_peer_info('host', notify=False))
+            viewer.list_peers(peer_type='server')
+            
+            url = f'http://127.0.0.1:{metrics.port}/metrics'
+            with urllib.request.urlopen(url, timeout=5) as response:
+                self.assertTrue(response.headers['Content-Type'].startswith('text/plain'))
+                text = response.read().decode('utf-8')
+            samples = dict(line.rsplit(' ', 1) for line in text.splitlines()
+                           if line and not line.startswith('#'))
+            
+            self.assertEqual(samples['litedesk_relay_peers{type="server"}'], '1')
+            self.assertEqual(samples['litedesk_relay_peers{type="client"}'], '1')
+            self.assertEqual(samples['litedesk_relay_messages_total{type="get_peer_info"}'], '5')
+            self.assertEqual(
+                samples['litedesk_relay_handler_seconds_bucket{type="get_peer_info",le="+Inf"}'], '5')
+            self.assertGreater(int(samples['litedesk_relay_lock_acquisitions_total']), 0)
+            self.assertIn('litedesk_relay_peer_queue_depth_max', samples)
+            self.assertIn('litedesk_relay_stream_bytes_total', samples)
+            
+            with self.assertRaises(urllib.error.HTTPError):
+                urllib.request.urlopen(f'http://127.0.0.1:{metrics.port}/', timeout=5)
+        finally:
+            metrics.stop()
+    
+    def test_udp_endpoint_probe(self):
+        """Test the relay reports the public address of a UDP socket"""
+        from hole_punch import discover_endpoint
+        
+        host = self._peer('host', 'server')
+        self.assertEqual(host.udp_port, self.port)
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind(('127.0.0.1', 0))
+        try:
+            observed = discover_endpoint(sock, ('127.0.0.1', host.udp_port),
+                                         host.peer_id, host.udp_token)
+            self.assertEqual(observed, ['127.0.0.1', sock.getsockname()[1]])
+            # Probes without the peer's token are not answered
+            self.assertIsNone(discover_endpoint(sock, ('127.0.0.1', host.udp_port),
+                                                host.peer_id, '0' * 32, timeout=0.3))
+            self.assertIsNone(discover_endpoint(sock, ('127.0.0.1', host.udp_port),
+                                                'other', host.udp_token, timeout=0.3))
+        finally:
+            sock.close()
+
+
+class TestTimingWheel(unittest.TestCase):
+    """Test the relay's idle-expiry timing wheel"""
+    
+    def test_items_come_due_on_their_tick(self):
+        """Test items are returned once their deadline slot is reached"""
+        from relay_server import TimingWheel
+        wheel = TimingWheel(tick=1.0, slots=8, now=100.0)
+        wheel.schedule('a', 'a', 102.5, now=100.0)
+        wheel.schedule('b', 'b', 105.0, now=100.0)
+        wheel.schedule('c', 'c', 103.0, now=100.0)
+        wheel.cancel('c')
+        
+        self.assertEqual(wheel.advance(102.0), [])
+        self.assertEqual(wheel.advance(103.0), ['a'])
+        self.assertEqual(wheel.advance(106.0), ['b'])
+        self.assertEqual(len(wheel), 0)
+    
+    def test_far_deadlines_come_up_early(self):
+        """Test deadlines past one revolution are capped to the last slot"""
+        from relay_server import TimingWheel
+        wheel = TimingWheel(tick=1.0, slots=4, now=0.0)
+        wheel.schedule('far', 'far', 100.0, now=0.0)
+        self.assertEqual(wheel.advance(3.0), ['far'])
+        
+        # A long stall sweeps each slot at most once
+        wheel.schedule('x', 'x', 5.0, now=3.0)
+        self.assertEqual(wheel.advance(1000.0), ['x'])
+
+
+class TestEventLoopRelayServer(TestRelayServer):
+    """Test the single-threaded event-loop relay core"""
+    
+    server_class = 'EventLoopRelayServer'
+    
+    def test_many_idle_peers_one_thread(self):
+        """Test hundreds of idle peers are served without extra threads"""
+        threads_before = threading.active_count()
+        socks = [self._register_raw(f'host{i}', 'server') for i in range(500)]
+        try:
+            self.assertEqual(threading.active_count(), threads_before)
+            self.assertEqual(len(self.relay.peers), 500)
+            
+            probe = self._register_raw('probe', 'client')
+            socks.append(probe)
+            start = time.perf_counter()
+            reply = self._request(probe, {'type': 'list_peers'})
+            list_ms = (time.perf_counter() - start) * 1000
+            self.assertEqual(len(reply['peers']), 100)
+            self.assertIsNotNone(reply['next_cursor'])
+            
+            start = time.perf_counter()
+            reply = self._request(probe, {'type': 'get_peer_info', 'target_id': 'host250'})
+            lookup_ms = (time.perf_counter() - start) * 1000
+            self.assertEqual(reply['peer_id'], 'host250')
+            print(f"  500 idle peers: list {list_ms:.1f} ms, lookup {lookup_ms:.1f} ms")
+        finally:
+            for sock in socks:
+                sock.close()
+
+
+class NatSocket:
+    """
+    UDP socket behind a userspace NAT stand-in
+    
+    Like a port-restricted cone NAT, inbound datagrams are dropped unless
+    this socket has already sent to their source. A symmetric NAT maps
+    each destination to a new public port the peer cannot guess, so only
+    the first destination (the relay) can ever answer.
+    """
+    
+    def __init__(self, symmetric=False):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(('127.0.0.1', 0))
+        self.symmetric = symmetric
+        self.contacted = set()
+        self.dropped = 0
+    
+    def sendto(self, datagram, addr):
+        addr = tuple(addr)
+        if not (self.symmetric and self.contacted):
+            self.contacted.add(addr)
+        return self.sock.sendto(datagram, addr)
+    
+    def recvfrom(self, size):
+        while True:
+            data, addr = self.sock.recvfrom(size)
+            if addr in self.contacted:
+                return data, addr
+            self.dropped += 1
+    
+    def __getattr__(self, name):
+        return getattr(self.sock, name)
+
+
+class TestHolePunch(unittest.TestCase):
+    """Test UDP hole punching and the direct stream it carries"""
+    
+    def test_punch_and_stream(self):
+        """Test both NATs open and a lossy punched path stays reliable"""
+        import secrets
+        from hole_punch import punch, local_endpoints, UdpStream
+        from udp_transport import ImpairedSocket
+        
+        a, b = NatSocket(), NatSocket()
+        # Unsolicited traffic does not get through
+        b.sendto(b'hello', a.getsockname())
+        a.settimeout(0.2)
+        self.assertRaises(socket.timeout, a.recvfrom, 2048)
+        b.contacted.clear()
+        
+        session_id = secrets.token_hex(16)
+        results = {}
+        threads = [
+            threading.Thread(target=lambda: results.update(a=punch(a, local_endpoints(b), session_id))),
+            threading.Thread(target=lambda: results.update(b=punch(b, local_endpoints(a), session_id)))
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(10)
+        self.assertEqual(results['a'], b.getsockname())
+        self.assertEqual(results['b'], a.getsockname())
+        
+        lossy = ImpairedSocket(b, loss_rate=0.05, seed=5)
+        stream_a = UdpStream(a, results['a'])
+        stream_b = UdpStream(lossy, results['b'])
+        try:
+            payload = bytes(range(256)) * 2048
+            threading.Thread(target=stream_b.sendall, args=(payload,), daemon=True).start()
+            received = b''
+            stream_a.settimeout(10)
+            while len(received) < len(payload):
+                chunk = stream_a.recv(65536)
+                self.assertTrue(chunk)
+                received += chunk
+            self.assertEqual(received, payload)
+            self.assertGreater(lossy.dropped, 0)
+            self.assertGreater(stream_b.retransmits, 0)
+            
+            stream_a.sendall(b'frame')
+            stream_b.settimeout(5)
+            self.assertEqual(stream_b.recv(16), b'frame')
+            
+            stream_b.close()
+            self.assertEqual(stream_a.recv(16), b'')
+            print(f"  Dropped {lossy.dropped} datagrams, {stream_b.retransmits} retransmits")
+        finally:
+            stream_a.close()
+            stream_b.close()
+    
+    def test_congestion_window(self):
+        """Test the stream backs off on timeout and resends only the oldest segment"""
+        from hole_punch import (UdpStream, SEGMENT_HEADER, STREAM_MAGIC, SEGMENT_ACK,
+                                INITIAL_CWND, MIN_CWND)
+        
+        peer = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        peer.bind(('127.0.0.1', 0))
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind(('127.0.0.1', 0))
+        stream = UdpStream(sock, peer.getsockname(), segment_size=100)
+        
+        def segments(idle):
+            seqs = []
+            peer.settimeout(idle)
+            try:
+                while True:
+                    data, addr = peer.recvfrom(2048)
+                    seqs.append(SEGMENT_HEADER.unpack_from(data)[2])
+            except socket.timeout:
+                return seqs
+        
+        try:
+            threading.Thread(target=stream.sendall, args=(bytes(100 * 40),), daemon=True).start()
+            # Only the initial congestion window goes out unacknowledged
+            self.assertEqual(segments(0.1), list(range(INITIAL_CWND)))
+            # The timer resends the oldest segment alone and collapses the window
+            self.assertEqual(segments(0.3), [0])
+            self.assertEqual(stream.retransmits, 1)
+            self.assertEqual(stream.cwnd, MIN_CWND)
+            
+            # Acknowledgements open the window again
+            peer.sendto(SEGMENT_HEADER.pack(STREAM_MAGIC, SEGMENT_ACK, 0, INITIAL_CWND),
+                        sock.getsockname())
+            seqs = segments(0.1)
+            self.assertGreater(stream.cwnd, MIN_CWND)
+            self.assertEqual(seqs, list(range(INITIAL_CWND, INITIAL_CWND + int(stream.cwnd))))
+        finally:
+            stream.close()
+            peer.close()
+    
+    def _session(self, symmetric):
+        """Connect a NATed client to a NATed server through the relay"""
+        from relay_server import EventLoopRelayServer
+        from network import NetworkServerWithRelay, NetworkClientWithRelay
+        
+        class NatServer(NetworkServerWithRelay):
+            def create_punch_socket(self):
+                return NatSocket(symmetric=symmetric)
+        
+        class NatClient(NetworkClientWithRelay):
+            def create_punch_socket(self):
+                return NatSocket()
+        
+        relay = EventLoopRelayServer(host='127.0.0.1', port=0)
+        threading.Thread(target=relay.start, daemon=True).start()
+        for _ in range(100):
+            if relay.running:
+                break
+            time.sleep(0.01)
+        relay_port = relay.socket.getsockname()[1]
+        self.addCleanup(relay.stop)
+        
+        server = NatServer(host='127.0.0.1', port=0, relay_host='127.0.0.1',
+                           relay_port=relay_port, peer_id='host')
+        server.start_with_relay()
+        self.addCleanup(server.stop)
+        client = NatClient(relay_host='127.0.0.1', relay_port=relay_port, peer_id='viewer')
+        # Nothing listens there: the direct TCP attempt fails as behind NAT
+        unused = socket.socket()
+        unused.bind(('127.0.0.1', 0))
+        client.server_port = unused.getsockname()[1]
+        unused.close()
+        self.addCleanup(client.disconnect)
+        
+        accepted = []
+        acceptor = threading.Thread(target=lambda: accepted.append(server.accept_connection()))
+        acceptor.start()
+        self.assertTrue(client.connect_via_relay('host'))
+        acceptor.join(15)
+        self.assertEqual(accepted, [True])
+        
+        from PIL import Image
+        buffer = BytesIO()
+        Image.new('RGB', (64, 48), color='blue').save(buffer, format='JPEG')
+        self.assertTrue(server.send_frame(64, 48, buffer.getvalue()))
+        self.assertEqual(client.receive_frame().size, (64, 48))
+        self.assertTrue(client.send_command('key_press', {'key': 'a'}))
+        self.assertEqual(server.receive_command()['type'], 'key_press')
+        return server, client
+    
+    def test_session_over_punched_path(self):
+        """Test a session runs over the punched path when both NATs allow it"""
+        from hole_punch import UdpStream
+        
+        server, client = self._session(symmetric=False)
+        self.assertIsInstance(client.socket, UdpStream)
+        self.assertIsInstance(server.client_socket, UdpStream)
+    
+    def test_file_transfer_over_punched_path(self):
+        """Test files go both ways over a punched path (no sendfile or select)"""
+        import tempfile
+        import shutil
+        from file_transfer import CHUNK_SIZE
+        
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, True)
+        remote = os.path.join(directory, 'server', 'notes.bin')
+        local = os.path.join(directory, 'photo.bin')
+        os.makedirs(os.path.dirname(remote))
+        for path, size in ((remote, 5 * CHUNK_SIZE + 7), (local, 3 * CHUNK_SIZE)):
+            with open(path, 'wb') as f:
+                f.write(os.urandom(size))
+        
+        server, client = self._session(symmetric=False)
+        server.transfer_dir = os.path.dirname(remote)
+        saved = os.path.join(directory, 'notes.bin')
+        ids = []
+        
+        def start():
+            ids.append(client.download('notes.bin', saved))
+            ids.append(client.upload(local, 'photo.bin'))
+        
+        events, frames = stream_transfers(server, client, start, 2, timeout=20)
+        self.assertEqual(events, {ids[0]: 'done', ids[1]: 'done'})
+        for source, copy in ((remote, saved),
+                             (local, os.path.join(directory, 'server', 'photo.bin'))):
+            with open(source, 'rb') as a, open(copy, 'rb') as b:
+                self.assertEqual(a.read(), b.read())
+        self.assertGreater(frames, 0)
+    
+    def test_symmetric_nat_falls_back_to_relay(self):
+        """Test a session falls back to the relay stream when punching fails"""
+        from hole_punch import UdpStream
+        
+        server, client = self._session(symmetric=True)
+        self.assertNotIsInstance(client.socket, UdpStream)
+        self.assertNotIsInstance(server.client_socket, UdpStream)
+
+
+class TestRelayLoadgen(unittest.TestCase):
+    """Test the relay load generator's mixed scenario"""
+    
+    def test_mixed_load(self):
+        """Test every request kind is answered and measured"""
+        from relay_server import EventLoopRelayServer
+        from relay_loadgen import run_mixed, compare_results, OPERATIONS
+        
+        relay = EventLoopRelayServer(host='127.0.0.1', port=0)
+        thread = threading.Thread(target=relay.start, daemon=True)
+        thread.start()
+        for _ in range(100):
+            if relay.running:
+                break
+            time.sleep(0.01)
+        try:
+            rates = {'list': 20, 'lookup': 50, 'relay': 100}
+            results = run_mixed('127.0.0.1', relay.socket.getsockname()[1], 20, rates,
+                                duration=0.5, heartbeat_interval=0.5, relay_pid=os.getpid())
+        finally:
+            relay.stop()
+            thread.join(2)
+        
+        self.assertEqual(results['peers'], 20)
+        self.assertEqual(set(results['operations']), set(OPERATIONS))
+        for kind, figures in results['operations'].items():
+            self.assertGreater(figures['completed'], 0, kind)
+            self.assertEqual(figures['completed'], figures['sent'], kind)
+            self.assertEqual(figures['errors'] + figures['lost'], 0, kind)
+            self.assertLessEqual(figures['p50_ms'], figures['p99_ms'])
+            self.assertLessEqual(figures['p99_ms'], figures['p999_ms'])
+        self.assertIsNotNone(results['register']['p50_ms'])
+        if sys.platform.startswith('linux'):
+            self.assertGreaterEqual(results['relay']['fds'], 20)
+        
+        # Run-over-run comparison
+        import json
+        faster = json.loads(json.dumps(results))
+        faster['operations']['relay']['p99_ms'] = results['operations']['relay']['p99_ms'] / 2
+        rows = {name: change for name, _, _, change in compare_results(results, faster)}
+        self.assertEqual(rows['operations.relay.p99_ms'], -50.0)
+        self.assertEqual(rows['operations.relay.sent'], 0.0)
+
+
+class TestRelayCluster(unittest.TestCase):
+    """Test relay workers sharing a peer registry"""
+    
+    def setUp(self):
+        import tempfile
+        from relay_cluster import RelayWorker, SharedPeerRegistry
+        self.run_dir = tempfile.mkdtemp()
+        registry_path = f'{self.run_dir}/registry.db'
+        SharedPeerRegistry.create(registry_path)
+        
+        # Separate ports so each test peer lands on a known worker
+        self.workers = [RelayWorker(i, '127.0.0.1', 0, self.run_dir, registry_path)
+                        for i in range(2)]
+        for worker in self.workers:
+            threading.Thread(target=worker.start, daemon=True).start()
+        for worker in self.workers:
+            for _ in range(200):
+                if worker.mailbox is not None:
+                    break
+                time.sleep(0.01)
+        self.clients = []
+    
+    def tearDown(self):
+        import shutil
+        for client in self.clients:
+            client.disconnect()
+        for worker in self.workers:
+            worker.stop()
+        time.sleep(0.2)
+        shutil.rmtree(self.run_dir, ignore_errors=True)
+    
+    def _peer(self, worker, peer_id, peer_type):
+        from relay_client import RelayClient
+        client = RelayClient('127.0.0.1', worker.socket.getsockname()[1])
+        self.assertTrue(client.connect(peer_id, peer_type))
+        self.clients.append(client)
+        return client
+    
+    def _wait_for(self, items):
+        for _ in range(200):
+            if items:
+                return items[0]
+            time.sleep(0.01)
+        self.fail('timed out')
+    
+    def test_cross_worker_lookup(self):
+        """Test a peer on one worker can find and notify a peer on another"""
+        from relay_loadgen import request
+        host = self._peer(self.workers[0], 'host', 'server')
+        requests = []
+        host.set_callback('connection_request', requests.append)
+        
+        viewer = socket.create_connection(('127.0.0.1', self.workers[1].socket.getsockname()[1]))
+        viewer.settimeout(5)
+        try:
+            request(viewer, {'type': 'register', 'peer_id': 'viewer', 'peer_type': 'client'})
+            reply = request(viewer, {'type': 'list_peers'})
+            self.assertEqual([p['peer_id'] for p in reply['peers']], ['host'])
+            reply = request(viewer, {'type': 'get_peer_info', 'target_id': 'host'})
+            self.assertEqual(reply['peer_id'], 'host')
+            self.assertEqual(self._wait_for(requests)['from_peer_id'], 'viewer')
+        finally:
+            viewer.close()
+    
+    def test_locked_registry_does_not_stall_loop(self):
+        """Test workers keep answering while the shared registry is write-locked"""
+        import sqlite3
+        from relay_loadgen import request, recv_message
+        from relay_server import encode_message
+        self._peer(self.workers[0], 'host', 'server')
+        port = self.workers[1].socket.getsockname()[1]
+        viewer = socket.create_connection(('127.0.0.1', port))
+        viewer.settimeout(5)
+        pending = socket.create_connection(('127.0.0.1', port))
+        pending.settimeout(5)
+        
+        lock = sqlite3.connect(f'{self.run_dir}/registry.db', isolation_level=None)
+        try:
+            request(viewer, {'type': 'register', 'peer_id': 'viewer', 'peer_type': 'client'})
+            lock.execute('BEGIN IMMEDIATE')
+            # This registration waits for the lock on the writer thread...
+            pending.sendall(encode_message({'type': 'register', 'peer_id': 'late',
+                                            'peer_type': 'server'}))
+            time.sleep(0.1)
+            # ...while lookups on the same worker are still answered
+            start = time.perf_counter()
+            reply = request(viewer, {'type': 'get_peer_info', 'target_id': 'host'})
+            self.assertEqual(reply['peer_id'], 'host')
+            self.assertLess(time.perf_counter() - start, 1.0)
+            lock.execute('ROLLBACK')
+            self.assertEqual(recv_message(pending)['type'], 'registered')
+        finally:
+            lock.close()
+            viewer.close()
+            pending.close()
+    
+    def test_cross_worker_presence(self):
+        """Test presence updates reach subscribers on other workers"""
+        viewer = self._peer(self.workers[1], 'viewer', 'client')
+        directory = viewer.subscribe(peer_type='server')
+        self.assertEqual(directory.list(), [])
+        
+        self._peer(self.workers[0], 'host', 'server')
+        for _ in range(200):
+            if directory.list():
+                break
+            time.sleep(0.01)
+        self.assertEqual([p['peer_id'] for p in directory.list()], ['host'])
+        
+        self.clients[-1].disconnect()
+        for _ in range(200):
+            if not directory.list():
+                break
+            time.sleep(0.01)
+        self.assertEqual(directory.list(), [])
+    
+    def test_cross_worker_stream(self):
+        """Test a stream pairs peers attached through different workers"""
+        host = self._peer(self.workers[0], 'host', 'server')
+        attached = []
+        host.set_callback('stream_request',
+                          lambda msg: attached.append(host.open_stream(msg['session_id'])))
+        viewer = self._peer(self.workers[1], 'viewer', 'client')
+        
+        viewer_sock = viewer.request_stream('host')
+        self.assertIsNotNone(viewer_sock)
+        host_sock = self._wait_for(attached)
+        self.assertIsNotNone(host_sock)
+        
+        viewer_sock.sendall(b'ping')
+        self.assertEqual(host_sock.recv(16), b'ping')
+        host_sock.sendall(b'pong')
+        self.assertEqual(viewer_sock.recv(16), b'pong')
+        viewer_sock.close()
+        host_sock.close()
+    
+    def test_reuseport_cluster(self):
+        """Test worker processes on one port see every registered peer"""
+        from relay_cluster import RelayCluster
+        from relay_loadgen import request
+        
+        probe = socket.socket()
+        probe.bind(('127.0.0.1', 0))
+        port = probe.getsockname()[1]
+        probe.close()
+        
+        cluster = RelayCluster('127.0.0.1', port, workers=2)
+        cluster.start()
+        socks = []
+        try:
+            for _ in range(100):
+                try:
+                    socket.create_connection(('127.0.0.1', port)).close()
+                    break
+                except OSError:
+                    time.sleep(0.05)
+            time.sleep(0.3)
+            
+            for i in range(20):
+                sock = socket.create_connection(('127.0.0.1', port))
+                sock.settimeout(5)
+                reply = request(sock, {'type': 'register', 'peer_id': f'host{i}',
+                                       'peer_type': 'server'})
+                self.assertEqual(reply['type'], 'registered')
+                socks.append(sock)
+            
+            viewer = socket.create_connection(('127.0.0.1', port))
+            viewer.settimeout(5)
+            socks.append(viewer)
+            request(viewer, {'type': 'register', 'peer_id': 'viewer', 'peer_type': 'client'})
+            reply = request(viewer, {'type': 'list_peers'})
+            self.assertEqual(len(reply['peers']), 20)
+            reply = request(viewer, {'type': 'get_peer_info', 'target_id': 'host7'})
+            self.assertEqual(reply['peer_id'], 'host7')
+        finally:
+            for sock in socks:
+                sock.close()
+            cluster.stop()
+
+
 def run_tests():
     """Run all tests with custom output"""
     print("=" * 70)
@@ -295,11 +2998,33 @@ def run_tests():
     # Add test classes
     suite.addTests(loader.loadTestsFromTestCase(TestPlatformUtils))
     suite.addTests(loader.loadTestsFromTestCase(TestImports))
+    suite.addTests(loader.loadTestsFromTestCase(TestStartup))
+    suite.addTests(loader.loadTestsFromTestCase(TestMicroBenchmarks))
     suite.addTests(loader.loadTestsFromTestCase(TestScreenCapture))
+    suite.addTests(loader.loadTestsFromTestCase(TestProfiling))
     suite.addTests(loader.loadTestsFromTestCase(TestInputControl))
     suite.addTests(loader.loadTestsFromTestCase(TestNetworkProtocol))
     suite.addTests(loader.loadTestsFromTestCase(TestNetworkCommunication))
     suite.addTests(loader.loadTestsFromTestCase(TestImageProcessing))
+    suite.addTests(loader.loadTestsFromTestCase(TestScrollDetect))
+    suite.addTests(loader.loadTestsFromTestCase(TestTileCache))
+    suite.addTests(loader.loadTestsFromTestCase(TestIdleScreen))
+    suite.addTests(loader.loadTestsFromTestCase(TestColorModes))
+    suite.addTests(loader.loadTestsFromTestCase(TestProgressiveRefinement))
+    suite.addTests(loader.loadTestsFromTestCase(TestVideoCodec))
+    suite.addTests(loader.loadTestsFromTestCase(TestDamageRegions))
+    suite.addTests(loader.loadTestsFromTestCase(TestX11DamageCapture))
+    suite.addTests(loader.loadTestsFromTestCase(TestShmTransport))
+    suite.addTests(loader.loadTestsFromTestCase(TestFileTransfer))
+    suite.addTests(loader.loadTestsFromTestCase(TestUdpTransport))
+    suite.addTests(loader.loadTestsFromTestCase(TestSessionResume))
+    suite.addTests(loader.loadTestsFromTestCase(TestDaemon))
+    suite.addTests(loader.loadTestsFromTestCase(TestRelayServer))
+    suite.addTests(loader.loadTestsFromTestCase(TestTimingWheel))
+    suite.addTests(loader.loadTestsFromTestCase(TestEventLoopRelayServer))
+    suite.addTests(loader.loadTestsFromTestCase(TestHolePunch))
+    suite.addTests(loader.loadTestsFromTestCase(TestRelayCluster))
+    suite.addTests(loader.loadTestsFromTestCase(TestRelayLoadgen))
     
     # Run tests
     runner = unittest.TextTestRunner(verbosity=2)
@@ -0,0 +1,287 @@
+"""
+LiteDesk - Tile Cache Module
+
+Content-addressed bitmap cache in the style of RDP. The screen is cut into
+fixed tiles; the server hashes every tile it sends (BLAKE2) and remembers
+which ones the client holds. When a window the client saw earlier comes
+back (alt-tab, a dialog toggled), its tiles go out as short cache
+references instead of pixels.
+
+The client stores decoded tiles in slots chosen by the server. The server
+runs the LRU for both sides and names the slot each new tile goes into,
+so eviction can never drift out of sync: the client overwrites exactly
+the slot the server evicted. Changed tiles are found by comparing each
+capture with the previous one, which is what the client shows. Requires
+NumPy.
+
+Tiles go out at motion quality first. A tile that then stays unchanged
+for REFINE_AFTER captures is sent again, sharp, into the same slot
+(progressive refinement), so moving content stays cheap and still
+content ends up crisp.
+"""
+import hashlib
+import struct
+from collections import OrderedDict, namedtuple
+
+try:
+    import numpy as np
+    NUMPY_AVAILABLE = True
+except ImportError:
+    NUMPY_AVAILABLE = False
+
+
+# Tile edge in pixels (a multiple of 16 keeps JPEG blocks inside one tile)
+TILE_SIZE = 64
+
+# New tiles per row of the atlas image carrying their pixels
+ATLAS_COLUMNS = 16
+
+# Captures a tile must stay unchanged before it is refined
+REFINE_AFTER = 3
+
+
+class TileUpdate(namedtuple('TileUpdate', 'width height tile_size columns reset entries')):
+    """
+    Tiles to draw over the client's framebuffer
+    
+    entries are (col, row, slot, new) tuples. A new tile takes the next
+    cell of the atlas (columns cells per row) and is stored in the slot; a
+    cached one is drawn from the slot. reset starts from an empty cache.
+    """
+    __slots__ = ()
+    kind = 'tiles'
+
+
+class TileCache:
+    """Deterministic LRU assigning client cache slots to tile hashes"""
+    
+    def __init__(self, capacity):
+        """
+        Initialize cache
+        
+        Args:
+            capacity: Slots the client has agreed to keep
+        """
+        self.capacity = capacity
+        self.slots = OrderedDict()  # digest -> slot, least recently used first
+        self.sharp = set()  # digests whose slot holds a refined copy
+    
+    def lookup(self, digest):
+        """
+        Slot holding a tile, marking it recently used
+        
+        Returns:
+            int: Slot, or None if the client does not hold the tile
+        """
+        slot = self.slots.get(digest)
+        if slot is not None:
+            self.slots.move_to_end(digest)
+        return slot
+    
+    def insert(self, digest):
+        """
+        Choose the slot a new tile goes into, evicting the least recently used
+        
+        Returns:
+            int: Slot the client must store the tile in
+        """
+        if len(self.slots) < self.capacity:
+            slot = len(self.slots)
+        else:
+            evicted, slot = self.slots.popitem(last=False)
+            self.sharp.discard(evicted)
+        self.slots[digest] = slot
+        return slot
+    
+    def __len__(self):
+        return len(self.slots)
+
+
+def tile_digest(pixels):
+    """Content hash of a tile (its shape included, so edge tiles never collide)"""
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(struct.pack('!HH', pixels.shape[0], pixels.shape[1]))
+    digest.update(pixels.tobytes())
+    return digest.digest()
+
+
+def dirty_tiles(prev, cur, tile_size=TILE_SIZE, regions=None):
+    """
+    Tiles whose pixels differ between two captures
+    
+    Args:
+        prev: Previous capture, (height, width, 3) uint8 array
+        cur: Current capture of the same shape
+        tile_size: Tile edge in pixels
+        regions: (x, y, w, h) rectangles outside which nothing changed,
+            when the capture backend knows (None: compare everything)
+    
+    Returns:
+        list: (col, row) of each changed tile, row by row
+    """
+    if regions is not None:
+        dirty = set()
+        for x, y, w, h in regions:
+            # Start on the tile grid so tile numbers carry over
+            left, top = x - x % tile_size, y - y % tile_size
+            found = dirty_tiles(prev[top:y + h, left:x + w], cur[top:y + h, left:x + w], tile_size)
+            dirty.update((col + left // tile_size, row + top // tile_size) for col, row in found)
+        return sorted(dirty, key=lambda position: (position[1], position[0]))
+    
+    height, width = cur.shape[:2]
+    starts = np.arange(0, width, tile_size)
+    dirty = []
+    for row, y in enumerate(range(0, height, tile_size)):
+        band = prev[y:y + tile_size] != cur[y:y + tile_size]
+        # any() over the long axis first: reducing the 3 channels is slow
+        columns = band.any(axis=0).any(axis=1)
+        changed = np.add.reduceat(columns, starts) > 0
+        dirty.extend((int(col), row) for col in np.flatnonzero(changed))
+    return dirty
+
+
+class TileEncoder:
+    """Turns captures into tile updates against one client's cache"""
+    
+    def __init__(self, capacity, tile_size=TILE_SIZE, refine_after=REFINE_AFTER):
+        """
+        Initialize encoder
+        
+        Args:
+            capacity: Tiles the client caches (negotiated at connect, see
+                network.TILE_CACHE_TILES)
+            tile_size: Tile edge in pixels
+            refine_after: Captures a tile must stay unchanged before refinement
+        """
+        self.capacity = capacity
+        self.tile_size = tile_size
+        self.refine_after = refine_after
+        self.cache = TileCache(capacity)
+        self.previous = None
+        self.settling = {}  # (col, row) shown at motion quality -> captures unchanged
+    
+    def reset(self):
+        """Start over: the next update redraws every tile into an empty cache"""
+        self.previous = None
+    
+    def sync(self, pixels, regions=None):
+        """Record what the client shows after an update sent another way"""
+        if self.previous is not None and self.previous.shape == pixels.shape:
+            self.age(dirty_tiles(self.previous, pixels, self.tile_size, regions))
+            self.previous = pixels
+    
+    def age(self, changed=()):
+        """
+        Count a capture towards refinement
+        
+        Args:
+            changed: (col, row) of tiles just redrawn at motion quality
+        """
+        settling = self.settling
+        for position in settling:
+            settling[position] += 1
+        for position in changed:
+            settling[position] = 0
+    
+    def _tile(self, pixels, col, row):
+        """Pixels of one tile (smaller at the right and bottom edges)"""
+        size = self.tile_size
+        return pixels[row * size:(row + 1) * size, col * size:(col + 1) * size]
+    
+    def update(self, pixels, regions=None):
+        """
+        Tile update taking the client from the previous capture to this one
+        
+        Args:
+            pixels: Capture as a (height, width, 3) uint8 array
+            regions: (x, y, w, h) rectangles outside which nothing changed
+                since the previous capture (None: compare everything)
+        
+        Returns:
+            tuple: (TileUpdate, atlas) where atlas is an array holding the
+            new tiles' pixels, or None when every tile came from the cache
+        """
+        height, width = pixels.shape[:2]
+        size = self.tile_size
+        prev, self.previous = self.previous, pixels
+        reset = prev is None or prev.shape != pixels.shape
+        if reset:
+            self.cache = TileCache(self.capacity)
+            self.settling = {}
+            positions = [(col, row) for row in range(-(-height // size))
+                         for col in range(-(-width // size))]
+        else:
+            positions = dirty_tiles(prev, pixels, size, regions)
+        
+        self.age(positions)
+        entries = []
+        new_tiles = []
+        for col, row in positions:
+            tile = self._tile(pixels, col, row)
+            digest = tile_digest(tile)
+            slot = self.cache.lookup(digest)
+            if slot is None:
+                slot = self.cache.insert(digest)
+                new_tiles.append(tile)
+                entries.append((col, row, slot, True))
+            else:
+                entries.append((col, row, slot, False))
+                if digest in self.cache.sharp:
+                    # Drawn from a refined copy: nothing left to refine
+                    del self.settling[(col, row)]
+        return self._pack(width, height, reset, entries, new_tiles)
+    
+    def refinement(self):
+        """
+        Resend sharp the tiles that stayed unchanged for refine_after captures
+        
+        Each goes into the slot that holds its content, so the cache keeps
+        the refined copy for the next time the tile comes back.
+        
+        Returns:
+            tuple: (TileUpdate, atlas) to send at high quality, or None
+            when nothing is due
+        """
+        due = [position for position, captures in self.settling.items()
+               if captures >= self.refine_after]
+        if not due or self.previous is None:
+            return None
+        
+        entries = []
+        new_tiles = []
+        for col, row in sorted(due, key=lambda position: (position[1], position[0])):
+            del self.settling[(col, row)]
+            tile = self._tile(self.previous, col, row)
+            digest = tile_digest(tile)
+            slot = self.cache.lookup(digest)
+            if slot is None:
+                slot = self.cache.insert(digest)
+            if digest in self.cache.sharp:
+                entries.append((col, row, slot, False))
+            else:
+                self.cache.sharp.add(digest)
+                new_tiles.append(tile)
+                entries.append((col, row, slot, True))
+        height, width = self.previous.shape[:2]
+        return self._pack(width, height, False, entries, new_tiles)
+    
+    def _pack(self, width, height, reset, entries, new_tiles):
+        """Build the TileUpdate and the atlas of its new tiles"""
+        size = self.tile_size
+        columns = min(ATLAS_COLUMNS, len(new_tiles)) or 1
+        update = TileUpdate(width, height, size, columns, reset, entries)
+        if not new_tiles:
+            return update, None
+        
+        rows = -(-len(new_tiles) // columns)
+        atlas = np.empty((rows * size, columns * size, 3), dtype=np.uint8)
+        for index, tile in enumerate(new_tiles):
+            y, x = (index // columns) * size, (index % columns) * size
+            th, tw = tile.shape[:2]
+            if (th, tw) != (size, size):
+                # Edge tile: repeat its border so JPEG does not bleed black into it
+                tile = np.pad(tile, ((0, size - th), (0, size - tw), (0, 0)), mode='edge')
+            atlas[y:y + size, x:x + size] = tile
+        # Unused cells of the last row
+        atlas[(rows - 1) * size:, (len(new_tiles) - (rows - 1) * columns) * size:] = 0
+        return update, atlas
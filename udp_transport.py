@@ -0,0 +1,275 @@
+"""
+LiteDesk - UDP Transport Module
+
+Optional UDP transport for screen frames. Frames are split into
+datagrams carrying sequence numbers, protected by XOR parity (one parity
+datagram per group of data fragments) and reassembled on the receiver
+with a bounded wait. Input commands stay on the reliable TCP channel.
+"""
+import random
+import socket
+import struct
+import time
+
+
+# Datagram header: kind, frame id, index, data fragment count,
+# FEC group size, total frame length
+DATAGRAM_HEADER = struct.Struct('!BIHHHI')
+
+KIND_DATA = 0
+KIND_PARITY = 1
+
+DEFAULT_FRAGMENT_SIZE = 1200
+DEFAULT_FEC_GROUP = 4
+DEFAULT_MAX_WAIT = 0.1
+
+
+def _xor_bytes(a, b):
+    """XOR two equal-length byte strings"""
+    return (int.from_bytes(a, 'big') ^ int.from_bytes(b, 'big')).to_bytes(len(a), 'big')
+
+
+class ImpairedSocket:
+    """
+    UDP socket wrapper that emulates packet loss and reordering
+    
+    Used to exercise the transport on loopback.
+    """
+    
+    def __init__(self, sock, loss_rate=0.0, reorder_rate=0.0, seed=None):
+        """
+        Initialize impaired socket
+        
+        Args:
+            sock: Underlying UDP socket
+            loss_rate: Probability (0-1) of dropping a datagram
+            reorder_rate: Probability (0-1) of delaying a datagram past the next one
+            seed: Random seed for reproducible runs
+        """
+        self.sock = sock
+        self.loss_rate = loss_rate
+        self.reorder_rate = reorder_rate
+        self.random = random.Random(seed)
+        self.held = None
+        self.dropped = 0
+    
+    def sendto(self, datagram, addr):
+        """Send a datagram, possibly dropping or reordering it"""
+        if self.random.random() < self.loss_rate:
+            self.dropped += 1
+            return
+        if self.held is None and self.random.random() < self.reorder_rate:
+            self.held = (datagram, addr)
+            return
+        self.sock.sendto(datagram, addr)
+        if self.held is not None:
+            self.sock.sendto(*self.held)
+            self.held = None
+    
+    def flush(self):
+        """Send any datagram held back for reordering"""
+        if self.held is not None:
+            self.sock.sendto(*self.held)
+            self.held = None
+    
+    def __getattr__(self, name):
+        # Receiving and socket options go straight to the real socket
+        return getattr(self.sock, name)
+
+
+class UdpFrameSender:
+    """Fragments frames into datagrams with XOR parity"""
+    
+    def __init__(self, sock, addr, fragment_size=DEFAULT_FRAGMENT_SIZE,
+                 fec_group=DEFAULT_FEC_GROUP):
+        """
+        Initialize frame sender
+        
+        Args:
+            sock: UDP socket (or ImpairedSocket) used for sending
+            addr: (host, port) of the receiver
+            fragment_size: Payload bytes per datagram
+            fec_group: Data fragments per parity datagram (0 disables FEC)
+        """
+        self.sock = sock
+        self.addr = addr
+        self.fragment_size = fragment_size
+        self.fec_group = fec_group
+        self.frame_id = 0
+    
+    def send_frame(self, payload):
+        """
+        Send one frame as a burst of datagrams
+        
+        Args:
+            payload: Frame bytes (frame header followed by image data)
+        """
+        self.frame_id = (self.frame_id + 1) & 0xFFFFFFFF
+        size = self.fragment_size
+        fragments = [payload[i:i + size] for i in range(0, len(payload), size)] or [b'']
+        count = len(fragments)
+        group = self.fec_group
+        
+        parity = None
+        for index, fragment in enumerate(fragments):
+            header = DATAGRAM_HEADER.pack(KIND_DATA, self.frame_id, index,
+                                          count, group, len(payload))
+            self.sock.sendto(header + fragment, self.addr)
+            
+            if group:
+                padded = fragment.ljust(size, b'\0')
+                parity = padded if parity is None else _xor_bytes(parity, padded)
+                if (index + 1) % group == 0 or index == count - 1:
+                    header = DATAGRAM_HEADER.pack(KIND_PARITY, self.frame_id,
+                                                  index // group, count, group,
+                                                  len(payload))
+                    self.sock.sendto(header + parity, self.addr)
+                    parity = None
+        
+        if hasattr(self.sock, 'flush'):
+            self.sock.flush()
+
+
+class _PendingFrame:
+    """Reassembly state for one frame"""
+    
+    def __init__(self, count, group, length):
+        self.count = count
+        self.group = group
+        self.length = length
+        self.fragments = {}
+        self.parity = {}
+        self.first_seen = time.monotonic()
+    
+    def fragment_length(self, index, size):
+        """Length of a data fragment, derived from the frame length"""
+        return min(size, self.length - index * size)
+    
+    def recover(self, size):
+        """Rebuild single missing fragments from parity where possible"""
+        for group_index, parity in self.parity.items():
+            start = group_index * self.group
+            members = range(start, min(start + self.group, self.count))
+            missing = [i for i in members if i not in self.fragments]
+            if len(missing) != 1:
+                continue
+            data = parity
+            for i in members:
+                if i != missing[0]:
+                    data = _xor_bytes(data, self.fragments[i].ljust(size, b'\0'))
+            self.fragments[missing[0]] = data[:self.fragment_length(missing[0], size)]
+    
+    def complete(self):
+        return len(self.fragments) == self.count
+    
+    def assemble(self):
+        return b''.join(self.fragments[i] for i in range(self.count))
+
+
+class UdpFrameReceiver:
+    """Reassembles frames from datagrams, recovering losses with parity"""
+    
+    def __init__(self, sock, fragment_size=DEFAULT_FRAGMENT_SIZE,
+                 max_wait=DEFAULT_MAX_WAIT, on_loss=None):
+        """
+        Initialize frame receiver
+        
+        Args:
+            sock: Bound UDP socket
+            fragment_size: Payload bytes per datagram (must match sender)
+            max_wait: Seconds to wait for missing fragments of a frame
+            on_loss: Callback invoked when a frame cannot be recovered
+        """
+        self.sock = sock
+        self.fragment_size = fragment_size
+        self.max_wait = max_wait
+        self.on_loss = on_loss
+        self.pending = {}
+        self.last_frame_id = 0
+        self.frames_received = 0
+        self.frames_recovered = 0
+        self.frames_lost = 0
+    
+    def receive_frame(self, timeout=1.0):
+        """
+        Receive the next complete frame
+        
+        Args:
+            timeout: Seconds to wait before giving up
+        
+        Returns:
+            bytes: Frame payload, or None on timeout
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            self._expire()
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+            
+            self.sock.settimeout(min(remaining, self.max_wait))
+            try:
+                datagram = self.sock.recv(65535)
+            except socket.timeout:
+                continue
+            
+            frame = self._handle_datagram(datagram)
+            if frame is not None:
+                return frame
+    
+    def _handle_datagram(self, datagram):
+        """Store one datagram and return a frame if it completes one"""
+        if len(datagram) < DATAGRAM_HEADER.size:
+            return None
+        kind, frame_id, index, count, group, length = DATAGRAM_HEADER.unpack_from(datagram)
+        if self._is_stale(frame_id):
+            return None
+        
+        pending = self.pending.get(frame_id)
+        if pending is None:
+            pending = _PendingFrame(count, group, length)
+            self.pending[frame_id] = pending
+        
+        body = datagram[DATAGRAM_HEADER.size:]
+        if kind == KIND_DATA:
+            pending.fragments[index] = body
+        else:
+            pending.parity[index] = body
+        
+        if not pending.complete() and pending.parity:
+            pending.recover(self.fragment_size)
+            if pending.complete():
+                self.frames_recovered += 1
+        
+        if not pending.complete():
+            return None
+        
+        del self.pending[frame_id]
+        # Any older frame still pending is superseded by this one
+        for old_id in [f for f in self.pending if self._precedes(f, frame_id)]:
+            del self.pending[old_id]
+            self._lost()
+        self.last_frame_id = frame_id
+        self.frames_received += 1
+        return pending.assemble()
+    
+    def _expire(self):
+        """Drop frames that have waited longer than max_wait"""
+        now = time.monotonic()
+        for frame_id, pending in list(self.pending.items()):
+            if now - pending.first_seen > self.max_wait:
+                del self.pending[frame_id]
+                self._lost()
+    
+    def _lost(self):
+        self.frames_lost += 1
+        if self.on_loss:
+            self.on_loss()
+    
+    def _is_stale(self, frame_id):
+        return frame_id == self.last_frame_id or self._precedes(frame_id, self.last_frame_id)
+    
+    @staticmethod
+    def _precedes(a, b):
+        """True if frame id a comes before b (with wrap-around)"""
+        return a != b and ((b - a) & 0xFFFFFFFF) < 0x80000000
@@ -0,0 +1,196 @@
+"""
+LiteDesk - Video Codec Module
+
+Inter-frame video for screens that play video or animations, where a
+JPEG per frame costs the most. Frames go through a software codec from
+libav via PyAV, on the CPU only: H.264 from x264 (ultrafast preset,
+zerolatency tune) or VP8 from libvpx (realtime deadline). After a
+keyframe each frame only codes what changed since the one before, so
+frames must be decoded in order; a decoder that lost one asks for a new
+keyframe and shows nothing until it arrives.
+
+Requires PyAV (pip install av).
+"""
+from collections import namedtuple
+from fractions import Fraction
+from PIL import Image
+
+try:
+    import av
+    AV_AVAILABLE = True
+except ImportError:
+    AV_AVAILABLE = False
+
+
+# Codec name on the wire -> (libav encoder, libav decoder, encoder options)
+CODECS = {
+    'h264': ('libx264', 'h264', {'preset': 'ultrafast', 'tune': 'zerolatency',
+                                 'forced-idr': '1'}),
+    'vp8': ('libvpx', 'vp8', {'deadline': 'realtime', 'cpu-used': '8',
+                              'lag-in-frames': '0', 'b': '10M'}),
+}
+
+# Constant-quality range of each codec (best, worst), mapped onto JPEG quality
+CRF_RANGE = {
+    'h264': (8, 44),
+    'vp8': (4, 56),
+}
+
+# Frames between keyframes when none is requested
+KEYFRAME_INTERVAL = 300
+
+
+class VideoUpdate(namedtuple('VideoUpdate', 'codec keyframe')):
+    """One compressed frame of the video stream; keyframes decode on their own"""
+    __slots__ = ()
+    kind = 'video'
+
+
+def crf_for_quality(codec, quality):
+    """
+    Constant rate factor giving about the picture of a JPEG quality
+    
+    Args:
+        codec: Key of CODECS
+        quality: JPEG quality (1-100)
+    
+    Returns:
+        int: CRF for the codec (lower is better)
+    """
+    best, worst = CRF_RANGE[codec]
+    return round(worst - (worst - best) * max(1, min(quality, 100)) / 100)
+
+
+def decodable_codecs():
+    """
+    Codecs this machine can decode
+    
+    Returns:
+        list: Keys of CODECS whose libav decoder is available
+    """
+    if not AV_AVAILABLE:
+        return []
+    return [codec for codec, (_, decoder, _) in CODECS.items()
+            if decoder in av.codecs_available]
+
+
+class VideoEncoder:
+    """Encodes captures of one client's stream"""
+    
+    def __init__(self, codec='h264', fps=10):
+        """
+        Initialize encoder
+        
+        Args:
+            codec: Key of CODECS
+            fps: Expected frame rate (guides the encoder's rate control)
+        
+        Raises:
+            RuntimeError: PyAV is not installed
+        """
+        if not AV_AVAILABLE:
+            raise RuntimeError("Video streaming requires PyAV: pip install av")
+        if codec not in CODECS:
+            raise ValueError(f"Unknown video codec: {codec}")
+        self.codec = codec
+        self.fps = fps
+        self.context = None
+        self.settings = None  # (width, height, quality) the context was opened for
+        self.pts = 0
+        self.keyframe_wanted = True
+    
+    def request_keyframe(self):
+        """Make the next frame a keyframe"""
+        self.keyframe_wanted = True
+    
+    def _open(self, width, height, quality):
+        """Start a new stream (the first frame is a keyframe)"""
+        encoder, _, options = CODECS[self.codec]
+        context = av.CodecContext.create(encoder, 'w')
+        context.width, context.height = width, height
+        context.pix_fmt = 'yuv420p'
+        context.time_base = Fraction(1, self.fps)
+        context.framerate = Fraction(self.fps)
+        context.gop_size = KEYFRAME_INTERVAL
+        context.options = dict(options, crf=str(crf_for_quality(self.codec, quality)))
+        self.context = context
+        self.settings = (width, height, quality)
+        self.pts = 0
+        self.keyframe_wanted = True
+    
+    def encode(self, img, quality):
+        """
+        Encode the next frame
+        
+        Args:
+            img: Capture as an RGB PIL Image
+            quality: JPEG-equivalent quality; a change restarts the stream
+        
+        Returns:
+            tuple: (data, VideoUpdate), or None if the encoder produced
+            nothing for this frame
+        """
+        width, height = img.size
+        # 4:2:0 chroma needs even dimensions; the decoder crops the padding
+        even = (width + 1) & ~1, (height + 1) & ~1
+        if even != img.size:
+            padded = Image.new('RGB', even)
+            padded.paste(img, (0, 0))
+            img = padded
+        if self.settings != (even[0], even[1], quality):
+            self._open(even[0], even[1], quality)
+        
+        frame = av.VideoFrame.from_image(img)
+        frame.pts = self.pts
+        self.pts += 1
+        if self.keyframe_wanted:
+            frame.pict_type = av.video.frame.PictureType.I
+            self.keyframe_wanted = False
+        
+        packets = self.context.encode(frame)
+        data = b''.join(bytes(packet) for packet in packets)
+        if not data:
+            return None
+        return data, VideoUpdate(self.codec, any(packet.is_keyframe for packet in packets))
+
+
+class VideoDecoder:
+    """Decodes the video stream on the client"""
+    
+    def __init__(self):
+        """Initialize decoder (it waits for a keyframe)"""
+        self.codec = None
+        self.context = None
+        self.synced = False
+    
+    def decode(self, codec, data, keyframe):
+        """
+        Decode one frame
+        
+        Args:
+            codec: Key of CODECS the frame was encoded with
+            data: Compressed frame
+            keyframe: Whether the frame decodes on its own
+        
+        Returns:
+            PIL.Image: Decoded frame (with any padding), or None when it
+            cannot be shown; synced is then False until a keyframe arrives
+        """
+        if codec != self.codec:
+            self.context = av.CodecContext.create(CODECS[codec][1], 'r')
+            self.codec = codec
+            self.synced = False
+        if keyframe:
+            self.synced = True
+        if not self.synced:
+            return None
+        
+        try:
+            frames = self.context.decode(av.Packet(data))
+        except av.error.FFmpegError as e:
+            print(f"Video decode failed, waiting for a keyframe: {e}")
+            self.synced = False
+            return None
+        if not frames:
+            return None
+        return frames[-1].to_image()
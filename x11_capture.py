@@ -0,0 +1,218 @@
+"""
+LiteDesk - X11 Capture Module
+
+Damage-driven screen capture for X11 desktops. Instead of grabbing the
+whole monitor and diffing it to find out what changed, it subscribes to
+the X server's DAMAGE extension, which reports every rectangle drawn to
+since the last grab. Only those rectangles are grabbed (through mss,
+which uses MIT-SHM shared memory when the server offers it) and patched
+into a copy of the previous frame, and they are handed to the encoder so
+it only compares pixels inside them. An idle desktop costs one poll of
+the X connection per frame.
+
+Requires python-xlib (installed with pynput on Linux), NumPy and an X
+server with the DAMAGE extension (Xorg and Xvfb both have it). Anywhere
+else ScreenCapture keeps grabbing the whole monitor through mss.
+"""
+import os
+from collections import namedtuple
+from scroll_detect import bounding_box
+
+try:
+    from Xlib import display as xdisplay
+    from Xlib.error import DisplayError
+    from Xlib.ext import damage
+    XLIB_AVAILABLE = True
+except ImportError:
+    XLIB_AVAILABLE = False
+
+try:
+    import numpy as np
+    NUMPY_AVAILABLE = True
+except ImportError:
+    NUMPY_AVAILABLE = False
+
+
+# Damaged rectangles grabbed one by one; past this they are merged into
+# their bounding box (many tiny grabs cost more than one larger one)
+MAX_RECTS = 32
+
+
+class DamageShot(namedtuple('DamageShot', 'size pixels damage')):
+    """
+    A capture plus the rectangles that changed since the previous one
+    
+    pixels is a (height, width, 3) RGB array; damage lists (x, y, w, h)
+    rectangles outside which it equals the previous capture.
+    """
+    __slots__ = ()
+    
+    @property
+    def rgb(self):
+        """Pixels as a buffer, like an mss screenshot"""
+        return self.pixels.data
+
+
+def clip_rects(rects, width, height):
+    """
+    Clip rectangles to a frame and drop those left empty
+    
+    Args:
+        rects: (x, y, w, h) rectangles
+        width: Frame width
+        height: Frame height
+    
+    Returns:
+        list: Clipped rectangles
+    """
+    clipped = []
+    for x, y, w, h in rects:
+        left, top = max(x, 0), max(y, 0)
+        right, bottom = min(x + w, width), min(y + h, height)
+        if right > left and bottom > top:
+            clipped.append((left, top, right - left, bottom - top))
+    return clipped
+
+
+def merge_rects(rects, max_rects=MAX_RECTS):
+    """
+    Drop rectangles inside others, and merge everything when too many remain
+    
+    Args:
+        rects: (x, y, w, h) rectangles
+        max_rects: Most rectangles to return
+    
+    Returns:
+        list: Rectangles covering at least the same area
+    """
+    kept = []
+    for rect in sorted(set(rects), key=lambda r: r[2] * r[3], reverse=True):
+        x, y, w, h = rect
+        if not any(kx <= x and ky <= y and x + w <= kx + kw and y + h <= ky + kh
+                   for kx, ky, kw, kh in kept):
+            kept.append(rect)
+    if len(kept) > max_rects:
+        return [bounding_box(kept)]
+    return kept
+
+
+class DamageCapture:
+    """Grabs only what the X server reports as drawn to since the last grab"""
+    
+    def __init__(self, sct, monitor, display_name=None):
+        """
+        Initialize capture
+        
+        Args:
+            sct: mss instance used for the grabs
+            monitor: mss monitor dict to capture
+            display_name: X display (default: $DISPLAY)
+        
+        Raises:
+            RuntimeError: No X server with the DAMAGE extension
+        """
+        try:
+            self.display = xdisplay.Display(display_name)
+        except (DisplayError, OSError) as e:
+            raise RuntimeError(f"Cannot open X display: {e}")
+        if not self.display.has_extension('DAMAGE'):
+            self.display.close()
+            raise RuntimeError("X server lacks the DAMAGE extension")
+        self.display.damage_query_version()
+        self.root = self.display.screen().root
+        # Delta rectangles: one event per newly damaged area until subtracted
+        self.damage = self.root.damage_create(damage.DamageReportDeltaRectangles)
+        self.display.flush()
+        
+        self.sct = sct
+        self.monitor = monitor
+        self.frame = None
+        self.full = True
+    
+    def invalidate(self):
+        """Grab the whole monitor next time (after a keyframe request)"""
+        self.full = True
+    
+    def poll(self):
+        """
+        Collect the rectangles damaged since the last poll
+        
+        Returns:
+            list: (x, y, w, h) in monitor coordinates
+        """
+        rects = []
+        while self.display.pending_events():
+            event = self.display.next_event()
+            if isinstance(event, damage.DamageNotify):
+                area = event.area
+                rects.append((area.x - self.monitor['left'], area.y - self.monitor['top'],
+                              area.width, area.height))
+        # Events generated after this still arrive; the region restarts empty
+        self.display.damage_subtract(self.damage)
+        self.display.flush()
+        return rects
+    
+    def grab_rect(self, x, y, w, h):
+        """Grab part of the monitor as a (h, w, 3) RGB array"""
+        shot = self.sct.grab({'left': self.monitor['left'] + x, 'top': self.monitor['top'] + y,
+                              'width': w, 'height': h})
+        # mss grabs BGRA
+        return np.frombuffer(shot.raw, dtype=np.uint8).reshape(h, w, 4)[:, :, 2::-1]
+    
+    def grab(self):
+        """
+        Capture the monitor
+        
+        Returns:
+            DamageShot: The frame and the rectangles that changed in it
+        """
+        width, height = self.monitor['width'], self.monitor['height']
+        rects = self.poll()
+        if self.full or self.frame is None:
+            self.full = False
+            self.frame = np.ascontiguousarray(self.grab_rect(0, 0, width, height))
+            return DamageShot((width, height), self.frame, [(0, 0, width, height)])
+        
+        changed = []
+        frame = self.frame
+        for x, y, w, h in merge_rects(clip_rects(rects, width, height)):
+            pixels = self.grab_rect(x, y, w, h)
+            if np.array_equal(pixels, frame[y:y + h, x:x + w]):
+                continue  # drawn over with the same pixels
+            if frame is self.frame:
+                # Copy on first change: the previous frame is still the
+                # encoder's reference
+                frame = frame.copy()
+            frame[y:y + h, x:x + w] = pixels
+            changed.append((x, y, w, h))
+        self.frame = frame
+        return DamageShot((width, height), frame, changed)
+    
+    def close(self):
+        """Release the damage object and the X connection"""
+        try:
+            self.display.damage_destroy(self.damage)
+            self.display.close()
+        except Exception:
+            pass
+
+
+def create_damage_capture(sct, monitor):
+    """
+    Damage-driven capture for this session, if it can have one
+    
+    Args:
+        sct: mss instance used for the grabs
+        monitor: mss monitor dict to capture
+    
+    Returns:
+        DamageCapture, or None when capture must fall back to whole-monitor
+        mss grabs (no X11 session, no DAMAGE, python-xlib or NumPy missing)
+    """
+    if not (XLIB_AVAILABLE and NUMPY_AVAILABLE) or not os.environ.get('DISPLAY'):
+        return None
+    try:
+        return DamageCapture(sct, monitor)
+    except Exception as e:
+        print(f"X11 damage tracking unavailable, grabbing whole frames: {e}")
+        return None